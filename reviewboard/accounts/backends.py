@@ -3,6 +3,7 @@ import pkg_resources
 import re
 import sre_constants
 import sys
+import threading
 from warnings import warn
 
 from django.conf import settings
@@ -11,7 +12,7 @@ from django.contrib.auth.models import User
 from django.contrib.auth import get_backends
 from django.contrib.auth import hashers
 from django.utils.translation import ugettext as _
-from djblets.util.misc import get_object_or_none
+from djblets.util.misc import cache_memoize, get_object_or_none
 
 from reviewboard.accounts.forms import ActiveDirectorySettingsForm, \
                                        LDAPSettingsForm, \
@@ -298,10 +299,34 @@ class LDAPBackend(AuthBackend):
 
 
 class ActiveDirectoryBackend(AuthBackend):
-    """Authenticate a user against an Active Directory server."""
+    """Authenticate a user against an Active Directory server.
+
+    Connections to domain controllers are kept in a pool and reused for
+    later logins, and the list of domain controllers found through DNS is
+    cached. The groups a user belongs to are cached as well, so that
+    they're only looked up again once they expire.
+    """
     name = _('Active Directory')
     settings_form = ActiveDirectorySettingsForm
 
+    #: The matching rule that searches through nested groups on the server.
+    MATCHING_RULE_IN_CHAIN = '1.2.840.113556.1.4.1941'
+
+    #: The maximum number of groups to look up in a single search.
+    GROUP_SEARCH_BATCH_SIZE = 50
+
+    #: The maximum number of idle connections to keep for each server.
+    MAX_POOLED_CONNECTIONS = 5
+
+    #: How long to cache the groups a user belongs to, in seconds.
+    DEFAULT_GROUP_CACHE_EXPIRATION = 5 * 60
+
+    #: How long to cache the domain controllers found through DNS.
+    DEFAULT_DC_CACHE_EXPIRATION = 60 * 60
+
+    _connection_pool = {}
+    _connection_pool_lock = threading.Lock()
+
     def get_domain_name(self):
         return str(settings.AD_DOMAIN_NAME)
 
@@ -315,11 +340,12 @@ class ActiveDirectoryBackend(AuthBackend):
 
         return ','.join(root)
 
-    def search_ad(self, con, filterstr):
+    def search_ad(self, con, filterstr, attrlist=None):
         import ldap
         search_root = self.get_ldap_search_root()
         logging.debug('Search root ' + search_root)
-        return con.search_s(search_root, scope=ldap.SCOPE_SUBTREE, filterstr=filterstr)
+        return con.search_s(search_root, scope=ldap.SCOPE_SUBTREE,
+                            filterstr=filterstr, attrlist=attrlist)
 
     def find_domain_controllers_from_dns(self):
         import DNS
@@ -328,99 +354,233 @@ class ActiveDirectoryBackend(AuthBackend):
         req = DNS.Base.DnsRequest(q, qtype = 'SRV').req()
         return [x['data'][-2:] for x in req.answers]
 
+    def get_domain_controllers(self):
+        """Returns the domain controllers to try, as (port, host) tuples.
+
+        Domain controllers found through DNS are cached for
+        ``AD_DC_CACHE_EXPIRATION`` seconds.
+        """
+        if settings.AD_FIND_DC_FROM_DNS:
+            return cache_memoize(
+                'ad-domain-controllers-%s' % self.get_domain_name(),
+                self.find_domain_controllers_from_dns,
+                expiration=getattr(settings, 'AD_DC_CACHE_EXPIRATION',
+                                   self.DEFAULT_DC_CACHE_EXPIRATION))
+        else:
+            return [('389', settings.AD_DOMAIN_CONTROLLER)]
+
     def can_recurse(self, depth):
         return (settings.AD_RECURSION_DEPTH == -1 or
                         depth <= settings.AD_RECURSION_DEPTH)
 
+    def get_group_names(self, con, user_data):
+        """Returns the names of all groups the user belongs to.
+
+        When there's no limit on the recursion depth, the server is asked
+        for all of the user's groups, including nested ones, in a single
+        search. Servers that don't support this fall back on
+        get_member_of().
+        """
+        import ldap
+
+        user_dn, data = user_data[0]
+
+        if settings.AD_RECURSION_DEPTH == -1 and user_dn:
+            try:
+                group_data = self.search_ad(
+                    con,
+                    '(&(objectClass=group)(member:%s:=%s))'
+                    % (self.MATCHING_RULE_IN_CHAIN,
+                       self._escape_filter(user_dn)),
+                    attrlist=['cn'])
+            except ldap.LDAPError, e:
+                logging.debug('Active Directory: Unable to search nested '
+                              'groups on the server: %s' % e)
+            else:
+                group_names = set([
+                    self._get_group_name(name)
+                    for name, group_info in group_data
+                    if name is not None
+                ])
+
+                # Servers that don't know about the matching rule find no
+                # groups at all, rather than failing.
+                if group_names or not data.get('memberOf'):
+                    return group_names
+
+        return self.get_member_of(con, user_data)
+
     def get_member_of(self, con, search_results, seen=None, depth=0):
-        depth += 1
+        """Returns the names of the groups in the search results' memberOf.
+
+        Nested groups are looked up one level at a time, with all the new
+        groups in a level found in as few searches as possible.
+        """
         if seen is None:
             seen = set()
 
-        for name, data in search_results:
-            if name is None:
-                continue
-            member_of = data.get('memberOf', [])
-            new_groups = [x.split(',')[0].split('=')[1] for x in member_of]
-            old_seen = seen.copy()
-            seen.update(new_groups)
-
-            # collect groups recursively
-            if self.can_recurse(depth):
-                for group in new_groups:
-                    if group in old_seen:
-                        continue
-
-                    # Search for groups with the specified CN. Use the CN
-                    # rather than The sAMAccountName so that behavior is
-                    # correct when the values differ (e.g. if a
-                    # "pre-Windows 2000" group name is set in AD)
-                    group_data = self.search_ad(
-                        con, '(&(objectClass=group)(cn=%s))' % group)
-                    seen.update(self.get_member_of(con, group_data,
-                                                   seen=seen, depth=depth))
-            else:
+        while search_results:
+            depth += 1
+            new_groups = []
+
+            for name, data in search_results:
+                if name is None:
+                    continue
+
+                for group_dn in data.get('memberOf', []):
+                    group = self._get_group_name(group_dn)
+
+                    if group not in seen:
+                        seen.add(group)
+                        new_groups.append(group)
+
+            if not new_groups:
+                break
+
+            if not self.can_recurse(depth):
                 logging.warning('ActiveDirectory recursive group check '
                                 'reached maximum recursion depth.')
+                break
+
+            search_results = []
+
+            for i in xrange(0, len(new_groups), self.GROUP_SEARCH_BATCH_SIZE):
+                # Search for groups with the specified CN. Use the CN
+                # rather than The sAMAccountName so that behavior is
+                # correct when the values differ (e.g. if a
+                # "pre-Windows 2000" group name is set in AD)
+                batch = new_groups[i:i + self.GROUP_SEARCH_BATCH_SIZE]
+                search_results.extend(self.search_ad(
+                    con,
+                    '(&(objectClass=group)(|%s))'
+                    % ''.join(['(cn=%s)' % self._escape_filter(group_name)
+                               for group_name in batch]),
+                    attrlist=['memberOf']))
 
         return seen
 
-    def get_ldap_connections(self):
+    def open_ldap_connection(self, host, port):
+        """Opens a new connection to a domain controller."""
         import ldap
-        if settings.AD_FIND_DC_FROM_DNS:
-            dcs = self.find_domain_controllers_from_dns()
-        else:
-            dcs = [('389', settings.AD_DOMAIN_CONTROLLER)]
+        con = ldap.open(host, port=int(port))
+        if settings.AD_USE_TLS:
+            con.start_tls_s()
+        con.set_option(ldap.OPT_REFERRALS, 0)
+        return con
 
-        for dc in dcs:
-            port, host = dc
-            con = ldap.open(host, port=int(port))
-            if settings.AD_USE_TLS:
-                con.start_tls_s()
-            con.set_option(ldap.OPT_REFERRALS, 0)
-            yield con
+    def get_ldap_connections(self):
+        for port, host in self.get_domain_controllers():
+            yield self.open_ldap_connection(host, port)
 
     def authenticate(self, username, password):
         import ldap
 
-        connections = self.get_ldap_connections()
         username = username.strip()
-        required_group = settings.AD_GROUP_NAME
 
-        for con in connections:
-            try:
-                bind_username ='%s@%s' % (username, self.get_domain_name())
-                con.simple_bind_s(bind_username, password)
-                user_data = self.search_ad(
-                    con,
-                    '(&(objectClass=user)(sAMAccountName=%s))' % username)
+        for port, host in self.get_domain_controllers():
+            key = (host, int(port))
 
-                if not user_data:
-                    return None
+            try:
+                con = self._get_pooled_connection(key)
 
-                if required_group:
+                if con is not None:
                     try:
-                        group_names = self.get_member_of(con, user_data)
-                    except Exception, e:
-                        logging.error("Active Directory error: failed getting"
-                                      "groups for user '%s': %s" % (username, e))
-                        return None
-
-                    if required_group not in group_names:
-                        logging.warning("Active Directory: User %s is not in required group %s" % (username, required_group))
-                        return None
-
-                return self.get_or_create_user(username, user_data)
+                        return self._authenticate(con, key, username,
+                                                  password)
+                    except ldap.SERVER_DOWN:
+                        # The server may have closed the connection while it
+                        # was idle. Try again with a new one.
+                        pass
+
+                return self._authenticate(self.open_ldap_connection(*key),
+                                          key, username, password)
             except ldap.SERVER_DOWN:
                 logging.warning('Active Directory: Domain controller is down')
                 continue
-            except ldap.INVALID_CREDENTIALS:
-                logging.warning('Active Directory: Failed login for user %s' % username)
-                return None
 
         logging.error('Active Directory error: Could not contact any domain controller servers')
         return None
 
+    def _authenticate(self, con, key, username, password):
+        import ldap
+
+        try:
+            user = self._authenticate_user(con, username, password)
+        except ldap.INVALID_CREDENTIALS:
+            logging.warning('Active Directory: Failed login for user %s' % username)
+            user = None
+
+        self._release_connection(key, con)
+
+        return user
+
+    def _authenticate_user(self, con, username, password):
+        required_group = settings.AD_GROUP_NAME
+
+        bind_username ='%s@%s' % (username, self.get_domain_name())
+        con.simple_bind_s(bind_username, password)
+        user_data = self.search_ad(
+            con,
+            '(&(objectClass=user)(sAMAccountName=%s))' % username)
+
+        if not user_data:
+            return None
+
+        if required_group:
+            try:
+                group_names = cache_memoize(
+                    'ad-groups-%s-%s' % (self.get_domain_name(), username),
+                    lambda: self.get_group_names(con, user_data),
+                    expiration=getattr(settings, 'AD_GROUP_CACHE_EXPIRATION',
+                                       self.DEFAULT_GROUP_CACHE_EXPIRATION))
+            except Exception, e:
+                logging.error("Active Directory error: failed getting"
+                              "groups for user '%s': %s" % (username, e))
+                return None
+
+            if required_group not in group_names:
+                logging.warning("Active Directory: User %s is not in required group %s" % (username, required_group))
+                return None
+
+        return self.get_or_create_user(username, user_data)
+
+    def _get_pooled_connection(self, key):
+        self._connection_pool_lock.acquire()
+
+        try:
+            connections = self._connection_pool.get(key)
+
+            if connections:
+                return connections.pop()
+
+            return None
+        finally:
+            self._connection_pool_lock.release()
+
+    def _release_connection(self, key, con):
+        self._connection_pool_lock.acquire()
+
+        try:
+            connections = self._connection_pool.setdefault(key, [])
+
+            if len(connections) < self.MAX_POOLED_CONNECTIONS:
+                connections.append(con)
+                return
+        finally:
+            self._connection_pool_lock.release()
+
+        try:
+            con.unbind_s()
+        except Exception:
+            pass
+
+    def _get_group_name(self, group_dn):
+        return group_dn.split(',')[0].split('=')[1]
+
+    def _escape_filter(self, value):
+        from ldap.filter import escape_filter_chars
+        return escape_filter_chars(value)
+
     def get_or_create_user(self, username, ad_user_data):
         username = username.strip()
 
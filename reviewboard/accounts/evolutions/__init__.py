@@ -2,4 +2,5 @@ SEQUENCE = [
     'is_private',
     'timezone',
     'open_an_issue',
+    'email_digest',
 ]
@@ -26,6 +26,8 @@ class PreferencesForm(forms.Form):
         label=_("Keep your user profile private"))
     open_an_issue = forms.BooleanField(required=False,
         label=_("Always open an issue when comment box opens"))
+    email_digest = forms.BooleanField(required=False,
+        label=_("Combine e-mails about each review request into digests"))
     first_name = forms.CharField(required=False)
     last_name = forms.CharField(required=False)
     email = forms.EmailField()
@@ -84,6 +86,7 @@ class PreferencesForm(forms.Form):
         profile.syntax_highlighting = self.cleaned_data['syntax_highlighting']
         profile.is_private = self.cleaned_data['profile_private']
         profile.open_an_issue = self.cleaned_data['open_an_issue']
+        profile.email_digest = self.cleaned_data['email_digest']
         profile.timezone = self.cleaned_data['timezone']
         profile.save()
 
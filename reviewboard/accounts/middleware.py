@@ -1,15 +1,13 @@
 import pytz
 from django.utils import timezone
 
-from reviewboard.accounts.models import Profile
+from reviewboard.admin.snapshot import get_request_snapshot
 
 
 class TimezoneMiddleware(object):
     """Middleware that activates the user's local timezone"""
     def process_request(self, request):
-        if request.user.is_authenticated():
-            try:
-                user = Profile.objects.get(user=request.user)
-                timezone.activate(pytz.timezone(user.timezone))
-            except Profile.DoesNotExist:
-                pass
+        profile = get_request_snapshot(request).profile
+
+        if profile is not None:
+            timezone.activate(pytz.timezone(profile.timezone))
@@ -65,6 +65,11 @@ class Profile(models.Model):
         verbose_name=_("opens an issue"),
         help_text=_("Indicates whether the user wishes to default "
                     "to opening an issue or not."))
+    email_digest = models.BooleanField(default=False,
+        verbose_name=_("e-mail digest"),
+        help_text=_("Indicates whether the user wishes to receive e-mail "
+                    "about review requests as periodic digests, instead "
+                    "of one e-mail for each change."))
 
     # Indicate whether submitted review requests should appear in the
     # review request lists (excluding the dashboard).
@@ -104,6 +109,8 @@ class Profile(models.Model):
         This will mark a review request as starred for this user and
         immediately save to the database.
         """
+        from reviewboard.reviews.datagrids import invalidate_sidebar_counts
+
         self.starred_review_requests.add(review_request)
 
         if (review_request.public and
@@ -118,6 +125,7 @@ class Profile(models.Model):
 
             site_profile.increment_starred_public_request_count()
 
+        invalidate_sidebar_counts(review_request.local_site)
         self.save()
 
     def unstar_review_request(self, review_request):
@@ -126,6 +134,8 @@ class Profile(models.Model):
         This will mark a review request as starred for this user and
         immediately save to the database.
         """
+        from reviewboard.reviews.datagrids import invalidate_sidebar_counts
+
         q = self.starred_review_requests.filter(pk=review_request.pk)
 
         if q.count() > 0:
@@ -143,6 +153,7 @@ class Profile(models.Model):
 
             site_profile.decrement_starred_public_request_count()
 
+        invalidate_sidebar_counts(review_request.local_site)
         self.save()
 
     def star_review_group(self, review_group):
@@ -151,8 +162,11 @@ class Profile(models.Model):
         This will mark a review group as starred for this user and
         immediately save to the database.
         """
+        from reviewboard.reviews.datagrids import invalidate_sidebar_counts
+
         if self.starred_groups.filter(pk=review_group.pk).count() == 0:
             self.starred_groups.add(review_group)
+            invalidate_sidebar_counts(review_group.local_site)
 
     def unstar_review_group(self, review_group):
         """Marks a review group as unstarred.
@@ -160,8 +174,11 @@ class Profile(models.Model):
         This will mark a review group as starred for this user and
         immediately save to the database.
         """
+        from reviewboard.reviews.datagrids import invalidate_sidebar_counts
+
         if self.starred_groups.filter(pk=review_group.pk).count() > 0:
             self.starred_groups.remove(review_group)
+            invalidate_sidebar_counts(review_group.local_site)
 
     def __unicode__(self):
         return self.user.username
@@ -1,7 +1,14 @@
+import re
+import sys
+import types
+
 from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.test.utils import override_settings
 from djblets.testing.decorators import add_fixtures
 from djblets.testing.testcases import TestCase
 
+from reviewboard.accounts.backends import ActiveDirectoryBackend
 from reviewboard.accounts.models import LocalSiteProfile
 from reviewboard.reviews.models import ReviewRequest
 
@@ -54,3 +61,269 @@ class ProfileTests(TestCase):
         self.assertFalse(review_request in
                          profile1.starred_review_requests.all())
         self.assertEqual(site_profile.starred_public_request_count, 0)
+
+
+class FakeLDAPError(Exception):
+    pass
+
+
+class FakeLDAPServerDown(FakeLDAPError):
+    pass
+
+
+class FakeLDAPInvalidCredentials(FakeLDAPError):
+    pass
+
+
+class FakeLDAPConnection(object):
+    """A connection to a fake Active Directory server.
+
+    This only understands the searches made by ActiveDirectoryBackend.
+    """
+    def __init__(self, server):
+        self.server = server
+        self.bound_as = None
+        self.closed = False
+
+    def set_option(self, option, value):
+        pass
+
+    def start_tls_s(self):
+        pass
+
+    def simple_bind_s(self, who, cred):
+        if self.closed:
+            raise FakeLDAPServerDown()
+
+        if self.server.passwords.get(who) != cred:
+            raise FakeLDAPInvalidCredentials()
+
+        self.bound_as = who
+
+    def unbind_s(self):
+        self.closed = True
+
+    def search_s(self, base, scope, filterstr, attrlist=None):
+        self.server.searches.append(filterstr)
+
+        m = re.search(r'\(sAMAccountName=([^)]*)\)', filterstr)
+
+        if m:
+            username = m.group(1)
+
+            if username in self.server.users:
+                return [self.server.users[username]]
+
+            return []
+
+        m = re.search(r'\(member:1.2.840.113556.1.4.1941:=([^)]*)\)',
+                      filterstr)
+
+        if m:
+            if not self.server.supports_in_chain:
+                return []
+
+            for dn, data in self.server.users.itervalues():
+                if dn == m.group(1):
+                    return self._get_nested_groups(data)
+
+            return []
+
+        return [self.server.groups[cn]
+                for cn in re.findall(r'\(cn=([^)]*)\)', filterstr)
+                if cn in self.server.groups]
+
+    def _get_nested_groups(self, data):
+        results = []
+        pending = list(data.get('memberOf', []))
+
+        while pending:
+            group_dn = pending.pop()
+            group = self.server.groups[group_dn.split(',')[0][3:]]
+
+            if group not in results:
+                results.append(group)
+                pending.extend(group[1].get('memberOf', []))
+
+        return results
+
+
+class FakeADServer(object):
+    def __init__(self):
+        self.users = {}
+        self.groups = {}
+        self.passwords = {}
+        self.searches = []
+        self.connections = []
+        self.supports_in_chain = True
+
+    def add_user(self, username, password, groups):
+        dn = 'CN=%s,CN=Users,DC=example,DC=com' % username
+        self.users[username] = (dn, {
+            'sAMAccountName': [username],
+            'memberOf': [self._get_group_dn(group) for group in groups],
+        })
+        self.passwords['%s@example.com' % username] = password
+
+    def add_group(self, name, groups=[]):
+        self.groups[name] = (self._get_group_dn(name), {
+            'cn': [name],
+            'memberOf': [self._get_group_dn(group) for group in groups],
+        })
+
+    def open(self, host, port=389):
+        con = FakeLDAPConnection(self)
+        self.connections.append(con)
+
+        return con
+
+    def _get_group_dn(self, name):
+        return 'CN=%s,CN=Groups,DC=example,DC=com' % name
+
+
+@override_settings(AD_DOMAIN_NAME='example.com',
+                   AD_USE_TLS=False,
+                   AD_FIND_DC_FROM_DNS=False,
+                   AD_DOMAIN_CONTROLLER='dc.example.com',
+                   AD_OU_NAME='',
+                   AD_SEARCH_ROOT='',
+                   AD_GROUP_NAME='reviewers',
+                   AD_RECURSION_DEPTH=-1)
+class ActiveDirectoryBackendTests(TestCase):
+    """Unit tests for ActiveDirectoryBackend."""
+    def setUp(self):
+        self.server = FakeADServer()
+        self.server.add_group('reviewers')
+        self.server.add_group('developers', ['reviewers'])
+        self.server.add_group('ui', ['developers'])
+        self.server.add_group('backend', ['developers'])
+        self.server.add_user('doc', 'secret', ['ui', 'backend'])
+
+        ldap = types.ModuleType('ldap')
+        ldap.SCOPE_SUBTREE = 2
+        ldap.OPT_REFERRALS = 8
+        ldap.LDAPError = FakeLDAPError
+        ldap.SERVER_DOWN = FakeLDAPServerDown
+        ldap.INVALID_CREDENTIALS = FakeLDAPInvalidCredentials
+        ldap.open = self.server.open
+
+        ldap.filter = types.ModuleType('ldap.filter')
+        ldap.filter.escape_filter_chars = lambda value: value
+
+        self._old_modules = dict([
+            (name, sys.modules.get(name))
+            for name in ('ldap', 'ldap.filter')
+        ])
+        sys.modules['ldap'] = ldap
+        sys.modules['ldap.filter'] = ldap.filter
+
+        ActiveDirectoryBackend._connection_pool.clear()
+        cache.clear()
+
+    def tearDown(self):
+        for name, module in self._old_modules.iteritems():
+            if module is None:
+                del sys.modules[name]
+            else:
+                sys.modules[name] = module
+
+        ActiveDirectoryBackend._connection_pool.clear()
+
+    def test_authenticate_with_nested_groups(self):
+        """Testing ActiveDirectoryBackend.authenticate with nested groups"""
+        user = ActiveDirectoryBackend().authenticate('doc', 'secret')
+        self.assertNotEqual(user, None)
+        self.assertEqual(user.username, 'doc')
+
+        # The user, and all of their groups.
+        self.assertEqual(len(self.server.searches), 2)
+
+    def test_authenticate_without_in_chain(self):
+        """Testing ActiveDirectoryBackend.authenticate with nested groups on
+        servers without LDAP_MATCHING_RULE_IN_CHAIN
+        """
+        self.server.supports_in_chain = False
+
+        user = ActiveDirectoryBackend().authenticate('doc', 'secret')
+        self.assertNotEqual(user, None)
+
+        # The user, the failed search for all groups, and then one search
+        # for each level of nested groups.
+        self.assertEqual(len(self.server.searches), 5)
+        self.assertTrue('(cn=ui)' in self.server.searches[2])
+        self.assertTrue('(cn=backend)' in self.server.searches[2])
+        self.assertTrue('(cn=developers)' in self.server.searches[3])
+        self.assertTrue('(cn=reviewers)' in self.server.searches[4])
+
+    def test_get_member_of_with_depth(self):
+        """Testing ActiveDirectoryBackend.get_member_of with a recursion
+        depth
+        """
+        backend = ActiveDirectoryBackend()
+        con = self.server.open('dc.example.com')
+        user_data = con.search_s('', 2, '(sAMAccountName=doc)')
+
+        with self.settings(AD_RECURSION_DEPTH=1):
+            self.assertEqual(backend.get_member_of(con, user_data),
+                             set(['ui', 'backend', 'developers']))
+
+        with self.settings(AD_RECURSION_DEPTH=2):
+            self.assertEqual(backend.get_member_of(con, user_data),
+                             set(['ui', 'backend', 'developers',
+                                  'reviewers']))
+
+    def test_authenticate_not_in_required_group(self):
+        """Testing ActiveDirectoryBackend.authenticate with a user not in
+        the required group
+        """
+        self.server.add_user('grumpy', 'grumpy', ['ui-contractors'])
+        self.server.add_group('ui-contractors')
+
+        self.assertEqual(
+            ActiveDirectoryBackend().authenticate('grumpy', 'grumpy'), None)
+
+    def test_authenticate_reuses_connections_and_groups(self):
+        """Testing ActiveDirectoryBackend.authenticate reusing connections
+        and cached groups
+        """
+        self.assertEqual(
+            ActiveDirectoryBackend().authenticate('doc', 'wrong'), None)
+        self.assertNotEqual(
+            ActiveDirectoryBackend().authenticate('doc', 'secret'), None)
+        self.assertNotEqual(
+            ActiveDirectoryBackend().authenticate('doc', 'secret'), None)
+
+        self.assertEqual(len(self.server.connections), 1)
+
+        # The groups are only searched for on the first successful login.
+        self.assertEqual(len(self.server.searches), 3)
+
+    def test_authenticate_with_closed_connection(self):
+        """Testing ActiveDirectoryBackend.authenticate with a pooled
+        connection that was closed by the server
+        """
+        ActiveDirectoryBackend().authenticate('doc', 'secret')
+        self.server.connections[0].closed = True
+
+        self.assertNotEqual(
+            ActiveDirectoryBackend().authenticate('doc', 'secret'), None)
+        self.assertEqual(len(self.server.connections), 2)
+
+    @override_settings(AD_FIND_DC_FROM_DNS=True)
+    def test_domain_controllers_cached(self):
+        """Testing ActiveDirectoryBackend caching domain controllers found
+        through DNS
+        """
+        lookups = []
+
+        def find_domain_controllers_from_dns():
+            lookups.append(1)
+            return [('389', 'dc1.example.com')]
+
+        for i in range(2):
+            backend = ActiveDirectoryBackend()
+            backend.find_domain_controllers_from_dns = \
+                find_domain_controllers_from_dns
+            self.assertNotEqual(backend.authenticate('doc', 'secret'), None)
+
+        self.assertEqual(len(lookups), 1)
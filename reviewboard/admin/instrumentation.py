@@ -0,0 +1,475 @@
+"""Per-view instrumentation.
+
+While a request is being handled, InstrumentationMiddleware keeps a
+ViewStats for it, which records the SQL queries, cache operations and SCM
+calls made along the way. Queries are only counted and timed, unless
+``settings.INSTRUMENTATION_CAPTURE_QUERIES`` is set, in which case their SQL
+is kept as well. Once the response is built, the stats are added to
+a rolling aggregate of the last few requests for each view, which is shown
+in the Administration Dashboard.
+
+The aggregate is kept in memory, so each server process has its own.
+"""
+import threading
+import time
+from collections import deque
+
+from django.conf import settings
+from django.core.cache import cache
+from django.core.signals import request_finished
+from django.db import connection
+from django.db.backends import BaseDatabaseWrapper, util
+from django.test.utils import override_settings
+
+
+#: The number of requests to keep stats for, for each view.
+MAX_SAMPLES = 100
+
+STAT_FIELDS = (
+    'num_queries',
+    'query_time',
+    'num_cache_gets',
+    'num_cache_sets',
+    'cache_bytes_read',
+    'cache_bytes_written',
+    'num_scm_calls',
+    'scm_time',
+    'render_time',
+)
+
+_local = threading.local()
+_samples = {}
+_samples_lock = threading.Lock()
+
+
+class ViewStats(object):
+    """The work done while handling a request.
+
+    ``queries`` holds the SQL queries that were run, if
+    ``settings.INSTRUMENTATION_CAPTURE_QUERIES`` is set. Otherwise, it's
+    empty, and the queries are only counted.
+    """
+    def __init__(self, view_name=None):
+        self.view_name = view_name
+        self.queries = []
+        self.capture_queries = getattr(settings,
+                                       'INSTRUMENTATION_CAPTURE_QUERIES',
+                                       False)
+
+        for field in STAT_FIELDS:
+            setattr(self, field, 0)
+
+        self._start_time = time.time()
+        self._stopped = False
+
+        if self.capture_queries:
+            self._start_num_queries = len(connection.queries)
+            self._old_use_debug_cursor = connection.use_debug_cursor
+
+            # Django only records queries when DEBUG is on, unless asked to.
+            connection.use_debug_cursor = True
+
+    def finish(self):
+        """Stops recording, and computes the totals."""
+        try:
+            self.render_time = time.time() - self._start_time
+
+            if self.capture_queries:
+                self.queries = connection.queries[self._start_num_queries:]
+                self.num_queries = len(self.queries)
+                self.query_time = sum([float(query['time'])
+                                       for query in self.queries])
+        finally:
+            self.stop()
+
+    def stop(self):
+        """Stops recording, without computing the totals.
+
+        This puts back the database connection's settings. It's safe to
+        call more than once.
+        """
+        if not self._stopped:
+            self._stopped = True
+
+            if self.capture_queries:
+                connection.use_debug_cursor = self._old_use_debug_cursor
+
+
+def start():
+    """Starts recording stats for the current thread.
+
+    The new ViewStats is returned.
+    """
+    _abandon_current()
+
+    stats = ViewStats()
+    _local.current = stats
+
+    return stats
+
+
+def finish():
+    """Stops recording stats for the current thread.
+
+    The finished ViewStats is returned, or None if nothing was being
+    recorded. If it has a view name, it's added to the aggregate.
+    """
+    stats = getattr(_local, 'current', None)
+
+    if stats is None:
+        return None
+
+    _local.current = None
+    stats.finish()
+    _local.last = stats
+
+    if stats.view_name:
+        _add_sample(stats)
+
+    return stats
+
+
+def _abandon_current(**kwargs):
+    """Stops recording stats that were never finished.
+
+    This happens when a request fails before InstrumentationMiddleware can
+    finish its stats. Nothing is added to the aggregate.
+    """
+    stats = getattr(_local, 'current', None)
+
+    if stats is not None:
+        _local.current = None
+        stats.stop()
+
+
+request_finished.connect(_abandon_current,
+                         dispatch_uid='instrumentation-abandon-current')
+
+
+def get_current():
+    """Returns the ViewStats being recorded for the current thread."""
+    return getattr(_local, 'current', None)
+
+
+def get_last():
+    """Returns the ViewStats last finished in the current thread."""
+    return getattr(_local, 'last', None)
+
+
+def get_view_name(view_func):
+    """Returns the name that stats for a view are recorded under.
+
+    This is the module and name of the view function, or the module and
+    class name for views that are callable objects, such as API resources.
+    """
+    name = getattr(view_func, '__name__', None)
+
+    if name is None:
+        cls = type(view_func)
+
+        return '%s.%s' % (cls.__module__, cls.__name__)
+
+    # Decorators usually copy the name of the function they wrap, but not
+    # its module, so look for the original function.
+    func = view_func
+
+    while getattr(func, 'func_closure', None):
+        for cell in func.func_closure:
+            contents = cell.cell_contents
+
+            if (callable(contents) and
+                getattr(contents, '__name__', None) == name):
+                func = contents
+                break
+        else:
+            break
+
+    return '%s.%s' % (func.__module__, name)
+
+
+def get_view_summaries():
+    """Returns a summary of the recorded stats for each view.
+
+    Each summary is a dictionary containing the ``view_name``, the number of
+    ``requests`` recorded, and an ``avg_`` and ``max_`` value for each of
+    the stats. Times are in milliseconds. The slowest views come first.
+    """
+    _samples_lock.acquire()
+
+    try:
+        items = [(view_name, list(samples))
+                 for view_name, samples in _samples.iteritems()]
+    finally:
+        _samples_lock.release()
+
+    summaries = []
+
+    for view_name, samples in items:
+        summary = {
+            'view_name': view_name,
+            'requests': len(samples),
+        }
+
+        for i, field in enumerate(STAT_FIELDS):
+            values = [sample[i] for sample in samples]
+
+            if field.endswith('_time'):
+                values = [value * 1000 for value in values]
+
+            summary['avg_' + field] = float(sum(values)) / len(values)
+            summary['max_' + field] = max(values)
+
+        summaries.append(summary)
+
+    summaries.sort(key=lambda summary: summary['avg_render_time'],
+                   reverse=True)
+
+    return summaries
+
+
+def reset():
+    """Clears all recorded stats."""
+    _samples_lock.acquire()
+
+    try:
+        _samples.clear()
+    finally:
+        _samples_lock.release()
+
+
+def _add_sample(stats):
+    sample = tuple([getattr(stats, field) for field in STAT_FIELDS])
+
+    _samples_lock.acquire()
+
+    try:
+        if stats.view_name not in _samples:
+            _samples[stats.view_name] = deque(maxlen=MAX_SAMPLES)
+
+        _samples[stats.view_name].append(sample)
+    finally:
+        _samples_lock.release()
+
+
+def instrument_scm_call(func):
+    """Records calls to a function as SCM calls.
+
+    The number of calls and the time spent in them are added to the
+    current ViewStats.
+    """
+    def _wrapper(*args, **kwargs):
+        stats = get_current()
+
+        if stats is None:
+            return func(*args, **kwargs)
+
+        start_time = time.time()
+
+        try:
+            return func(*args, **kwargs)
+        finally:
+            stats.num_scm_calls += 1
+            stats.scm_time += time.time() - start_time
+
+    _wrapper.__name__ = func.__name__
+    _wrapper.__doc__ = func.__doc__
+
+    return _wrapper
+
+
+class _CountingCursorWrapper(util.CursorWrapper):
+    """A cursor wrapper that counts and times queries.
+
+    This is used in place of Django's CursorWrapper, and only adds to the
+    current ViewStats. Unlike CursorDebugWrapper, it doesn't format or keep
+    the SQL, so it's cheap enough to use for every request.
+    """
+    def execute(self, sql, params=()):
+        self.set_dirty()
+
+        return _count_query(self.cursor.execute, sql, params)
+
+    def executemany(self, sql, param_list):
+        self.set_dirty()
+
+        return _count_query(self.cursor.executemany, sql, param_list)
+
+
+def _count_query(func, sql, params):
+    stats = get_current()
+
+    if stats is None:
+        return func(sql, params)
+
+    start_time = time.time()
+
+    try:
+        return func(sql, params)
+    finally:
+        stats.num_queries += 1
+        stats.query_time += time.time() - start_time
+
+
+def _instrument_queries():
+    """Counts the queries run on every database connection.
+
+    Database backends look up CursorWrapper from this module each time a
+    cursor is made, so replacing it here covers every connection.
+
+    When ``settings.DEBUG`` is on, or a connection's ``use_debug_cursor`` is
+    set, a CursorDebugWrapper is made instead. Other code (such as djblets'
+    logging middleware) may replace that class with its own, so rather than
+    replacing it, the debug cursor is wrapped in a counting cursor.
+    """
+    if not issubclass(util.CursorWrapper, _CountingCursorWrapper):
+        util.CursorWrapper = _CountingCursorWrapper
+
+    if getattr(BaseDatabaseWrapper, '_rb_instrumented', False):
+        return
+
+    make_debug_cursor = BaseDatabaseWrapper.make_debug_cursor
+
+    def _make_debug_cursor(self, cursor):
+        return _CountingCursorWrapper(make_debug_cursor(self, cursor), self)
+
+    BaseDatabaseWrapper.make_debug_cursor = _make_debug_cursor
+    BaseDatabaseWrapper._rb_instrumented = True
+
+
+def _get_value_size(value):
+    # Only strings are counted. Those make up most of the data that's worth
+    # measuring, such as the large data stored by cache_memoize, and other
+    # values would have to be pickled a second time just to measure them.
+    if isinstance(value, basestring):
+        return len(value)
+
+    return 0
+
+
+def _instrument_cache():
+    """Records operations on the default cache backend.
+
+    This wraps the methods on the cache object itself, so that code which
+    imported it beforehand is recorded as well.
+    """
+    if getattr(cache, '_rb_instrumented', False):
+        return
+
+    cache_get = cache.get
+    cache_get_many = cache.get_many
+    cache_set = cache.set
+    cache_set_many = cache.set_many
+    cache_add = cache.add
+
+    def _get(key, *args, **kwargs):
+        value = cache_get(key, *args, **kwargs)
+        stats = get_current()
+
+        if stats is not None:
+            stats.num_cache_gets += 1
+            stats.cache_bytes_read += _get_value_size(value)
+
+        return value
+
+    def _get_many(keys, *args, **kwargs):
+        stats = get_current()
+
+        if stats is None:
+            return cache_get_many(keys, *args, **kwargs)
+
+        # Some backends implement get_many() using get(), so anything it
+        # records is replaced here.
+        num_cache_gets = stats.num_cache_gets
+        cache_bytes_read = stats.cache_bytes_read
+
+        values = cache_get_many(keys, *args, **kwargs)
+
+        stats.num_cache_gets = num_cache_gets + len(keys)
+        stats.cache_bytes_read = cache_bytes_read + sum([
+            _get_value_size(value)
+            for value in values.itervalues()
+        ])
+
+        return values
+
+    def _set(key, value, *args, **kwargs):
+        stats = get_current()
+
+        if stats is not None:
+            stats.num_cache_sets += 1
+            stats.cache_bytes_written += _get_value_size(value)
+
+        return cache_set(key, value, *args, **kwargs)
+
+    def _set_many(data, *args, **kwargs):
+        stats = get_current()
+
+        if stats is None:
+            return cache_set_many(data, *args, **kwargs)
+
+        # As with get_many(), set_many() may be implemented using set().
+        num_cache_sets = stats.num_cache_sets
+        cache_bytes_written = stats.cache_bytes_written
+
+        try:
+            return cache_set_many(data, *args, **kwargs)
+        finally:
+            stats.num_cache_sets = num_cache_sets + len(data)
+            stats.cache_bytes_written = cache_bytes_written + sum([
+                _get_value_size(value)
+                for value in data.itervalues()
+            ])
+
+    def _add(key, value, *args, **kwargs):
+        stats = get_current()
+
+        if stats is not None:
+            stats.num_cache_sets += 1
+            stats.cache_bytes_written += _get_value_size(value)
+
+        return cache_add(key, value, *args, **kwargs)
+
+    cache.get = _get
+    cache.get_many = _get_many
+    cache.set = _set
+    cache.set_many = _set_many
+    cache.add = _add
+    cache._rb_instrumented = True
+
+
+_instrument_cache()
+_instrument_queries()
+
+
+class QueryBudgetTestMixin(object):
+    """A mixin for test cases that checks how much work views do.
+
+    This requires InstrumentationMiddleware, which is enabled by default.
+    """
+    def assertQueryBudget(self, url, max_queries, data={}):
+        """Fetches a URL, and checks the number of queries its view ran.
+
+        The URL is fetched twice, and only the second request is checked,
+        so that work done only once, such as loading extensions or filling
+        the cache, isn't counted. The queries run by middleware are
+        included, and are listed if the budget is exceeded. The response is
+        returned.
+        """
+        self.client.get(url, data)
+
+        with override_settings(INSTRUMENTATION_CAPTURE_QUERIES=True):
+            response = self.client.get(url, data)
+
+        stats = get_last()
+
+        self.assertNotEqual(stats, None,
+                            'No stats were recorded for %s' % url)
+
+        if stats.num_queries > max_queries:
+            self.fail('%s ran %d queries for %s, over its budget of %d:\n%s'
+                      % (stats.view_name, stats.num_queries, url,
+                         max_queries,
+                         '\n'.join([query['sql']
+                                    for query in stats.queries])))
+
+        return response
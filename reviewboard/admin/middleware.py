@@ -3,6 +3,8 @@ import os
 
 from django.conf import settings
 from django.contrib import auth
+from django.middleware import http
+from djblets.siteconfig.models import SiteConfiguration
 
 try:
     from django.core.handlers.modpython import ModPythonRequest
@@ -18,8 +20,10 @@ except ImportError:
 
 
 from reviewboard import initialize
+from reviewboard.admin import instrumentation
 from reviewboard.admin.checks import check_updates_required
 from reviewboard.admin.siteconfig import load_site_config
+from reviewboard.admin.snapshot import RequestSnapshot
 from reviewboard.admin.views import manual_updates_required
 
 
@@ -35,13 +39,55 @@ class InitReviewBoardMiddleware(object):
             self._initialized = True
 
 
+class ConditionalGetMiddleware(http.ConditionalGetMiddleware):
+    """Handles conditional GET requests without reading streamed responses.
+
+    Django's ConditionalGetMiddleware computes a Content-Length for every
+    response, which reads the entire content of responses built from
+    iterators. That defeats the purpose of streaming large responses (such
+    as raw diffs), so those are left without a Content-Length.
+    """
+    def process_response(self, request, response):
+        if (response._base_content_is_iter and
+            not response.has_header('Content-Length')):
+            # Prevent the parent class from computing the length.
+            response['Content-Length'] = ''
+            response = super(ConditionalGetMiddleware, self).process_response(
+                request, response)
+            del response['Content-Length']
+
+            return response
+
+        return super(ConditionalGetMiddleware, self).process_response(
+            request, response)
+
+
 class LoadSettingsMiddleware(object):
     """
     Middleware that loads the settings on each request.
+
+    The settings are only loaded again when the site configuration has
+    changed. SettingsMiddleware replaces the cached SiteConfiguration
+    whenever it's saved, so a new object means new settings.
+
+    This also stores a RequestSnapshot for the request in
+    ``request.snapshot``.
     """
+    def __init__(self):
+        self._loaded_siteconfig = None
+
     def process_request(self, request):
-        # Load all site settings.
-        load_site_config()
+        try:
+            siteconfig = SiteConfiguration.objects.get_current()
+        except SiteConfiguration.DoesNotExist:
+            siteconfig = None
+
+        if siteconfig is None or siteconfig is not self._loaded_siteconfig:
+            # Load all site settings.
+            load_site_config()
+            self._loaded_siteconfig = siteconfig
+
+        request.snapshot = RequestSnapshot(request, siteconfig)
 
 
 class CheckUpdatesRequiredMiddleware(object):
@@ -110,3 +156,36 @@ class X509AuthMiddleware(object):
                     auth.login(request, user)
 
         return None
+
+
+class InstrumentationMiddleware(object):
+    """
+    Middleware that records the work done for each view.
+
+    The SQL queries, cache operations, SCM calls and time taken for each
+    request are added to the stats for its view. See
+    :py:mod:`reviewboard.admin.instrumentation`.
+
+    This should come before other middleware, so that their work is
+    included.
+    """
+    def process_request(self, request):
+        instrumentation.start()
+
+    def process_view(self, request, view_func, view_args, view_kwargs):
+        stats = instrumentation.get_current()
+
+        if stats is not None:
+            stats.view_name = instrumentation.get_view_name(view_func)
+
+    def process_response(self, request, response):
+        stats = instrumentation.finish()
+
+        if stats is not None and stats.view_name:
+            logging.debug('%s ran %d queries (%.2fms) and %d SCM calls in '
+                          '%.2fms for %s'
+                          % (stats.view_name, stats.num_queries,
+                             stats.query_time * 1000, stats.num_scm_calls,
+                             stats.render_time * 1000, request.path))
+
+        return response
@@ -0,0 +1,86 @@
+from djblets.siteconfig.models import SiteConfiguration
+
+from reviewboard.accounts.models import Profile
+
+
+class RequestSnapshot(object):
+    """The settings and profiles used while handling a request.
+
+    Middleware, views and template tags all need the site configuration
+    and the user's profiles. A snapshot is created for each request by
+    LoadSettingsMiddleware and stored as ``request.snapshot``, so that these
+    are looked up at most once per request.
+
+    The user's Profile is fetched through ``request.user.get_profile()``,
+    which caches it on the user, so code that calls that directly shares the
+    same Profile.
+    """
+    def __init__(self, request, siteconfig=None):
+        self.request = request
+
+        if siteconfig is None:
+            try:
+                siteconfig = SiteConfiguration.objects.get_current()
+            except SiteConfiguration.DoesNotExist:
+                # The site hasn't been set up yet.
+                pass
+
+        self.siteconfig = siteconfig
+        self._site_profiles = {}
+
+    @property
+    def profile(self):
+        """The user's Profile.
+
+        This is None if the user is anonymous or doesn't have a Profile yet.
+        """
+        user = self.request.user
+
+        if not user.is_authenticated():
+            return None
+
+        try:
+            return user.get_profile()
+        except Profile.DoesNotExist:
+            return None
+
+    def get_local_site_profile(self, local_site):
+        """Returns the user's LocalSiteProfile for a LocalSite.
+
+        The LocalSiteProfile is created if it doesn't exist. This returns
+        None if the user doesn't have a Profile.
+        """
+        key = local_site and local_site.pk
+
+        if key not in self._site_profiles:
+            profile = self.profile
+
+            if profile is None:
+                return None
+
+            site_profile, is_new = profile.site_profiles.get_or_create(
+                local_site=local_site,
+                user=self.request.user,
+                profile=profile)
+
+            if is_new:
+                site_profile.save()
+
+            self._site_profiles[key] = site_profile
+
+        return self._site_profiles[key]
+
+
+def get_request_snapshot(request):
+    """Returns the RequestSnapshot for a request.
+
+    A snapshot is created if the request doesn't have one yet, such as when
+    LoadSettingsMiddleware hasn't run.
+    """
+    snapshot = getattr(request, 'snapshot', None)
+
+    if snapshot is None:
+        snapshot = RequestSnapshot(request)
+        request.snapshot = snapshot
+
+    return snapshot
@@ -1,9 +1,19 @@
 from django.conf import settings
+from django.contrib.auth.models import AnonymousUser, User
+from django.core.cache import cache
+from django.core.signals import request_finished
+from django.db import connection
 from django.forms import ValidationError
 from django.test import TestCase
+from django.test.client import RequestFactory
+from django.test.utils import override_settings
 from djblets.siteconfig.models import SiteConfiguration
 
-from reviewboard.admin import checks
+from reviewboard.accounts.middleware import TimezoneMiddleware
+from reviewboard.admin import checks, instrumentation, middleware
+from reviewboard.admin.middleware import LoadSettingsMiddleware
+from reviewboard.admin.snapshot import get_request_snapshot
+from reviewboard.admin.widgets import ViewPerformanceWidget
 from reviewboard.admin.validation import validate_bug_tracker
 
 
@@ -73,3 +83,211 @@ class ValidatorTests(TestCase):
             self.assertFalse(True, "validate_bug_tracker() raised a "
                                    "ValidationError when no error was "
                                    "expected.")
+
+
+class RequestSnapshotTests(TestCase):
+    """Unit tests for RequestSnapshot and LoadSettingsMiddleware."""
+    fixtures = ['test_users']
+
+    def setUp(self):
+        self._old_load_site_config = middleware.load_site_config
+        self.factory = RequestFactory()
+
+    def tearDown(self):
+        middleware.load_site_config = self._old_load_site_config
+
+    def test_load_settings_when_changed(self):
+        """Testing LoadSettingsMiddleware only loading changed settings"""
+        calls = []
+
+        def _load_site_config():
+            calls.append(1)
+            self._old_load_site_config()
+
+        middleware.load_site_config = _load_site_config
+        settings_middleware = LoadSettingsMiddleware()
+
+        for i in range(3):
+            request = self._get_request()
+            settings_middleware.process_request(request)
+            self.assertEqual(request.snapshot.siteconfig,
+                             SiteConfiguration.objects.get_current())
+
+        self.assertEqual(len(calls), 1)
+
+        SiteConfiguration.objects.get_current().save()
+        settings_middleware.process_request(self._get_request())
+        self.assertEqual(len(calls), 2)
+
+    def test_profile(self):
+        """Testing RequestSnapshot.profile sharing the user's profile"""
+        request = self._get_request(User.objects.get(username='doc'))
+        get_request_snapshot(request)
+
+        def run_request():
+            TimezoneMiddleware().process_request(request)
+            request.user.get_profile()
+            get_request_snapshot(request).profile
+
+        self.assertNumQueries(1, run_request)
+        self.assertEqual(get_request_snapshot(request).profile.user.username,
+                         'doc')
+
+    def test_profile_anonymous(self):
+        """Testing RequestSnapshot.profile with anonymous users"""
+        request = self._get_request()
+        self.assertEqual(get_request_snapshot(request).profile, None)
+
+    def test_get_local_site_profile(self):
+        """Testing RequestSnapshot.get_local_site_profile"""
+        user = User.objects.get(username='doc')
+        request = self._get_request(user)
+        snapshot = get_request_snapshot(request)
+
+        site_profile = snapshot.get_local_site_profile(None)
+        self.assertEqual(site_profile.user, user)
+        self.assertEqual(site_profile.local_site, None)
+
+        self.assertNumQueries(
+            0, lambda: snapshot.get_local_site_profile(None))
+
+    def _get_request(self, user=None):
+        request = self.factory.get('/')
+        request.user = user or AnonymousUser()
+
+        return request
+
+
+class InstrumentationTests(TestCase):
+    """Unit tests for reviewboard.admin.instrumentation."""
+    fixtures = ['test_users']
+
+    def setUp(self):
+        instrumentation.reset()
+
+    def tearDown(self):
+        instrumentation.finish()
+        instrumentation.reset()
+
+    def test_queries(self):
+        """Testing instrumentation counting SQL queries"""
+        old_use_debug_cursor = connection.use_debug_cursor
+
+        stats = instrumentation.start()
+        stats.view_name = 'test_view'
+        self.assertEqual(connection.use_debug_cursor, old_use_debug_cursor)
+        list(User.objects.all())
+        User.objects.get(username='doc')
+        self.assertEqual(instrumentation.finish(), stats)
+
+        self.assertEqual(stats.num_queries, 2)
+        self.assertEqual(stats.queries, [])
+        self.assertTrue(stats.query_time > 0)
+        self.assertTrue(stats.render_time > 0)
+
+    def test_queries_with_debug(self):
+        """Testing instrumentation counting SQL queries with DEBUG on"""
+        with override_settings(DEBUG=True):
+            stats = instrumentation.start()
+            list(User.objects.all())
+            User.objects.get(username='doc')
+            instrumentation.finish()
+
+        self.assertEqual(stats.num_queries, 2)
+        self.assertEqual(stats.queries, [])
+        self.assertTrue(stats.query_time > 0)
+
+    def test_capture_queries(self):
+        """Testing instrumentation keeping SQL queries"""
+        old_use_debug_cursor = connection.use_debug_cursor
+
+        with override_settings(INSTRUMENTATION_CAPTURE_QUERIES=True):
+            stats = instrumentation.start()
+            self.assertTrue(connection.use_debug_cursor)
+            list(User.objects.all())
+            User.objects.get(username='doc')
+            instrumentation.finish()
+
+        self.assertEqual(stats.num_queries, 2)
+        self.assertEqual(len(stats.queries), 2)
+        self.assertEqual(connection.use_debug_cursor, old_use_debug_cursor)
+
+    def test_unfinished_request(self):
+        """Testing instrumentation cleaning up after unfinished requests"""
+        old_use_debug_cursor = connection.use_debug_cursor
+
+        with override_settings(INSTRUMENTATION_CAPTURE_QUERIES=True):
+            instrumentation.start()
+
+        request_finished.send(sender=self.__class__)
+
+        self.assertEqual(instrumentation.get_current(), None)
+        self.assertEqual(connection.use_debug_cursor, old_use_debug_cursor)
+
+    def test_cache(self):
+        """Testing instrumentation recording cache operations"""
+        stats = instrumentation.start()
+        cache.set('instrumentation-test', 'abc')
+        cache.set_many({
+            'instrumentation-test-1': 'de',
+            'instrumentation-test-2': 'f',
+        })
+        cache.get('instrumentation-test')
+        cache.get_many(['instrumentation-test-1', 'instrumentation-test-2'])
+        instrumentation.finish()
+
+        self.assertEqual(stats.num_cache_sets, 3)
+        self.assertEqual(stats.cache_bytes_written, 6)
+        self.assertEqual(stats.num_cache_gets, 3)
+        self.assertEqual(stats.cache_bytes_read, 6)
+
+    def test_scm_calls(self):
+        """Testing instrumentation recording SCM calls"""
+        @instrumentation.instrument_scm_call
+        def get_file(path, revision):
+            return 'data'
+
+        self.assertEqual(get_file('/foo', '1'), 'data')
+
+        stats = instrumentation.start()
+        get_file('/foo', '1')
+        get_file('/bar', '1')
+        instrumentation.finish()
+
+        self.assertEqual(stats.num_scm_calls, 2)
+
+    def test_view_summaries(self):
+        """Testing instrumentation.get_view_summaries"""
+        for num_queries in (1, 3):
+            stats = instrumentation.start()
+            stats.view_name = 'test_view'
+
+            for i in range(num_queries):
+                User.objects.get(username='doc')
+
+            instrumentation.finish()
+
+        # Requests without a view aren't recorded.
+        instrumentation.start()
+        instrumentation.finish()
+
+        summaries = instrumentation.get_view_summaries()
+        self.assertEqual(len(summaries), 1)
+        self.assertEqual(summaries[0]['view_name'], 'test_view')
+        self.assertEqual(summaries[0]['requests'], 2)
+        self.assertEqual(summaries[0]['avg_num_queries'], 2)
+        self.assertEqual(summaries[0]['max_num_queries'], 3)
+
+    def test_middleware(self):
+        """Testing InstrumentationMiddleware"""
+        self.client.login(username='doc', password='doc')
+        self.client.get('/dashboard/')
+
+        summaries = instrumentation.get_view_summaries()
+        self.assertEqual(len(summaries), 1)
+        self.assertEqual(summaries[0]['view_name'],
+                         'reviewboard.reviews.views.dashboard')
+
+        widget = ViewPerformanceWidget()
+        self.assertTrue('reviewboard.reviews.views.dashboard' in
+                        widget.render(RequestFactory().get('/admin/')))
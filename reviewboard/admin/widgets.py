@@ -9,6 +9,7 @@ from django.template.loader import render_to_string
 from django.utils.translation import ugettext as _
 from djblets.util.misc import cache_memoize
 
+from reviewboard.admin import instrumentation
 from reviewboard.admin.cache_stats import get_cache_stats
 from reviewboard.attachments.models import FileAttachment
 from reviewboard.changedescs.models import ChangeDescription
@@ -255,6 +256,27 @@ class ServerCacheWidget(Widget):
         }
 
 
+class ViewPerformanceWidget(Widget):
+    """View performance widget.
+
+    Displays the average number of queries, cache operations and SCM calls,
+    and the time taken, for the slowest views handled by this server
+    process.
+    """
+    title = 'View Performance'
+    template = 'admin/widgets/w-view-performance.html'
+    size = Widget.LARGE
+    cache_data = False
+
+    #: The maximum number of views to show.
+    MAX_VIEWS = 15
+
+    def generate_data(self, request):
+        return {
+            'views': instrumentation.get_view_summaries()[:self.MAX_VIEWS],
+        }
+
+
 class NewsWidget(Widget):
     """News widget.
 
@@ -471,3 +493,4 @@ register(ReviewGroupsWidget)
 register(ServerCacheWidget)
 register(NewsWidget)
 register(DatabaseStatsWidget)
+register(ViewPerformanceWidget)
@@ -0,0 +1,584 @@
+"""Benchmarks for Review Board's core operations.
+
+Each scenario times one operation, such as uploading a diff or rendering
+the dashboard, over a number of iterations, and records the queries, cache
+operations and SCM calls made along the way using
+:py:mod:`reviewboard.admin.instrumentation`.
+
+The benchmarks create their own users, repository and review requests in the
+configured database, and remove them once they're done. They won't run if a
+user or repository with the names they use already exists. Other data in the
+database, such as that created by the fill-database command, is left alone,
+but affects the results of scenarios like the dashboard and API lists.
+Files are written to a temporary directory and served by
+:py:class:`reviewboard.scmtools.fixture.FixtureTool`, so no repository
+server is needed.
+
+These are run by the benchmark management command.
+"""
+import difflib
+import os
+import random
+import shutil
+import tempfile
+
+from django.conf import settings
+from django.contrib.auth import login
+from django.contrib.auth.models import User
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.db.models import Q
+from django.http import HttpRequest
+from django.test.client import Client
+from django.utils.importlib import import_module
+from djblets.siteconfig.models import SiteConfiguration
+
+from reviewboard.accounts.backends import StandardAuthBackend
+from reviewboard.accounts.models import Profile
+from reviewboard.admin import instrumentation
+from reviewboard.diffviewer.diffutils import get_chunks
+from reviewboard.diffviewer.forms import UploadDiffForm
+from reviewboard.diffviewer.models import DiffSetHistory, FileDiff, \
+                                          FileDiffData
+from reviewboard.reviews.models import Comment, Review, ReviewRequest
+from reviewboard.scmtools.fixture import FixtureTool
+from reviewboard.scmtools.models import Repository, Tool
+from reviewboard.search.documents import SCHEMA, analyze_documents, \
+                                         build_documents, get_search_index
+from reviewboard.search.index import SearchIndex
+
+
+BENCHMARK_USERNAME = 'rb-benchmark'
+REPOSITORY_NAME = 'Benchmark Repository'
+
+# Comments span up to 10 lines, so generated files need at least this many.
+MIN_NUM_LINES = 11
+
+WORDS = [
+    'buffer', 'chunk', 'count', 'data', 'diff', 'entry', 'file', 'index',
+    'item', 'length', 'line', 'node', 'offset', 'path', 'result', 'size',
+    'state', 'value',
+]
+
+
+def generate_file(rand, num_lines):
+    """Generates the lines of a C-like source file."""
+    lines = []
+
+    for i in xrange(num_lines):
+        if i % 25 == 0:
+            lines.append('int %s_%d(int %s)\n'
+                         % (rand.choice(WORDS), i, rand.choice(WORDS)))
+        elif i % 25 == 1:
+            lines.append('{\n')
+        elif i % 25 == 24:
+            lines.append('}\n')
+        else:
+            lines.append('    %s += %s(%s, %d);\n'
+                         % (rand.choice(WORDS), rand.choice(WORDS),
+                            rand.choice(WORDS), rand.randint(0, 1000)))
+
+    return lines
+
+
+def modify_file(rand, lines, change_interval=40):
+    """Returns a copy of the lines with some of them changed or removed."""
+    new_lines = []
+
+    for i, line in enumerate(lines):
+        if i % change_interval != change_interval / 2:
+            new_lines.append(line)
+        else:
+            change = rand.randint(0, 2)
+
+            if change == 0:
+                new_lines.append(line.replace(';', ' + 1;'))
+            elif change == 1:
+                new_lines.append(line)
+                new_lines.append('    %s = 0;\n' % rand.choice(WORDS))
+
+    return new_lines
+
+
+class BenchmarkError(Exception):
+    """An error preventing the benchmarks from running."""
+    pass
+
+
+class BenchmarkData(object):
+    """The data used by the benchmark scenarios.
+
+    This creates a user, a repository using FixtureTool, and a review
+    request with a diff of generated files, along with reviews and
+    comments. Everything created is removed by cleanup(), other than the
+    FixtureTool's Tool, which is left registered. Nothing else in the
+    database is removed.
+
+    ``scm_latency`` is the number of milliseconds that each operation on
+    the repository takes.
+    """
+    def __init__(self, num_files=5, num_lines=5000, num_reviews=20,
+                 num_comments=5, seed=0, scm_latency=0):
+        self.num_files = num_files
+        self.num_lines = num_lines
+        self.num_reviews = num_reviews
+        self.num_comments = num_comments
+        self.scm_latency = scm_latency
+        self.rand = random.Random(seed)
+        self.user = None
+        self.repository = None
+        self.repository_dir = None
+        self.review_requests = []
+        self.diffset_histories = []
+        self.diff_hashes = set()
+
+    def setup(self):
+        """Creates the data used by the scenarios.
+
+        BenchmarkError is raised if the benchmark's user or repository
+        already exists, rather than touching existing data.
+        """
+        if User.objects.filter(username=BENCHMARK_USERNAME).exists():
+            raise BenchmarkError(
+                'A user named "%s" already exists. It may have been left '
+                'behind by a benchmark that didn\'t finish, and must be '
+                'removed before running the benchmarks.'
+                % BENCHMARK_USERNAME)
+
+        if Repository.objects.filter(name=REPOSITORY_NAME).exists():
+            raise BenchmarkError(
+                'A repository named "%s" already exists. It may have been '
+                'left behind by a benchmark that didn\'t finish, and must '
+                'be removed before running the benchmarks.'
+                % REPOSITORY_NAME)
+
+        self.user = User.objects.create(username=BENCHMARK_USERNAME,
+                                        first_name='Benchmark',
+                                        last_name='User',
+                                        email='benchmark@example.com')
+        self.user.set_unusable_password()
+        self.user.save()
+        Profile.objects.create(user=self.user, first_time_setup_done=True)
+
+        self.tool, is_new = Tool.objects.get_or_create(
+            class_name='%s.%s' % (FixtureTool.__module__,
+                                  FixtureTool.__name__),
+            defaults={
+                'name': FixtureTool.name,
+            })
+        self.repository_dir = tempfile.mkdtemp(prefix='rb-benchmark-repo-')
+        repository = Repository(name=REPOSITORY_NAME,
+                                path=self.repository_dir,
+                                tool=self.tool)
+        repository.extra_data['fixture_latency'] = self.scm_latency
+        repository.save()
+        self.repository = repository
+
+        self.diff = self._generate_diff()
+
+        # Don't send e-mail for anything published here. This isn't saved,
+        # so it only affects this process.
+        siteconfig = SiteConfiguration.objects.get_current()
+        send_review_mail = siteconfig.get('mail_send_review_mail')
+        siteconfig.set('mail_send_review_mail', False)
+
+        try:
+            self.review_request = self.create_review_request()
+            self.diffset = self.upload_diff(
+                self.review_request.diffset_history)
+            self.review_request.publish(self.user)
+            self._create_reviews(self.review_request)
+        finally:
+            siteconfig.set('mail_send_review_mail', send_review_mail)
+
+    def cleanup(self):
+        """Removes everything created for the benchmarks.
+
+        Only the objects created by setup() and the scenarios are removed,
+        looked up by their IDs. Stored diff data is shared between identical
+        diffs, so the data for the uploaded diffs is only removed if nothing
+        else uses it.
+        """
+        review_request_ids = []
+        history_ids = [history.pk for history in self.diffset_histories]
+
+        if self.user is not None:
+            for review_request in ReviewRequest.objects.filter(
+                    submitter=self.user.pk):
+                review_request_ids.append(review_request.pk)
+                history_ids.append(review_request.diffset_history_id)
+                review_request.delete()
+
+        DiffSetHistory.objects.filter(pk__in=history_ids).delete()
+
+        if self.diff_hashes:
+            used_hashes = set()
+
+            for hashes in FileDiff.objects.filter(
+                    Q(diff_hash__in=self.diff_hashes) |
+                    Q(parent_diff_hash__in=self.diff_hashes)).values_list(
+                        'diff_hash', 'parent_diff_hash'):
+                used_hashes.update(hashes)
+
+            FileDiffData.objects.filter(
+                binary_hash__in=self.diff_hashes - used_hashes).delete()
+
+        self._remove_from_search_index(review_request_ids)
+
+        if self.repository is not None:
+            Repository.objects.filter(pk=self.repository.pk).delete()
+            self.repository = None
+
+        if self.user is not None:
+            User.objects.filter(pk=self.user.pk).delete()
+            self.user = None
+
+        if self.repository_dir:
+            shutil.rmtree(self.repository_dir)
+            self.repository_dir = None
+
+        self.review_requests = []
+        self.diffset_histories = []
+        self.diff_hashes = set()
+
+    def create_review_request(self):
+        """Creates a new public review request."""
+        review_request = ReviewRequest.objects.create(self.user,
+                                                      self.repository)
+        review_request.public = True
+        review_request.summary = 'Benchmark review request'
+        review_request.description = ' '.join(
+            [self.rand.choice(WORDS) for i in xrange(100)])
+        review_request.target_people.add(self.user)
+        review_request.save()
+
+        self.review_requests.append(review_request)
+
+        return review_request
+
+    def upload_diff(self, diffset_history=None):
+        """Uploads the generated diff, and returns the new DiffSet."""
+        if diffset_history is None:
+            diffset_history = DiffSetHistory.objects.create()
+            self.diffset_histories.append(diffset_history)
+
+        diff_file = SimpleUploadedFile('benchmark.diff', self.diff)
+        form = UploadDiffForm(self.repository, {})
+        diffset = form.create(diff_file, None, diffset_history)
+
+        for filediff in diffset.files.all():
+            self.diff_hashes.add(filediff.diff_hash_id)
+
+        return diffset
+
+    def _remove_from_search_index(self, review_request_ids):
+        # Publishing the review request and its reviews adds it to the
+        # site's search index, if search is enabled.
+        siteconfig = SiteConfiguration.objects.get_current()
+
+        if not review_request_ids or not siteconfig.get('search_enable'):
+            return
+
+        writer = get_search_index().writer()
+
+        try:
+            for review_request_id in review_request_ids:
+                writer.delete_document(review_request_id)
+        except:
+            writer.cancel()
+            raise
+
+        writer.commit()
+
+    def _generate_diff(self):
+        diff = []
+
+        for i in xrange(self.num_files):
+            path = '/src/benchmark/file%d.c' % i
+            old_lines = generate_file(self.rand, self.num_lines)
+            new_lines = modify_file(self.rand, old_lines)
+
+            self._write_file(path, '1', ''.join(old_lines))
+            diff.extend(difflib.unified_diff(old_lines, new_lines,
+                                             path, path, '1', '2'))
+
+        return ''.join(diff)
+
+    def _write_file(self, path, revision, data):
+        file_path = os.path.join(self.repository_dir, 'revisions', revision,
+                                 path.lstrip('/'))
+        file_dir = os.path.dirname(file_path)
+
+        if not os.path.exists(file_dir):
+            os.makedirs(file_dir)
+
+        fp = open(file_path, 'wb')
+        fp.write(data)
+        fp.close()
+
+    def _create_reviews(self, review_request):
+        filediffs = list(self.diffset.files.all())
+
+        for i in xrange(self.num_reviews):
+            review = Review.objects.create(review_request=review_request,
+                                           user=self.user,
+                                           body_top='Review %d' % i)
+
+            for j in xrange(self.num_comments):
+                first_line = self.rand.randint(1, self.num_lines - 10)
+                review.comments.add(Comment.objects.create(
+                    filediff=self.rand.choice(filediffs),
+                    text='Comment %d on review %d' % (j, i),
+                    first_line=first_line,
+                    num_lines=self.rand.randint(1, 10)))
+
+            review.publish(user=self.user)
+
+
+class Scenario(object):
+    """A benchmark of a single operation.
+
+    Subclasses implement run(), which performs the operation once.
+    """
+    name = None
+    description = None
+
+    def __init__(self, data):
+        self.data = data
+
+    def setup(self):
+        """Prepares for the scenario's iterations."""
+        pass
+
+    def teardown(self):
+        """Cleans up after the scenario's iterations."""
+        pass
+
+    def run(self):
+        raise NotImplementedError
+
+    def measure(self):
+        """Runs the scenario once, and returns the ViewStats for the run."""
+        stats = instrumentation.start()
+
+        try:
+            self.run()
+        finally:
+            instrumentation.finish()
+
+        return stats
+
+
+class URLScenario(Scenario):
+    """A benchmark of fetching a page or API resource.
+
+    The stats are those recorded by InstrumentationMiddleware, so they
+    include the work done by middleware.
+    """
+    url = None
+
+    def setup(self):
+        # The benchmark user has no usable password, so it's logged in by
+        # creating its session directly.
+        user = self.data.user
+        user.backend = '%s.%s' % (StandardAuthBackend.__module__,
+                                  StandardAuthBackend.__name__)
+
+        request = HttpRequest()
+        request.session = import_module(settings.SESSION_ENGINE).SessionStore()
+        login(request, user)
+        request.session.save()
+
+        self.client = Client()
+        self.client.cookies[settings.SESSION_COOKIE_NAME] = \
+            request.session.session_key
+
+    def get_url(self):
+        return self.url
+
+    def run(self):
+        response = self.client.get(self.get_url())
+
+        if response.status_code != 200:
+            raise ValueError('%s returned HTTP %d'
+                             % (self.get_url(), response.status_code))
+
+        # Responses may be built from iterators, so read them here to be
+        # sure that all the work is done.
+        response.content
+
+    def measure(self):
+        self.run()
+
+        return instrumentation.get_last()
+
+
+class DiffUploadScenario(Scenario):
+    name = 'diff-upload'
+    description = 'Uploads a diff using UploadDiffForm.create()'
+
+    def run(self):
+        self.data.upload_diff()
+
+
+class DiffChunksScenario(Scenario):
+    name = 'diff-chunks'
+    description = 'Generates the chunks for each file in a diff'
+
+    def setup(self):
+        self.filediffs = list(self.data.diffset.files.all())
+
+    def run(self):
+        for filediff in self.filediffs:
+            list(get_chunks(self.data.diffset, filediff, None, False, True))
+
+
+class ReviewDetailScenario(URLScenario):
+    name = 'review-detail'
+    description = 'Renders a review request with reviews and comments'
+
+    def get_url(self):
+        return self.data.review_request.get_absolute_url()
+
+
+class DashboardScenario(URLScenario):
+    name = 'dashboard'
+    description = 'Renders the dashboard'
+    url = '/dashboard/'
+
+
+class ReviewRequestListAPIScenario(URLScenario):
+    name = 'api-review-requests'
+    description = 'Fetches the review request list from the API'
+    url = '/api/review-requests/'
+
+
+class ReviewListAPIScenario(URLScenario):
+    name = 'api-reviews'
+    description = "Fetches the review request's review list from the API"
+
+    def get_url(self):
+        return '/api/review-requests/%s/reviews/' % \
+               self.data.review_request.display_id
+
+
+class UserListAPIScenario(URLScenario):
+    name = 'api-users'
+    description = 'Fetches the user list from the API'
+    url = '/api/users/'
+
+
+class SearchIndexScenario(Scenario):
+    name = 'search-index'
+    description = 'Indexes review requests in a new search index'
+
+    def setup(self):
+        self.index_dir = tempfile.mkdtemp(prefix='rb-benchmark-')
+        self.index = SearchIndex(self.index_dir, SCHEMA)
+
+    def teardown(self):
+        shutil.rmtree(self.index_dir)
+
+    def run(self):
+        review_requests = list(
+            ReviewRequest.objects.filter(public=True)
+                                 .select_related('submitter')
+                                 .order_by('-pk')[:100])
+        writer = self.index.writer(clear=True)
+
+        for doc_id, fields in analyze_documents(
+                build_documents(review_requests)):
+            writer.add_analyzed_document(doc_id, fields)
+
+        writer.commit()
+
+
+SCENARIOS = [
+    DiffUploadScenario,
+    DiffChunksScenario,
+    ReviewDetailScenario,
+    DashboardScenario,
+    ReviewRequestListAPIScenario,
+    ReviewListAPIScenario,
+    UserListAPIScenario,
+    SearchIndexScenario,
+]
+
+
+def get_scenario(name):
+    """Returns the Scenario class with the given name, or None."""
+    for scenario_cls in SCENARIOS:
+        if scenario_cls.name == name:
+            return scenario_cls
+
+    return None
+
+
+def _get_percentile(values, percentile):
+    values = sorted(values)
+
+    return values[min(int(len(values) * percentile), len(values) - 1)]
+
+
+def summarize(samples):
+    """Summarizes the ViewStats recorded over a scenario's iterations.
+
+    Times are in milliseconds.
+    """
+    times = [stats.render_time * 1000 for stats in samples]
+    queries = [stats.num_queries for stats in samples]
+    query_times = [stats.query_time * 1000 for stats in samples]
+
+    return {
+        'iterations': len(samples),
+        'first_ms': times[0],
+        'mean_ms': sum(times) / len(times),
+        'p50_ms': _get_percentile(times, 0.5),
+        'p95_ms': _get_percentile(times, 0.95),
+        'max_ms': max(times),
+        'p50_queries': _get_percentile(queries, 0.5),
+        'max_queries': max(queries),
+        'p50_query_ms': _get_percentile(query_times, 0.5),
+        'mean_cache_gets': (float(sum([stats.num_cache_gets
+                                       for stats in samples])) /
+                            len(samples)),
+        'mean_scm_calls': (float(sum([stats.num_scm_calls
+                                      for stats in samples])) /
+                           len(samples)),
+    }
+
+
+def run_benchmarks(scenario_names=None, iterations=10, **data_options):
+    """Runs the benchmark scenarios, and returns the results.
+
+    ``scenario_names`` is a list of scenarios to run, defaulting to all of
+    them. ``data_options`` are passed to BenchmarkData.
+
+    The results are a dictionary mapping scenario names to summaries from
+    summarize().
+    """
+    if scenario_names:
+        scenario_classes = [get_scenario(name) for name in scenario_names]
+    else:
+        scenario_classes = SCENARIOS
+
+    data = BenchmarkData(**data_options)
+    results = {}
+
+    try:
+        data.setup()
+
+        for scenario_cls in scenario_classes:
+            scenario = scenario_cls(data)
+            scenario.setup()
+
+            try:
+                results[scenario.name] = summarize([
+                    scenario.measure()
+                    for i in xrange(iterations)
+                ])
+            finally:
+                scenario.teardown()
+    finally:
+        data.cleanup()
+
+    return results
@@ -40,7 +40,9 @@ import paramiko
 
 from reviewboard import get_version_string
 from reviewboard.scmtools.core import SCMTool
+from reviewboard.ssh import controlmaster
 from reviewboard.ssh.client import SSHClient
+from reviewboard.ssh.errors import SSHError
 
 
 DEBUG = os.getenv('DEBUG_RBSSH')
@@ -217,9 +219,27 @@ def parse_options(args):
                       dest='local_site_name', metavar='NAME',
                       default=os.getenv('RB_LOCAL_SITE'),
                       help='the local site name containing the SSH keys to use')
+    parser.add_option('--rb-control-master',
+                      action='store_true', dest='control_master',
+                      default=False,
+                      help='run a control master that shares SSH connections '
+                           'between rbssh processes')
+    parser.add_option('--rb-control-idle-timeout',
+                      type='int', dest='control_idle_timeout',
+                      metavar='SECONDS',
+                      default=controlmaster.ControlMaster.DEFAULT_IDLE_TIMEOUT,
+                      help='the number of seconds the control master keeps '
+                           'idle connections open')
+    parser.add_option('--rb-no-control-master',
+                      action='store_false', dest='use_control_master',
+                      default=os.getenv('RBSSH_CONTROL_MASTER') != '0',
+                      help="don't use a running control master")
 
     (options, args) = parser.parse_args(args)
 
+    if options.control_master:
+        return None, args
+
     if options.subsystem:
         if len(options.subsystem) != 2:
             parser.error('-s requires a hostname and a valid subsystem')
@@ -239,6 +259,59 @@ def parse_options(args):
     return hostname, args
 
 
+def run_control_master():
+    if not controlmaster.is_supported():
+        logging.error('The control master is not supported on this platform')
+        sys.exit(1)
+
+    master = controlmaster.ControlMaster(
+        controlmaster.get_control_path(),
+        idle_timeout=options.control_idle_timeout,
+        allow_agent=options.allow_agent)
+
+    try:
+        master.listen()
+    except SSHError, e:
+        logging.error(e)
+        sys.exit(1)
+
+    logging.info('Listening on %s' % master.path)
+
+    try:
+        master.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+    return 0
+
+
+def run_with_control_master(hostname, username, command):
+    """Runs a command over a connection held by a control master.
+
+    This returns None if there's no control master running, or if it
+    couldn't run the command.
+    """
+    if not options.use_control_master or not controlmaster.is_supported():
+        return None
+
+    request = {
+        'hostname': hostname,
+        'port': options.port,
+        'username': username,
+        'local_site_name': options.local_site_name,
+        'allow_agent': options.allow_agent,
+    }
+
+    if options.subsystem == 'sftp':
+        request['subsystem'] = 'sftp'
+    else:
+        request['command'] = ' '.join(command)
+
+    return controlmaster.run_command(controlmaster.get_control_path(),
+                                     request, sys.stdin, sys.stdout,
+                                     sys.stderr)
+
+
 def main():
     if DEBUG:
         pid = os.getpid()
@@ -267,6 +340,9 @@ def main():
 
     path, command = parse_options(sys.argv[1:])
 
+    if options.control_master:
+        return run_control_master()
+
     if '://' not in path:
         path = 'ssh://' + path
 
@@ -277,6 +353,13 @@ def main():
 
     logging.debug('!!! %s, %s, %s' % (hostname, username, command))
 
+    if options.subsystem == 'sftp' or command:
+        status = run_with_control_master(hostname, username, command)
+
+        if status is not None:
+            logging.debug('!!! Done using the control master')
+            return status
+
     client = SSHClient(namespace=options.local_site_name)
     client.set_missing_host_key_policy(paramiko.WarningPolicy())
 
@@ -287,7 +370,8 @@ def main():
 
     while True:
         try:
-            client.connect(hostname, username=username, password=password,
+            client.connect(hostname, port=options.port or 22,
+                           username=username, password=password,
                            pkey=key, allow_agent=options.allow_agent)
             break
         except paramiko.AuthenticationException, e:
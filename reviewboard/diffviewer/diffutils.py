@@ -1,9 +1,11 @@
 from __future__ import with_statement
 import fnmatch
+import hashlib
 import os
 import re
 import subprocess
 import tempfile
+from bisect import bisect_left, bisect_right
 from difflib import SequenceMatcher
 
 try:
@@ -386,10 +388,104 @@ def get_original_file(filediff):
 
 
 def get_patched_file(buffer, filediff):
+    """
+    Returns the result of applying a filediff's diff to the given buffer.
+
+    Patched files are stored in the cache keyed by the SHA1 of the original
+    buffer and the SHA1 of the normalized diff. Since the result depends
+    only on those two inputs, the same revision of a file shown in several
+    interdiffs is only patched once.
+    """
+    diff = _get_normalized_diff(filediff)
+
+    # See get_original_file for why the result is wrapped in a list.
+    return cache_memoize(_make_patched_file_key(buffer, diff),
+                         lambda: [patch(diff, buffer, filediff.dest_file)],
+                         large_data=True)[0]
+
+
+def get_patched_file_for_filediff(filediff):
+    """
+    Returns the patched version of a filediff's file.
+
+    This is equivalent to calling get_original_file and then
+    get_patched_file, but also records the patched file's content address
+    under a key built from the filediff's inputs (repository, file,
+    revision, parent diff and diff). Later calls for the same inputs will
+    go straight to the stored patched file, without fetching or patching
+    the original file.
+    """
+    if filediff.diff_hash_id:
+        diff_hash = filediff.diff_hash_id
+    else:
+        diff_hash = hashlib.sha1(filediff.diff).hexdigest()
+
+    if filediff.parent_diff_hash_id:
+        parent_diff_hash = filediff.parent_diff_hash_id
+    elif filediff.parent_diff:
+        parent_diff_hash = hashlib.sha1(filediff.parent_diff).hexdigest()
+    else:
+        parent_diff_hash = ''
+
+    index_key = "patched-file-index:%s:%s:%s:%s:%s" % (
+        filediff.diffset.repository_id, urlquote(filediff.source_file),
+        urlquote(filediff.source_revision), parent_diff_hash, diff_hash)
+
+    def fetch_patched_file():
+        return get_patched_file(get_original_file(filediff), filediff)
+
+    # If we end up computing the patched file in order to find its key,
+    # we hold onto it here so we don't have to look it up again.
+    patched = []
+
+    def compute_key():
+        orig = get_original_file(filediff)
+        patched.append(get_patched_file(orig, filediff))
+
+        return _make_patched_file_key(orig, _get_normalized_diff(filediff))
+
+    key = cache_memoize(index_key, compute_key)
+
+    if patched:
+        return patched[0]
+
+    # The patched file may have been evicted from the cache even though
+    # the index entry still exists. In that case, recompute and store it.
+    return cache_memoize(key, lambda: [fetch_patched_file()],
+                         large_data=True)[0]
+
+
+def _get_normalized_diff(filediff):
     tool = filediff.diffset.repository.get_scmtool()
-    diff = tool.normalize_patch(filediff.diff, filediff.source_file,
+
+    return tool.normalize_patch(filediff.diff, filediff.source_file,
                                 filediff.source_revision)
-    return patch(diff, buffer, filediff.dest_file)
+
+
+def _make_patched_file_key(buffer, diff):
+    return "patched-file:%s:%s" % (hashlib.sha1(buffer).hexdigest(),
+                                   hashlib.sha1(diff).hexdigest())
+
+
+def get_header_regexes_for_filename(filename):
+    """Returns the regexes used to find headers in a file.
+
+    This returns a tuple of the language key (the key into HEADER_REGEXES)
+    and the list of regexes for that language, based on the filename. If
+    there are no regexes for the file, this returns (None, []).
+    """
+    basename = os.path.basename(filename)
+
+    if basename in HEADER_REGEX_ALIASES:
+        language = HEADER_REGEX_ALIASES[basename]
+    else:
+        ext = os.path.splitext(basename)[1]
+        language = HEADER_REGEX_ALIASES.get(ext, ext)
+
+    if language in HEADER_REGEXES:
+        return language, HEADER_REGEXES[language]
+    else:
+        return None, []
 
 
 def register_interesting_lines_for_filename(differ, filename):
@@ -398,23 +494,42 @@ def register_interesting_lines_for_filename(differ, filename):
     This will add watches for headers (functions, classes, etc.) to the diff
     viewer. The regular expressions used are based on the filename provided.
     """
-    # Add any interesting lines we may want to show.
-    regexes = []
-
-    if file in HEADER_REGEX_ALIASES:
-        regexes = HEADER_REGEXES[HEADER_REGEX_ALIASES[filename]]
-    else:
-        basename, ext = os.path.splitext(filename)
-
-        if ext in HEADER_REGEXES:
-            regexes = HEADER_REGEXES[ext]
-        elif ext in HEADER_REGEX_ALIASES:
-            regexes = HEADER_REGEXES[HEADER_REGEX_ALIASES[ext]]
+    language, regexes = get_header_regexes_for_filename(filename)
 
     for regex in regexes:
         differ.add_interesting_line_regex('header', regex)
 
 
+def get_file_headers(lines, filename, blob_hash):
+    """Returns the headers (functions, classes, etc.) found in a file.
+
+    The result is a list of (linenum, line) tuples, sorted by the 0-based
+    line number. Since the headers depend only on the file's content and
+    its language, they're cached under the hash of the file's content and
+    the language, and computed only once no matter how many diffs the
+    file is shown in.
+    """
+    language, regexes = get_header_regexes_for_filename(filename)
+
+    if not regexes:
+        return []
+
+    def find_headers():
+        headers = []
+
+        for linenum, line in enumerate(lines):
+            if line.strip():
+                for regex in regexes:
+                    if regex.match(line):
+                        headers.append((linenum, line))
+                        break
+
+        return headers
+
+    return cache_memoize("file-headers:%s:%s" % (language, blob_hash),
+                         find_headers, large_data=True)
+
+
 def compute_chunk_last_header(lines, numlines, meta, last_header=None):
     """Computes information for the displayed function/class headers.
 
@@ -445,7 +560,24 @@ def compute_chunk_last_header(lines, numlines, meta, last_header=None):
 
 
 def get_chunks(diffset, filediff, interfilediff, force_interdiff,
-               enable_syntax_highlighting):
+               enable_syntax_highlighting, render_rows=None):
+    """Generates the chunks for a filediff or interdiff.
+
+    If render_rows is provided, it must be a (first, last) tuple of
+    virtual row numbers (inclusive). Only lines within that range will be
+    fully rendered. Lines outside of it will contain only their row and line
+    numbers, which is enough to compute chunk boundaries and headers without
+    the cost of computing changed regions for every line.
+    """
+    def render_line(vlinenum, oldlinenum, newlinenum, oldline, newline,
+                    oldmarkup, newmarkup):
+        if render_rows[0] <= vlinenum <= render_rows[1]:
+            return diff_line(vlinenum, oldlinenum, newlinenum, oldline,
+                             newline, oldmarkup, newmarkup)
+
+        return [vlinenum, oldlinenum or '', '', [], newlinenum or '', '', [],
+                False]
+
     def diff_line(vlinenum, oldlinenum, newlinenum, oldline, newline,
                   oldmarkup, newmarkup):
         # This function accesses the variable meta, defined in an outer context.
@@ -476,10 +608,10 @@ def get_chunks(diffset, filediff, interfilediff, force_interdiff,
         if not meta:
             meta = {}
 
-        left_headers = list(get_interesting_headers(differ, all_lines,
-                                                    start, end - 1, False))
-        right_headers = list(get_interesting_headers(differ, all_lines,
-                                                     start, end - 1, True))
+        left_headers = get_interesting_headers(all_lines, start, end - 1,
+                                               False)
+        right_headers = get_interesting_headers(all_lines, start, end - 1,
+                                                True)
 
         meta['left_headers'] = left_headers
         meta['right_headers'] = right_headers
@@ -502,44 +634,39 @@ def get_chunks(diffset, filediff, interfilediff, force_interdiff,
             'meta': meta,
         }
 
-    def get_interesting_headers(differ, lines, start, end, is_modified_file):
+    def get_interesting_headers(lines, start, end, is_modified_file):
         """Returns all headers for a region of a diff.
 
-        This scans for all headers that fall within the specified range
+        This looks up all headers that fall within the specified range
         of the specified lines on both the original and modified files.
         """
-        possible_functions = differ.get_interesting_lines('header',
-                                                          is_modified_file)
+        if is_modified_file:
+            headers, header_linenums = header_index[1]
+            linenum_index = 4
+        else:
+            headers, header_linenums = header_index[0]
+            linenum_index = 1
 
-        if not possible_functions:
-            raise StopIteration
+        if not headers:
+            return []
 
         try:
-            if is_modified_file:
-                last_index = last_header_index[1]
-                i1 = lines[start][4]
-                i2 = lines[end - 1][4]
-            else:
-                last_index = last_header_index[0]
-                i1 = lines[start][1]
-                i2 = lines[end - 1][1]
+            i1 = lines[start][linenum_index]
+            i2 = lines[end - 1][linenum_index]
         except IndexError:
-            raise StopIteration
+            return []
 
-        for i in xrange(last_index, len(possible_functions)):
-            linenum, line = possible_functions[i]
-            linenum += 1
+        if i1 == '' or i2 == '':
+            # There are no lines on this side of the chunk.
+            return []
 
-            if linenum > i2:
-                break
-            elif linenum >= i1:
-                last_index = i
-                yield (linenum, line)
-
-        if is_modified_file:
-            last_header_index[1] = last_index
-        else:
-            last_header_index[0] = last_index
+        # Header line numbers are 0-based, and i1 and i2 are 1-based.
+        return [
+            (linenum + 1, line)
+            for linenum, line in headers[
+                bisect_left(header_linenums, i1 - 1):
+                bisect_right(header_linenums, i2 - 1)]
+        ]
 
     def apply_pygments(data, filename):
         # XXX Guessing is preferable but really slow, especially on XML
@@ -595,14 +722,16 @@ def get_chunks(diffset, filediff, interfilediff, force_interdiff,
 
     file = filediff.source_file
 
-    old = get_original_file(filediff)
-    new = get_patched_file(old, filediff)
-
     if interfilediff:
-        old = new
-        interdiff_orig = get_original_file(interfilediff)
-        new = get_patched_file(interdiff_orig, interfilediff)
-    elif force_interdiff:
+        # Both sides are patched files, which are likely to have been
+        # computed already when viewing other interdiffs of these revisions.
+        old = get_patched_file_for_filediff(filediff)
+        new = get_patched_file_for_filediff(interfilediff)
+    else:
+        old = get_original_file(filediff)
+        new = get_patched_file(old, filediff)
+
+    if force_interdiff and not interfilediff:
         # Basically, revert the change.
         old, new = new, old
 
@@ -679,7 +808,18 @@ def get_chunks(diffset, filediff, interfilediff, force_interdiff,
 
     linenum = 1
     last_header = [None, None]
-    last_header_index = [0, 0]
+    header_index = []
+    blob_hashes = []
+
+    for data, lines in ((old, a), (new, b)):
+        if isinstance(data, unicode):
+            data = data.encode('utf-8')
+
+        blob_hash = hashlib.sha1(data).hexdigest()
+        blob_hashes.append(blob_hash)
+
+        headers = get_file_headers(lines, file, blob_hash)
+        header_index.append((headers, [header[0] for header in headers]))
 
     ignore_space = True
     for pattern in siteconfig.get("diffviewer_include_space_patterns"):
@@ -687,11 +827,10 @@ def get_chunks(diffset, filediff, interfilediff, force_interdiff,
             ignore_space = False
             break
 
-    differ = Differ(a, b, ignore_space=ignore_space,
-                    compat_version=diffset.diffcompat)
-
-    # Register any regexes for interesting lines we may want to show.
-    register_interesting_lines_for_filename(differ, file)
+    # The line lists are built entirely from the file contents, so the
+    # hashes of the contents identify them.
+    opcodes = get_diff_opcodes(a, b, blob_hashes[0], blob_hashes[1],
+                               ignore_space, diffset.diffcompat)
 
     # TODO: Make this back into a preference if people really want it.
     context_num_lines = siteconfig.get("diffviewer_context_num_lines")
@@ -708,12 +847,17 @@ def get_chunks(diffset, filediff, interfilediff, force_interdiff,
 
     chunk_index = 0
 
-    for tag, i1, i2, j1, j2, meta in opcodes_with_metadata(differ):
+    for tag, i1, i2, j1, j2, meta in opcodes:
         oldlines = markup_a[i1:i2]
         newlines = markup_b[j1:j2]
         numlines = max(len(oldlines), len(newlines))
 
-        lines = map(diff_line,
+        if render_rows is None:
+            line_func = diff_line
+        else:
+            line_func = render_line
+
+        lines = map(line_func,
                     xrange(linenum, linenum + numlines),
                     xrange(i1 + 1, i2 + 1), xrange(j1 + 1, j2 + 1),
                     a[i1:i2], b[j1:j2], oldlines, newlines)
@@ -771,6 +915,81 @@ def is_valid_move_range(lines):
     return False
 
 
+# The opcode tags, indexed by the integer stored in cached opcodes.
+OPCODE_TAGS = ('equal', 'replace', 'delete', 'insert')
+OPCODE_TAG_INDEXES = dict((tag, i) for i, tag in enumerate(OPCODE_TAGS))
+
+
+def get_diff_opcodes(a, b, a_hash, b_hash, ignore_space, compat_version):
+    """Returns opcodes with metadata for two lists of lines.
+
+    This is equivalent to calling opcodes_with_metadata on a Differ for
+    the lists of lines, but the result is cached based on the hashes of the
+    lines, the whitespace setting and the differ compatibility version.
+    None of those depend on how the diff is rendered, so changing
+    syntax highlighting or context settings won't require diffing again.
+
+    The hashes must uniquely identify the line lists, such as SHA1s of the
+    file contents they were built from.
+    """
+    def compute_opcodes():
+        differ = Differ(a, b, ignore_space=ignore_space,
+                        compat_version=compat_version)
+
+        return [_compact_opcode(opcode)
+                for opcode in opcodes_with_metadata(differ)]
+
+    key = "diff-opcodes:%s:%s:%d:%s" % (a_hash, b_hash, int(ignore_space),
+                                        compat_version)
+
+    return [_expand_opcode(opcode)
+            for opcode in cache_memoize(key, compute_opcodes,
+                                        large_data=True)]
+
+
+def _compact_opcode(opcode):
+    """Converts an opcode with metadata into a tuple of integers.
+
+    The result is in the form of:
+
+        (tag_index, i1, i2, j1, j2, whitespace_chunk,
+         whitespace_lines, moved)
+
+    whitespace_lines and moved are flattened tuples of (old, new) and
+    (line, destination) pairs, respectively.
+    """
+    tag, i1, i2, j1, j2, meta = opcode
+    whitespace_lines = []
+    moved = []
+
+    for pair in meta['whitespace_lines']:
+        whitespace_lines.extend(pair)
+
+    for pair in sorted(meta.get('moved', {}).iteritems()):
+        moved.extend(pair)
+
+    return (OPCODE_TAG_INDEXES[tag], i1, i2, j1, j2,
+            int(meta['whitespace_chunk']), tuple(whitespace_lines),
+            tuple(moved))
+
+
+def _expand_opcode(compact_opcode):
+    """Converts a compacted opcode back into an opcode with metadata."""
+    (tag_index, i1, i2, j1, j2, whitespace_chunk, whitespace_lines,
+     moved) = compact_opcode
+
+    meta = {
+        'whitespace_chunk': bool(whitespace_chunk),
+        'whitespace_lines': zip(whitespace_lines[::2],
+                                whitespace_lines[1::2]),
+    }
+
+    if moved:
+        meta['moved'] = dict(zip(moved[::2], moved[1::2]))
+
+    return (OPCODE_TAGS[tag_index], i1, i2, j1, j2, meta)
+
+
 def opcodes_with_metadata(differ):
     """Returns opcodes from the differ with extra metadata.
 
@@ -1156,6 +1375,24 @@ def get_diff_files(diffset, filediff=None, interdiffset=None):
     return files
 
 
+def _get_file_chunks_key(filediff, interfilediff, force_interdiff):
+    """Returns the part of a chunk cache key identifying a file's diff."""
+    if not force_interdiff:
+        return str(filediff.pk)
+    elif interfilediff:
+        return "interdiff-%s-%s" % (filediff.pk, interfilediff.pk)
+    else:
+        return "interdiff-%s-none" % filediff.pk
+
+
+def _file_has_chunks(filediff):
+    # If the file is binary or deleted, there are no chunks. There are also
+    # no chunks if there is no source_revision, which occurs if a file has
+    # moved and has no changes.
+    return (not filediff.binary and not filediff.deleted and
+            filediff.source_revision != '')
+
+
 def populate_diff_chunks(files, enable_syntax_highlighting=True):
     """Populates a list of diff files with chunk data.
 
@@ -1174,19 +1411,9 @@ def populate_diff_chunks(files, enable_syntax_highlighting=True):
         force_interdiff = file['force_interdiff']
         chunks = []
 
-        # If the file is binary or deleted, don't get chunks. Also don't
-        # get chunks if there is no source_revision, which occurs if a
-        # file has moved and has no changes.
-        if (not filediff.binary and not filediff.deleted and
-            filediff.source_revision != ''):
-            key = key_prefix
-
-            if not force_interdiff:
-                key += str(filediff.pk)
-            elif interfilediff:
-                key += "interdiff-%s-%s" % (filediff.pk, interfilediff.pk)
-            else:
-                key += "interdiff-%s-none" % filediff.pk
+        if _file_has_chunks(filediff):
+            key = key_prefix + _get_file_chunks_key(filediff, interfilediff,
+                                                    force_interdiff)
 
             chunks = cache_memoize(
                 key,
@@ -1219,6 +1446,93 @@ def populate_diff_chunks(files, enable_syntax_highlighting=True):
         })
 
 
+def get_chunk_index(file):
+    """Returns an index of the chunks for a file in a diff.
+
+    This accepts a file (generated by get_diff_files) and returns a list
+    containing a small dictionary for each chunk, with the chunk's
+    ``index``, ``change``, ``collapsable`` flag, ``first_row`` (the virtual
+    row number of its first line) and ``numlines``.
+
+    The index is computed without rendering any lines, and is cached
+    independently of syntax highlighting. It can be used to find the chunks
+    within a range of lines without generating the rest of the diff.
+    """
+    filediff = file['filediff']
+    interfilediff = file['interfilediff']
+    force_interdiff = file['force_interdiff']
+
+    if not _file_has_chunks(filediff):
+        return []
+
+    def build_index():
+        return [
+            {
+                'index': chunk['index'],
+                'change': chunk['change'],
+                'collapsable': chunk['collapsable'],
+                'first_row': chunk['lines'][0][0],
+                'numlines': chunk['numlines'],
+            }
+            for chunk in get_chunks(filediff.diffset, filediff, interfilediff,
+                                    force_interdiff, False,
+                                    render_rows=(0, 0))
+        ]
+
+    key = "diff-chunk-index-" + _get_file_chunks_key(filediff, interfilediff,
+                                                     force_interdiff)
+
+    return cache_memoize(key, build_index, large_data=True)
+
+
+def get_chunks_in_row_range(file, chunk_index, first_row, last_row,
+                            enable_syntax_highlighting=True):
+    """Returns the chunks covering a range of rows in a file's diff.
+
+    This accepts a file (generated by get_diff_files), the file's index
+    (generated by get_chunk_index), and the first and last virtual row
+    numbers (inclusive) to return.
+
+    Only the lines within the range are rendered, and chunks past the range
+    are never generated. Chunks that are only partially within the range
+    are trimmed down to the lines that are inside it.
+    """
+    windowed_index = [
+        entry
+        for entry in chunk_index
+        if (entry['first_row'] <= last_row and
+            entry['first_row'] + entry['numlines'] - 1 >= first_row)
+    ]
+
+    if not windowed_index:
+        return []
+
+    first_index = windowed_index[0]['index']
+    last_index = windowed_index[-1]['index']
+    chunks = []
+
+    for chunk in get_chunks(file['filediff'].diffset, file['filediff'],
+                            file['interfilediff'], file['force_interdiff'],
+                            enable_syntax_highlighting,
+                            render_rows=(first_row, last_row)):
+        if chunk['index'] > last_index:
+            break
+        elif chunk['index'] < first_index:
+            continue
+
+        lines = [
+            line
+            for line in chunk['lines']
+            if first_row <= line[0] <= last_row
+        ]
+
+        chunk['lines'] = lines
+        chunk['numlines'] = len(lines)
+        chunks.append(chunk)
+
+    return chunks
+
+
 def get_file_chunks_in_range(context, filediff, interfilediff,
                              first_line, num_lines):
     """
@@ -0,0 +1,11 @@
+from django_evolution.mutations import AddField
+from django.db import models
+
+from reviewboard.diffviewer.fields import BinaryField
+
+
+MUTATIONS = [
+    AddField('FileDiffData', 'compressed_binary', BinaryField, null=True),
+    AddField('FileDiffData', 'data_format', models.CharField, initial='B',
+             max_length=1),
+]
@@ -0,0 +1,51 @@
+import base64
+
+from django.db import models
+from django.utils.importlib import import_module
+
+
+class BinaryField(models.Field):
+    """
+    A field for storing raw binary data.
+
+    Unlike Base64Field, the data is stored as-is in a binary column, with
+    no encoding overhead. Values read from the database may be buffers
+    rather than strings, depending on the database backend. Both can be
+    passed to str() or to functions like zlib.decompress.
+    """
+    DB_TYPES = {
+        'mysql': 'longblob',
+        'oracle': 'BLOB',
+        'postgresql': 'bytea',
+        'sqlite': 'BLOB',
+    }
+
+    def __init__(self, *args, **kwargs):
+        kwargs['editable'] = False
+        super(BinaryField, self).__init__(*args, **kwargs)
+
+    def db_type(self, connection):
+        return self.DB_TYPES.get(connection.vendor, 'BLOB')
+
+    def get_db_prep_value(self, value, connection, prepared=False):
+        if value is not None:
+            # Each backend's module imports its database driver as Database.
+            database = import_module(connection.__module__).Database
+            value = database.Binary(value)
+
+        return value
+
+    def to_python(self, value):
+        # Serialized data is base64-encoded. See value_to_string.
+        if isinstance(value, basestring):
+            return base64.b64decode(value)
+
+        return value
+
+    def value_to_string(self, obj):
+        value = self._get_val_from_obj(obj)
+
+        if value is None:
+            return None
+
+        return base64.b64encode(str(value))
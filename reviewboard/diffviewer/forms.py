@@ -1,12 +1,15 @@
+import hashlib
 import os
 
 from django import forms
+from django.db import transaction
 from django.utils.encoding import smart_unicode
 from django.utils.translation import ugettext as _
 from djblets.siteconfig.models import SiteConfiguration
 
 from reviewboard.diffviewer.diffutils import DEFAULT_DIFF_COMPAT_VERSION
-from reviewboard.diffviewer.models import DiffSet, FileDiff
+from reviewboard.diffviewer.models import DiffSet, FileDiff, FileDiffData, \
+                                         FilePathToken
 from reviewboard.scmtools.core import PRE_CREATION, UNKNOWN, FileNotFoundError
 
 
@@ -110,27 +113,51 @@ class UploadDiffForm(forms.Form):
                 if f.origChangesetId:
                     parent_changeset_id = f.origChangesetId
 
-        diffset = DiffSet(name=diff_file.name, revision=0,
+        return self._create_diffset(diff_file.name, basedir, files,
+                                    parent_files, parent_changeset_id,
+                                    diffset_history)
+
+    @transaction.commit_on_success
+    def _create_diffset(self, name, basedir, files, parent_files,
+                        parent_changeset_id, diffset_history):
+        """Creates the DiffSet and its FileDiffs for the parsed files.
+
+        The diff data for every file is stored in one pass: existing
+        FileDiffData rows are looked up together, the missing ones are
+        created in bulk, and then all FileDiffs are inserted at once.
+        """
+        tool = self.repository.get_scmtool()
+
+        diffset = DiffSet(name=name, revision=0,
                           basedir=basedir,
                           history=diffset_history,
                           diffcompat=DEFAULT_DIFF_COMPAT_VERSION)
         diffset.repository = self.repository
         diffset.save()
 
+        parent_contents = {}
+
         for f in files:
             if f.origFile in parent_files:
-                parent_file = parent_files[f.origFile]
-                parent_content = parent_file.data
-                source_rev = parent_file.origInfo
-            else:
-                parent_content = ""
+                parent_contents[f.origFile] = parent_files[f.origFile].data
 
-                if (tool.diff_uses_changeset_ids and
-                    parent_changeset_id and
-                    f.origInfo != PRE_CREATION):
-                    source_rev = parent_changeset_id
-                else:
-                    source_rev = f.origInfo
+        filediff_data = FileDiffData.objects.get_or_create_many_for_data(
+            [f.data for f in files] +
+            [data for data in parent_contents.itervalues() if data])
+
+        filediffs = []
+
+        for f in files:
+            parent_content = parent_contents.get(f.origFile, "")
+
+            if f.origFile in parent_files:
+                source_rev = parent_files[f.origFile].origInfo
+            elif (tool.diff_uses_changeset_ids and
+                  parent_changeset_id and
+                  f.origInfo != PRE_CREATION):
+                source_rev = parent_changeset_id
+            else:
+                source_rev = f.origInfo
 
             dest_file = os.path.join(basedir, f.newFile).replace("\\", "/")
 
@@ -141,16 +168,25 @@ class UploadDiffForm(forms.Form):
             else:
                 status = FileDiff.MODIFIED
 
-            filediff = FileDiff(diffset=diffset,
-                                source_file=f.origFile,
-                                dest_file=dest_file,
-                                source_revision=smart_unicode(source_rev),
-                                dest_detail=f.newInfo,
-                                diff=f.data,
-                                parent_diff=parent_content,
-                                binary=f.binary,
-                                status=status)
-            filediff.save()
+            if parent_content:
+                parent_diff_hash = \
+                    filediff_data[hashlib.sha1(parent_content).hexdigest()]
+            else:
+                parent_diff_hash = None
+
+            filediffs.append(FileDiff(
+                diffset=diffset,
+                source_file=f.origFile,
+                dest_file=dest_file,
+                source_revision=smart_unicode(source_rev),
+                dest_detail=f.newInfo,
+                diff_hash=filediff_data[hashlib.sha1(f.data).hexdigest()],
+                parent_diff_hash=parent_diff_hash,
+                binary=f.binary,
+                status=status))
+
+        FileDiff.objects.bulk_create(filediffs)
+        FilePathToken.objects.index_diffset(diffset, filediffs)
 
         return diffset
 
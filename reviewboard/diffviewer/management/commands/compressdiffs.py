@@ -0,0 +1,50 @@
+import optparse
+
+from django.core.management.base import NoArgsCommand
+from django.db import transaction
+
+from reviewboard.diffviewer.models import FileDiffData
+
+
+class Command(NoArgsCommand):
+    option_list = NoArgsCommand.option_list + (
+        optparse.make_option('--batch-size', type='int', dest='batch_size',
+                             default=100,
+                             help='The number of diffs to convert at a time'),
+        )
+    help = ("Converts diffs stored in the old base64 format to the "
+            "compressed format, reporting the space saved.")
+
+    def handle_noargs(self, **options):
+        batch_size = options['batch_size']
+        last_hash = ''
+        num_converted = 0
+        old_size = 0
+        new_size = 0
+
+        while True:
+            batch = list(
+                FileDiffData.objects
+                    .filter(data_format=FileDiffData.FORMAT_BASE64,
+                            binary_hash__gt=last_hash)
+                    .order_by('binary_hash')[:batch_size])
+
+            if not batch:
+                break
+
+            with transaction.commit_on_success():
+                for filediff_data in batch:
+                    old_size += len(filediff_data.get_binary_base64())
+                    filediff_data.data = filediff_data.binary
+                    filediff_data.save()
+                    new_size += len(filediff_data.compressed_binary)
+
+            num_converted += len(batch)
+            last_hash = batch[-1].binary_hash
+
+            self.stdout.write('Converted %d diffs...\n' % num_converted)
+
+        self.stdout.write('Converted %d diffs from %d bytes to %d bytes, '
+                          'saving %d bytes.\n'
+                          % (num_converted, old_size, new_size,
+                             old_size - new_size))
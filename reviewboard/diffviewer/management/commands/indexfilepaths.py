@@ -0,0 +1,52 @@
+import optparse
+
+from django.core.management.base import NoArgsCommand
+from django.db import transaction
+
+from reviewboard.diffviewer.models import DiffSet, FilePathToken
+
+
+class Command(NoArgsCommand):
+    option_list = NoArgsCommand.option_list + (
+        optparse.make_option('--full', action='store_true', dest='full',
+                             default=False,
+                             help='Rebuild the index for every diffset, '
+                                  'instead of only those not yet indexed'),
+        optparse.make_option('--batch-size', type='int', dest='batch_size',
+                             default=100,
+                             help='The number of diffsets to index at a time'),
+        )
+    help = ("Indexes the file paths in existing diffsets, for looking up "
+            "review requests by the files they touch.")
+
+    def handle_noargs(self, **options):
+        batch_size = options['batch_size']
+        full = options['full']
+        last_id = 0
+        num_indexed = 0
+
+        diffsets = DiffSet.objects.all()
+
+        if full:
+            FilePathToken.objects.all().delete()
+        else:
+            diffsets = diffsets.filter(path_tokens__isnull=True)
+
+        while True:
+            batch = list(diffsets.filter(pk__gt=last_id)
+                                 .order_by('pk')[:batch_size])
+
+            if not batch:
+                break
+
+            with transaction.commit_on_success():
+                for diffset in batch:
+                    FilePathToken.objects.index_diffset(diffset)
+
+            num_indexed += len(batch)
+            last_id = batch[-1].pk
+
+            self.stdout.write('Indexed %d diffsets...\n' % num_indexed)
+
+        self.stdout.write('Indexed the file paths in %d diffsets.\n'
+                          % num_indexed)
@@ -1,4 +1,7 @@
-from django.db import models
+import hashlib
+import zlib
+
+from django.db import IntegrityError, models, transaction
 from djblets.util.fields import Base64DecodedValue
 
 
@@ -10,11 +13,191 @@ class FileDiffDataManager(models.Manager):
     forced to encode the data. This is a workaround to Base64Field checking
     if the object has been saved into the database using the pk.
     """
+    LOOKUP_BATCH_SIZE = 500
+
     def get_or_create(self, *args, **kwargs):
         defaults = kwargs.get('defaults', {})
 
-        if defaults and defaults['binary']:
+        if defaults.get('binary'):
             defaults['binary'] = \
                 Base64DecodedValue(kwargs['defaults']['binary'])
 
         return super(FileDiffDataManager, self).get_or_create(*args, **kwargs)
+
+    def get_or_create_for_data(self, data):
+        """Returns the FileDiffData for the given diff data.
+
+        The FileDiffData is looked up by the SHA1 of the data. If it doesn't
+        exist yet, it will be created, storing the data compressed.
+        """
+        filediff_data, is_new = self.get_or_create(
+            binary_hash=hashlib.sha1(data).hexdigest(),
+            defaults={
+                'compressed_binary': zlib.compress(data),
+                'data_format': self.model.FORMAT_ZLIB,
+            })
+
+        return filediff_data
+
+    def get_or_create_many_for_data(self, data_list):
+        """Returns the FileDiffData for each item in a list of diff data.
+
+        This is the bulk form of get_or_create_for_data. All existing rows
+        are looked up using as few queries as possible, and any missing rows
+        are created in a single bulk insert.
+
+        The result is a dictionary mapping the SHA1 of each item to its
+        FileDiffData.
+        """
+        data_by_hash = {}
+
+        for data in data_list:
+            data_by_hash.setdefault(hashlib.sha1(data).hexdigest(), data)
+
+        hashes = data_by_hash.keys()
+        result = {}
+
+        # Look up in batches, in order to stay within the limits some
+        # databases place on the number of query parameters.
+        for i in xrange(0, len(hashes), self.LOOKUP_BATCH_SIZE):
+            batch = hashes[i:i + self.LOOKUP_BATCH_SIZE]
+
+            for filediff_data in self.filter(binary_hash__in=batch):
+                result[filediff_data.binary_hash] = filediff_data
+
+        missing = [
+            self.model(binary_hash=binary_hash,
+                       compressed_binary=zlib.compress(data),
+                       data_format=self.model.FORMAT_ZLIB)
+            for binary_hash, data in data_by_hash.iteritems()
+            if binary_hash not in result
+        ]
+
+        if missing:
+            sid = transaction.savepoint(using=self.db)
+
+            try:
+                self.bulk_create(missing)
+                transaction.savepoint_commit(sid, using=self.db)
+
+                for filediff_data in missing:
+                    result[filediff_data.binary_hash] = filediff_data
+            except IntegrityError:
+                # Another upload created some of these in the meantime.
+                # Fall back on creating them one at a time.
+                transaction.savepoint_rollback(sid, using=self.db)
+
+                for filediff_data in missing:
+                    binary_hash = filediff_data.binary_hash
+                    result[binary_hash] = \
+                        self.get_or_create_for_data(data_by_hash[binary_hash])
+
+        return result
+
+
+class FilePathTokenManager(models.Manager):
+    """A manager for FilePathToken.
+
+    This maintains an index of the files touched by each diffset. For each
+    file path in a diffset, the following are stored:
+
+    * Every suffix of the path, such as ``main.cc``, ``linux/main.cc`` and
+      ``player/linux/main.cc`` for ``/trunk/player/linux/main.cc``.
+    * Every run of directories in the path, such as ``player``,
+      ``trunk/player``, and ``player/linux``.
+    * The full path and each directory prefix, anchored at the root.
+
+    Each of these is stored as a hash, which allows for fast lookups of
+    diffsets touching a file or directory regardless of the path's length.
+    """
+    FILE = 'F'
+    DIRECTORY = 'D'
+    ROOT_FILE = '/F'
+    ROOT_DIRECTORY = '/D'
+
+    def index_diffset(self, diffset, filediffs=None):
+        """Adds the paths of all files in a diffset to the index.
+
+        ``filediffs`` can be passed if the diffset's FileDiffs have already
+        been loaded.
+        """
+        if filediffs is None:
+            filediffs = diffset.files.all()
+
+        token_hashes = set()
+
+        for filediff in filediffs:
+            for path in (filediff.source_file, filediff.dest_file):
+                for kind, token in self.get_tokens(path):
+                    token_hashes.add(self.get_token_hash(kind, token))
+
+        self.bulk_create([
+            self.model(diffset=diffset, token_hash=token_hash)
+            for token_hash in token_hashes
+        ])
+
+    def get_histories_touching(self, path):
+        """Returns the IDs of diffset histories containing a path.
+
+        If the path ends with ``/``, it's treated as a directory, and the
+        result includes any history touching a file under that directory.
+        Otherwise, it may name either a file or a directory. A path starting
+        with ``/`` must match from the top of the repository. Otherwise, it
+        can match the end of a file's path, or any of its directories.
+
+        This returns a values queryset that can be used as a subquery.
+        """
+        is_directory = path.rstrip().endswith('/')
+        components = self._split_path(path)
+
+        if not components:
+            return self.none().values('diffset__history')
+
+        token = '/'.join(components)
+
+        if path.lstrip().startswith('/'):
+            kinds = [self.ROOT_DIRECTORY]
+
+            if not is_directory:
+                kinds.append(self.ROOT_FILE)
+        else:
+            kinds = [self.DIRECTORY]
+
+            if not is_directory:
+                kinds.append(self.FILE)
+
+        return self.filter(
+            token_hash__in=[self.get_token_hash(kind, token)
+                            for kind in kinds]).values('diffset__history')
+
+    def get_tokens(self, path):
+        """Yields the (kind, token) pairs to index for a file path."""
+        components = self._split_path(path)
+
+        if not components:
+            return
+
+        dirs = components[:-1]
+
+        for i in xrange(len(components)):
+            yield self.FILE, '/'.join(components[i:])
+
+        for i in xrange(len(dirs)):
+            for j in xrange(i + 1, len(dirs) + 1):
+                yield self.DIRECTORY, '/'.join(dirs[i:j])
+
+        yield self.ROOT_FILE, '/'.join(components)
+
+        for i in xrange(1, len(dirs) + 1):
+            yield self.ROOT_DIRECTORY, '/'.join(dirs[:i])
+
+    def get_token_hash(self, kind, token):
+        return hashlib.sha1(
+            ('%s:%s' % (kind, token)).encode('utf-8')).hexdigest()
+
+    def _split_path(self, path):
+        return [
+            component
+            for component in path.strip().replace('\\', '/').split('/')
+            if component
+        ]
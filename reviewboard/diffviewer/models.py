@@ -1,25 +1,54 @@
-import hashlib
+import zlib
 
 from django.db import models
 from django.utils import timezone
 from django.utils.translation import ugettext_lazy as _
 from djblets.util.fields import Base64Field
 
-from reviewboard.diffviewer.managers import FileDiffDataManager
+from reviewboard.diffviewer.fields import BinaryField
+from reviewboard.diffviewer.managers import FileDiffDataManager, \
+                                           FilePathTokenManager
 from reviewboard.scmtools.core import PRE_CREATION
 from reviewboard.scmtools.models import Repository
 
 
 class FileDiffData(models.Model):
     """
-    Contains hash and base64 pairs.
+    Contains hash and diff data pairs.
 
-    These pairs are used to reduce diff database storage.
+    These pairs are used to reduce diff database storage. Diffs are stored
+    zlib-compressed in ``compressed_binary``. Older rows may instead store
+    the uncompressed diff as base64 in ``binary``, which is indicated by
+    ``data_format``. Callers should use ``data``, which handles both.
     """
+    FORMAT_BASE64 = 'B'
+    FORMAT_ZLIB = 'Z'
+
+    FORMATS = (
+        (FORMAT_BASE64, _('Base64')),
+        (FORMAT_ZLIB, _('Zlib compressed')),
+    )
+
     binary_hash = models.CharField(_("hash"), max_length=40, primary_key=True)
-    binary = Base64Field(_("base64"))
+    binary = Base64Field(_("base64"), blank=True)
+    compressed_binary = BinaryField(_("compressed data"), null=True)
+    data_format = models.CharField(_("data format"), max_length=1,
+                                   choices=FORMATS, default=FORMAT_BASE64)
     objects = FileDiffDataManager()
 
+    def _get_data(self):
+        if self.data_format == self.FORMAT_ZLIB:
+            return zlib.decompress(self.compressed_binary)
+        else:
+            return self.binary
+
+    def _set_data(self, data):
+        self.compressed_binary = zlib.compress(data)
+        self.binary = ''
+        self.data_format = self.FORMAT_ZLIB
+
+    data = property(_get_data, _set_data)
+
 
 class FileDiff(models.Model):
     """
@@ -85,14 +114,11 @@ class FileDiff(models.Model):
             return self.diff64
         else:
             # Data exists in FileDiffData, retrieve it.
-            return self.diff_hash.binary
+            return self.diff_hash.data
 
     def _set_diff(self, diff):
-        hashkey = self._hash_hexdigest(diff)
-
         # Add hash to table if it doesn't exist, and set diff_hash to this.
-        self.diff_hash, is_new = FileDiffData.objects.get_or_create(
-            binary_hash=hashkey, defaults={'binary': diff})
+        self.diff_hash = FileDiffData.objects.get_or_create_for_data(diff)
         self.diff64 = ""
 
     diff = property(_get_diff, _set_diff)
@@ -101,24 +127,17 @@ class FileDiff(models.Model):
         if not self.parent_diff_hash:
             return self.parent_diff64
         else:
-            return self.parent_diff_hash.binary
+            return self.parent_diff_hash.data
 
     def _set_parent_diff(self, parent_diff):
         if parent_diff != "":
-            hashkey = self._hash_hexdigest(parent_diff)
-
             # Add hash to table if it doesn't exist, and set diff_hash to this.
-            self.parent_diff_hash, is_new = FileDiffData.objects.get_or_create(
-                binary_hash=hashkey, defaults={'binary': parent_diff})
+            self.parent_diff_hash = \
+                FileDiffData.objects.get_or_create_for_data(parent_diff)
             self.parent_diff64 = ""
 
     parent_diff = property(_get_parent_diff, _set_parent_diff)
 
-    def _hash_hexdigest(self, diff):
-        hasher = hashlib.sha1()
-        hasher.update(diff)
-        return hasher.hexdigest()
-
     def __unicode__(self):
         return u"%s (%s) -> %s (%s)" % (self.source_file, self.source_revision,
                                         self.dest_file, self.dest_detail)
@@ -153,11 +172,11 @@ class DiffSet(models.Model):
         diffset otherwise.
         """
         if self.revision == 0 and self.history != None:
-            if self.history.diffsets.count() == 0:
-                # Start on revision 1. It's more human-grokable.
-                self.revision = 1
-            else:
-                self.revision = self.history.diffsets.latest().revision + 1
+            latest_revision = self.history.diffsets.aggregate(
+                revision=models.Max('revision'))['revision']
+
+            # Start on revision 1. It's more human-grokable.
+            self.revision = (latest_revision or 0) + 1
 
         if self.history:
             self.history.last_diff_updated = self.timestamp
@@ -173,6 +192,23 @@ class DiffSet(models.Model):
         ordering = ['revision', 'timestamp']
 
 
+class FilePathToken(models.Model):
+    """
+    An entry in the index of files touched by a diffset.
+
+    See FilePathTokenManager for how paths are indexed.
+    """
+    diffset = models.ForeignKey(DiffSet, related_name='path_tokens',
+                                verbose_name=_('diff set'))
+    token_hash = models.CharField(_('token hash'), max_length=40,
+                                  db_index=True)
+
+    objects = FilePathTokenManager()
+
+    def __unicode__(self):
+        return u'%s (diffset %s)' % (self.token_hash, self.diffset_id)
+
+
 class DiffSetHistory(models.Model):
     """
     A collection of diffsets.
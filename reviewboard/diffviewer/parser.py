@@ -29,6 +29,9 @@ class DiffParser(object):
 
     INDEX_SEP = "=" * 67
 
+    # The number of FileDiffs fetched at a time when generating raw diffs.
+    RAW_DIFF_BATCH_SIZE = 50
+
     def __init__(self, data):
         self.data = data
         self.lines = data.splitlines()
@@ -197,4 +200,28 @@ class DiffParser(object):
 
         The returned diff as composed of all FileDiffs in the provided diffset.
         """
-        return ''.join([filediff.diff for filediff in diffset.files.all()])
+        return ''.join(self.iter_raw_diff(diffset))
+
+    def iter_raw_diff(self, diffset):
+        """Returns a raw diff as an iterator of strings.
+
+        This yields the diff of each FileDiff in the provided diffset, in
+        order. FileDiffs and their diff data are fetched in batches of
+        RAW_DIFF_BATCH_SIZE, so only a batch at a time is held in memory.
+        This is suitable for streaming large diffs in a response.
+        """
+        last_pk = 0
+
+        while True:
+            filediffs = list(
+                diffset.files.filter(pk__gt=last_pk)
+                             .select_related('diff_hash')
+                             .order_by('pk')[:self.RAW_DIFF_BATCH_SIZE])
+
+            if not filediffs:
+                break
+
+            for filediff in filediffs:
+                yield filediff.diff
+
+            last_pk = filediffs[-1].pk
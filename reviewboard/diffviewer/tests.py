@@ -1,10 +1,15 @@
 import os
 import unittest
+from StringIO import StringIO
 
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.core.management import call_command
 from django.test import TestCase
 from djblets.siteconfig.models import SiteConfiguration
 
-from reviewboard.diffviewer.models import DiffSet, FileDiff
+from reviewboard.diffviewer.forms import UploadDiffForm
+from reviewboard.diffviewer.models import (DiffSet, DiffSetHistory, FileDiff,
+                                           FileDiffData, FilePathToken)
 from reviewboard.diffviewer.templatetags.difftags import highlightregion
 import reviewboard.diffviewer.diffutils as diffutils
 import reviewboard.diffviewer.parser as diffparser
@@ -141,6 +146,20 @@ class InterestingLinesTest(TestCase):
         self.assertEqual(lines[1][0], (1, 'class HelloWorld\n'))
         self.assertEqual(lines[1][1], (3, '\tdef helloWorld()\n'))
 
+    def testFileHeaders(self):
+        """Testing get_file_headers matches the interesting lines scanner"""
+        for filename in os.listdir(os.path.join(self.PREFIX, "orig_src")):
+            if not filename.startswith('helloworld.'):
+                continue
+
+            f = open(os.path.join(self.PREFIX, "orig_src", filename), "r")
+            a = f.readlines()
+            f.close()
+
+            headers = diffutils.get_file_headers(a, filename,
+                                                 'test-%s' % filename)
+            self.assertEqual(headers, self.__get_lines(filename)[0])
+
     def __get_lines(self, filename):
         f = open(os.path.join(self.PREFIX, "orig_src", filename), "r")
         a = f.readlines()
@@ -335,6 +354,22 @@ class DiffParserTest(unittest.TestCase):
             self.assertEqual(i_moves[0][j], i)
             self.assertEqual(r_moves[0][i], j)
 
+    def testCachedOpcodes(self):
+        """Testing get_diff_opcodes matches opcodes_with_metadata"""
+        old = self._get_file('orig_src', 'movetest1.c').splitlines()
+        new = self._get_file('new_src', 'movetest1.c').splitlines()
+        compat_version = diffutils.DEFAULT_DIFF_COMPAT_VERSION
+        differ = diffutils.Differ(old, new)
+        expected = list(diffutils.opcodes_with_metadata(differ))
+
+        # Fetch twice, so the second result comes from the cache.
+        for i in range(2):
+            self.assertEqual(
+                diffutils.get_diff_opcodes(old, new, 'test-movetest1-old',
+                                           'test-movetest1-new', False,
+                                           compat_version),
+                expected)
+
     def _get_file(self, *relative):
         f = open(os.path.join(*tuple([self.PREFIX] + list(relative))))
         data = f.read()
@@ -407,7 +442,7 @@ class HighlightRegionTest(TestCase):
 
 class DbTests(TestCase):
     """Unit tests for database operations."""
-    fixtures = ['test_scmtools.json']
+    fixtures = ['test_users', 'test_site', 'test_scmtools.json']
     PREFIX = os.path.join(os.path.dirname(__file__), 'testdata')
 
     def testLongFilenames(self):
@@ -448,3 +483,248 @@ class DbTests(TestCase):
         filediff2.save()
 
         self.assertEquals(filediff1.diff_hash, filediff2.diff_hash)
+
+    def testCompressedDiffData(self):
+        """Testing storing diffs compressed in FileDiffData"""
+        repository = Repository.objects.get(pk=3)
+        diffset = DiffSet.objects.create(name='test',
+                                         revision=1,
+                                         repository=repository)
+        data = self._get_file('diffs', 'unified', 'foo.c.diff')
+
+        filediff = FileDiff(diff=data, diffset=diffset)
+        filediff.save()
+
+        filediff = FileDiff.objects.get(pk=filediff.pk)
+        self.assertEqual(filediff.diff_hash.data_format,
+                         FileDiffData.FORMAT_ZLIB)
+        self.assertEqual(filediff.diff, data)
+
+    def testCompressDiffsCommand(self):
+        """Testing the compressdiffs management command with legacy diffs"""
+        repository = Repository.objects.get(pk=3)
+        diffset = DiffSet.objects.create(name='test',
+                                         revision=1,
+                                         repository=repository)
+        data = self._get_file('diffs', 'unified', 'foo.c.diff')
+
+        filediff_data, is_new = FileDiffData.objects.get_or_create(
+            binary_hash='legacy', defaults={'binary': data})
+        filediff = FileDiff.objects.create(diff_hash=filediff_data,
+                                           diffset=diffset)
+
+        filediff = FileDiff.objects.get(pk=filediff.pk)
+        self.assertEqual(filediff.diff_hash.data_format,
+                         FileDiffData.FORMAT_BASE64)
+        self.assertEqual(filediff.diff, data)
+
+        call_command('compressdiffs', stdout=StringIO())
+
+        filediff = FileDiff.objects.get(pk=filediff.pk)
+        self.assertEqual(filediff.diff_hash.data_format,
+                         FileDiffData.FORMAT_ZLIB)
+        self.assertEqual(filediff.diff_hash.get_binary_base64(), '')
+        self.assertEqual(filediff.diff, data)
+
+    def testPatchedFileCache(self):
+        """Testing that patched files are reused without refetching"""
+        filediff = self._create_foo_filediff()
+        orig_data = self._get_file('orig_src', 'foo.c')
+        new_data = self._get_file('new_src', 'foo.c')
+        fetches = []
+
+        def get_original_file(filediff):
+            fetches.append(filediff)
+            return orig_data
+
+        old_get_original_file = diffutils.get_original_file
+        diffutils.get_original_file = get_original_file
+
+        try:
+            self.assertEqual(diffutils.get_patched_file_for_filediff(filediff),
+                             new_data)
+            self.assertEqual(diffutils.get_patched_file_for_filediff(filediff),
+                             new_data)
+        finally:
+            diffutils.get_original_file = old_get_original_file
+
+        self.assertEqual(len(fetches), 1)
+
+    def testChunkIndex(self):
+        """Testing get_chunk_index and get_chunks_in_row_range"""
+        filediff = self._create_foo_filediff()
+        orig_data = self._get_file('orig_src', 'foo.c')
+
+        old_get_original_file = diffutils.get_original_file
+        diffutils.get_original_file = lambda filediff: orig_data
+
+        try:
+            files = diffutils.get_diff_files(filediff.diffset, filediff)
+            chunks = list(diffutils.get_chunks(filediff.diffset, filediff,
+                                               None, False, False))
+            chunk_index = diffutils.get_chunk_index(files[0])
+
+            self.assertEqual(len(chunk_index), len(chunks))
+
+            for entry, chunk in zip(chunk_index, chunks):
+                self.assertEqual(entry['index'], chunk['index'])
+                self.assertEqual(entry['change'], chunk['change'])
+                self.assertEqual(entry['first_row'], chunk['lines'][0][0])
+                self.assertEqual(entry['numlines'], chunk['numlines'])
+
+            # Fetch a window starting partway into the second chunk.
+            first_row = chunk_index[1]['first_row'] + 1
+            last_row = first_row + 4
+            window = diffutils.get_chunks_in_row_range(
+                files[0], chunk_index, first_row, last_row, False)
+        finally:
+            diffutils.get_original_file = old_get_original_file
+
+        expected_lines = [
+            line
+            for chunk in chunks
+            for line in chunk['lines']
+            if first_row <= line[0] <= last_row
+        ]
+
+        self.assertEqual(window[0]['index'], 1)
+        self.assertEqual([line for chunk in window for line in chunk['lines']],
+                         expected_lines)
+
+    def testIterRawDiff(self):
+        """Testing DiffParser.iter_raw_diff"""
+        repository = Repository.objects.get(pk=3)
+        diffset = DiffSet.objects.create(name='test',
+                                         revision=1,
+                                         repository=repository)
+        diffs = ['diff %d\n' % i for i in range(5)]
+
+        for diff in diffs:
+            FileDiff.objects.create(diff=diff, diffset=diffset)
+
+        parser = diffparser.DiffParser('')
+        parser.RAW_DIFF_BATCH_SIZE = 2
+
+        self.assertEqual(list(parser.iter_raw_diff(diffset)), diffs)
+        self.assertEqual(parser.raw_diff(diffset), ''.join(diffs))
+
+    def testUploadDiffFormBulkCreate(self):
+        """Testing UploadDiffForm.create storing all files in bulk"""
+        repository = Repository.objects.get(pk=3)
+        history = DiffSetHistory.objects.create(name='test')
+        diff = (
+            'diff --git a/README b/README\n'
+            'new file mode 100644\n'
+            'index 0000000..e69de29\n'
+            '--- /dev/null\n'
+            '+++ b/README\n'
+            '@@ -0,0 +1,1 @@\n'
+            '+Hello\n'
+            'diff --git a/NEWS b/NEWS\n'
+            'new file mode 100644\n'
+            'index 0000000..e69de29\n'
+            '--- /dev/null\n'
+            '+++ b/NEWS\n'
+            '@@ -0,0 +1,1 @@\n'
+            '+Goodbye\n'
+        )
+
+        diffsets = []
+
+        for i in range(2):
+            diff_file = SimpleUploadedFile('diff', diff)
+            form = UploadDiffForm(repository)
+            diffsets.append(form.create(diff_file, None, history))
+
+            if i == 0:
+                num_filediff_data = FileDiffData.objects.count()
+
+        # The second upload should reuse the stored diff data.
+        self.assertEqual(FileDiffData.objects.count(), num_filediff_data)
+        self.assertEqual([diffset.revision for diffset in diffsets], [1, 2])
+
+        files1 = list(diffsets[0].files.order_by('source_file'))
+        files2 = list(diffsets[1].files.order_by('source_file'))
+
+        self.assertEqual([f.source_file for f in files1], ['NEWS', 'README'])
+        self.assertEqual([f.diff_hash_id for f in files1],
+                         [f.diff_hash_id for f in files2])
+        self.assertTrue(files1[1].diff.endswith('+Hello\n'))
+        self.assertEqual(files1[1].parent_diff_hash, None)
+
+    def testFilePathIndex(self):
+        """Testing looking up diffsets by the file paths they touch"""
+        repository = Repository.objects.get(pk=3)
+        history = DiffSetHistory.objects.create(name='test')
+        diff = (
+            'diff --git a/player/linux/main.cc b/player/linux/main.cc\n'
+            'new file mode 100644\n'
+            'index 0000000..e69de29\n'
+            '--- /dev/null\n'
+            '+++ b/player/linux/main.cc\n'
+            '@@ -0,0 +1,1 @@\n'
+            '+Hello\n'
+        )
+        form = UploadDiffForm(repository)
+        form.create(SimpleUploadedFile('diff', diff), None, history)
+
+        other_history = DiffSetHistory.objects.create(name='other')
+        diffset = DiffSet.objects.create(name='other', revision=1,
+                                         history=other_history,
+                                         repository=repository)
+        FileDiff.objects.create(diffset=diffset,
+                                source_file='/vmuiLinux/main.cc',
+                                dest_file='/vmuiLinux/main.cc',
+                                source_revision='123')
+        FilePathToken.objects.index_diffset(diffset)
+
+        def touching(path):
+            return sorted(
+                h['diffset__history'] for h in
+                FilePathToken.objects.get_histories_touching(path))
+
+        both = sorted([history.pk, other_history.pk])
+        self.assertEqual(touching('main.cc'), both)
+        self.assertEqual(touching('linux/main.cc'), [history.pk])
+        self.assertEqual(touching('vmuiLinux/main.cc'), [other_history.pk])
+        self.assertEqual(touching('/player/linux/main.cc'), [history.pk])
+        self.assertEqual(touching('/linux/main.cc'), [])
+        self.assertEqual(touching('linux'), [history.pk])
+        self.assertEqual(touching('player/'), [history.pk])
+        self.assertEqual(touching('/linux/'), [])
+        self.assertEqual(touching('main.cc/'), [])
+        self.assertEqual(touching('Main.cc'), [])
+        self.assertEqual(touching('/'), [])
+
+    def testIndexFilePathsCommand(self):
+        """Testing the indexfilepaths management command"""
+        filediff = self._create_foo_filediff()
+        self.assertFalse(FilePathToken.objects.exists())
+
+        call_command('indexfilepaths', stdout=StringIO())
+
+        self.assertEqual(
+            FilePathToken.objects.filter(diffset=filediff.diffset).count(),
+            len(set(FilePathToken.objects.get_tokens(filediff.source_file))))
+
+    def _create_foo_filediff(self):
+        repository = Repository.objects.get(pk=3)
+        diffset = DiffSet.objects.create(name='test',
+                                         revision=1,
+                                         repository=repository)
+        filediff = FileDiff(source_file='/foo.c',
+                            dest_file='/foo.c',
+                            source_revision='123',
+                            diff=self._get_file('diffs', 'unified',
+                                                'foo.c.diff'),
+                            diffset=diffset)
+        filediff.save()
+
+        return filediff
+
+    def _get_file(self, *relative):
+        f = open(os.path.join(*((self.PREFIX,) + relative)), "r")
+        data = f.read()
+        f.close()
+
+        return data
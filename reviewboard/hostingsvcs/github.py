@@ -1,17 +1,26 @@
 import httplib
 import logging
+import re
+import socket
+import threading
+import time
 import urllib2
+import urlparse
+from StringIO import StringIO
 
 from django import forms
 from django.contrib.sites.models import Site
+from django.core.cache import cache
 from django.utils import simplejson
 from django.utils.translation import ugettext_lazy as _
 from djblets.siteconfig.models import SiteConfiguration
+from djblets.util.misc import cache_memoize, make_cache_key
 
 from reviewboard.hostingsvcs.errors import AuthorizationError, \
                                            SSHKeyAssociationError
 from reviewboard.hostingsvcs.forms import HostingServiceForm
-from reviewboard.hostingsvcs.service import HostingService
+from reviewboard.hostingsvcs.service import HostingService, \
+                                            is_serving_web_request
 from reviewboard.scmtools.errors import FileNotFoundError
 from reviewboard.site.urlresolvers import local_site_reverse
 
@@ -154,6 +163,21 @@ class GitHub(HostingService):
     API_URL = 'https://api.github.com/'
     RAW_MIMETYPE = 'application/vnd.github.v3.raw'
 
+    # Once fewer than this many API requests are left before the rate limit
+    # resets, requests are spaced out over the time remaining.
+    RATE_LIMIT_PACE_THRESHOLD = 100
+
+    # The longest time, in seconds, to hold a request back for pacing.
+    MAX_REQUEST_DELAY = 5
+
+    MAX_REDIRECTS = 5
+
+    _blob_sha_re = re.compile(r'^[0-9a-f]{40}$')
+
+    # Open connections to the API, kept for each thread so they can be
+    # reused between requests.
+    _connections = threading.local()
+
     def authorize(self, username, password, local_site_name=None,
                   *args, **kwargs):
         site = Site.objects.get_current()
@@ -200,18 +224,34 @@ class GitHub(HostingService):
     def get_file(self, repository, path, revision, *args, **kwargs):
         url = self._build_api_url(repository, 'git/blobs/%s' % revision)
 
-        try:
+        def fetch_blob():
             return self._http_get(url, headers={
                 'Accept': self.RAW_MIMETYPE,
             })[0]
+
+        try:
+            if self._blob_sha_re.match(revision):
+                # A blob's SHA-1 is the hash of its contents, so a fetched
+                # blob never needs to be fetched again.
+                return cache_memoize(
+                    self._get_blob_cache_key(repository, revision),
+                    lambda: [fetch_blob()],
+                    large_data=True)[0]
+            else:
+                return fetch_blob()
         except (urllib2.URLError, urllib2.HTTPError):
             raise FileNotFoundError(path, revision)
 
     def get_file_exists(self, repository, path, revision, *args, **kwargs):
+        if (self._blob_sha_re.match(revision) and
+            cache.has_key(make_cache_key(
+                self._get_blob_cache_key(repository, revision)))):
+            return True
+
         url = self._build_api_url(repository, 'git/blobs/%s' % revision)
 
         try:
-            self._http_get(url, headers={
+            self._http_head(url, headers={
                 'Accept': self.RAW_MIMETYPE,
             })
 
@@ -308,26 +348,177 @@ class GitHub(HostingService):
 
         return msg
 
-    def _http_get(self, url, *args, **kwargs):
-        data, headers = super(GitHub, self)._http_get(url, *args, **kwargs)
-        self._check_rate_limits(headers)
-        return data, headers
+    def _open_request(self, request):
+        """Performs an HTTP request to the GitHub API.
 
-    def _http_post(self, url, *args, **kwargs):
-        data, headers = super(GitHub, self)._http_post(url, *args, **kwargs)
-        self._check_rate_limits(headers)
-        return data, headers
+        Outside of a web request, such as in management commands, requests
+        are paced according to the rate limit for the account. While
+        serving a web request, nothing is held back, since that would stall
+        the page, but once the rate limit is used up the request fails
+        right away. Connections are reused for later requests from the same
+        thread.
+        """
+        if is_serving_web_request():
+            self._check_rate_limit_exhausted()
+        else:
+            delay = self._get_request_delay()
+
+            if delay > 0:
+                time.sleep(delay)
+
+        return self._send_request(request.get_method(),
+                                  request.get_full_url(),
+                                  request.get_data(),
+                                  dict(request.header_items()))
+
+    def _send_request(self, method, url, body, headers, num_redirects=0):
+        scheme, netloc, path, query, fragment = urlparse.urlsplit(url)
+
+        if query:
+            path += '?' + query
+
+        if 'User-agent' not in headers:
+            headers['User-agent'] = 'Review Board'
+
+        while True:
+            conn, is_new = self._get_connection(scheme, netloc)
+
+            try:
+                conn.request(method, path, body, headers)
+                response = conn.getresponse()
+                data = response.read()
+                break
+            except (httplib.HTTPException, socket.error), e:
+                self._close_connection(scheme, netloc)
+
+                # The server may have closed a connection we kept open, so
+                # try again on a new one. Only requests that are safe to
+                # repeat are tried again, since the server may have already
+                # handled the first one.
+                if is_new or method not in ('GET', 'HEAD'):
+                    raise urllib2.URLError(e)
+
+        if response.will_close:
+            self._close_connection(scheme, netloc)
+
+        self._check_rate_limits(response.msg)
+
+        location = response.getheader('Location')
+
+        if (response.status in (301, 302, 303, 307) and location and
+            method in ('GET', 'HEAD') and
+            num_redirects < self.MAX_REDIRECTS):
+            return self._send_request(method,
+                                      urlparse.urljoin(url, location),
+                                      None, headers, num_redirects + 1)
+        elif response.status >= 300:
+            raise urllib2.HTTPError(url, response.status, response.reason,
+                                    response.msg, StringIO(data))
+
+        return data, response.msg
+
+    def _get_connection(self, scheme, netloc):
+        """Returns a connection to a server, and whether it's new."""
+        if not hasattr(self._connections, 'conns'):
+            self._connections.conns = {}
+
+        key = (scheme, netloc)
+        conn = self._connections.conns.get(key)
+
+        if conn is not None:
+            return conn, False
+
+        if scheme == 'https':
+            conn = httplib.HTTPSConnection(netloc)
+        else:
+            conn = httplib.HTTPConnection(netloc)
+
+        self._connections.conns[key] = conn
+
+        return conn, True
+
+    def _close_connection(self, scheme, netloc):
+        conn = self._connections.conns.pop((scheme, netloc), None)
+
+        if conn is not None:
+            conn.close()
 
     def _check_rate_limits(self, headers):
+        """Records the rate limit reported in the response headers.
+
+        The rate limit is stored in the cache, so that every process using
+        the account can pace its requests.
+        """
         rate_limit_remaining = headers.get('X-RateLimit-Remaining', None)
 
         try:
-            if (rate_limit_remaining is not None and
-                int(rate_limit_remaining) <= 100):
-                logging.warning('GitHub rate limit for %s is down to %s',
-                                self.account.username, rate_limit_remaining)
-        except ValueError:
-            pass
+            rate_limit_remaining = int(rate_limit_remaining)
+        except (TypeError, ValueError):
+            return
+
+        if rate_limit_remaining <= self.RATE_LIMIT_PACE_THRESHOLD:
+            logging.warning('GitHub rate limit for %s is down to %s',
+                            self.account.username, rate_limit_remaining)
+
+        try:
+            rate_limit_reset = int(headers.get('X-RateLimit-Reset', None))
+        except (TypeError, ValueError):
+            return
+
+        cache.set(self._get_rate_limit_cache_key(),
+                  (rate_limit_remaining, rate_limit_reset),
+                  max(rate_limit_reset - int(time.time()), 1))
+
+    def _check_rate_limit_exhausted(self):
+        """Raises an error if the account's rate limit is used up.
+
+        This is a URLError, like other errors making the request, so that
+        callers handle it the same way.
+        """
+        rate_limit = cache.get(self._get_rate_limit_cache_key())
+
+        if rate_limit:
+            remaining, reset = rate_limit
+            time_left = int(reset - time.time())
+
+            if remaining <= 0 and time_left > 0:
+                logging.warning('Not making a GitHub API request for %s: the '
+                                'rate limit resets in %d seconds',
+                                self.account.username, time_left)
+                raise urllib2.URLError(
+                    'The GitHub API rate limit for %s has been used up. It '
+                    'resets in %d seconds.'
+                    % (self.account.username, time_left))
+
+    def _get_request_delay(self):
+        """Returns the number of seconds to wait before the next request.
+
+        Once the account's rate limit is running low, the remaining requests
+        are spread out evenly until the limit resets, rather than being used
+        up at once. Each call counts against the remaining requests, so that
+        processes making requests at the same time are spaced out as well.
+        """
+        key = self._get_rate_limit_cache_key()
+        rate_limit = cache.get(key)
+
+        if not rate_limit:
+            return 0
+
+        remaining, reset = rate_limit
+        time_left = reset - time.time()
+
+        if remaining > self.RATE_LIMIT_PACE_THRESHOLD or time_left <= 0:
+            return 0
+
+        cache.set(key, (max(remaining - 1, 0), reset), int(time_left) + 1)
+
+        return min(time_left / (remaining + 1), self.MAX_REQUEST_DELAY)
+
+    def _get_rate_limit_cache_key(self):
+        return 'github-rate-limit:%s' % self.account.username
+
+    def _get_blob_cache_key(self, repository, sha):
+        return 'github-blob:%s:%s' % (self._get_repo_api_url(repository), sha)
 
     def _build_api_url(self, repository, api_path):
         return '%s%s?access_token=%s' % (
@@ -0,0 +1,15 @@
+from reviewboard.hostingsvcs.service import set_serving_web_request
+
+
+class HostingServiceMiddleware(object):
+    """Middleware that tells hosting services when a web request is served.
+
+    See :py:func:`reviewboard.hostingsvcs.service.is_serving_web_request`.
+    """
+    def process_request(self, request):
+        set_serving_web_request(True)
+
+    def process_response(self, request, response):
+        set_serving_web_request(False)
+
+        return response
@@ -1,9 +1,11 @@
 import base64
 import logging
 import mimetools
+import threading
 import urllib2
 from pkg_resources import iter_entry_points
 
+from django.core.signals import request_finished
 from django.utils import simplejson
 from django.utils.translation import ugettext_lazy as _
 
@@ -179,8 +181,11 @@ class HostingService(object):
 
     def _http_get(self, url, *args, **kwargs):
         r = self._build_request(url, *args, **kwargs)
-        u = urllib2.urlopen(r)
-        return u.read(), u.headers
+        return self._open_request(r)
+
+    def _http_head(self, url, *args, **kwargs):
+        r = self._build_request(url, method='HEAD', *args, **kwargs)
+        return self._open_request(r)[1]
 
     def _http_post(self, url, body=None, fields={}, files={},
                    content_type=None, headers={}, *args, **kwargs):
@@ -198,13 +203,24 @@ class HostingService(object):
         headers['Content-Length'] = str(len(body))
 
         r = self._build_request(url, body, headers, **kwargs)
-        u = urllib2.urlopen(r)
+        return self._open_request(r)
+
+    def _open_request(self, request):
+        """Performs an HTTP request.
+
+        This returns a tuple of the response data and headers. Errors are
+        raised as urllib2.HTTPError or urllib2.URLError.
+        """
+        u = urllib2.urlopen(request)
         return u.read(), u.headers
 
     def _build_request(self, url, body=None, headers={}, username=None,
-                       password=None):
+                       password=None, method=None):
         r = urllib2.Request(url, body, headers)
 
+        if method is not None:
+            r.get_method = lambda: method
+
         if username is not None and password is not None:
             r.add_header(urllib2.HTTPBasicAuthHandler.auth_header,
                          'Basic %s' % base64.b64encode(username + ':' +
@@ -240,6 +256,32 @@ class HostingService(object):
         return content_type, content
 
 
+_request_state = threading.local()
+
+
+def set_serving_web_request(serving):
+    """Sets whether the current thread is serving a web request.
+
+    This is set by HostingServiceMiddleware. Hosting services can check it
+    with is_serving_web_request() to avoid holding up a page, such as by
+    waiting on an API rate limit.
+    """
+    _request_state.serving_web_request = serving
+
+
+def is_serving_web_request():
+    """Returns whether the current thread is serving a web request."""
+    return getattr(_request_state, 'serving_web_request', False)
+
+
+def _finish_web_request(**kwargs):
+    _request_state.serving_web_request = False
+
+
+request_finished.connect(_finish_web_request,
+                         dispatch_uid='hostingsvcs-finish-web-request')
+
+
 def get_hosting_services():
     """Gets the list of hosting services.
 
@@ -1,12 +1,81 @@
+import socket
+import threading
+import time
+import urllib2
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+from SocketServer import ThreadingMixIn
+
 from django.contrib.sites.models import Site
+from django.core.cache import cache
 from django.test import TestCase
 from django.utils import simplejson
 
 from reviewboard.hostingsvcs.models import HostingServiceAccount
-from reviewboard.hostingsvcs.service import get_hosting_service
+from reviewboard.hostingsvcs.service import get_hosting_service, \
+                                            set_serving_web_request
+from reviewboard.scmtools.errors import FileNotFoundError
 from reviewboard.scmtools.models import Repository
 
 
+class StubGitHubAPIServer(ThreadingMixIn, HTTPServer):
+    """A local HTTP server that stands in for the GitHub API in tests.
+
+    It serves the blobs in ``blobs`` for the myuser/myrepo repository, and
+    reports the rate limit in ``rate_limit``.
+    """
+    daemon_threads = True
+
+    def __init__(self):
+        HTTPServer.__init__(self, ('127.0.0.1', 0), StubGitHubAPIHandler)
+        self.url = 'http://127.0.0.1:%d/' % self.server_address[1]
+        self.blobs = {}
+        self.rate_limit = (5000, int(time.time()) + 3600)
+        self.requests = []
+        self.num_connections = 0
+
+        thread = threading.Thread(target=self.serve_forever)
+        thread.setDaemon(True)
+        thread.start()
+
+    def process_request(self, request, client_address):
+        self.num_connections += 1
+        ThreadingMixIn.process_request(self, request, client_address)
+
+
+class StubGitHubAPIHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        self.server.requests.append((self.command, self.path))
+
+        prefix = '/repos/myuser/myrepo/git/blobs/'
+        path, query = self.path.split('?', 1)
+        data = None
+
+        if path.startswith(prefix) and query == 'access_token=abc123':
+            data = self.server.blobs.get(path[len(prefix):])
+
+        if data is None:
+            self.send_response(404)
+            data = simplejson.dumps({'message': 'Not Found'})
+        else:
+            self.send_response(200)
+
+        self.send_header('Content-Length', str(len(data)))
+        self.send_header('X-RateLimit-Remaining',
+                         str(self.server.rate_limit[0]))
+        self.send_header('X-RateLimit-Reset', str(self.server.rate_limit[1]))
+        self.end_headers()
+
+        if self.command != 'HEAD':
+            self.wfile.write(data)
+
+    do_HEAD = do_GET
+
+    def log_message(self, *args):
+        pass
+
+
 class ServiceTests(TestCase):
     service_name = None
 
@@ -200,10 +269,16 @@ class GitHubTests(ServiceTests):
     def setUp(self):
         super(GitHubTests, self).setUp()
         self._old_format_public_key = self.service_class._format_public_key
+        self._old_api_url = self.service_class.API_URL
+        self.api_server = None
 
     def tearDown(self):
         super(GitHubTests, self).tearDown()
         self.service_class._format_public_key = self._old_format_public_key
+        self.service_class.API_URL = self._old_api_url
+
+        if self.api_server:
+            self.api_server.shutdown()
 
     def test_service_support(self):
         """Testing the GitHub service support capabilities"""
@@ -421,6 +496,136 @@ class GitHubTests(ServiceTests):
         self.assertEqual(http_post_data['kwargs']['username'], 'myuser')
         self.assertEqual(http_post_data['kwargs']['password'], 'mypass')
 
+    def test_get_file(self):
+        """Testing GitHub.get_file caching blobs"""
+        sha = 'a' * 40
+        server = self._start_api_server()
+        server.blobs[sha] = 'file data'
+        repository = self._get_repository()
+
+        self.assertEqual(repository.get_file('README', sha), 'file data')
+        self.assertEqual(repository.get_file('README', sha), 'file data')
+        self.assertEqual(server.requests, [
+            ('GET', '/repos/myuser/myrepo/git/blobs/%s?access_token=abc123'
+                    % sha),
+        ])
+
+        # The cached blob is known to exist without asking GitHub.
+        self.assertTrue(repository.get_file_exists('README', sha))
+        self.assertEqual(len(server.requests), 1)
+
+        self.assertRaises(FileNotFoundError,
+                          lambda: repository.get_file('README', 'b' * 40))
+
+    def test_get_file_exists(self):
+        """Testing GitHub.get_file_exists using HEAD requests"""
+        server = self._start_api_server()
+        server.blobs['a' * 40] = 'file data'
+        repository = self._get_repository()
+
+        self.assertTrue(repository.get_file_exists('README', 'a' * 40))
+        self.assertFalse(repository.get_file_exists('README', 'b' * 40))
+        self.assertEqual([method for method, path in server.requests],
+                         ['HEAD', 'HEAD'])
+
+        # Both requests went over the same connection.
+        self.assertEqual(server.num_connections, 1)
+
+    def test_rate_limit_pacing(self):
+        """Testing GitHub pacing requests when the rate limit is low"""
+        server = self._start_api_server()
+        repository = self._get_repository()
+        service = repository.hosting_service
+
+        repository.get_file_exists('README', 'a' * 40)
+        self.assertEqual(service._get_request_delay(), 0)
+
+        server.rate_limit = (99, int(time.time()) + 10)
+        repository.get_file_exists('README', 'a' * 40)
+        delay = service._get_request_delay()
+        self.assertTrue(0 < delay <= 0.1)
+
+        # Every request counts against the remaining limit, even before
+        # GitHub reports it.
+        self.assertTrue(service._get_request_delay() > delay)
+
+        server.rate_limit = (0, int(time.time()) + 3600)
+        repository.get_file_exists('README', 'a' * 40)
+        self.assertEqual(service._get_request_delay(),
+                         service.MAX_REQUEST_DELAY)
+
+    def test_rate_limit_in_web_request(self):
+        """Testing GitHub failing fast in web requests without rate limit"""
+        server = self._start_api_server()
+        repository = self._get_repository()
+        server.blobs['a' * 40] = 'file data'
+
+        server.rate_limit = (0, int(time.time()) + 3600)
+        self.assertTrue(repository.get_file_exists('README', 'a' * 40))
+
+        set_serving_web_request(True)
+
+        try:
+            start_time = time.time()
+            self.assertFalse(repository.get_file_exists('README', 'a' * 40))
+            self.assertTrue(time.time() - start_time < 1)
+        finally:
+            set_serving_web_request(False)
+
+        self.assertEqual(len(server.requests), 1)
+
+    def test_retry_on_reused_connection(self):
+        """Testing GitHub only retrying GET and HEAD on reused connections"""
+        class DroppedConnection(object):
+            def request(self, *args, **kwargs):
+                raise socket.error('Connection reset by peer')
+
+            def close(self):
+                pass
+
+        server = self._start_api_server()
+        service = self._get_repository().hosting_service
+        url = server.url + 'repos/myuser/myrepo/keys?access_token=abc123'
+        netloc = server.url.split('/')[2]
+
+        for method in ('POST', 'GET'):
+            service._get_connection('http', netloc)
+            service._connections.conns[('http', netloc)] = \
+                DroppedConnection()
+
+            if method == 'POST':
+                self.assertRaises(urllib2.URLError,
+                                  lambda: service._send_request(
+                                      method, url, '{}', {}))
+                self.assertEqual(server.requests, [])
+            else:
+                self.assertRaises(urllib2.HTTPError,
+                                  lambda: service._send_request(
+                                      method, url, None, {}))
+                self.assertEqual(server.requests,
+                                 [('GET', '/repos/myuser/myrepo/keys?'
+                                          'access_token=abc123')])
+
+    def _start_api_server(self):
+        cache.clear()
+
+        self.api_server = StubGitHubAPIServer()
+        self.service_class.API_URL = self.api_server.url
+
+        return self.api_server
+
+    def _get_repository(self):
+        account = self._get_hosting_account()
+        account.data['authorization'] = {'token': 'abc123'}
+
+        repository = Repository(hosting_account=account)
+        repository.extra_data = {
+            'repository_plan': 'public',
+            'github_public_repo_name': 'myrepo',
+        }
+
+        return repository
+
     def _get_repo_api_url(self, plan, fields):
         account = self._get_hosting_account()
         service = account.service
@@ -1,15 +1,23 @@
 import logging
 
 from django.conf import settings
+from django.contrib.auth.models import User
 from django.contrib.sites.models import Site
-from django.core.mail import EmailMultiAlternatives
+from django.core.cache import cache
+from django.core.mail import EmailMultiAlternatives, make_msgid
 from django.core.urlresolvers import reverse
+from django.db import transaction
+from django.db.models import Q
+from django.db.models.signals import m2m_changed, post_delete, post_init, \
+                                     post_save, pre_delete
 from django.template.loader import render_to_string
 from django.utils import timezone
 from djblets.siteconfig.models import SiteConfiguration
+from djblets.util.misc import make_cache_key
 
 from reviewboard.accounts.signals import user_registered
-from reviewboard.reviews.models import ReviewRequest, Review
+from reviewboard.notifications.models import DigestEvent, QueuedEmail
+from reviewboard.reviews.models import Group, ReviewRequest, Review
 from reviewboard.reviews.signals import review_request_published, \
                                         review_published, reply_published
 from reviewboard.reviews.views import build_diff_comment_fragments
@@ -60,6 +68,93 @@ def user_registered_cb(user, **kwargs):
         mail_new_user(user)
 
 
+def group_users_changed_cb(sender, instance, action, reverse, pk_set,
+                           **kwargs):
+    """
+    Listens for changes to the members of review groups, and invalidates
+    the cached e-mail addresses for the groups.
+
+    When ``reverse`` is set, ``instance`` is a user whose groups changed.
+    """
+    if action in ('post_add', 'post_remove'):
+        if reverse:
+            group_ids = pk_set
+        else:
+            group_ids = [instance.pk]
+    elif action == 'pre_clear' and reverse:
+        # The user's groups can't be looked up once they're cleared.
+        instance._rb_cleared_group_ids = \
+            list(instance.review_groups.values_list('pk', flat=True))
+        return
+    elif action == 'post_clear':
+        if reverse:
+            group_ids = getattr(instance, '_rb_cleared_group_ids', [])
+        else:
+            group_ids = [instance.pk]
+    else:
+        return
+
+    invalidate_group_email_addresses(group_ids)
+
+
+# The fields of a User that affect the e-mail addresses for its groups.
+USER_EMAIL_FIELDS = ('is_active', 'email', 'first_name', 'last_name')
+
+
+def _get_user_email_fields(user):
+    # Deferred fields aren't loaded here, so they show up as None, and will
+    # compare as changed.
+    return tuple([user.__dict__.get(field) for field in USER_EMAIL_FIELDS])
+
+
+def user_loaded_cb(sender, instance, **kwargs):
+    """
+    Listens for users being loaded, and remembers the fields used in their
+    e-mail addresses, so that user_changed_cb can tell if they've changed.
+    """
+    instance._rb_email_fields = _get_user_email_fields(instance)
+
+
+def user_changed_cb(sender, instance, created=False, **kwargs):
+    """
+    Listens for changes to users, which may change their names, e-mail
+    addresses or whether they're active, and invalidates the cached e-mail
+    addresses for their groups.
+
+    Saves that don't change any of those, such as updating the last login
+    time, are ignored.
+    """
+    if created:
+        return
+
+    fields = _get_user_email_fields(instance)
+
+    if fields != getattr(instance, '_rb_email_fields', None):
+        instance._rb_email_fields = fields
+        _invalidate_user_group_email_addresses(instance)
+
+
+def user_deleted_cb(sender, instance, **kwargs):
+    """
+    Listens for users being deleted, and invalidates the cached e-mail
+    addresses for their groups.
+    """
+    _invalidate_user_group_email_addresses(instance)
+
+
+def _invalidate_user_group_email_addresses(user):
+    invalidate_group_email_addresses(
+        user.review_groups.values_list('pk', flat=True))
+
+
+def group_changed_cb(sender, instance, **kwargs):
+    """
+    Listens for changes to review groups, which may change their mailing
+    lists, and invalidates their cached e-mail addresses.
+    """
+    invalidate_group_email_addresses([instance.pk])
+
+
 def connect_signals():
     review_request_published.connect(review_request_published_cb,
                                      sender=ReviewRequest)
@@ -67,6 +162,13 @@ def connect_signals():
     reply_published.connect(reply_published_cb, sender=Review)
     user_registered.connect(user_registered_cb)
 
+    m2m_changed.connect(group_users_changed_cb, sender=Group.users.through)
+    post_init.connect(user_loaded_cb, sender=User)
+    post_save.connect(user_changed_cb, sender=User)
+    pre_delete.connect(user_deleted_cb, sender=User)
+    post_save.connect(group_changed_cb, sender=Group)
+    post_delete.connect(group_changed_cb, sender=Group)
+
 
 def build_email_address(fullname, email):
     if not fullname:
@@ -80,19 +182,100 @@ def get_email_address_for_user(u):
 
 
 def get_email_addresses_for_group(g):
-    if g.mailing_list:
-        if g.mailing_list.find(",") == -1:
-            # The mailing list field has only one e-mail address in it,
-            # so we can just use that and the group's display name.
-            return [u'"%s" <%s>' % (g.display_name, g.mailing_list)]
+    return get_email_addresses_for_groups([g])[g.pk]
+
+
+def get_email_addresses_for_groups(groups):
+    """Returns the e-mail addresses for several review groups.
+
+    The result maps the ID of each group to a list of addresses. This is
+    either the group's mailing list, or the addresses of its active members.
+
+    The members' addresses for each group are cached until the group or its
+    members change. Those that aren't cached are looked up together, so this
+    takes the same number of queries regardless of the number of groups.
+    """
+    addresses = {}
+    group_keys = dict([
+        (_get_group_email_addresses_cache_key(group.pk), group)
+        for group in groups
+    ])
+    cached_addresses = cache.get_many(group_keys.keys())
+    missing_group_ids = []
+
+    for key, g in group_keys.iteritems():
+        if g.mailing_list:
+            if g.mailing_list.find(",") == -1:
+                # The mailing list field has only one e-mail address in it,
+                # so we can just use that and the group's display name.
+                addresses[g.pk] = [u'"%s" <%s>' % (g.display_name,
+                                                   g.mailing_list)]
+            else:
+                # The mailing list field has multiple e-mail addresses in
+                # it. We don't know which one should have the group's
+                # display name attached to it, so just return their custom
+                # list as-is.
+                addresses[g.pk] = g.mailing_list.split(',')
+        elif key in cached_addresses:
+            addresses[g.pk] = cached_addresses[key]
         else:
-            # The mailing list field has multiple e-mail addresses in it.
-            # We don't know which one should have the group's display name
-            # attached to it, so just return their custom list as-is.
-            return g.mailing_list.split(',')
-    else:
-        return [get_email_address_for_user(u)
-                for u in g.users.filter(is_active=True)]
+            addresses[g.pk] = []
+            missing_group_ids.append(g.pk)
+
+    if missing_group_ids:
+        members = Group.users.through.objects.filter(
+            group__in=missing_group_ids,
+            user__is_active=True).values_list('group', 'user__first_name',
+                                              'user__last_name',
+                                              'user__email')
+
+        for group_id, first_name, last_name, email in members:
+            # This matches User.get_full_name().
+            full_name = (u'%s %s' % (first_name, last_name)).strip()
+            addresses[group_id].append(build_email_address(full_name, email))
+
+        cache.set_many(
+            dict([
+                (_get_group_email_addresses_cache_key(group_id),
+                 addresses[group_id])
+                for group_id in missing_group_ids
+            ]),
+            settings.CACHE_EXPIRATION_TIME)
+
+    return addresses
+
+
+def invalidate_group_email_addresses(group_ids):
+    """Invalidates the cached e-mail addresses for review groups."""
+    keys = [_get_group_email_addresses_cache_key(group_id)
+            for group_id in group_ids]
+
+    if keys:
+        cache.delete_many(keys)
+
+
+def _get_group_email_addresses_cache_key(group_id):
+    return make_cache_key('group-email-addresses:%s' % group_id)
+
+
+def get_digest_users(user_ids, group_ids):
+    """Returns the users who receive e-mail about a change in a digest.
+
+    ``user_ids`` are the IDs of the users who would be e-mailed directly,
+    and ``group_ids`` are the IDs of the groups whose members would be. Of
+    those, the active users who have chosen to receive digests are returned,
+    using one query. If digests are turned off, this is always empty.
+    """
+    if not getattr(settings, 'EMAIL_DIGEST_WINDOW', None):
+        return []
+
+    q = Q(pk__in=user_ids)
+
+    if group_ids:
+        q = q | Q(review_groups__in=group_ids)
+
+    return list(User.objects.filter(q, is_active=True,
+                                    profile__email_digest=True).distinct())
 
 
 class SpiffyEmailMessage(EmailMultiAlternatives):
@@ -101,8 +284,9 @@ class SpiffyEmailMessage(EmailMultiAlternatives):
     This also knows about several headers (standard and variations),
     including Sender/X-Sender, In-Reply-To/References, and Reply-To.
 
-    The generated Message-ID header from the e-mail can be accessed
-    through the :py:attr:`message_id` attribute after the e-mail is sent.
+    The Message-ID header is generated up-front, and can be accessed
+    through the :py:attr:`message_id` attribute, even if the e-mail is
+    queued to be sent later.
     """
     def __init__(self, subject, text_body, html_body, from_email, sender,
                  to, cc, in_reply_to, headers={}):
@@ -122,13 +306,14 @@ class SpiffyEmailMessage(EmailMultiAlternatives):
         # hopefully avoid auto replies.
         headers['Auto-Submitted'] = 'auto-generated'
         headers['From'] = from_email
+        headers['Message-ID'] = make_msgid()
 
         super(SpiffyEmailMessage, self).__init__(subject, text_body,
                                                  settings.DEFAULT_FROM_EMAIL,
                                                  to, headers=headers)
 
         self.cc = cc or []
-        self.message_id = None
+        self.message_id = headers['Message-ID']
 
         self.attach_alternative(html_body, "text/html")
 
@@ -144,10 +329,15 @@ class SpiffyEmailMessage(EmailMultiAlternatives):
 
 def send_review_mail(user, review_request, subject, in_reply_to,
                      extra_recipients, text_template_name,
-                     html_template_name, context={}):
+                     html_template_name, context={}, digest_event=None):
     """
     Formats and sends an e-mail out with the current domain and review request
     being added to the template context. Returns the resulting message ID.
+
+    If ``digest_event`` is given, it's an unsaved DigestEvent for the change
+    being e-mailed about. Recipients who receive digests are left off the
+    e-mail, and the event is saved for them instead. If that leaves nobody
+    to e-mail, nothing is sent and None is returned.
     """
     current_site = Site.objects.get_current()
 
@@ -155,29 +345,55 @@ def send_review_mail(user, review_request, subject, in_reply_to,
 
     recipients = set()
     to_field = set()
+    user_ids = set()
 
     if from_email:
         recipients.add(from_email)
+        user_ids.add(user.pk)
 
     if review_request.submitter.is_active:
         recipients.add(get_email_address_for_user(review_request.submitter))
+        user_ids.add(review_request.submitter_id)
 
     for u in review_request.target_people.filter(is_active=True):
         recipients.add(get_email_address_for_user(u))
         to_field.add(get_email_address_for_user(u))
+        user_ids.add(u.pk)
+
+    target_groups = list(review_request.target_groups.all())
 
-    for group in review_request.target_groups.all():
-        for address in get_email_addresses_for_group(group):
-            recipients.add(address)
+    for addresses in get_email_addresses_for_groups(target_groups).values():
+        recipients.update(addresses)
 
-    for profile in review_request.starred_by.all():
+    for profile in review_request.starred_by.select_related('user'):
         if profile.user.is_active:
             recipients.add(get_email_address_for_user(profile.user))
+            user_ids.add(profile.user_id)
 
     if extra_recipients:
         for recipient in extra_recipients:
             if recipient.is_active:
                 recipients.add(get_email_address_for_user(recipient))
+                user_ids.add(recipient.pk)
+
+    if digest_event is not None:
+        digest_users = get_digest_users(
+            user_ids,
+            [group.pk for group in target_groups if not group.mailing_list])
+
+        if digest_users:
+            for u in digest_users:
+                address = get_email_address_for_user(u)
+                recipients.discard(address)
+                to_field.discard(address)
+
+            digest_event.review_request = review_request
+            digest_event.user = user
+            digest_event.user_ids = [u.pk for u in digest_users]
+            digest_event.save()
+
+    if not recipients:
+        return None
 
     siteconfig = current_site.config.get()
     domain_method = siteconfig.get("site_domain_method")
@@ -202,14 +418,8 @@ def send_review_mail(user, review_request, subject, in_reply_to,
         to_field = recipients
         cc_field = set()
 
-    base_url = '%s://%s' % (domain_method, current_site.domain)
-
-    headers = {
-        'X-ReviewBoard-URL': base_url,
-        'X-ReviewRequest-URL': base_url + review_request.get_absolute_url(),
-        'X-ReviewGroup': ', '.join(group.name for group in \
-                                    review_request.target_groups.all())
-    }
+    headers = _get_review_request_headers(review_request, target_groups,
+                                          domain_method, current_site.domain)
 
     sender = None
 
@@ -226,7 +436,7 @@ def send_review_mail(user, review_request, subject, in_reply_to,
                                  from_email, sender, list(to_field),
                                  list(cc_field), in_reply_to, headers)
     try:
-        message.send()
+        QueuedEmail.objects.queue(message)
     except Exception, e:
         logging.error("Error sending e-mail notification with subject '%s' on "
                       "behalf of '%s' to '%s': %s",
@@ -239,6 +449,17 @@ def send_review_mail(user, review_request, subject, in_reply_to,
     return message.message_id
 
 
+def _get_review_request_headers(review_request, target_groups, domain_method,
+                                domain):
+    base_url = '%s://%s' % (domain_method, domain)
+
+    return {
+        'X-ReviewBoard-URL': base_url,
+        'X-ReviewRequest-URL': base_url + review_request.get_absolute_url(),
+        'X-ReviewGroup': ', '.join(group.name for group in target_groups)
+    }
+
+
 def mail_review_request(user, review_request, changedesc=None):
     """
     Send an e-mail representing the supplied review request.
@@ -272,14 +493,21 @@ def mail_review_request(user, review_request, changedesc=None):
         extra_context['change_text'] = changedesc.text
         extra_context['changes'] = changedesc.fields_changed
 
-    review_request.time_emailed = timezone.now()
-    review_request.email_message_id = \
+    message_id = \
         send_review_mail(user, review_request, subject, reply_message_id,
                          extra_recipients,
                          'notifications/review_request_email.txt',
                          'notifications/review_request_email.html',
-                         extra_context)
-    review_request.save()
+                         extra_context,
+                         DigestEvent(kind=DigestEvent.REVIEW_REQUEST,
+                                     changedesc=changedesc))
+
+    # If everyone gets this in a digest, nothing was sent, and the existing
+    # Message-ID is kept so that later e-mail is still threaded with it.
+    if message_id is not None:
+        review_request.time_emailed = timezone.now()
+        review_request.email_message_id = message_id
+        review_request.save()
 
 
 def mail_review(user, review):
@@ -302,7 +530,7 @@ def mail_review(user, review):
             review.ordered_comments, extra_context,
             "notifications/email_diff_comment_fragment.html")
 
-    review.email_message_id = \
+    message_id = \
         send_review_mail(user,
                          review_request,
                          u"Re: Review Request %d: %s" % (review_request.id, review_request.summary),
@@ -310,9 +538,13 @@ def mail_review(user, review):
                          None,
                          'notifications/review_email.txt',
                          'notifications/review_email.html',
-                         extra_context)
-    review.time_emailed = timezone.now()
-    review.save()
+                         extra_context,
+                         DigestEvent(kind=DigestEvent.REVIEW, review=review))
+
+    if message_id is not None:
+        review.email_message_id = message_id
+        review.time_emailed = timezone.now()
+        review.save()
 
 
 def mail_reply(user, reply):
@@ -337,7 +569,7 @@ def mail_reply(user, reply):
             extra_context,
             "notifications/email_diff_comment_fragment.html")
 
-    reply.email_message_id = \
+    message_id = \
         send_review_mail(user,
                          review_request,
                          u"Re: Review Request %d: %s" % (review_request.id, review_request.summary),
@@ -345,9 +577,168 @@ def mail_reply(user, reply):
                          review.participants,
                          'notifications/reply_email.txt',
                          'notifications/reply_email.html',
-                         extra_context)
-    reply.time_emailed = timezone.now()
-    reply.save()
+                         extra_context,
+                         DigestEvent(kind=DigestEvent.REPLY, review=reply))
+
+    if message_id is not None:
+        reply.email_message_id = message_id
+        reply.time_emailed = timezone.now()
+        reply.save()
+
+
+def send_digests():
+    """Sends the digests that are due.
+
+    Each review request's digest is sent once its first event is
+    ``settings.EMAIL_DIGEST_WINDOW`` seconds old. It covers all the events
+    for the review request so far. This returns the number of review
+    requests that digests were sent for.
+    """
+    window = getattr(settings, 'EMAIL_DIGEST_WINDOW', None)
+
+    if not window:
+        return 0
+
+    review_request_ids = \
+        DigestEvent.objects.get_due_review_request_ids(window)
+
+    for review_request_id in review_request_ids:
+        with transaction.commit_on_success():
+            events = list(
+                DigestEvent.objects.select_for_update()
+                    .filter(review_request=review_request_id)
+                    .select_related('review_request', 'user', 'review',
+                                    'changedesc')
+                    .order_by('timestamp', 'pk'))
+
+            if events:
+                mail_digest(events[0].review_request, events)
+                DigestEvent.objects.filter(
+                    pk__in=[event.pk for event in events]).delete()
+
+    return len(review_request_ids)
+
+
+def mail_digest(review_request, events):
+    """Sends digests of a list of DigestEvents for a review request.
+
+    Each user gets the events they would have been e-mailed about, in one
+    e-mail threaded with the rest of the review request's e-mail. Users
+    who would have been e-mailed about the same events share an e-mail,
+    so that it's only rendered once.
+    """
+    current_site = Site.objects.get_current()
+    siteconfig = current_site.config.get()
+    domain_method = siteconfig.get("site_domain_method")
+    review_request_url = review_request.get_absolute_url()
+
+    # Find the events for each user, and then the users for each set of
+    # events.
+    user_events = {}
+
+    for event in events:
+        for user_id in event.user_ids:
+            user_events.setdefault(user_id, []).append(event)
+
+    event_users = {}
+
+    for user_id, user_event_list in user_events.iteritems():
+        key = tuple([event.pk for event in user_event_list])
+        event_users.setdefault(key, []).append(user_id)
+
+    users = User.objects.in_bulk(user_events.keys())
+    comments = _get_digest_comments([event.review_id for event in events
+                                     if event.review_id])
+    headers = _get_review_request_headers(
+        review_request, list(review_request.target_groups.all()),
+        domain_method, current_site.domain)
+    subject = u"Re: Review Request %d: %s" % (review_request.id,
+                                              review_request.summary)
+
+    for event_ids, user_ids in event_users.iteritems():
+        to_field = [get_email_address_for_user(users[user_id])
+                    for user_id in sorted(user_ids)
+                    if user_id in users and users[user_id].is_active]
+
+        if not to_field:
+            continue
+
+        event_list = []
+
+        for event in user_events[user_ids[0]]:
+            if event.review_id:
+                url = '%s#review%d' % (review_request_url, event.review_id)
+            else:
+                url = review_request_url
+
+            if event.changedesc:
+                fields_changed = sorted(event.changedesc.fields_changed)
+            else:
+                fields_changed = []
+
+            # The user who made the change may have been deleted since.
+            if event.user:
+                user_name = (event.user.get_full_name() or
+                             event.user.username)
+            else:
+                user_name = 'A deleted user'
+
+            event_list.append({
+                'kind': event.kind,
+                'user': event.user,
+                'user_name': user_name,
+                'timestamp': event.timestamp,
+                'review': event.review,
+                'changedesc': event.changedesc,
+                'fields_changed': fields_changed,
+                'comments': comments.get(event.review_id, []),
+                'url': url,
+            })
+
+        context = {
+            'domain': current_site.domain,
+            'domain_method': domain_method,
+            'review_request': review_request,
+            'events': event_list,
+        }
+
+        if review_request.local_site:
+            context['local_site_name'] = review_request.local_site.name
+
+        text_body = render_to_string('notifications/digest_email.txt',
+                                     context)
+        html_body = render_to_string('notifications/digest_email.html',
+                                     context)
+
+        message = SpiffyEmailMessage(subject, text_body, html_body,
+                                     settings.DEFAULT_FROM_EMAIL, None,
+                                     to_field, None,
+                                     review_request.email_message_id,
+                                     headers)
+
+        try:
+            QueuedEmail.objects.queue(message)
+        except Exception, e:
+            logging.error("Error sending e-mail digest with subject '%s' "
+                          "to '%s': %s",
+                          subject, ','.join(to_field), e, exc_info=1)
+
+
+def _get_digest_comments(review_ids):
+    """Returns the comments on reviews, keyed by the review ID."""
+    comments = {}
+
+    if review_ids:
+        review_comments = Review.comments.through.objects.filter(
+            review__in=review_ids).select_related('comment__filediff')
+        review_comments = review_comments.order_by('comment__filediff',
+                                                   'comment__first_line')
+
+        for review_comment in review_comments:
+            comments.setdefault(review_comment.review_id, []).append(
+                review_comment.comment)
+
+    return comments
 
 
 def mail_new_user(user):
@@ -375,7 +766,7 @@ def mail_new_user(user):
                                   for a in settings.ADMINS], None, None)
 
     try:
-        message.send()
+        QueuedEmail.objects.queue(message)
     except Exception, e:
         logging.error("Error sending e-mail notification with subject '%s' on "
                       "behalf of '%s' to admin: %s",
@@ -0,0 +1,41 @@
+import logging
+import optparse
+import time
+
+from django.core.management.base import NoArgsCommand
+
+from reviewboard.notifications.email import send_digests
+
+
+class Command(NoArgsCommand):
+    option_list = NoArgsCommand.option_list + (
+        optparse.make_option('--interval', type='float', dest='interval',
+                             default=None,
+                             help='Keep running, checking for digests to '
+                                  'send every INTERVAL seconds'),
+        )
+    help = ("Sends e-mail digests that are due. This is needed when "
+            "EMAIL_DIGEST_WINDOW is set.")
+
+    def handle_noargs(self, **options):
+        interval = options['interval']
+
+        while True:
+            try:
+                count = send_digests()
+            except Exception, e:
+                if interval is None:
+                    raise
+
+                logging.error('Error sending e-mail digests: %s', e,
+                              exc_info=1)
+                count = 0
+
+            if count:
+                self.stdout.write('Sent digests for %d review requests.\n'
+                                  % count)
+
+            if interval is None:
+                break
+
+            time.sleep(interval)
@@ -0,0 +1,70 @@
+import logging
+import optparse
+import time
+
+from django.core.mail import get_connection
+from django.core.management.base import NoArgsCommand
+
+from reviewboard.notifications.managers import close_connection
+from reviewboard.notifications.models import QueuedEmail
+
+
+class Command(NoArgsCommand):
+    option_list = NoArgsCommand.option_list + (
+        optparse.make_option('--batch-size', type='int', dest='batch_size',
+                             default=100,
+                             help='The number of e-mails to send at a time'),
+        optparse.make_option('--interval', type='float', dest='interval',
+                             default=None,
+                             help='Keep running, checking for new e-mails '
+                                  'every INTERVAL seconds'),
+        optparse.make_option('--retry-failed', action='store_true',
+                             dest='retry_failed', default=False,
+                             help='Try again to send e-mails that failed '
+                                  'too many times'),
+        )
+    help = ("Sends queued e-mails. This is needed when DEFER_EMAIL_SENDING "
+            "is set.")
+
+    def handle_noargs(self, **options):
+        batch_size = options['batch_size']
+        interval = options['interval']
+
+        if options['retry_failed']:
+            count = QueuedEmail.objects.retry_failed()
+            self.stdout.write('Queued %d failed e-mails to be sent again.\n'
+                              % count)
+
+        while True:
+            num_processed = 0
+
+            # One connection to the mail server is used for everything
+            # that's due now.
+            connection = get_connection()
+
+            try:
+                while True:
+                    count = QueuedEmail.objects.process_pending(
+                        batch_size, connection)
+
+                    if count == 0:
+                        break
+
+                    num_processed += count
+            except Exception, e:
+                if interval is None:
+                    raise
+
+                logging.error('Error sending queued e-mails: %s', e,
+                              exc_info=1)
+            finally:
+                close_connection(connection)
+
+            if num_processed:
+                self.stdout.write('Processed %d queued e-mails.\n'
+                                  % num_processed)
+
+            if interval is None:
+                break
+
+            time.sleep(interval)
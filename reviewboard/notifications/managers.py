@@ -0,0 +1,184 @@
+from __future__ import absolute_import
+
+import logging
+from datetime import timedelta
+from email.utils import formatdate
+
+from django.conf import settings
+from django.core.mail import get_connection
+from django.db import transaction
+from django.db.models import Manager
+from django.utils import timezone
+
+
+#: The number of seconds to wait before retrying an e-mail that couldn't be
+#: sent. This doubles after each failed attempt, up to MAX_RETRY_DELAY.
+RETRY_DELAY = 60
+
+#: The longest number of seconds to wait before retrying an e-mail.
+MAX_RETRY_DELAY = 60 * 60
+
+#: The number of attempts made to send an e-mail before giving up on it.
+MAX_ATTEMPTS = 10
+
+
+def close_connection(connection):
+    """Closes a connection to the mail server, ignoring any errors."""
+    try:
+        connection.close()
+    except Exception:
+        # Connections that were already closed or dropped can raise here.
+        pass
+
+
+class QueuedEmailManager(Manager):
+    """A manager for QueuedEmail models.
+
+    This queues up e-mails, and sends them in batches over a single
+    connection to the mail server.
+    """
+
+    def queue(self, message):
+        """Sends an e-mail, or queues it to be sent later.
+
+        If ``settings.DEFER_EMAIL_SENDING`` is set, the message is saved to
+        the database, to be sent later by :py:meth:`process_pending`, and
+        the new QueuedEmail is returned. Otherwise, it's sent immediately,
+        and any error sending it is raised.
+        """
+        if not getattr(settings, 'DEFER_EMAIL_SENDING', False):
+            message.send()
+            return None
+
+        headers = message.extra_headers.copy()
+
+        # The e-mail should be dated when it was written, not when it's sent.
+        if 'date' not in [name.lower() for name in headers]:
+            headers['Date'] = formatdate()
+
+        html_body = ''
+
+        for content, mimetype in getattr(message, 'alternatives', []):
+            if mimetype == 'text/html':
+                html_body = content
+
+        queued_email = self.model(subject=message.subject,
+                                  from_email=message.from_email,
+                                  text_body=message.body,
+                                  html_body=html_body)
+        queued_email.to = list(message.to)
+        queued_email.cc = list(message.cc)
+        queued_email.headers = headers
+        queued_email.save()
+
+        return queued_email
+
+    def process_pending(self, batch_size=100, connection=None):
+        """Sends a batch of queued e-mails that are due to be sent.
+
+        The e-mails are sent over ``connection``, which should already be
+        open, so that it can be reused for several batches. If it's not
+        given, a connection is opened for this batch.
+
+        Sent e-mails are removed from the queue. E-mails that couldn't be
+        sent are scheduled to be retried later. This returns the number of
+        e-mails that were processed, which will be 0 once there are none
+        left that are due.
+        """
+        with transaction.commit_on_success():
+            queued_emails = list(
+                self.select_for_update()
+                    .filter(failed=False, next_attempt__lte=timezone.now())
+                    .order_by('pk')[:batch_size])
+
+            if not queued_emails:
+                return 0
+
+            if connection is not None:
+                return self._send_emails(queued_emails, connection)
+
+            connection = get_connection()
+
+            try:
+                return self._send_emails(queued_emails, connection)
+            finally:
+                close_connection(connection)
+
+    def retry_failed(self):
+        """Queues up e-mails that failed to send, to be tried again.
+
+        This returns the number of e-mails that were queued again.
+        """
+        return self.filter(failed=True).update(failed=False, attempts=0,
+                                               next_attempt=timezone.now())
+
+    def _send_emails(self, queued_emails, connection):
+        sent_ids = []
+        num_processed = 0
+
+        # This does nothing if the connection is already open.
+        connection.open()
+
+        for queued_email in queued_emails:
+            num_processed += 1
+
+            try:
+                connection.send_messages([queued_email.get_message()])
+            except Exception, e:
+                self._record_failure(queued_email, e)
+
+                # The connection may have been dropped, so start over with
+                # a new one. If that can't be done, the rest of the e-mails
+                # are left for the next batch.
+                close_connection(connection)
+
+                try:
+                    connection.open()
+                except Exception:
+                    break
+            else:
+                sent_ids.append(queued_email.pk)
+
+        if sent_ids:
+            self.filter(pk__in=sent_ids).delete()
+
+        return num_processed
+
+    def _record_failure(self, queued_email, error):
+        queued_email.attempts += 1
+        queued_email.last_error = unicode(error)
+
+        if queued_email.attempts >= MAX_ATTEMPTS:
+            queued_email.failed = True
+            logging.error("Giving up on sending e-mail %d with subject '%s' "
+                          "after %d attempts: %s",
+                          queued_email.pk, queued_email.subject,
+                          queued_email.attempts, error)
+        else:
+            delay = min(RETRY_DELAY * 2 ** (queued_email.attempts - 1),
+                        MAX_RETRY_DELAY)
+            queued_email.next_attempt = \
+                timezone.now() + timedelta(seconds=delay)
+            logging.warning("Error sending e-mail %d with subject '%s'. "
+                            "Retrying in %d seconds: %s",
+                            queued_email.pk, queued_email.subject, delay,
+                            error)
+
+        queued_email.save()
+
+
+class DigestEventManager(Manager):
+    """A manager for DigestEvent models."""
+
+    def get_due_review_request_ids(self, window):
+        """Returns the IDs of review requests with digests due to be sent.
+
+        A digest is due once its first event is ``window`` seconds old.
+        """
+        cutoff = timezone.now() - timedelta(seconds=window)
+
+        return list(
+            self.filter(timestamp__lte=cutoff)
+                .order_by()
+                .values_list('review_request', flat=True)
+                .distinct())
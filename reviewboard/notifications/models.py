@@ -0,0 +1,93 @@
+from django.contrib.auth.models import User
+from django.core.mail import EmailMultiAlternatives
+from django.db import models
+from django.utils import timezone
+from django.utils.translation import ugettext_lazy as _
+from djblets.util.fields import JSONField
+
+from reviewboard.notifications.managers import DigestEventManager, \
+                                               QueuedEmailManager
+
+
+class QueuedEmail(models.Model):
+    """An e-mail waiting to be sent.
+
+    When ``settings.DEFER_EMAIL_SENDING`` is set, e-mails are stored here
+    instead of being sent while publishing, and are sent in batches by the
+    ``sendqueuedmail`` management command.
+
+    E-mails that can't be sent are retried later, waiting longer after each
+    attempt. After too many attempts, they're marked as failed, and are
+    left here until they're retried or removed.
+    """
+    subject = models.TextField(_('subject'))
+    from_email = models.CharField(_('from e-mail address'), max_length=254)
+    to = JSONField()
+    cc = JSONField()
+    headers = JSONField()
+    text_body = models.TextField(_('text body'))
+    html_body = models.TextField(_('HTML body'), blank=True)
+    time_added = models.DateTimeField(_('time added'), default=timezone.now)
+    next_attempt = models.DateTimeField(_('next attempt'),
+                                        default=timezone.now,
+                                        db_index=True)
+    attempts = models.IntegerField(_('attempts'), default=0)
+    last_error = models.TextField(_('last error'), blank=True)
+    failed = models.BooleanField(_('failed'), default=False)
+
+    objects = QueuedEmailManager()
+
+    def get_message(self):
+        """Returns the EmailMessage to send for this e-mail."""
+        message = EmailMultiAlternatives(self.subject, self.text_body,
+                                         self.from_email, self.to,
+                                         cc=self.cc, headers=self.headers)
+
+        if self.html_body:
+            message.attach_alternative(self.html_body, 'text/html')
+
+        return message
+
+    def __unicode__(self):
+        return self.subject
+
+
+class DigestEvent(models.Model):
+    """A change to a review request, waiting to be sent in a digest.
+
+    Users who've chosen to receive digests don't get e-mail for each change
+    to a review request. Instead, the change is stored here, along with the
+    IDs of those users, and the ``senddigests`` management command sends
+    the changes to each review request together once
+    ``settings.EMAIL_DIGEST_WINDOW`` seconds have passed since the first
+    one.
+    """
+    REVIEW_REQUEST = 'review_request'
+    REVIEW = 'review'
+    REPLY = 'reply'
+
+    KIND_CHOICES = (
+        (REVIEW_REQUEST, _('Review request published')),
+        (REVIEW, _('Review published')),
+        (REPLY, _('Reply published')),
+    )
+
+    kind = models.CharField(_('kind'), max_length=16, choices=KIND_CHOICES)
+    review_request = models.ForeignKey('reviews.ReviewRequest',
+                                       related_name='digest_events')
+    user = models.ForeignKey(User, blank=True, null=True, related_name='+',
+                             on_delete=models.SET_NULL)
+    review = models.ForeignKey('reviews.Review', blank=True, null=True,
+                               related_name='digest_events')
+    changedesc = models.ForeignKey('changedescs.ChangeDescription',
+                                   blank=True, null=True,
+                                   related_name='digest_events')
+    user_ids = JSONField()
+    timestamp = models.DateTimeField(_('timestamp'), default=timezone.now,
+                                     db_index=True)
+
+    objects = DigestEventManager()
+
+    def __unicode__(self):
+        return u'%s on %s (%s)' % (self.kind, self.review_request_id,
+                                   self.timestamp)
@@ -1,14 +1,30 @@
+import asyncore
+import smtpd
+import threading
+from datetime import timedelta
+
 from django.conf import settings
 from django.contrib.auth.models import User
 from django.core import mail
+from django.core.cache import cache
+from django.core.management import call_command
 from django.test import TestCase
+from django.test.utils import override_settings
+from django.utils import timezone
 from djblets.siteconfig.models import SiteConfiguration
 
 from reviewboard import initialize
+from reviewboard.accounts.models import Profile
 from reviewboard.admin.siteconfig import load_site_config
-from reviewboard.notifications.email import build_email_address, \
+from reviewboard.notifications.email import SpiffyEmailMessage, \
+                                            build_email_address, \
                                             get_email_address_for_user, \
-                                            get_email_addresses_for_group
+                                            get_email_addresses_for_group, \
+                                            get_email_addresses_for_groups, \
+                                            mail_review, \
+                                            mail_review_request, send_digests
+from reviewboard.notifications.managers import MAX_ATTEMPTS
+from reviewboard.notifications.models import DigestEvent, QueuedEmail
 from reviewboard.reviews.models import Group, Review, ReviewRequest
 
 
@@ -194,3 +210,364 @@ class ReviewRequestEmailTests(TestCase, EmailTestHelper):
 
     def _get_sender(self, user):
         return build_email_address(user.get_full_name(), self.sender)
+
+
+class GroupEmailAddressTests(TestCase):
+    """Tests for looking up and caching e-mail addresses for groups."""
+    fixtures = ['test_users']
+
+    def setUp(self):
+        initialize()
+        cache.clear()
+
+        self.doc = User.objects.get(username='doc')
+        self.grumpy = User.objects.get(username='grumpy')
+
+        self.group1 = Group.objects.create(name='group1')
+        self.group1.users.add(self.doc, self.grumpy)
+        self.group2 = Group.objects.create(name='group2')
+        self.group2.users.add(self.doc)
+        self.group3 = Group.objects.create(name='group3',
+                                           display_name='Group 3',
+                                           mailing_list='list@example.com')
+
+    def test_get_email_addresses_for_groups(self):
+        """Testing get_email_addresses_for_groups"""
+        groups = [self.group1, self.group2, self.group3]
+
+        # Any number of groups takes one query, and none once cached.
+        with self.assertNumQueries(1):
+            addresses = get_email_addresses_for_groups(groups)
+
+        with self.assertNumQueries(0):
+            self.assertEqual(get_email_addresses_for_groups(groups),
+                             addresses)
+
+        self.assertEqual(sorted(addresses[self.group1.pk]),
+                         sorted([get_email_address_for_user(self.doc),
+                                 get_email_address_for_user(self.grumpy)]))
+        self.assertEqual(addresses[self.group2.pk],
+                         [get_email_address_for_user(self.doc)])
+        self.assertEqual(addresses[self.group3.pk],
+                         [u'"Group 3" <list@example.com>'])
+
+    def test_invalidate_on_membership_change(self):
+        """Testing group e-mail addresses after membership changes"""
+        get_email_addresses_for_groups([self.group1, self.group2])
+
+        self.group2.users.add(self.grumpy)
+        self.assertEqual(len(get_email_addresses_for_group(self.group2)), 2)
+
+        self.grumpy.review_groups.remove(self.group2)
+        self.assertEqual(get_email_addresses_for_group(self.group2),
+                         [get_email_address_for_user(self.doc)])
+
+        self.doc.review_groups.clear()
+        self.assertEqual(get_email_addresses_for_group(self.group1),
+                         [get_email_address_for_user(self.grumpy)])
+        self.assertEqual(get_email_addresses_for_group(self.group2), [])
+
+    def test_invalidate_on_user_change(self):
+        """Testing group e-mail addresses after users change"""
+        get_email_addresses_for_groups([self.group1, self.group2])
+
+        self.doc.is_active = False
+        self.doc.save()
+        self.assertEqual(get_email_addresses_for_group(self.group1),
+                         [get_email_address_for_user(self.grumpy)])
+
+        self.grumpy.email = 'grumpy2@example.com'
+        self.grumpy.save()
+        self.assertEqual(get_email_addresses_for_group(self.group1),
+                         [get_email_address_for_user(self.grumpy)])
+
+        self.grumpy.delete()
+        self.assertEqual(get_email_addresses_for_group(self.group1), [])
+
+    def test_user_change_without_email_fields(self):
+        """Testing group e-mail addresses kept after unrelated user changes"""
+        get_email_addresses_for_groups([self.group1, self.group2])
+
+        self.doc.last_login = timezone.now()
+        self.doc.save()
+        self.assertNumQueries(
+            0,
+            lambda: get_email_addresses_for_groups([self.group1,
+                                                    self.group2]))
+
+
+class LocalSMTPServer(smtpd.SMTPServer):
+    """A local stand-in for a mail server, used for testing.
+
+    This records the e-mails sent to it and the number of connections made,
+    and can be told to reject e-mails.
+    """
+    def __init__(self):
+        smtpd.SMTPServer.__init__(self, ('127.0.0.1', 0), None)
+
+        self.port = self.socket.getsockname()[1]
+        self.messages = []
+        self.num_connections = 0
+        self.reject = False
+        self._running = False
+        self._thread = None
+
+    def start(self):
+        self._running = True
+        self._thread = threading.Thread(target=self._serve)
+        self._thread.setDaemon(True)
+        self._thread.start()
+
+    def stop(self):
+        self._running = False
+        self._thread.join()
+        asyncore.close_all()
+
+    def handle_accept(self):
+        self.num_connections += 1
+        smtpd.SMTPServer.handle_accept(self)
+
+    def process_message(self, peer, mailfrom, rcpttos, data):
+        if self.reject:
+            return '451 Try again later'
+
+        self.messages.append(data)
+
+    def _serve(self):
+        while self._running:
+            asyncore.loop(timeout=0.05, count=1)
+
+
+class QueuedEmailTests(TestCase):
+    """Tests for queueing e-mails with DEFER_EMAIL_SENDING."""
+    def setUp(self):
+        mail.outbox = []
+
+        self.smtp_server = LocalSMTPServer()
+        self.smtp_server.start()
+
+        self.settings_override = override_settings(
+            DEFER_EMAIL_SENDING=True,
+            EMAIL_BACKEND='django.core.mail.backends.smtp.EmailBackend',
+            EMAIL_HOST='127.0.0.1',
+            EMAIL_PORT=self.smtp_server.port,
+            EMAIL_HOST_USER='',
+            EMAIL_HOST_PASSWORD='',
+            EMAIL_USE_TLS=False)
+        self.settings_override.enable()
+
+    def tearDown(self):
+        self.settings_override.disable()
+        self.smtp_server.stop()
+
+    def _queue(self, subject='Review Request 1: Test'):
+        message = SpiffyEmailMessage(subject, 'Text body', '<p>HTML body</p>',
+                                     'doc@example.com', None,
+                                     ['grumpy@example.com'],
+                                     ['dopey@example.com'], None)
+        QueuedEmail.objects.queue(message)
+
+        return message
+
+    def test_queue(self):
+        """Testing QueuedEmailManager.queue with DEFER_EMAIL_SENDING"""
+        message = self._queue()
+
+        self.assertEqual(len(mail.outbox), 0)
+        self.assertEqual(self.smtp_server.messages, [])
+
+        queued_email = QueuedEmail.objects.get()
+        self.assertEqual(queued_email.subject, 'Review Request 1: Test')
+        self.assertEqual(queued_email.to, ['grumpy@example.com'])
+        self.assertEqual(queued_email.cc, ['dopey@example.com'])
+        self.assertEqual(queued_email.html_body, '<p>HTML body</p>')
+        self.assertEqual(queued_email.headers['Message-ID'],
+                         message.message_id)
+        self.assertTrue('Date' in queued_email.headers)
+
+    def test_queue_not_deferred(self):
+        """Testing QueuedEmailManager.queue without DEFER_EMAIL_SENDING"""
+        with override_settings(DEFER_EMAIL_SENDING=False):
+            self._queue()
+
+        self.assertEqual(len(self.smtp_server.messages), 1)
+        self.assertEqual(QueuedEmail.objects.count(), 0)
+
+    def test_sendqueuedmail(self):
+        """Testing sending queued e-mails over one connection"""
+        message = self._queue()
+        self._queue()
+        self._queue()
+
+        call_command('sendqueuedmail')
+
+        self.assertEqual(len(self.smtp_server.messages), 3)
+        self.assertEqual(self.smtp_server.num_connections, 1)
+        self.assertTrue('Message-ID: %s' % message.message_id
+                        in self.smtp_server.messages[0])
+        self.assertEqual(QueuedEmail.objects.count(), 0)
+
+    def test_retry(self):
+        """Testing retrying queued e-mails that couldn't be sent"""
+        self._queue()
+        self.smtp_server.reject = True
+
+        self.assertEqual(QueuedEmail.objects.process_pending(), 1)
+
+        queued_email = QueuedEmail.objects.get()
+        self.assertEqual(queued_email.attempts, 1)
+        self.assertFalse(queued_email.failed)
+        self.assertTrue(queued_email.next_attempt > timezone.now())
+        self.assertNotEqual(queued_email.last_error, '')
+
+        # It isn't retried until the next attempt is due.
+        self.smtp_server.reject = False
+        self.assertEqual(QueuedEmail.objects.process_pending(), 0)
+
+        queued_email.next_attempt = timezone.now() - timedelta(seconds=1)
+        queued_email.save()
+
+        self.assertEqual(QueuedEmail.objects.process_pending(), 1)
+        self.assertEqual(len(self.smtp_server.messages), 1)
+        self.assertEqual(QueuedEmail.objects.count(), 0)
+
+    def test_retry_failed(self):
+        """Testing giving up on queued e-mails, and retrying them"""
+        self._queue()
+        self.smtp_server.reject = True
+
+        QueuedEmail.objects.update(attempts=MAX_ATTEMPTS - 1)
+        QueuedEmail.objects.process_pending()
+
+        queued_email = QueuedEmail.objects.get()
+        self.assertTrue(queued_email.failed)
+        self.assertEqual(QueuedEmail.objects.process_pending(), 0)
+
+        self.assertEqual(QueuedEmail.objects.retry_failed(), 1)
+        self.smtp_server.reject = False
+        self.assertEqual(QueuedEmail.objects.process_pending(), 1)
+        self.assertEqual(len(self.smtp_server.messages), 1)
+
+
+class DigestTests(TestCase):
+    """Tests for sending e-mail digests with EMAIL_DIGEST_WINDOW."""
+    fixtures = ['test_users']
+
+    def setUp(self):
+        initialize()
+        cache.clear()
+
+        mail.outbox = []
+
+        siteconfig = SiteConfiguration.objects.get_current()
+        siteconfig.set("mail_send_review_mail", True)
+        siteconfig.save()
+        load_site_config()
+
+        self.settings_override = override_settings(EMAIL_DIGEST_WINDOW=600)
+        self.settings_override.enable()
+
+        self.doc = User.objects.get(username='doc')
+        self.grumpy = User.objects.get(username='grumpy')
+        self.dopey = User.objects.get(username='dopey')
+
+        profile = self.grumpy.get_profile()
+        profile.email_digest = True
+        profile.save()
+
+        self.review_request = ReviewRequest.objects.create(self.doc, None)
+        self.review_request.summary = 'Test digests'
+        self.review_request.public = True
+        self.review_request.save()
+        self.review_request.target_people.add(self.grumpy)
+
+    def tearDown(self):
+        self.settings_override.disable()
+
+    def test_digest(self):
+        """Testing sending changes to a review request in a digest"""
+        mail_review_request(self.doc, self.review_request)
+
+        self.assertEqual(len(mail.outbox), 1)
+        self.assertEqual(mail.outbox[0].to,
+                         [get_email_address_for_user(self.doc)])
+
+        review = Review.objects.create(review_request=self.review_request,
+                                       user=self.dopey,
+                                       body_top='Looks good to me.',
+                                       ship_it=True, public=True)
+        mail_review(self.dopey, review)
+
+        self.assertEqual(len(mail.outbox), 2)
+        self.assertFalse(get_email_address_for_user(self.grumpy) in
+                         mail.outbox[1].to + mail.outbox[1].cc)
+
+        events = DigestEvent.objects.order_by('pk')
+        self.assertEqual([event.kind for event in events],
+                         [DigestEvent.REVIEW_REQUEST, DigestEvent.REVIEW])
+        self.assertEqual(events[0].user_ids, [self.grumpy.pk])
+
+        # Nothing is sent until the window has passed.
+        self.assertEqual(send_digests(), 0)
+        self.assertEqual(len(mail.outbox), 2)
+
+        DigestEvent.objects.update(
+            timestamp=timezone.now() - timedelta(seconds=601))
+
+        self.assertEqual(send_digests(), 1)
+        self.assertEqual(len(mail.outbox), 3)
+        self.assertEqual(DigestEvent.objects.count(), 0)
+
+        message = mail.outbox[2]
+        self.assertEqual(message.to, [get_email_address_for_user(self.grumpy)])
+        self.assertEqual(message.subject,
+                         'Re: Review Request %d: Test digests'
+                         % self.review_request.pk)
+        self.assertEqual(message.extra_headers['In-Reply-To'],
+                         self.review_request.email_message_id)
+        self.assertTrue('Looks good to me.' in message.body)
+
+    def test_digest_only(self):
+        """Testing no e-mail is sent when every recipient gets digests"""
+        for user in (self.doc, self.dopey):
+            profile, is_new = Profile.objects.get_or_create(user=user)
+            profile.email_digest = True
+            profile.save()
+
+        review = Review.objects.create(review_request=self.review_request,
+                                       user=self.dopey,
+                                       body_top='Looks good to me.',
+                                       public=True)
+        mail_review(self.dopey, review)
+
+        self.assertEqual(len(mail.outbox), 0)
+        self.assertEqual(DigestEvent.objects.count(), 1)
+
+        review = Review.objects.get(pk=review.pk)
+        self.assertEqual(review.email_message_id, None)
+        self.assertEqual(review.time_emailed, None)
+
+    def test_digest_deleted_user(self):
+        """Testing digests with changes by a user who was since deleted"""
+        mail_review_request(self.dopey, self.review_request)
+        self.assertEqual(DigestEvent.objects.count(), 1)
+
+        self.dopey.delete()
+
+        event = DigestEvent.objects.get()
+        self.assertEqual(event.user, None)
+
+        DigestEvent.objects.update(
+            timestamp=timezone.now() - timedelta(seconds=601))
+        self.assertEqual(send_digests(), 1)
+        self.assertTrue('A deleted user' in mail.outbox[-1].body)
+
+    def test_digest_disabled(self):
+        """Testing e-mail is sent immediately without EMAIL_DIGEST_WINDOW"""
+        with override_settings(EMAIL_DIGEST_WINDOW=None):
+            mail_review_request(self.doc, self.review_request)
+
+        self.assertEqual(len(mail.outbox), 1)
+        self.assertTrue(get_email_address_for_user(self.grumpy) in
+                        mail.outbox[0].to)
+        self.assertEqual(DigestEvent.objects.count(), 0)
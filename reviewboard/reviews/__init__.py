@@ -0,0 +1,16 @@
+from reviewboard.signals import initializing
+
+
+def _connect_signals(**kwargs):
+    """
+    Listens to the ``initializing`` signal and connects the signals used
+    to track public updates to review requests and to keep the Dashboard
+    sidebar counts up to date.
+    """
+    from reviewboard.reviews import datagrids, updates
+
+    datagrids.connect_signals()
+    updates.connect_signals()
+
+
+initializing.connect(_connect_signals)
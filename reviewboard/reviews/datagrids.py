@@ -1,17 +1,23 @@
 import pytz
 import logging
 
+from django.conf import settings
 from django.contrib.auth.models import User
 from django.contrib.staticfiles.templatetags.staticfiles import static
+from django.core.cache import cache
+from django.db.models import Q
+from django.db.models.signals import m2m_changed, post_delete, post_save
 from django.http import Http404
 from django.template.defaultfilters import date
 from django.utils.datastructures import SortedDict
 from django.utils.html import conditional_escape
 from django.utils.translation import ugettext_lazy as _
 from djblets.datagrid.grids import Column, DateTimeColumn, DataGrid
+from djblets.util.misc import make_cache_key
 from djblets.util.templatetags.djblets_utils import ageid
 
 from reviewboard.accounts.models import Profile
+from reviewboard.admin.snapshot import get_request_snapshot
 from reviewboard.reviews.models import Group, ReviewRequest
 from reviewboard.reviews.templatetags.reviewtags import render_star
 from reviewboard.site.urlresolvers import local_site_reverse
@@ -704,7 +710,8 @@ class DashboardDataGrid(ReviewRequestDataGrid):
             raise Http404
 
         # Pre-load all querysets for the sidebar.
-        self.counts = get_sidebar_counts(user, self.local_site)
+        self.counts = get_sidebar_counts(user, self.local_site,
+                                         get_request_snapshot(self.request))
 
         return False
 
@@ -792,23 +799,126 @@ class WatchedGroupDataGrid(GroupDataGrid):
         self.queryset = self.queryset.filter(local_site=local_site)
 
         # Pre-load all querysets for the sidebar.
-        self.counts = get_sidebar_counts(user, local_site)
+        self.counts = get_sidebar_counts(user, local_site,
+                                         get_request_snapshot(request))
 
     def link_to_object(self, group, value):
         return ".?view=to-group&group=%s" % group.name
 
 
-def get_sidebar_counts(user, local_site):
-    """Returns counts used for the Dashboard sidebar."""
-    profile = user.get_profile()
+def _get_sidebar_counts_generation_key(local_site_id):
+    return make_cache_key('sidebar-counts-generation:%s' % local_site_id)
 
-    site_profile, is_new = user.get_profile().site_profiles.get_or_create(
-        local_site=local_site,
-        user=user,
-        profile=profile)
 
-    if is_new:
-        site_profile.save()
+def invalidate_sidebar_counts(local_site):
+    """Invalidates the cached Dashboard sidebar counts for a LocalSite.
+
+    This must be called whenever any of the counters shown in the sidebar
+    may have changed. Rather than deleting each user's cached counts, this
+    bumps a generation number that's part of every cache key for the
+    LocalSite.
+    """
+    _invalidate_sidebar_counts_for_local_site_id(local_site and local_site.pk)
+
+
+def _invalidate_sidebar_counts_for_local_site_id(local_site_id):
+    key = _get_sidebar_counts_generation_key(local_site_id)
+
+    try:
+        cache.incr(key)
+    except ValueError:
+        # The generation isn't in the cache yet. Anything cached under the
+        # old generation is now unreachable, so any value will do.
+        cache.set(key, 1, settings.CACHE_EXPIRATION_TIME)
+
+
+def _invalidate_sidebar_counts_for_groups(group_ids):
+    local_site_ids = set(
+        Group.objects.filter(pk__in=group_ids)
+            .values_list('local_site', flat=True))
+
+    for local_site_id in local_site_ids:
+        _invalidate_sidebar_counts_for_local_site_id(local_site_id)
+
+
+def _on_group_users_changed(sender, instance, action, reverse, pk_set,
+                            **kwargs):
+    """Invalidates the sidebar counts when a group's members change.
+
+    When ``reverse`` is set, ``instance`` is a user whose groups changed.
+    """
+    if action in ('post_add', 'post_remove'):
+        if reverse:
+            _invalidate_sidebar_counts_for_groups(pk_set)
+        else:
+            _invalidate_sidebar_counts_for_local_site_id(
+                instance.local_site_id)
+    elif action == 'pre_clear' and reverse:
+        # The user's groups can't be looked up once they're cleared.
+        instance._rb_sidebar_cleared_group_ids = \
+            list(instance.review_groups.values_list('pk', flat=True))
+    elif action == 'post_clear':
+        if reverse:
+            _invalidate_sidebar_counts_for_groups(
+                getattr(instance, '_rb_sidebar_cleared_group_ids', []))
+        else:
+            _invalidate_sidebar_counts_for_local_site_id(
+                instance.local_site_id)
+
+
+def _on_group_changed(sender, instance, **kwargs):
+    """Invalidates the sidebar counts when a group is renamed or deleted."""
+    _invalidate_sidebar_counts_for_local_site_id(instance.local_site_id)
+
+
+def connect_signals():
+    m2m_changed.connect(_on_group_users_changed,
+                        sender=Group.users.through)
+    post_save.connect(_on_group_changed, sender=Group)
+    post_delete.connect(_on_group_changed, sender=Group)
+
+
+def get_sidebar_counts(user, local_site, snapshot=None):
+    """Returns counts used for the Dashboard sidebar.
+
+    The counts are cached for the user and LocalSite, until they're
+    invalidated by :py:func:`invalidate_sidebar_counts`. If the counts are
+    computed for a request, its RequestSnapshot can be passed to reuse the
+    user's profiles.
+    """
+    generation_key = _get_sidebar_counts_generation_key(
+        local_site and local_site.pk)
+    generation = cache.get(generation_key)
+
+    if generation is None:
+        generation = 1
+        cache.add(generation_key, generation, settings.CACHE_EXPIRATION_TIME)
+
+    key = make_cache_key('sidebar-counts:%s:%s:%s' % (
+        user.pk, local_site and local_site.pk, generation))
+    counts = cache.get(key)
+
+    if counts is None:
+        counts = _get_sidebar_counts_uncached(user, local_site, snapshot)
+        cache.set(key, counts, settings.CACHE_EXPIRATION_TIME)
+
+    return counts
+
+
+def _get_sidebar_counts_uncached(user, local_site, snapshot=None):
+    """Computes the counts used for the Dashboard sidebar."""
+    if snapshot is not None:
+        profile = snapshot.profile
+        site_profile = snapshot.get_local_site_profile(local_site)
+    else:
+        profile = user.get_profile()
+        site_profile, is_new = profile.site_profiles.get_or_create(
+            local_site=local_site,
+            user=user,
+            profile=profile)
+
+        if is_new:
+            site_profile.save()
 
     counts = {
         'outgoing': site_profile.pending_outgoing_request_count,
@@ -820,12 +930,36 @@ def get_sidebar_counts(user, local_site):
         'starred_groups': SortedDict(),
     }
 
-    for group in Group.objects.filter(
-            users=user, local_site=local_site).order_by('name'):
-        counts['groups'][group.name] = group.incoming_request_count
-
-    for group in Group.objects.filter(
-            starred_by=profile, local_site=local_site).order_by('name'):
-        counts['starred_groups'][group.name] = group.incoming_request_count
+    # Fetch the groups the user belongs to and the groups they've starred
+    # at once, noting which list each group belongs in.
+    members = Group.users.through
+    starred = Profile.starred_groups.through
+    groups = Group.objects.filter(
+        Q(users=user) | Q(starred_by=profile),
+        local_site=local_site).distinct().order_by('name').extra(
+        select={
+            'is_member': 'EXISTS (SELECT 1 FROM %s WHERE %s = %s.%s AND '
+                         '%s = %%s)' % (
+                members._meta.db_table,
+                members._meta.get_field('group').column,
+                Group._meta.db_table,
+                Group._meta.pk.column,
+                members._meta.get_field('user').column),
+            'is_starred': 'EXISTS (SELECT 1 FROM %s WHERE %s = %s.%s AND '
+                          '%s = %%s)' % (
+                starred._meta.db_table,
+                starred._meta.get_field('group').column,
+                Group._meta.db_table,
+                Group._meta.pk.column,
+                starred._meta.get_field('profile').column),
+        },
+        select_params=(user.pk, profile.pk))
+
+    for group in groups:
+        if group.is_member:
+            counts['groups'][group.name] = group.incoming_request_count
+
+        if group.is_starred:
+            counts['starred_groups'][group.name] = group.incoming_request_count
 
     return counts
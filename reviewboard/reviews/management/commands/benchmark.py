@@ -0,0 +1,110 @@
+import optparse
+import time
+
+from django.core.management.base import CommandError, NoArgsCommand
+from django.utils import simplejson
+
+from reviewboard import get_version_string
+from reviewboard.benchmark import MIN_NUM_LINES, SCENARIOS, \
+                                  BenchmarkError, get_scenario, \
+                                  run_benchmarks
+
+
+class Command(NoArgsCommand):
+    option_list = NoArgsCommand.option_list + (
+        optparse.make_option('--scenarios', dest='scenarios', default=None,
+                             help='A comma-separated list of scenarios to '
+                                  'run (defaults to all of them)'),
+        optparse.make_option('--list', action='store_true',
+                             dest='list_scenarios', default=False,
+                             help='List the available scenarios'),
+        optparse.make_option('--iterations', type='int', dest='iterations',
+                             default=10,
+                             help='The number of times to run each scenario'),
+        optparse.make_option('--files', type='int', dest='num_files',
+                             default=5,
+                             help='The number of files in the generated diff'),
+        optparse.make_option('--lines', type='int', dest='num_lines',
+                             default=5000,
+                             help='The number of lines in each generated '
+                                  'file'),
+        optparse.make_option('--reviews', type='int', dest='num_reviews',
+                             default=20,
+                             help='The number of reviews on the review '
+                                  'request'),
+        optparse.make_option('--comments', type='int', dest='num_comments',
+                             default=5,
+                             help='The number of comments in each review'),
+        optparse.make_option('--seed', type='int', dest='seed', default=0,
+                             help='The seed used to generate files'),
+        optparse.make_option('--scm-latency', type='int', dest='scm_latency',
+                             default=0,
+                             help='The number of milliseconds each '
+                                  'repository operation takes'),
+        optparse.make_option('-o', '--output', dest='output', default=None,
+                             help='The file to write the results to '
+                                  '(defaults to standard output)'),
+        )
+    help = ("Benchmarks diff uploads, diff rendering, review request pages, "
+            "the dashboard, API lists and search indexing, and reports the "
+            "results as JSON.")
+
+    def handle_noargs(self, **options):
+        if options['list_scenarios']:
+            for scenario_cls in SCENARIOS:
+                self.stdout.write('%-20s %s\n' % (scenario_cls.name,
+                                                  scenario_cls.description))
+
+            return
+
+        if options['scenarios']:
+            scenario_names = [name.strip()
+                              for name in options['scenarios'].split(',')]
+
+            for name in scenario_names:
+                if get_scenario(name) is None:
+                    raise CommandError('Unknown scenario "%s". Use --list '
+                                       'to see the available scenarios.'
+                                       % name)
+        else:
+            scenario_names = None
+
+        if options['iterations'] < 1:
+            raise CommandError('--iterations must be at least 1')
+
+        if options['num_lines'] < MIN_NUM_LINES:
+            raise CommandError('--lines must be at least %d' % MIN_NUM_LINES)
+
+        data_options = {
+            'num_files': options['num_files'],
+            'num_lines': options['num_lines'],
+            'num_reviews': options['num_reviews'],
+            'num_comments': options['num_comments'],
+            'seed': options['seed'],
+            'scm_latency': options['scm_latency'],
+        }
+
+        start_time = time.time()
+
+        try:
+            results = run_benchmarks(scenario_names,
+                                     iterations=options['iterations'],
+                                     **data_options)
+        except BenchmarkError, e:
+            raise CommandError(unicode(e))
+
+        report = simplejson.dumps({
+            'version': get_version_string(),
+            'timestamp': time.strftime('%Y-%m-%dT%H:%M:%SZ',
+                                       time.gmtime(start_time)),
+            'iterations': options['iterations'],
+            'options': data_options,
+            'scenarios': results,
+        }, indent=2, sort_keys=True)
+
+        if options['output']:
+            fp = open(options['output'], 'w')
+            fp.write(report)
+            fp.close()
+        else:
+            self.stdout.write(report + '\n')
@@ -0,0 +1,75 @@
+import optparse
+
+from django.core.management.base import NoArgsCommand
+
+from reviewboard.accounts.models import LocalSiteProfile
+from reviewboard.reviews.datagrids import invalidate_sidebar_counts
+from reviewboard.reviews.models import Group, IncomingCounterUpdate
+
+
+class Command(NoArgsCommand):
+    option_list = NoArgsCommand.option_list + (
+        optparse.make_option('--dry-run', action='store_true',
+                             dest='dry_run', default=False,
+                             help="Report incorrect counters, but don't "
+                                  "fix them"),
+        )
+    help = ("Checks all review request-related counters against the "
+            "database, repairing any that have drifted.")
+
+    def handle_noargs(self, **options):
+        dry_run = options['dry_run']
+        local_sites = {}
+        num_fixed = 0
+
+        if IncomingCounterUpdate.objects.exists():
+            if dry_run:
+                self.stdout.write('There are queued counter updates. Run '
+                                  'processcounterupdates first for accurate '
+                                  'results.\n')
+            else:
+                # Queued updates would otherwise be applied on top of the
+                # repaired counters.
+                while IncomingCounterUpdate.objects.process_pending():
+                    pass
+
+        for model, field_names in (
+                (LocalSiteProfile, ('direct_incoming_request_count',
+                                    'total_incoming_request_count',
+                                    'pending_outgoing_request_count',
+                                    'total_outgoing_request_count',
+                                    'starred_public_request_count')),
+                (Group, ('incoming_request_count',))):
+            fields = [model._meta.get_field(field_name)
+                      for field_name in field_names]
+
+            for obj in model.objects.select_related('local_site'):
+                changes = {}
+
+                for field in fields:
+                    stored = getattr(obj, field.attname)
+                    expected = field._initializer(obj)
+
+                    if stored != expected:
+                        self.stdout.write('%s %s: %s is %s, should be %s\n'
+                                          % (model.__name__, obj.pk,
+                                             field.name, stored, expected))
+                        changes[field.attname] = expected
+
+                if changes:
+                    num_fixed += 1
+                    local_sites[obj.local_site_id] = obj.local_site
+
+                    if not dry_run:
+                        model.objects.filter(pk=obj.pk).update(**changes)
+
+        if not dry_run:
+            for local_site in local_sites.itervalues():
+                invalidate_sidebar_counts(local_site)
+
+        if dry_run:
+            self.stdout.write('Found %d objects with incorrect counters.\n'
+                              % num_fixed)
+        else:
+            self.stdout.write('Fixed %d objects with incorrect counters.\n'
+                              % num_fixed)
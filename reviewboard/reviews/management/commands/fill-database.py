@@ -2,9 +2,11 @@ import os
 import random
 import string
 import sys
+import time
 from optparse import make_option
 
 from django import db
+from django.conf import settings
 from django.contrib.auth.models import User
 from django.core.files.uploadedfile import UploadedFile
 from django.core.management.base import (
@@ -103,18 +105,23 @@ class Command(NoArgsCommand):
         make_option('--diff-comments', default=None, dest='diff_comments',
             help='The number of comments per diff [min:max]'),
         make_option('-p', '--password', type="string", default=None,
-            dest='password', help='The login password for users created')
+            dest='password', help='The login password for users created'),
+        make_option('--benchmark-diffs', action='store_true', default=False,
+            dest='benchmark_diffs',
+            help='Report the time (and queries, if DEBUG is on) spent '
+                 'creating each diff')
         )
 
     @transaction.commit_on_success
     def handle_noargs(self, users=None, review_requests=None, diffs=None,
                       reviews=None, diff_comments=None, password=None,
-                      verbosity=NORMAL, **options):
+                      benchmark_diffs=False, verbosity=NORMAL, **options):
         num_of_requests = None
         num_of_diffs = None
         num_of_reviews = None
         num_of_diff_comments = None
         random.seed()
+        self.diff_timings = []
 
         if review_requests:
             num_of_requests = self.parseCommand("review_requests",
@@ -231,7 +238,17 @@ class Command(NoArgsCommand):
                     file_to_open = diff_dir + files[random_number]
                     f = UploadedFile(open(file_to_open, 'r'))
                     form = UploadDiffForm(review_request.repository, f)
+
+                    if benchmark_diffs:
+                        db.reset_queries()
+                        start_time = time.time()
+
                     cur_diff = form.create(f, None, diffset_history)
+
+                    if benchmark_diffs:
+                        self.record_diff_timing(cur_diff,
+                                                time.time() - start_time)
+
                     review_request.diffset_history = diffset_history
                     review_request.save()
                     review_request.publish(new_user)
@@ -302,6 +319,42 @@ class Command(NoArgsCommand):
             else:
                 print "user %s created successfully" % new_user.username
 
+        if benchmark_diffs:
+            self.print_diff_timings()
+
+    def record_diff_timing(self, diffset, elapsed):
+        """Records the time and queries spent creating a diffset."""
+        if settings.DEBUG:
+            num_queries = len(db.connection.queries)
+        else:
+            num_queries = None
+
+        num_files = diffset.files.count()
+        self.diff_timings.append((num_files, elapsed, num_queries))
+
+        print "diff %s: %d files in %.3fs (%s queries)" % (
+            diffset.name, num_files, elapsed,
+            num_queries if num_queries is not None else 'unknown')
+
+    def print_diff_timings(self):
+        """Prints a summary of the recorded diff creation timings."""
+        if not self.diff_timings:
+            print "No diffs were created"
+            return
+
+        total_files = sum(t[0] for t in self.diff_timings)
+        total_time = sum(t[1] for t in self.diff_timings)
+
+        print "Created %d diffs (%d files) in %.3fs, %.3fs per diff" % (
+            len(self.diff_timings), total_files, total_time,
+            total_time / len(self.diff_timings))
+
+        if settings.DEBUG:
+            total_queries = sum(t[2] for t in self.diff_timings)
+            print "%d queries total, %.1f per diff" % (
+                total_queries,
+                float(total_queries) / len(self.diff_timings))
+
     def parseCommand(self, com_arg, com_string):
         """Parse the values given in the command line."""
         try:
@@ -1,13 +1,19 @@
 from django.core.management.base import NoArgsCommand
 
 from reviewboard.accounts.models import LocalSiteProfile
-from reviewboard.reviews.models import Group
+from reviewboard.reviews.datagrids import invalidate_sidebar_counts
+from reviewboard.reviews.models import Group, IncomingCounterUpdate
+from reviewboard.site.models import LocalSite
 
 
 class Command(NoArgsCommand):
     help="Fixes all incorrect review request-related counters."
 
     def handle_noargs(self, **options):
+        # The counters will be recomputed from scratch, so any queued
+        # updates would end up being counted twice.
+        IncomingCounterUpdate.objects.all().delete()
+
         LocalSiteProfile.objects.update(
             direct_incoming_request_count=None,
             total_incoming_request_count=None,
@@ -15,3 +21,8 @@ class Command(NoArgsCommand):
             total_outgoing_request_count=None,
             starred_public_request_count=None)
         Group.objects.update(incoming_request_count=None)
+
+        invalidate_sidebar_counts(None)
+
+        for local_site in LocalSite.objects.all():
+            invalidate_sidebar_counts(local_site)
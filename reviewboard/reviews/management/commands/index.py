@@ -1,29 +1,39 @@
-from datetime import datetime
+from collections import deque
+import multiprocessing
 import os
 import optparse
 import sys
 import time
 
-from django.core.management.base import NoArgsCommand
-from django.db.models import Q
+from django.core.management.base import CommandError, NoArgsCommand
+from django.db import connection
+from django.db.models import Max
+from django.utils.dateparse import parse_datetime
 
 from djblets.siteconfig.models import SiteConfiguration
 
 from reviewboard.reviews.models import ReviewRequest
+from reviewboard.search.documents import SCHEMA, analyze_documents, \
+                                         build_documents, \
+                                         get_indexed_review_requests, \
+                                         get_search_index, is_indexed
+from reviewboard.search.index import IndexWriter, SearchIndex
 
-try:
-    import lucene
-    lucene.initVM(lucene.CLASSPATH)
-    have_lucene = True
 
-    lv = [int(x) for x in lucene.VERSION.split('.')]
-    lucene_is_2x = lv[0] == 2 and lv[1] < 9
-    lucene_is_3x = lv[0] == 3 or (lv[0] == 2 and lv[1] == 9)
-except ImportError:
-    # This is here just in case someone is misconfigured but manages to
-    # skip the dependency checks inside manage.py (perhaps they have
-    # DEBUG = False)
-    have_lucene = False
+# The manifest used for a full rebuild of the index while it's in progress.
+# It replaces the main manifest once the rebuild is complete.
+REBUILD_MANIFEST_NAME = 'rebuild.json'
+
+# Queries run by --benchmark. These match the text generated by the
+# fill-database command.
+BENCHMARK_QUERIES = [
+    u'lorem',
+    u'ipsum dolor',
+    u'+vestibulum -lorem',
+    u'summary:consect*',
+    u'file:models.py',
+    u'nonexistent',
+]
 
 
 class Command(NoArgsCommand):
@@ -31,10 +41,26 @@ class Command(NoArgsCommand):
         optparse.make_option('--full', action='store_false',
                              dest='incremental', default=True,
                              help='Do a full (level-0) index of the database'),
+        optparse.make_option('--batch-size', type='int', dest='batch_size',
+                             default=500,
+                             help='The number of review requests to fetch '
+                                  'from the database at a time'),
+        optparse.make_option('--processes', type='int', dest='processes',
+                             default=None,
+                             help='The number of processes used to build '
+                                  'the index (defaults to the number of '
+                                  'CPUs)'),
+        optparse.make_option('--benchmark', action='store_true',
+                             dest='benchmark', default=False,
+                             help='Report the index size and the time taken '
+                                  'by some sample queries'),
         )
     help = "Creates a search index of review requests"
     requires_model_validation = True
 
+    #: The number of documents to index between saving progress.
+    COMMIT_DOCS = IndexWriter.FLUSH_DOCS
+
     def handle_noargs(self, **options):
         siteconfig = SiteConfiguration.objects.get_current()
 
@@ -45,158 +71,258 @@ class Command(NoArgsCommand):
                              'settings to run this command.\n')
             sys.exit(1)
 
-        if not have_lucene:
-            sys.stderr.write('PyLucene is required to build the search index.\n')
-            sys.exit(1)
-
         incremental = options.get('incremental', True)
+        self.batch_size = options.get('batch_size') or 500
+        self.processes = (options.get('processes') or
+                          multiprocessing.cpu_count())
+        self.verbose = sys.stdout.isatty()
+        self.num_docs = 0
+
+        if self.batch_size < 1 or self.processes < 1:
+            raise CommandError('--batch-size and --processes must be at '
+                               'least 1')
+
+        index = get_search_index()
+
+        if not os.path.exists(index.path):
+            os.makedirs(index.path)
+
+        if incremental and 'last_updated' not in index.get_state():
+            # This index was never fully built, so there's nothing to
+            # update.
+            incremental = False
+
+        if self.processes > 1:
+            # The worker processes don't use the database, so they shouldn't
+            # share our connection.
+            connection.close()
+            self.pool = multiprocessing.Pool(self.processes)
+        else:
+            self.pool = None
+
+        start_time = time.time()
+
+        try:
+            if incremental:
+                self.update_index(index)
+            else:
+                self.rebuild_index(index)
+        finally:
+            if self.pool:
+                self.pool.terminate()
+
+        elapsed = time.time() - start_time
 
-        store_dir = siteconfig.get("search_index_file")
-        if not os.path.exists(store_dir):
-            os.mkdir(store_dir)
-        timestamp_file = os.path.join(store_dir, 'timestamp')
-
-        timestamp = 0
-        if incremental:
-            try:
-                f = open(timestamp_file, 'r')
-                timestamp = datetime.utcfromtimestamp(int(f.read()))
-                f.close()
-            except IOError:
-                incremental = False
-
-        f = open(timestamp_file, 'w')
-        f.write('%d' % time.time())
-        f.close()
-
-        if lucene_is_2x:
-            store = lucene.FSDirectory.getDirectory(store_dir, False)
-            writer = lucene.IndexWriter(store, False,
-                                        lucene.StandardAnalyzer(),
-                                        not incremental)
-        elif lucene_is_3x:
-            store = lucene.FSDirectory.open(lucene.File(store_dir))
-            writer = lucene.IndexWriter(store,
-                lucene.StandardAnalyzer(lucene.Version.LUCENE_CURRENT),
-                not incremental,
-                lucene.IndexWriter.MaxFieldLength.LIMITED)
+        print 'Indexed %d documents in %.2fs (%.1f docs/sec)' % (
+            self.num_docs, elapsed, self.num_docs / max(elapsed, 0.001))
+
+        if options.get('benchmark', False):
+            self.print_benchmark(index)
+
+    def rebuild_index(self, index):
+        """Builds a new index of every review request.
+
+        The new index is built alongside the current one, which continues
+        to be used for searches until the new one is complete. Progress is
+        saved as review requests are indexed, in order of ID, so an
+        interrupted rebuild picks up where it left off.
+        """
+        rebuild_index = SearchIndex(index.path, SCHEMA, REBUILD_MANIFEST_NAME)
+        state = rebuild_index.get_state()
+
+        if 'last_id' in state:
+            if self.verbose:
+                print 'Resuming index rebuild after review request #%d' % \
+                      state['last_id']
         else:
-            assert False
-
-        status = Q(status='P') | Q(status='S')
-        objects = ReviewRequest.objects.filter(status)
-        if incremental:
-            query = Q(last_updated__gt=timestamp)
-            # FIXME: re-index based on reviews once reviews are indexed.  I
-            # tried ORing this in, but it doesn't seem to work.
-            #        Q(review__timestamp__gt=timestamp)
-            objects = objects.filter(query)
-
-        if sys.stdout.isatty():
+            # Anything updated after this point will be re-indexed once
+            # all review requests have been added.
+            state = {
+                'last_id': 0,
+                'last_updated': self.get_last_updated(),
+            }
+            writer = rebuild_index.writer(clear=True)
+            writer.state.update(state)
+            writer.commit()
+
+        if self.verbose:
             print 'Creating Review Request Index'
-        totalobjs = objects.count()
-        i = 0
+
+        self.index_review_requests(
+            rebuild_index,
+            get_indexed_review_requests().filter(pk__gt=state['last_id']),
+            save_last_id=True)
+
+        self.update_index(rebuild_index, optimize=True)
+        index.replace_with(rebuild_index)
+
+    def update_index(self, index, optimize=False):
+        """Updates the index with review requests that have changed."""
+        state = index.get_state()
+        last_updated = self.get_last_updated()
+        queryset = ReviewRequest.objects.select_related('submitter')
+
+        if state['last_updated']:
+            queryset = queryset.filter(
+                last_updated__gt=parse_datetime(state['last_updated']))
+
+        if self.verbose:
+            print 'Updating Review Request Index'
+
+        self.index_review_requests(index, queryset,
+                                   state={'last_updated': last_updated},
+                                   optimize=optimize)
+
+    def index_review_requests(self, index, queryset, state={},
+                              save_last_id=False, optimize=False):
+        """Indexes review requests from a queryset.
+
+        Review requests are fetched in batches, along with the information
+        in other tables needed to index them. The fetched batches are
+        analyzed by the process pool, while the next batch is fetched.
+        Review requests that shouldn't be indexed are removed from the
+        index.
+
+        Changes are committed every ``COMMIT_DOCS`` review requests. If
+        ``save_last_id`` is True, the ID of the last review request
+        committed is saved in the index's state. ``state`` is saved once
+        all the review requests have been indexed.
+        """
+        total = queryset.count()
+        num_indexed = 0
+        num_uncommitted = 0
         prev_pct = -1
+        writer = index.writer()
+
+        try:
+            for last_id, documents, deleted in self.iter_analyzed_batches(
+                    queryset):
+                for doc_id, fields in documents:
+                    writer.add_analyzed_document(doc_id, fields)
 
-        for request in objects:
-            try:
-                # Remove the old documents from the index
-                if incremental:
-                    writer.deleteDocuments(lucene.Term('id', str(request.id)))
+                for doc_id in deleted:
+                    writer.delete_document(doc_id)
 
-                self.index_review_request(writer, request)
+                num_indexed += len(documents) + len(deleted)
+                num_uncommitted += len(documents) + len(deleted)
+                self.num_docs += len(documents)
+
+                if self.verbose and total:
+                    pct = num_indexed * 100 / total
 
-                if sys.stdout.isatty():
-                    i += 1
-                    pct = (i * 100 / totalobjs)
                     if pct != prev_pct:
                         sys.stdout.write("  [%s%%]\r" % pct)
                         sys.stdout.flush()
                         prev_pct = pct
 
-            except Exception, e:
-                sys.stderr.write('Error indexing ReviewRequest #%d: %s\n' % \
-                                 (request.id, e))
+                if save_last_id:
+                    writer.state['last_id'] = last_id
+
+                if num_uncommitted >= self.COMMIT_DOCS:
+                    writer.commit()
+                    writer = index.writer()
+                    num_uncommitted = 0
+        except:
+            writer.cancel()
+            raise
+
+        if self.verbose:
+            print 'Writing Index'
+
+        writer.state.update(state)
+        writer.commit(optimize=optimize)
+
+    def iter_analyzed_batches(self, queryset):
+        """Yields batches of analyzed documents from a queryset.
+
+        Each item is a tuple of the last review request ID in the batch,
+        the analyzed documents, and the IDs of review requests that should
+        be removed from the index.
+        """
+        results = deque()
+
+        if self.pool:
+            max_pending = self.processes * 2
+        else:
+            max_pending = 1
+
+        for last_id, documents, deleted in self.iter_batches(queryset):
+            if self.pool:
+                result = self.pool.apply_async(analyze_documents,
+                                               (documents,))
+            else:
+                result = analyze_documents(documents)
+
+            results.append((last_id, result, deleted))
+
+            while len(results) >= max_pending:
+                yield self._get_result(results.popleft())
 
-        if sys.stdout.isatty():
-            print 'Optimizing Index'
-        writer.optimize()
+        while results:
+            yield self._get_result(results.popleft())
 
-        if sys.stdout.isatty():
-            print 'Indexed %d documents' % totalobjs
-            print 'Done'
+    def iter_batches(self, queryset):
+        """Yields batches of documents to index from a queryset.
 
-        writer.close()
+        Review requests are fetched in order of ID, starting after the
+        last ID in the previous batch.
+        """
+        last_id = 0
 
-    def index_review_request(self, writer, request):
-        if lucene_is_2x:
-            lucene_tokenized = lucene.Field.Index.TOKENIZED
-            lucene_un_tokenized = lucene.Field.Index.UN_TOKENIZED
-        elif lucene_is_3x:
-            lucene_tokenized = lucene.Field.Index.ANALYZED
-            lucene_un_tokenized = lucene.Field.Index.NOT_ANALYZED
+        while True:
+            review_requests = list(
+                queryset.filter(pk__gt=last_id).order_by('pk')
+                [:self.batch_size])
+
+            if not review_requests:
+                break
+
+            last_id = review_requests[-1].pk
+            indexed = []
+            deleted = []
+
+            for review_request in review_requests:
+                if is_indexed(review_request):
+                    indexed.append(review_request)
+                else:
+                    deleted.append(review_request.pk)
+
+            yield last_id, build_documents(indexed), deleted
+
+    def get_last_updated(self):
+        """Returns the newest last_updated timestamp as a string."""
+        last_updated = ReviewRequest.objects.aggregate(
+            last_updated=Max('last_updated'))['last_updated']
+
+        if last_updated:
+            return last_updated.isoformat()
         else:
-            assert False
-
-        # There are several fields we want to make available to users.
-        # We index them individually, but also create a big hunk of text
-        # to use for the default field, so people can just type in a
-        # string and get results.
-        doc = lucene.Document()
-        doc.add(lucene.Field('id', str(request.id),
-                             lucene.Field.Store.YES,
-                             lucene.Field.Index.NO))
-        doc.add(lucene.Field('summary', request.summary,
-                             lucene.Field.Store.NO,
-                             lucene_tokenized))
-        if request.changenum:
-            doc.add(lucene.Field('changenum',
-                                 unicode(request.changenum),
-                                 lucene.Field.Store.NO,
-                                 lucene_tokenized))
-        # Remove commas, since lucene won't tokenize it right with them
-        bugs = ' '.join(request.bugs_closed.split(','))
-        doc.add(lucene.Field('bug', bugs,
-                             lucene.Field.Store.NO,
-                             lucene_tokenized))
-
-        name = ' '.join([request.submitter.username,
-                         request.submitter.get_full_name()])
-        doc.add(lucene.Field('author', name,
-                             lucene.Field.Store.NO,
-                             lucene_tokenized))
-        doc.add(lucene.Field('username', request.submitter.username,
-                             lucene.Field.Store.NO,
-                             lucene_un_tokenized))
-
-        # FIXME: index reviews
-        # FIXME: index dates
-
-        files = []
-        if request.diffset_history:
-            for diffset in request.diffset_history.diffsets.all():
-                for filediff in diffset.files.all():
-                    if filediff.source_file:
-                        files.append(filediff.source_file)
-                    if filediff.dest_file:
-                        files.append(filediff.dest_file)
-        aggregate_files = '\n'.join(set(files))
-        # FIXME: this tokenization doesn't let people search for files
-        # in a really natural way.  It'll split on '/' which handles the
-        # majority case, but it'd be nice to be able to drill down
-        # (main.cc, vmuiLinux/main.cc, and player/linux/main.cc)
-        doc.add(lucene.Field('file', aggregate_files,
-                             lucene.Field.Store.NO,
-                             lucene_tokenized))
-
-        text = '\n'.join([request.summary,
-                          request.description,
-                          unicode(request.changenum),
-                          request.testing_done,
-                          bugs,
-                          name,
-                          aggregate_files])
-        doc.add(lucene.Field('text', text,
-                             lucene.Field.Store.NO,
-                             lucene_tokenized))
-        writer.addDocument(doc)
+            return None
+
+    def print_benchmark(self, index):
+        """Prints the index size and sample query timings."""
+        num_docs = len(index.reader().doc_ids())
+        index_size = sum(
+            os.path.getsize(os.path.join(index.path, name))
+            for name in os.listdir(index.path))
+
+        print 'Index size: %d bytes (%.1f bytes/doc)' % (
+            index_size, float(index_size) / max(num_docs, 1))
+
+        start_time = time.time()
+        index.reader()
+        print 'Opened index in %.1fms' % ((time.time() - start_time) * 1000)
+
+        for query in BENCHMARK_QUERIES:
+            start_time = time.time()
+            results = index.search(query)
+            print '%-24s %6d results in %.1fms' % (
+                query, len(results), (time.time() - start_time) * 1000)
+
+    def _get_result(self, item):
+        last_id, result, deleted = item
+
+        if self.pool:
+            result = result.get()
+
+        return last_id, result, deleted
@@ -0,0 +1,45 @@
+import optparse
+import time
+
+from django.core.management.base import NoArgsCommand
+
+from reviewboard.reviews.models import IncomingCounterUpdate
+
+
+class Command(NoArgsCommand):
+    option_list = NoArgsCommand.option_list + (
+        optparse.make_option('--batch-size', type='int', dest='batch_size',
+                             default=500,
+                             help='The number of updates to apply at a time'),
+        optparse.make_option('--interval', type='float', dest='interval',
+                             default=None,
+                             help='Keep running, checking for new updates '
+                                  'every INTERVAL seconds'),
+        )
+    help = ("Applies queued changes to the incoming review request "
+            "counters. This is needed when DEFER_COUNTER_UPDATES is set.")
+
+    def handle_noargs(self, **options):
+        batch_size = options['batch_size']
+        interval = options['interval']
+
+        while True:
+            num_processed = 0
+
+            while True:
+                count = IncomingCounterUpdate.objects.process_pending(
+                    batch_size)
+
+                if count == 0:
+                    break
+
+                num_processed += count
+
+            if num_processed:
+                self.stdout.write('Applied %d counter updates.\n'
+                                  % num_processed)
+
+            if interval is None:
+                break
+
+            time.sleep(interval)
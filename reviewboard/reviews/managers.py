@@ -1,8 +1,9 @@
 import logging
 
+from django.conf import settings
 from django.contrib.auth.models import User
 from django.core.exceptions import ObjectDoesNotExist
-from django.db import connections, router
+from django.db import connections, router, transaction
 from django.db.models import Manager, Q
 from django.db.models.query import QuerySet
 
@@ -26,6 +27,120 @@ class DefaultReviewerManager(Manager):
             Q(repository__isnull=True) | Q(repository=repository))
 
 
+class IncomingCounterUpdateManager(Manager):
+    """A manager for IncomingCounterUpdate models.
+
+    This queues up and applies changes to the incoming review request
+    counters on groups and LocalSiteProfiles.
+    """
+
+    def queue(self, review_request, delta):
+        """Queues a change to the incoming counters for a review request.
+
+        ``delta`` is added to the incoming counters of the review request's
+        target groups and people, the members of the target groups, and
+        the users who have starred the review request.
+
+        If ``settings.DEFER_COUNTER_UPDATES`` is set, the change is saved
+        to the database, to be applied later by :py:meth:`process_pending`.
+        Otherwise, it's applied immediately.
+        """
+        update = self.model(local_site=review_request.local_site,
+                            delta=delta)
+        update.group_ids = list(
+            review_request.target_groups.values_list('pk', flat=True))
+        update.user_ids = list(
+            review_request.target_people.values_list('pk', flat=True))
+        update.starred_profile_ids = list(
+            review_request.starred_by.values_list('pk', flat=True))
+
+        if getattr(settings, 'DEFER_COUNTER_UPDATES', False):
+            update.save()
+        else:
+            self.apply_updates([update])
+
+        return update
+
+    def process_pending(self, batch_size=500):
+        """Applies a batch of pending updates from the queue.
+
+        The applied updates are removed from the queue. This returns the
+        number of updates that were processed, which will be 0 once the
+        queue is empty.
+        """
+        with transaction.commit_on_success():
+            updates = list(
+                self.select_for_update()
+                    .select_related('local_site')
+                    .order_by('pk')[:batch_size])
+
+            if updates:
+                self.apply_updates(updates)
+                self.filter(pk__in=[update.pk for update in updates]).delete()
+
+        return len(updates)
+
+    def apply_updates(self, updates):
+        """Applies a list of updates to the counters.
+
+        Updates for the same set of groups and people are combined first,
+        so that a review request being published and then closed doesn't
+        touch the counters at all.
+        """
+        from reviewboard.accounts.models import LocalSiteProfile
+        from reviewboard.reviews.datagrids import invalidate_sidebar_counts
+        from reviewboard.reviews.models import Group
+
+        deltas = {}
+        local_sites = {}
+
+        for update in updates:
+            key = (update.local_site_id,
+                   frozenset(update.group_ids),
+                   frozenset(update.user_ids),
+                   frozenset(update.starred_profile_ids))
+            deltas[key] = deltas.get(key, 0) + update.delta
+            local_sites[update.local_site_id] = update.local_site
+
+        for key, delta in deltas.iteritems():
+            if delta == 0:
+                continue
+
+            local_site_id, group_ids, user_ids, starred_profile_ids = key
+            site_profiles = LocalSiteProfile.objects.filter(
+                local_site=local_site_id)
+
+            if group_ids:
+                Group.incoming_request_count.increment(
+                    Group.objects.filter(pk__in=group_ids), delta)
+
+            if user_ids:
+                LocalSiteProfile.direct_incoming_request_count.increment(
+                    site_profiles.filter(user__in=user_ids), delta)
+
+            if group_ids and user_ids:
+                q = (Q(user__review_groups__in=group_ids) |
+                     Q(user__in=user_ids))
+            elif group_ids:
+                q = Q(user__review_groups__in=group_ids)
+            elif user_ids:
+                q = Q(user__in=user_ids)
+            else:
+                q = None
+
+            if q is not None:
+                LocalSiteProfile.total_incoming_request_count.increment(
+                    site_profiles.filter(q), delta)
+
+            if starred_profile_ids:
+                LocalSiteProfile.starred_public_request_count.increment(
+                    site_profiles.filter(profile__in=starred_profile_ids),
+                    delta)
+
+        for local_site in local_sites.itervalues():
+            invalidate_sidebar_counts(local_site)
+
+
 class ReviewGroupManager(Manager):
     """A manager for Group models."""
     def accessible(self, user, visible_only=True, local_site=None):
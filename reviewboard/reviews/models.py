@@ -19,6 +19,7 @@ from reviewboard.diffviewer.models import DiffSet, DiffSetHistory, FileDiff
 from reviewboard.attachments.models import FileAttachment
 from reviewboard.reviews.errors import PermissionError
 from reviewboard.reviews.managers import DefaultReviewerManager, \
+                                         IncomingCounterUpdateManager, \
                                          ReviewGroupManager, \
                                          ReviewRequestManager, \
                                          ReviewManager
@@ -26,6 +27,7 @@ from reviewboard.reviews.signals import review_request_published, \
                                         review_request_reopened, \
                                         review_request_closed, \
                                         reply_published, review_published
+from reviewboard.reviews.updates import notify_review_request_updated
 from reviewboard.scmtools.errors import InvalidChangeNumberError
 from reviewboard.scmtools.models import Repository
 from reviewboard.site.models import LocalSite
@@ -738,6 +740,7 @@ class ReviewRequest(BaseReviewRequestDetails):
 
     def delete(self, **kwargs):
         from reviewboard.accounts.models import Profile, LocalSiteProfile
+        from reviewboard.reviews.datagrids import invalidate_sidebar_counts
 
         profile, profile_is_new = \
             Profile.objects.get_or_create(user=self.submitter)
@@ -757,22 +760,9 @@ class ReviewRequest(BaseReviewRequestDetails):
             site_profile.decrement_pending_outgoing_request_count()
 
         if self.public:
-            people = self.target_people.all()
-            groups = self.target_groups.all()
-
-            Group.incoming_request_count.decrement(groups)
-            LocalSiteProfile.direct_incoming_request_count.decrement(
-                LocalSiteProfile.objects.filter(user__in=people,
-                                                local_site=local_site))
-            LocalSiteProfile.total_incoming_request_count.decrement(
-                LocalSiteProfile.objects.filter(
-                    Q(local_site=local_site) &
-                    Q(Q(user__review_groups__in=groups) |
-                      Q(user__in=people))))
-            LocalSiteProfile.starred_public_request_count.decrement(
-                LocalSiteProfile.objects.filter(
-                    profile__starred_review_requests=self,
-                    local_site=local_site))
+            IncomingCounterUpdate.objects.queue(self, -1)
+
+        invalidate_sidebar_counts(local_site)
 
         super(ReviewRequest, self).delete(**kwargs)
 
@@ -859,8 +849,6 @@ class ReviewRequest(BaseReviewRequestDetails):
         self.save()
 
     def publish(self, user):
-        from reviewboard.accounts.models import LocalSiteProfile
-
         """
         Save the current draft attached to this review request. Send out the
         associated email. Returns the review request that was saved.
@@ -876,21 +864,7 @@ class ReviewRequest(BaseReviewRequestDetails):
         # Decrement should not happen while publishing
         # a new request or a discarded request
         if self.public:
-            Group.incoming_request_count.decrement(self.target_groups.all())
-            LocalSiteProfile.direct_incoming_request_count.decrement(
-                    LocalSiteProfile.objects.filter(
-                        user__in=self.target_people.all(),
-                        local_site=self.local_site))
-            LocalSiteProfile.total_incoming_request_count.decrement(
-                    LocalSiteProfile.objects.filter(
-                        Q(local_site=self.local_site) &
-                        Q(Q(user__review_groups__in= \
-                            self.target_groups.all()) |
-                          Q(user__in=self.target_people.all()))))
-            LocalSiteProfile.starred_public_request_count.decrement(
-                    LocalSiteProfile.objects.filter(
-                        profile__starred_review_requests=self,
-                        local_site=self.local_site))
+            IncomingCounterUpdate.objects.queue(self, -1)
 
         draft = get_object_or_none(self.draft)
         if draft is not None:
@@ -909,6 +883,7 @@ class ReviewRequest(BaseReviewRequestDetails):
 
     def _update_counts(self):
         from reviewboard.accounts.models import Profile, LocalSiteProfile
+        from reviewboard.reviews.datagrids import invalidate_sidebar_counts
 
         profile, profile_is_new = \
             Profile.objects.get_or_create(user=self.submitter)
@@ -943,43 +918,15 @@ class ReviewRequest(BaseReviewRequestDetails):
                 site_profile.increment_pending_outgoing_request_count()
 
             if self.public and self.id is not None:
-                groups = self.target_groups.all()
-                people = self.target_people.all()
-
-                Group.incoming_request_count.increment(groups)
-                LocalSiteProfile.direct_incoming_request_count.increment(
-                    LocalSiteProfile.objects.filter(user__in=people,
-                                                    local_site=local_site))
-                LocalSiteProfile.total_incoming_request_count.increment(
-                    LocalSiteProfile.objects.filter(
-                        Q(local_site=local_site) &
-                        Q(Q(user__review_groups__in=groups) |
-                          Q(user__in=people))))
-                LocalSiteProfile.starred_public_request_count.increment(
-                    LocalSiteProfile.objects.filter(
-                        profile__starred_review_requests=self,
-                        local_site=local_site))
+                IncomingCounterUpdate.objects.queue(self, 1)
         else:
             if old_status != self.status:
                 site_profile.decrement_pending_outgoing_request_count()
 
             if old_public:
-                groups = self.target_groups.all()
-                people = self.target_people.all()
-
-                Group.incoming_request_count.decrement(groups)
-                LocalSiteProfile.direct_incoming_request_count.decrement(
-                    LocalSiteProfile.objects.filter(user__in=people,
-                                                    local_site=local_site))
-                LocalSiteProfile.total_incoming_request_count.decrement(
-                    LocalSiteProfile.objects.filter(
-                        Q(local_site=local_site) &
-                        Q(Q(user__review_groups__in=groups) |
-                          Q(user__in=people))))
-                LocalSiteProfile.starred_public_request_count.decrement(
-                    LocalSiteProfile.objects.filter(
-                        profile__starred_review_requests=self,
-                        local_site=local_site))
+                IncomingCounterUpdate.objects.queue(self, -1)
+
+        invalidate_sidebar_counts(local_site)
 
     def _get_review_request(self):
         """Returns this review request.
@@ -999,6 +946,32 @@ class ReviewRequest(BaseReviewRequestDetails):
         )
 
 
+class IncomingCounterUpdate(models.Model):
+    """A pending change to the incoming review request counters.
+
+    Publishing or closing a review request changes the incoming counters
+    of every target group and every member of those groups, which can take
+    a long time for large groups. When ``settings.DEFER_COUNTER_UPDATES``
+    is set, these changes are stored here and applied in batches by the
+    ``processcounterupdates`` management command.
+
+    The IDs of the affected groups, people and starring profiles are
+    recorded at the time of the change, so that later changes to the
+    review request don't affect how this is applied.
+    """
+    local_site = models.ForeignKey(LocalSite, blank=True, null=True)
+    delta = models.IntegerField()
+    group_ids = JSONField()
+    user_ids = JSONField()
+    starred_profile_ids = JSONField()
+    timestamp = models.DateTimeField(_('timestamp'), default=timezone.now)
+
+    objects = IncomingCounterUpdateManager()
+
+    def __unicode__(self):
+        return u'%+d (%s)' % (self.delta, self.timestamp)
+
+
 class ReviewRequestDraft(BaseReviewRequestDetails):
     """
     A draft of a review request.
@@ -1426,6 +1399,10 @@ class BaseComment(models.Model):
             if not review.public:
                 review.timestamp = self.timestamp
                 review.save()
+            else:
+                # This is a change to a published comment, such as an issue
+                # status change, so let anything watching for updates know.
+                notify_review_request_updated(review.review_request_id)
 
             ReviewRequest.objects.filter(pk=review.review_request_id).update(
                 last_review_activity_timestamp=self.timestamp)
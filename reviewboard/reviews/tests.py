@@ -1,26 +1,42 @@
 from datetime import timedelta
+from StringIO import StringIO
 import logging
 import os
+import threading
 
 from django.conf import settings
 from django.contrib.auth.models import AnonymousUser, User
+from django.core.cache import cache
 from django.core.files.uploadedfile import SimpleUploadedFile
+from django.core.management import call_command
 from django.core.urlresolvers import reverse
 from django.template import Context, Template
 from django.test import TestCase
+from django.test.utils import override_settings
 
 from djblets.siteconfig.models import SiteConfiguration
 
+from reviewboard import initialize
 from reviewboard.accounts.models import Profile, LocalSiteProfile
+from reviewboard.admin.instrumentation import QueryBudgetTestMixin
 from reviewboard.attachments.models import FileAttachment
+from reviewboard.benchmark import BENCHMARK_USERNAME, REPOSITORY_NAME, \
+                                  BenchmarkError, run_benchmarks
+from reviewboard.diffviewer.models import FileDiffData
+from reviewboard.reviews.datagrids import get_sidebar_counts
 from reviewboard.reviews.forms import DefaultReviewerForm, GroupForm
 from reviewboard.reviews.models import Comment, \
                                        DefaultReviewer, \
                                        Group, \
+                                       IncomingCounterUpdate, \
                                        ReviewRequest, \
                                        ReviewRequestDraft, \
                                        Review, \
                                        Screenshot
+from reviewboard.reviews.updates import get_update_serial, \
+                                        notify_review_request_updated, \
+                                        wait_for_update
+from reviewboard.scmtools import managers as scmtools_managers
 from reviewboard.scmtools.models import Repository, Tool
 from reviewboard.site.models import LocalSite
 from reviewboard.site.urlresolvers import local_site_reverse
@@ -319,6 +335,82 @@ class ViewTests(TestCase):
         self.assertEqual(replies[0].text, comment_text_3)
         self.assertEqual(replies[1].text, comment_text_2)
 
+    def test_review_detail_entry_cache(self):
+        """Testing review_detail caching rendered review boxes"""
+        cache.clear()
+
+        review_request = ReviewRequest.objects.get(
+            summary="Add permission checking for JSON API")
+        review_request.reviews.all().delete()
+        review_request.repository = None
+        review_request.save()
+
+        user = User.objects.get(username='doc')
+        review = Review.objects.create(review_request=review_request,
+                                       user=user,
+                                       body_top='Original text')
+        review.publish()
+
+        self.client.login(username='admin', password='admin')
+
+        response = self.client.get('/r/%d/' % review_request.pk)
+        self.assertEqual(response.status_code, 200)
+        self.assertContains(response, 'Original text')
+
+        # Change the review without changing its timestamp. The cached box
+        # should still be used.
+        Review.objects.filter(pk=review.pk).update(body_top='Changed text')
+
+        response = self.client.get('/r/%d/' % review_request.pk)
+        self.assertContains(response, 'Original text')
+        self.assertNotContains(response, 'Changed text')
+
+        # A new reply invalidates the box.
+        reply = Review.objects.create(review_request=review_request,
+                                      user=user,
+                                      base_reply_to=review,
+                                      body_top='Reply text',
+                                      body_top_reply_to=review)
+        reply.publish()
+
+        response = self.client.get('/r/%d/' % review_request.pk)
+        self.assertContains(response, 'Changed text')
+        self.assertContains(response, 'Reply text')
+
+    def test_review_detail_entry_cache_reviewer_name(self):
+        """Testing review_detail re-rendering cached review boxes when the
+        reviewer's name changes
+        """
+        cache.clear()
+
+        review_request = ReviewRequest.objects.get(
+            summary="Add permission checking for JSON API")
+        review_request.reviews.all().delete()
+        review_request.repository = None
+        review_request.save()
+
+        user = User.objects.get(username='doc')
+        user.first_name = 'Original'
+        user.last_name = 'Reviewer'
+        user.save()
+
+        review = Review.objects.create(review_request=review_request,
+                                       user=user,
+                                       body_top='Review text')
+        review.publish()
+
+        self.client.login(username='admin', password='admin')
+
+        response = self.client.get('/r/%d/' % review_request.pk)
+        self.assertContains(response, 'Original Reviewer')
+
+        user.first_name = 'Renamed'
+        user.save()
+
+        response = self.client.get('/r/%d/' % review_request.pk)
+        self.assertContains(response, 'Renamed Reviewer')
+        self.assertNotContains(response, 'Original Reviewer')
+
     def test_review_detail_file_attachment_visibility(self):
         """Testing visibility of file attachments on review requests."""
         caption_1 = 'File Attachment 1'
@@ -824,6 +916,97 @@ class ViewTests(TestCase):
         self.assertNotEqual(etag1, etag2)
 
 
+class QueryBudgetTests(QueryBudgetTestMixin, TestCase):
+    """Tests for the number of queries run by views.
+
+    If a change needs more queries, make sure it isn't running a query for
+    each item on the page before raising the budget.
+    """
+    fixtures = ['test_users', 'test_reviewrequests', 'test_scmtools',
+                'test_site']
+
+    def setUp(self):
+        self.client.login(username='admin', password='admin')
+
+    def test_review_detail(self):
+        """Testing review_detail query budget"""
+        response = self.assertQueryBudget('/r/3/', 25)
+        self.assertEqual(response.status_code, 200)
+
+    def test_dashboard(self):
+        """Testing dashboard query budget"""
+        response = self.assertQueryBudget('/dashboard/', 5)
+        self.assertEqual(response.status_code, 200)
+
+    def test_review_request_list_api(self):
+        """Testing review request list API query budget"""
+        response = self.assertQueryBudget('/api/review-requests/', 20)
+        self.assertEqual(response.status_code, 200)
+
+
+class BenchmarkTests(TestCase):
+    """Tests for reviewboard.benchmark."""
+    fixtures = ['test_users']
+
+    def setUp(self):
+        # The benchmark's Tool may reuse the ID of a Tool that was cached by
+        # an earlier test.
+        scmtools_managers._TOOL_CACHE.clear()
+
+    def tearDown(self):
+        scmtools_managers._TOOL_CACHE.clear()
+
+    def test_run_benchmarks(self):
+        """Testing run_benchmarks"""
+        num_diff_data = FileDiffData.objects.count()
+
+        results = run_benchmarks(['diff-upload', 'diff-chunks',
+                                  'review-detail', 'dashboard'],
+                                 iterations=2, num_files=2, num_lines=200,
+                                 num_reviews=2, num_comments=2)
+
+        self.assertEqual(sorted(results.keys()),
+                         ['dashboard', 'diff-chunks', 'diff-upload',
+                          'review-detail'])
+
+        for summary in results.itervalues():
+            self.assertEqual(summary['iterations'], 2)
+            self.assertTrue(summary['p50_ms'] <= summary['p95_ms'])
+
+        self.assertEqual(results['diff-upload']['mean_scm_calls'], 2)
+        self.assertTrue(results['review-detail']['p50_queries'] > 0)
+
+        # Everything created for the benchmarks is removed.
+        self.assertFalse(
+            User.objects.filter(username=BENCHMARK_USERNAME).exists())
+        self.assertFalse(
+            Repository.objects.filter(name=REPOSITORY_NAME).exists())
+        self.assertFalse(ReviewRequest.objects.filter(
+            submitter__username=BENCHMARK_USERNAME).exists())
+        self.assertEqual(FileDiffData.objects.count(), num_diff_data)
+
+    def test_benchmark_command_min_lines(self):
+        """Testing the benchmark command with too few lines per file"""
+        stderr = StringIO()
+
+        # Django reports the CommandError and exits.
+        self.assertRaises(SystemExit,
+                          lambda: call_command('benchmark', num_lines=10,
+                                               stdout=StringIO(),
+                                               stderr=stderr))
+        self.assertTrue('--lines must be at least' in stderr.getvalue())
+    def test_run_benchmarks_existing_data(self):
+        """Testing run_benchmarks with an existing benchmark user"""
+        user = User.objects.create(username=BENCHMARK_USERNAME)
+
+        self.assertRaises(BenchmarkError,
+                          lambda: run_benchmarks(['diff-upload'],
+                                                 iterations=1))
+
+        # The existing user is left alone.
+        self.assertTrue(User.objects.filter(pk=user.pk).exists())
+
+
 class DraftTests(TestCase):
     fixtures = ['test_users', 'test_reviewrequests', 'test_scmtools']
 
@@ -1687,6 +1870,114 @@ class CounterTests(TestCase):
         self.assertEqual(self.site_profile2.starred_public_request_count, 0)
         self.assertEqual(self.group.incoming_request_count, 1)
 
+    def test_sidebar_counts_cache(self):
+        """Testing get_sidebar_counts caching and invalidation"""
+        cache.clear()
+        self.profile.star_review_group(self.group)
+
+        counts = get_sidebar_counts(self.user, None)
+        self.assertEqual(counts['groups'].items(), [('test-group', 0)])
+        self.assertEqual(counts['starred_groups'].items(),
+                         [('test-group', 0)])
+        self.assertEqual(counts['outgoing'], 1)
+
+        # A second lookup should come straight from the cache.
+        self.assertNumQueries(0, lambda: get_sidebar_counts(self.user, None))
+
+        draft = ReviewRequestDraft.create(self.review_request)
+        draft.target_groups.add(self.group)
+        self.review_request.publish(self.user)
+
+        counts = get_sidebar_counts(self.user, None)
+        self.assertEqual(counts['groups']['test-group'], 1)
+        self.assertEqual(counts['starred_groups']['test-group'], 1)
+
+    def test_sidebar_counts_group_membership(self):
+        """Testing get_sidebar_counts invalidation on group membership"""
+        initialize()
+        cache.clear()
+        group2 = Group.objects.create(name='test-group2')
+
+        counts = get_sidebar_counts(self.user, None)
+        self.assertEqual(counts['groups'].keys(), ['test-group'])
+
+        self.user.review_groups = [self.group, group2]
+        counts = get_sidebar_counts(self.user, None)
+        self.assertEqual(counts['groups'].keys(),
+                         ['test-group', 'test-group2'])
+
+        group2.name = 'test-group3'
+        group2.save()
+        counts = get_sidebar_counts(self.user, None)
+        self.assertEqual(counts['groups'].keys(),
+                         ['test-group', 'test-group3'])
+
+        self.group.users.remove(self.user)
+        counts = get_sidebar_counts(self.user, None)
+        self.assertEqual(counts['groups'].keys(), ['test-group3'])
+
+    def test_check_review_counts(self):
+        """Testing the checkreviewcounts command repairing counters"""
+        draft = ReviewRequestDraft.create(self.review_request)
+        draft.target_groups.add(self.group)
+        self.review_request.publish(self.user)
+
+        Group.objects.filter(pk=self.group.pk).update(
+            incoming_request_count=5)
+        LocalSiteProfile.objects.filter(pk=self.site_profile.pk).update(
+            pending_outgoing_request_count=3)
+
+        call_command('checkreviewcounts', dry_run=True, stdout=StringIO())
+        self._reload_objects()
+        self.assertEqual(self.group.incoming_request_count, 5)
+
+        call_command('checkreviewcounts', stdout=StringIO())
+        self._reload_objects()
+        self.assertEqual(self.group.incoming_request_count, 1)
+        self.assertEqual(self.site_profile.pending_outgoing_request_count, 1)
+
+    def test_deferred_counter_updates(self):
+        """Testing counters with DEFER_COUNTER_UPDATES"""
+        draft = ReviewRequestDraft.create(self.review_request)
+        draft.target_groups.add(self.group)
+
+        with override_settings(DEFER_COUNTER_UPDATES=True):
+            self.review_request.publish(self.user)
+
+        self._reload_objects()
+        self.assertEqual(self.group.incoming_request_count, 0)
+        self.assertEqual(self.site_profile.total_incoming_request_count, 0)
+        self.assertEqual(IncomingCounterUpdate.objects.count(), 1)
+
+        self.assertEqual(IncomingCounterUpdate.objects.process_pending(), 1)
+        self.assertEqual(IncomingCounterUpdate.objects.count(), 0)
+
+        self._reload_objects()
+        self.assertEqual(self.group.incoming_request_count, 1)
+        self.assertEqual(self.site_profile.total_incoming_request_count, 1)
+
+    def test_deferred_counter_updates_coalesced(self):
+        """Testing deferred counter updates cancelling each other out"""
+        draft = ReviewRequestDraft.create(self.review_request)
+        draft.target_groups.add(self.group)
+
+        with override_settings(DEFER_COUNTER_UPDATES=True):
+            self.review_request.publish(self.user)
+            self.review_request.close(ReviewRequest.DISCARDED)
+
+        self.assertEqual(IncomingCounterUpdate.objects.count(), 2)
+
+        # Mark the group's counter as bad. If the updates were applied
+        # individually, this would change.
+        Group.objects.filter(pk=self.group.pk).update(
+            incoming_request_count=10)
+
+        with self.assertNumQueries(3):
+            IncomingCounterUpdate.objects.process_pending()
+
+        self._reload_objects()
+        self.assertEqual(self.group.incoming_request_count, 10)
+
     def _reload_objects(self):
         self.test_site = LocalSite.objects.get(pk=self.test_site.pk)
         self.site_profile = \
@@ -1909,3 +2200,43 @@ class UserInfoboxTests(TestCase):
         user.save()
 
         self.client.get(local_site_reverse('user-infobox', args=['test']))
+
+
+class UpdateNotificationTests(TestCase):
+    """Tests for reviewboard.reviews.updates"""
+    fixtures = ['test_users', 'test_reviewrequests', 'test_scmtools']
+
+    def setUp(self):
+        initialize()
+
+        siteconfig = SiteConfiguration.objects.get_current()
+        siteconfig.set('mail_send_review_mail', False)
+        siteconfig.save()
+
+    def test_notify_on_review_published(self):
+        """Testing that publishing a review changes the update serial"""
+        review_request = ReviewRequest.objects.get(pk=3)
+        serial = get_update_serial(review_request.pk)
+
+        review = Review.objects.create(review_request=review_request,
+                                       user=User.objects.get(username='doc'))
+        self.assertEqual(get_update_serial(review_request.pk), serial)
+
+        review.publish()
+        self.assertNotEqual(get_update_serial(review_request.pk), serial)
+
+    def test_wait_for_update(self):
+        """Testing wait_for_update being woken up by a notification"""
+        serial = get_update_serial(3)
+        timer = threading.Timer(0.1, notify_review_request_updated, [3])
+        timer.start()
+
+        try:
+            self.assertTrue(wait_for_update(3, serial, 10))
+        finally:
+            timer.cancel()
+
+    def test_wait_for_update_timeout(self):
+        """Testing wait_for_update timing out"""
+        serial = get_update_serial(3)
+        self.assertFalse(wait_for_update(3, serial, 0.1))
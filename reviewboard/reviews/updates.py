@@ -0,0 +1,105 @@
+"""Tracking of public updates to review requests.
+
+Every time something public happens on a review request (it's published,
+a review or reply is published, or an issue's status changes), the review
+request's update serial is changed in the cache. Clients waiting on updates
+can watch this serial instead of querying the database.
+
+Waiters in the same process are woken up immediately. Waiters in other
+processes will notice the change the next time they check the cache.
+"""
+import threading
+import time
+
+from django.core.cache import cache
+from djblets.util.misc import make_cache_key
+
+from reviewboard.reviews.signals import review_request_published, \
+                                        review_request_closed, \
+                                        review_request_reopened, \
+                                        review_published, reply_published
+
+
+#: How often, in seconds, waiters check the cache for updates made by
+#: other processes.
+POLL_INTERVAL = 1.0
+
+_update_condition = threading.Condition()
+
+
+def _make_update_key(review_request_id):
+    return make_cache_key('review-request-update-serial:%s' %
+                          review_request_id)
+
+
+def get_update_serial(review_request_id):
+    """Returns the current update serial for a review request.
+
+    The serial is an opaque value that changes every time the review request
+    has a public update. It may be None if there haven't been any updates
+    recently.
+    """
+    return cache.get(_make_update_key(review_request_id))
+
+
+def notify_review_request_updated(review_request_id):
+    """Records a public update to a review request.
+
+    This changes the update serial and wakes up anything waiting on updates
+    in this process.
+    """
+    cache.set(_make_update_key(review_request_id), '%f' % time.time())
+
+    _update_condition.acquire()
+
+    try:
+        _update_condition.notify_all()
+    finally:
+        _update_condition.release()
+
+
+def wait_for_update(review_request_id, serial, timeout):
+    """Waits for a public update to a review request.
+
+    This will block until the review request's update serial differs from
+    ``serial``, or until ``timeout`` seconds have passed.
+
+    Returns True if there was an update, or False if the wait timed out.
+    """
+    end_time = time.time() + timeout
+
+    while True:
+        if get_update_serial(review_request_id) != serial:
+            return True
+
+        remaining = end_time - time.time()
+
+        if remaining <= 0:
+            return False
+
+        _update_condition.acquire()
+
+        try:
+            _update_condition.wait(min(remaining, POLL_INTERVAL))
+        finally:
+            _update_condition.release()
+
+
+def _on_review_request_updated(sender, review_request, **kwargs):
+    notify_review_request_updated(review_request.pk)
+
+
+def _on_review_published(sender, review, **kwargs):
+    notify_review_request_updated(review.review_request_id)
+
+
+def _on_reply_published(sender, reply, **kwargs):
+    notify_review_request_updated(reply.review_request_id)
+
+
+def connect_signals():
+    review_request_published.connect(_on_review_request_updated)
+    review_request_closed.connect(_on_review_request_updated)
+    review_request_reopened.connect(_on_review_request_updated)
+    review_published.connect(_on_review_published)
+    reply_published.connect(_on_reply_published)
@@ -1,10 +1,12 @@
 import copy
+import hashlib
 import logging
 import time
 
 from django.conf import settings
 from django.contrib.auth.models import User
 from django.contrib.sites.models import Site
+from django.core.cache import cache
 from django.core.urlresolvers import reverse
 from django.db.models import Q
 from django.http import HttpResponse, HttpResponseRedirect, Http404, \
@@ -12,12 +14,12 @@ from django.http import HttpResponse, HttpResponseRedirect, Http404, \
 from django.shortcuts import get_object_or_404, get_list_or_404, \
                              render_to_response
 from django.template.context import RequestContext
-from django.template.loader import render_to_string
+from django.template.loader import get_template, render_to_string
 from django.utils import simplejson, timezone
 from django.utils.http import http_date
 from django.utils.safestring import mark_safe
 from django.utils.timezone import utc
-from django.utils.translation import ugettext as _
+from django.utils.translation import get_language, ugettext as _
 from django.views.decorators.cache import cache_control
 from django.views.generic.list_detail import object_list
 
@@ -26,11 +28,12 @@ from djblets.siteconfig.models import SiteConfiguration
 from djblets.util.dates import get_latest_timestamp
 from djblets.util.http import set_last_modified, get_modified_since, \
                               set_etag, etag_if_none_match
-from djblets.util.misc import get_object_or_none
+from djblets.util.misc import get_object_or_none, make_cache_key
 
 from reviewboard.accounts.decorators import check_login_required, \
                                             valid_prefs_required
-from reviewboard.accounts.models import ReviewRequestVisit, Profile
+from reviewboard.accounts.models import ReviewRequestVisit
+from reviewboard.admin.snapshot import get_request_snapshot
 from reviewboard.attachments.forms import UploadFileForm, CommentFileForm
 from reviewboard.attachments.models import FileAttachment
 from reviewboard.changedescs.models import ChangeDescription
@@ -38,6 +41,7 @@ from reviewboard.diffviewer.diffutils import get_file_chunks_in_range
 from reviewboard.diffviewer.models import DiffSet
 from reviewboard.diffviewer.views import view_diff, view_diff_fragment, \
                                          exception_traceback_string
+from reviewboard.extensions.base import get_extension_manager
 from reviewboard.extensions.hooks import DashboardHook, \
                                          ReviewRequestDetailHook
 from reviewboard.reviews.ui.screenshot import LegacyScreenshotReviewUI
@@ -56,11 +60,16 @@ from reviewboard.reviews.models import Comment, \
                                        Screenshot, ScreenshotComment
 from reviewboard.scmtools.core import PRE_CREATION
 from reviewboard.scmtools.errors import SCMError
+from reviewboard.search.documents import get_search_index
 from reviewboard.site.models import LocalSite
 from reviewboard.ssh.errors import SSHError
 from reviewboard.webapi.encoder import status_to_string
 
 
+#: The maximum number of results shown for a search.
+MAX_SEARCH_RESULTS = 100
+
+
 #####
 ##### Helper functions
 #####
@@ -150,6 +159,196 @@ def _build_id_map(objects):
     return id_map
 
 
+def _get_changedesc_fields(changedesc, review_request, diffset_versions):
+    """Returns the list of changed fields to display for a change description.
+
+    Each item in the list is a dictionary describing a field, in the form
+    expected by the :template:`reviews/changedesc_box.html` template.
+    """
+    fields_changed = []
+
+    for name, info in changedesc.fields_changed.iteritems():
+        info = copy.deepcopy(info)
+        multiline = False
+        diff_revision = False
+
+        if 'added' in info or 'removed' in info:
+            change_type = 'add_remove'
+
+            # We don't hard-code URLs in the bug info, since the
+            # tracker may move, but we can do it here.
+            if (name == "bugs_closed" and
+                review_request.repository and
+                review_request.repository.bug_tracker):
+                bug_url = review_request.repository.bug_tracker
+                for field in info:
+                    for i, buginfo in enumerate(info[field]):
+                        try:
+                            full_bug_url = bug_url % buginfo[0]
+                            info[field][i] = (buginfo[0], full_bug_url)
+                        except TypeError:
+                            logging.warning("Invalid bugtracker url format")
+            elif name == "diff" and "added" in info:
+                # Sets the incremental revision number for a review
+                # request change, provided it is an updated diff.
+                diff_revision = diffset_versions[info['added'][0][2]]
+
+        elif 'old' in info or 'new' in info:
+            change_type = 'changed'
+            multiline = (name == "description" or name == "testing_done")
+
+            # Branch text is allowed to have entities, so mark it safe.
+            if name == "branch":
+                if 'old' in info:
+                    info['old'][0] = mark_safe(info['old'][0])
+
+                if 'new' in info:
+                    info['new'][0] = mark_safe(info['new'][0])
+
+            # Make status human readable.
+            if name == 'status':
+                if 'old' in info:
+                    info['old'][0] = status_to_string(info['old'][0])
+
+                if 'new' in info:
+                    info['new'][0] = status_to_string(info['new'][0])
+
+        elif name == "screenshot_captions":
+            change_type = 'screenshot_captions'
+        elif name == "file_captions":
+            change_type = 'file_captions'
+        else:
+            # No clue what this is. Bail.
+            continue
+
+        fields_changed.append({
+            'title': fields_changed_name_map.get(name, name),
+            'multiline': multiline,
+            'info': info,
+            'type': change_type,
+            'diff_revision': diff_revision,
+        })
+
+    return fields_changed
+
+
+def _get_review_entry_cache_key(entry, viewer_key):
+    """Returns the cache key for a rendered review box.
+
+    The key changes whenever the review, its comments, or any public replies
+    to it are modified. The reviewer's display name and screenshot and file
+    attachment captions are rendered inside the box, so they are part of the
+    key as well.
+    """
+    review = entry['review']
+    captions = [review.user.get_full_name() or review.user.username]
+
+    for comment in entry['comments']['screenshot_comments']:
+        if hasattr(comment, 'screenshot'):
+            captions.append(u'%s:%s' % (comment.screenshot.caption,
+                                        comment.screenshot.draft_caption))
+
+    for comment in entry['comments']['file_attachment_comments']:
+        if hasattr(comment, 'file_attachment'):
+            captions.append(u'%s:%s' % (comment.file_attachment.caption,
+                                        comment.file_attachment.draft_caption))
+
+    captions_hash = hashlib.sha1(
+        u'\n'.join(captions).encode('utf-8')).hexdigest()
+
+    return make_cache_key('review-detail-review:%d:%s:%s:%s:%s' % (
+        review.pk, entry['last_updated'].isoformat(), entry['class'],
+        captions_hash, viewer_key))
+
+
+def _get_changedesc_entry_cache_key(entry, viewer_key):
+    """Returns the cache key for a rendered change description box."""
+    changedesc = entry['changedesc']
+
+    return make_cache_key('review-detail-changedesc:%d:%s:%s:%s' % (
+        changedesc.pk, changedesc.timestamp.isoformat(), entry['class'],
+        viewer_key))
+
+
+def _get_enabled_extensions_key():
+    """Returns a key for the extensions enabled in this process.
+
+    Extensions can add content to the review boxes through template hooks,
+    so cached boxes must not outlive a change to the enabled extensions.
+    """
+    extensions = sorted([
+        '%s:%s' % (extension.id, extension.info.version)
+        for extension in get_extension_manager().get_enabled_extensions()
+    ])
+
+    return hashlib.sha1(','.join(extensions)).hexdigest()
+
+
+def _render_review_detail_entries(context, entries, viewer_key,
+                                  get_changeinfo):
+    """Renders the review and change description boxes for the detail page.
+
+    Each box is cached separately, keyed on its own modification state and
+    on the parts of the viewer's state that affect rendering. All cached
+    boxes are fetched at once, and only the boxes that are missing or out
+    of date are rendered.
+
+    Entries marked with ``uncacheable`` (such as reviews with one of the
+    viewer's draft replies) are always rendered.
+
+    The rendered HTML is stored in the ``html`` key of each entry.
+    """
+    keys = {}
+
+    for i, entry in enumerate(entries):
+        if entry.get('uncacheable'):
+            continue
+        elif 'review' in entry:
+            keys[i] = _get_review_entry_cache_key(entry, viewer_key)
+        else:
+            keys[i] = _get_changedesc_entry_cache_key(entry, viewer_key)
+
+    cached = cache.get_many(keys.values())
+    review_template = None
+    changedesc_template = None
+    to_cache = {}
+
+    for i, entry in enumerate(entries):
+        key = keys.get(i)
+
+        if key in cached:
+            entry['html'] = mark_safe(cached[key])
+            continue
+
+        if 'review' in entry:
+            if review_template is None:
+                review_template = get_template('reviews/review_box.html')
+
+            template = review_template
+        else:
+            if changedesc_template is None:
+                changedesc_template = \
+                    get_template('reviews/changedesc_box.html')
+
+            template = changedesc_template
+            entry['changeinfo'] = get_changeinfo(entry['changedesc'])
+
+        context.update({'entry': entry})
+
+        try:
+            html = template.render(context)
+        finally:
+            context.pop()
+
+        entry['html'] = mark_safe(html)
+
+        if key:
+            to_cache[key] = html
+
+    if to_cache:
+        cache.set_many(to_cache, settings.CACHE_EXPIRATION_TIME)
+
+
 def _query_for_diff(review_request, user, revision, draft):
     """
     Queries for a diff based on several parameters.
@@ -319,6 +518,7 @@ def review_detail(request,
     reply_timestamps = {}
     reviews_entry_map = {}
     reviews_id_map = {}
+    draft_reply_ids = set()
     review_timestamp = 0
 
     # Start by going through all reviews that point to this review request.
@@ -363,6 +563,14 @@ def review_detail(request,
             # we'll use this timestamp in the ETag.
             review_timestamp = review.timestamp
 
+        if (not review.public and
+            review.base_reply_to_id is not None and
+            request.user.is_authenticated() and
+            review.user_id == request.user.pk):
+            # The boxes for reviews with a draft reply from this user
+            # can't be shared with anyone else, so they won't be cached.
+            draft_reply_ids.add(review.base_reply_to_id)
+
         if review.public or (request.user.is_authenticated() and
                              review.user_id == request.user.pk):
             reviews_id_map[review.pk] = review
@@ -393,15 +601,13 @@ def review_detail(request,
             visited.timestamp = timezone.now()
             visited.save()
 
-        # Try using get_profile first, because it caches for future calls.
-        # If it fails, it's okay. We don't rely upon it here.
-        try:
-            profile = request.user.get_profile()
+        # The profile may not exist. That's okay. We don't rely upon it here.
+        profile = get_request_snapshot(request).profile
+
+        if profile is not None:
             starred_review_requests = \
                 profile.starred_review_requests.filter(pk=review_request.pk)
             starred = (starred_review_requests.count() > 0)
-        except Profile.DoesNotExist:
-            pass
 
     draft = review_request.get_draft(request.user)
     review_request_details = draft or review_request
@@ -472,7 +678,10 @@ def review_detail(request,
                     'file_attachment_comments': []
                 },
                 'timestamp': review.timestamp,
+                'last_updated': max(review.timestamp,
+                                    latest_reply or review.timestamp),
                 'class': state,
+                'uncacheable': review.pk in draft_reply_ids,
             }
             reviews_entry_map[review.pk] = entry
             entries.append(entry)
@@ -604,6 +813,10 @@ def review_detail(request,
                 if comment.is_reply():
                     replied_comment = comment_map[comment.reply_to_id]
                     replied_comment._replies.append(comment)
+
+                entry = reviews_entry_map[parent_review.base_reply_to_id]
+                entry['last_updated'] = max(entry['last_updated'],
+                                            comment.timestamp)
             elif parent_review.public:
                 # This is a comment on a public review we're going to show.
                 # Add it to the list.
@@ -611,6 +824,11 @@ def review_detail(request,
                 entry = reviews_entry_map[obj.review_id]
                 entry['comments'][key].append(comment)
 
+                # Changing an issue's status updates the comment's timestamp,
+                # so this must be taken into account for caching.
+                entry['last_updated'] = max(entry['last_updated'],
+                                            comment.timestamp)
+
                 if comment.issue_opened:
                     status_key = \
                         comment.issue_status_to_string(comment.issue_status)
@@ -621,70 +839,6 @@ def review_detail(request,
     # Sort all the reviews and ChangeDescriptions into a single list, for
     # display.
     for changedesc in changedescs:
-        fields_changed = []
-
-        for name, info in changedesc.fields_changed.iteritems():
-            info = copy.deepcopy(info)
-            multiline = False
-            diff_revision = False
-
-            if 'added' in info or 'removed' in info:
-                change_type = 'add_remove'
-
-                # We don't hard-code URLs in the bug info, since the
-                # tracker may move, but we can do it here.
-                if (name == "bugs_closed" and
-                    review_request.repository and
-                    review_request.repository.bug_tracker):
-                    bug_url = review_request.repository.bug_tracker
-                    for field in info:
-                        for i, buginfo in enumerate(info[field]):
-                            try:
-                                full_bug_url = bug_url % buginfo[0]
-                                info[field][i] = (buginfo[0], full_bug_url)
-                            except TypeError:
-                                logging.warning("Invalid bugtracker url format")
-                elif name == "diff" and "added" in info:
-                    # Sets the incremental revision number for a review
-                    # request change, provided it is an updated diff.
-                    diff_revision = diffset_versions[info['added'][0][2]]
-
-            elif 'old' in info or 'new' in info:
-                change_type = 'changed'
-                multiline = (name == "description" or name == "testing_done")
-
-                # Branch text is allowed to have entities, so mark it safe.
-                if name == "branch":
-                    if 'old' in info:
-                        info['old'][0] = mark_safe(info['old'][0])
-
-                    if 'new' in info:
-                        info['new'][0] = mark_safe(info['new'][0])
-
-                # Make status human readable.
-                if name == 'status':
-                    if 'old' in info:
-                        info['old'][0] = status_to_string(info['old'][0])
-
-                    if 'new' in info:
-                        info['new'][0] = status_to_string(info['new'][0])
-
-            elif name == "screenshot_captions":
-                change_type = 'screenshot_captions'
-            elif name == "file_captions":
-                change_type = 'file_captions'
-            else:
-                # No clue what this is. Bail.
-                continue
-
-            fields_changed.append({
-                'title': fields_changed_name_map.get(name, name),
-                'multiline': multiline,
-                'info': info,
-                'type': change_type,
-                'diff_revision': diff_revision,
-            })
-
         # Expand the latest review change
         state = ''
 
@@ -693,7 +847,6 @@ def review_detail(request,
             state = 'collapsed'
 
         entries.append({
-            'changeinfo': fields_changed,
             'changedesc': changedesc,
             'timestamp': changedesc.timestamp,
             'class': state,
@@ -709,9 +862,8 @@ def review_detail(request,
         if status in (ReviewRequest.DISCARDED, ReviewRequest.SUBMITTED):
             close_description = latest_changedesc.text
 
-    response = render_to_response(
-        template_name,
-        RequestContext(request, _make_review_request_context(review_request, {
+    context = RequestContext(request, _make_review_request_context(
+        review_request, {
             'draft': draft,
             'detail_hooks': ReviewRequestDetailHook.hooks,
             'review_request_details': review_request_details,
@@ -726,7 +878,28 @@ def review_detail(request,
             'has_diffs': (draft and draft.diffset) or len(diffsets) > 0,
             'file_attachments': file_attachments,
             'screenshots': screenshots,
-        })))
+        }))
+
+    # Entries are rendered individually, so that they can be cached
+    # separately. This is the state of the viewer that affects how an
+    # entry is rendered.
+    viewer_key = '%d:%d:%d:%s:%s:%s:%s:%s' % (
+        int(request.user.is_authenticated()),
+        int(request.user.is_authenticated() and
+            request.user.pk == review_request.submitter_id),
+        int(draft is not None),
+        get_language(),
+        timezone.get_current_timezone_name(),
+        local_site_name,
+        settings.AJAX_SERIAL,
+        _get_enabled_extensions_key())
+
+    _render_review_detail_entries(
+        context, entries, viewer_key,
+        lambda changedesc: _get_changedesc_fields(changedesc, review_request,
+                                                  diffset_versions))
+
+    response = render_to_response(template_name, context)
     set_etag(response, etag)
 
     return response
@@ -1067,8 +1240,10 @@ def raw_diff(request,
     draft = review_request.get_draft(request.user)
     diffset = _query_for_diff(review_request, request.user, revision, draft)
 
+    # The diff is streamed a few files at a time, rather than built in
+    # memory, since diffsets can be very large.
     tool = review_request.repository.get_scmtool()
-    data = tool.get_parser('').raw_diff(diffset)
+    data = tool.get_parser('').iter_raw_diff(diffset)
 
     resp = HttpResponse(data, mimetype='text/x-patch')
 
@@ -1394,46 +1569,34 @@ def search(request,
         if query_review_request:
             return HttpResponseRedirect(query_review_request.get_absolute_url())
 
-    import lucene
-    lv = [int(x) for x in lucene.VERSION.split('.')]
-    lucene_is_2x = lv[0] == 2 and lv[1] < 9
-    lucene_is_3x = lv[0] == 3 or (lv[0] == 2 and lv[1] == 9)
+    index = get_search_index()
 
-    # We may have already initialized lucene
-    try:
-        lucene.initVM(lucene.CLASSPATH)
-    except ValueError:
-        pass
-
-    index_file = siteconfig.get("search_index_file")
-    if lucene_is_2x:
-        store = lucene.FSDirectory.getDirectory(index_file, False)
-    elif lucene_is_3x:
-        store = lucene.FSDirectory.open(lucene.File(index_file))
-    else:
-        assert False
-
-    try:
-        searcher = lucene.IndexSearcher(store)
-    except lucene.JavaError, e:
+    if not index.exists():
         # FIXME: show a useful error
-        raise e
-
-    if lucene_is_2x:
-        parser = lucene.QueryParser('text', lucene.StandardAnalyzer())
-        result_ids = [int(lucene.Hit.cast_(hit).getDocument().get('id')) \
-                      for hit in searcher.search(parser.parse(query))]
-    elif lucene_is_3x:
-        parser = lucene.QueryParser(lucene.Version.LUCENE_CURRENT, 'text',
-            lucene.StandardAnalyzer(lucene.Version.LUCENE_CURRENT))
-        result_ids = [searcher.doc(hit.doc).get('id') \
-                      for hit in searcher.search(parser.parse(query), 100).scoreDocs]
+        raise Http404
 
-    searcher.close()
+    result_ids = [
+        review_request_id
+        for review_request_id, score in index.search(query, MAX_SEARCH_RESULTS)
+    ]
 
     results = ReviewRequest.objects.filter(id__in=result_ids,
                                            local_site__name=local_site_name)
 
+    if result_ids:
+        # Keep the results in the order they were ranked.
+        results = results.extra(
+            select={
+                'search_rank': 'CASE %s END' % ' '.join([
+                    'WHEN %s.%s = %d THEN %d' % (
+                        ReviewRequest._meta.db_table,
+                        ReviewRequest._meta.pk.column,
+                        review_request_id, rank)
+                    for rank, review_request_id in enumerate(result_ids)
+                ]),
+            },
+            order_by=['search_rank'])
+
     return object_list(request=request,
                        queryset=results,
                        paginate_by=10,
@@ -0,0 +1,320 @@
+"""An SCMTool backed by a local directory of versioned files.
+
+This is meant for development and load testing. It serves files and
+changesets from a directory on the local disk, and can add latency and
+failures to its operations, so that the diff viewer and the caching built
+around repositories can be exercised without a real repository server.
+
+This isn't registered as an SCMTool by default, since it's not meant for
+production sites. To use it, add a Tool with a class name of
+``reviewboard.scmtools.fixture.FixtureTool``.
+
+The directory is laid out as::
+
+    <path>/
+        HEAD                        The name of the HEAD revision (optional)
+        revisions/<revision>/<file> The contents of <file> at <revision>
+        changesets/<number>.json    A changeset
+
+A file only exists at the revisions that have a copy of it. If there's no
+HEAD file, HEAD is looked up as a revision named "HEAD". Revision names
+can't contain path separators or "..", and files are only ever read from
+inside the revisions directory.
+
+Changesets are JSON objects, which may contain ``summary``,
+``description``, ``testing_done``, ``branch``, ``bugs_closed``, ``files``,
+``username`` and ``pending`` keys.
+
+Latency and failures are set in the repository's extra data:
+
+``fixture_latency``
+    The number of milliseconds each operation takes.
+
+``fixture_latency_jitter``
+    A random number of milliseconds, up to this many, added to the latency.
+
+``fixture_failure_rate``
+    The fraction of operations, from 0 to 1, that fail with an SCMError.
+
+``fixture_seed``
+    The seed for the jitter and failures, for repeatable runs.
+"""
+import os
+import random
+import threading
+import time
+
+from django.utils import simplejson
+
+from reviewboard.scmtools.core import ChangeSet, HEAD, PRE_CREATION, \
+                                      Revision, SCMTool
+from reviewboard.scmtools.errors import EmptyChangeSetError, \
+                                        FileNotFoundError, \
+                                        RepositoryNotFoundError, SCMError
+
+
+class FixtureTool(SCMTool):
+    name = "Fixture"
+    field_help_text = {
+        'path': 'The path to the local directory containing the files.',
+    }
+
+    # Repository.get_scmtool() creates a new FixtureTool each time, so the
+    # random state for each repository is kept here, in order for seeded
+    # runs to be repeatable.
+    _randoms = {}
+    _randoms_lock = threading.Lock()
+
+    def __init__(self, repository):
+        SCMTool.__init__(self, repository)
+
+        self.root = repository.path
+        extra_data = repository.extra_data or {}
+
+        self.latency = float(extra_data.get('fixture_latency', 0)) / 1000
+        self.latency_jitter = \
+            float(extra_data.get('fixture_latency_jitter', 0)) / 1000
+        self.failure_rate = float(extra_data.get('fixture_failure_rate', 0))
+        self.random = self._get_random(extra_data.get('fixture_seed'))
+
+    def get_file(self, path, revision=HEAD):
+        self._simulate_operation('get_file')
+
+        return self._read_file(path, revision)
+
+    def file_exists(self, path, revision=HEAD):
+        self._simulate_operation('file_exists')
+
+        return self._file_exists(path, revision)
+
+    def get_files(self, files):
+        """Returns the contents of several files in one operation.
+
+        ``files`` is a list of (path, revision) tuples. The result is a
+        dictionary mapping each of those to the file's contents. The latency
+        is added once for the whole batch.
+        """
+        self._simulate_operation('get_files')
+
+        return dict([
+            ((path, revision), self._read_file(path, revision))
+            for path, revision in files
+        ])
+
+    def files_exist(self, files):
+        """Returns whether several files exist, in one operation.
+
+        ``files`` is a list of (path, revision) tuples. The result is a
+        dictionary mapping each of those to whether the file exists.
+        """
+        self._simulate_operation('files_exist')
+
+        return dict([
+            ((path, revision), self._file_exists(path, revision))
+            for path, revision in files
+        ])
+
+    def parse_diff_revision(self, file_str, revision_str, *args, **kwargs):
+        revision_str = revision_str.strip()
+
+        if not revision_str or revision_str == PRE_CREATION.name:
+            revision = PRE_CREATION
+        elif revision_str == HEAD.name:
+            revision = HEAD
+        else:
+            revision = Revision(revision_str)
+
+        return file_str, revision
+
+    def get_diffs_use_absolute_paths(self):
+        return True
+
+    def get_changeset(self, changesetid, allow_empty=False):
+        self._simulate_operation('get_changeset')
+
+        return self._read_changeset(changesetid, allow_empty)
+
+    def get_pending_changesets(self, userid):
+        self._simulate_operation('get_pending_changesets')
+
+        changesets = []
+        changesets_dir = os.path.join(self.root, 'changesets')
+
+        if os.path.isdir(changesets_dir):
+            for filename in sorted(os.listdir(changesets_dir)):
+                changesetid, ext = os.path.splitext(filename)
+
+                if ext == '.json':
+                    changeset = self._read_changeset(changesetid, True)
+
+                    if changeset.pending and changeset.username == userid:
+                        changesets.append(changeset)
+
+        return changesets
+
+    def get_filenames_in_revision(self, revision):
+        self._simulate_operation('get_filenames_in_revision')
+
+        revision_dir = self._get_revision_dir(revision)
+
+        if revision_dir is None:
+            raise SCMError('Invalid revision %s' % revision)
+
+        filenames = []
+
+        for dirpath, dirnames, dirfilenames in os.walk(revision_dir):
+            for filename in dirfilenames:
+                filenames.append('/' + os.path.relpath(
+                    os.path.join(dirpath, filename),
+                    revision_dir).replace(os.sep, '/'))
+
+        filenames.sort()
+
+        return filenames
+
+    def get_fields(self):
+        return ['diff_path', 'changenum']
+
+    @classmethod
+    def check_repository(cls, path, username=None, password=None,
+                         local_site_name=None):
+        if not os.path.isdir(os.path.join(path, 'revisions')):
+            raise RepositoryNotFoundError()
+
+    def _get_random(self, seed):
+        key = (self.root, seed)
+
+        self._randoms_lock.acquire()
+
+        try:
+            if key not in self._randoms:
+                self._randoms[key] = random.Random(seed)
+
+            return self._randoms[key]
+        finally:
+            self._randoms_lock.release()
+
+    def _simulate_operation(self, operation):
+        """Adds the configured latency, and possibly a failure."""
+        latency = self.latency
+
+        if self.latency_jitter:
+            latency += self.random.uniform(0, self.latency_jitter)
+
+        if latency > 0:
+            time.sleep(latency)
+
+        if self.failure_rate and self.random.random() < self.failure_rate:
+            raise SCMError('Simulated failure in %s on %s'
+                           % (operation, self.repository.name))
+
+    def _resolve_revision(self, revision):
+        if revision == HEAD:
+            head_path = os.path.join(self.root, 'HEAD')
+
+            if os.path.exists(head_path):
+                fp = open(head_path, 'r')
+                revision = fp.read().strip()
+                fp.close()
+
+        return str(revision)
+
+    def _get_revision_dir(self, revision):
+        """Returns the path on disk to the directory for a revision.
+
+        Revisions come from uploaded diffs, so None is returned for any
+        revision that isn't a plain name, or whose directory would be
+        outside of the revisions directory.
+        """
+        revision = self._resolve_revision(revision)
+
+        if (not revision or revision in ('.', '..') or '/' in revision or
+            os.sep in revision or (os.altsep and os.altsep in revision)):
+            return None
+
+        revisions_dir = os.path.realpath(os.path.join(self.root, 'revisions'))
+        revision_dir = os.path.realpath(os.path.join(revisions_dir, revision))
+
+        if not revision_dir.startswith(revisions_dir + os.sep):
+            return None
+
+        return revision_dir
+
+    def _get_file_path(self, path, revision):
+        """Returns the path on disk to a file at a revision.
+
+        None is returned for files that can't exist, such as those outside
+        of the revision's directory. Symlinks are resolved before checking.
+        """
+        if revision == PRE_CREATION:
+            return None
+
+        revision_dir = self._get_revision_dir(revision)
+
+        if revision_dir is None:
+            return None
+
+        file_path = os.path.realpath(os.path.join(revision_dir,
+                                                  path.lstrip('/')))
+
+        if not file_path.startswith(revision_dir + os.sep):
+            return None
+
+        return file_path
+
+    def _file_exists(self, path, revision):
+        file_path = self._get_file_path(path, revision)
+
+        return file_path is not None and os.path.isfile(file_path)
+
+    def _read_file(self, path, revision):
+        file_path = self._get_file_path(path, revision)
+
+        if not file_path:
+            raise FileNotFoundError(path, revision)
+
+        try:
+            fp = open(file_path, 'rb')
+
+            try:
+                return fp.read()
+            finally:
+                fp.close()
+        except IOError, e:
+            raise FileNotFoundError(path, revision, str(e))
+
+    def _read_changeset(self, changesetid, allow_empty):
+        if '/' in str(changesetid) or os.sep in str(changesetid):
+            return None
+
+        changeset_path = os.path.join(self.root, 'changesets',
+                                      '%s.json' % changesetid)
+
+        if not os.path.exists(changeset_path):
+            return None
+
+        fp = open(changeset_path, 'r')
+
+        try:
+            data = simplejson.load(fp)
+        except ValueError, e:
+            raise SCMError('Changeset %s could not be parsed: %s'
+                           % (changesetid, e))
+        finally:
+            fp.close()
+
+        changeset = ChangeSet()
+        changeset.changenum = changesetid
+        changeset.summary = data.get('summary', '')
+        changeset.description = data.get('description', '')
+        changeset.testing_done = data.get('testing_done', '')
+        changeset.branch = data.get('branch', '')
+        changeset.bugs_closed = data.get('bugs_closed', [])
+        changeset.files = data.get('files', [])
+        changeset.username = data.get('username', '')
+        changeset.pending = data.get('pending', False)
+
+        if not changeset.files and not allow_empty:
+            raise EmptyChangeSetError(changesetid)
+
+        return changeset
@@ -4,6 +4,7 @@ from django.db import models
 from django.utils.translation import ugettext_lazy as _
 from djblets.util.fields import JSONField
 
+from reviewboard.admin.instrumentation import instrument_scm_call
 from reviewboard.hostingsvcs.models import HostingServiceAccount
 from reviewboard.scmtools.managers import RepositoryManager, ToolManager
 from reviewboard.site.models import LocalSite
@@ -140,6 +141,7 @@ class Repository(models.Model):
 
         return None
 
+    @instrument_scm_call
     def get_file(self, path, revision):
         """Returns a file from the repository.
 
@@ -154,6 +156,7 @@ class Repository(models.Model):
         else:
             return self.get_scmtool().get_file(path, revision)
 
+    @instrument_scm_call
     def get_file_exists(self, path, revision):
         """Returns whether or not a file exists in the repository.
 
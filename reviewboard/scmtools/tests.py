@@ -1,8 +1,10 @@
 import errno
 import imp
 import os
+import shutil
 import socket
 import tempfile
+import time
 try:
     from hashlib import md5
 except ImportError:
@@ -25,7 +27,9 @@ from reviewboard.reviews.models import Group
 from reviewboard.scmtools.core import HEAD, PRE_CREATION, ChangeSet, Revision
 from reviewboard.scmtools.errors import SCMError, FileNotFoundError, \
                                         RepositoryNotFoundError, \
-                                        AuthenticationError
+                                        AuthenticationError, \
+                                        EmptyChangeSetError
+from reviewboard.scmtools.fixture import FixtureTool
 from reviewboard.scmtools.forms import RepositoryForm
 from reviewboard.scmtools.git import ShortSHA1Error
 from reviewboard.scmtools.models import Repository, Tool
@@ -1512,6 +1516,184 @@ class GitTests(SCMTestCase):
             lambda: self.remote_tool.get_file('README', 'd7e96b3'))
 
 
+class FixtureTests(DjangoTestCase):
+    """Unit tests for FixtureTool."""
+    def setUp(self):
+        self.repo_dir = tempfile.mkdtemp(prefix='rb-tests-')
+
+        self._write('revisions/1/src/main.c', 'int main() {}\n')
+        self._write('revisions/1/README', 'Version 1\n')
+        self._write('revisions/2/README', 'Version 2\n')
+        self._write('HEAD', '2\n')
+        self._write('changesets/10.json',
+                    '{"summary": "Summary", "description": "Description",'
+                    ' "files": ["/README"], "username": "doc",'
+                    ' "pending": true}')
+        self._write('changesets/11.json', '{"summary": "Empty"}')
+
+        self.repository = Repository(name='Fixture', path=self.repo_dir)
+        self.tool = FixtureTool(self.repository)
+
+    def tearDown(self):
+        shutil.rmtree(self.repo_dir)
+
+    def _write(self, path, data):
+        path = os.path.join(self.repo_dir, path)
+
+        if not os.path.exists(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+
+        fp = open(path, 'w')
+        fp.write(data)
+        fp.close()
+
+    def test_get_file(self):
+        """Testing FixtureTool.get_file"""
+        self.assertEqual(self.tool.get_file('/src/main.c', '1'),
+                         'int main() {}\n')
+        self.assertEqual(self.tool.get_file('README', Revision('1')),
+                         'Version 1\n')
+        self.assertEqual(self.tool.get_file('README', HEAD), 'Version 2\n')
+
+    def test_get_file_not_found(self):
+        """Testing FixtureTool.get_file with missing files"""
+        self.assertRaises(FileNotFoundError,
+                          lambda: self.tool.get_file('/src/main.c', '2'))
+        self.assertRaises(FileNotFoundError,
+                          lambda: self.tool.get_file('README', PRE_CREATION))
+        self.assertRaises(FileNotFoundError,
+                          lambda: self.tool.get_file('../../HEAD', '1'))
+
+    def test_get_file_outside_revisions(self):
+        """Testing FixtureTool.get_file with paths outside of the revisions"""
+        self._write('secret', 'Secret\n')
+        os.symlink(os.path.join(self.repo_dir, 'secret'),
+                   os.path.join(self.repo_dir, 'revisions', '1', 'link'))
+
+        for path, revision in (('/secret', '..'),
+                               ('/secret', '../'),
+                               ('/hostname', '../../../../etc'),
+                               ('/link', '1')):
+            self.assertRaises(FileNotFoundError,
+                              lambda: self.tool.get_file(path, revision))
+            self.assertFalse(self.tool.file_exists(path, revision))
+
+        self.assertRaises(SCMError,
+                          lambda: self.tool.get_filenames_in_revision('..'))
+
+    def test_file_exists(self):
+        """Testing FixtureTool.file_exists"""
+        self.assertTrue(self.tool.file_exists('/src/main.c', '1'))
+        self.assertFalse(self.tool.file_exists('/src/main.c', HEAD))
+        self.assertFalse(self.tool.file_exists('README', PRE_CREATION))
+
+    def test_batch_operations(self):
+        """Testing FixtureTool.get_files and files_exist"""
+        self.assertEqual(self.tool.get_files([('README', '1'),
+                                              ('README', '2')]),
+                         {
+                             ('README', '1'): 'Version 1\n',
+                             ('README', '2'): 'Version 2\n',
+                         })
+        self.assertEqual(self.tool.files_exist([('/src/main.c', '1'),
+                                                ('/src/main.c', '2')]),
+                         {
+                             ('/src/main.c', '1'): True,
+                             ('/src/main.c', '2'): False,
+                         })
+
+    def test_parse_diff_revision(self):
+        """Testing FixtureTool.parse_diff_revision"""
+        self.assertEqual(self.tool.parse_diff_revision('/README', '1'),
+                         ('/README', '1'))
+        self.assertEqual(
+            self.tool.parse_diff_revision('/README', 'PRE-CREATION')[1],
+            PRE_CREATION)
+        self.assertEqual(self.tool.parse_diff_revision('/README', 'HEAD')[1],
+                         HEAD)
+
+    def test_get_changeset(self):
+        """Testing FixtureTool.get_changeset"""
+        changeset = self.tool.get_changeset(10)
+        self.assertEqual(changeset.changenum, 10)
+        self.assertEqual(changeset.summary, 'Summary')
+        self.assertEqual(changeset.description, 'Description')
+        self.assertEqual(changeset.files, ['/README'])
+        self.assertTrue(changeset.pending)
+
+        self.assertEqual(self.tool.get_changeset(12), None)
+        self.assertRaises(EmptyChangeSetError,
+                          lambda: self.tool.get_changeset(11))
+        self.assertEqual(
+            self.tool.get_changeset(11, allow_empty=True).summary, 'Empty')
+
+        pending = self.tool.get_pending_changesets('doc')
+        self.assertEqual([pending_changeset.changenum
+                          for pending_changeset in pending],
+                         ['10'])
+
+    def test_get_filenames_in_revision(self):
+        """Testing FixtureTool.get_filenames_in_revision"""
+        self.assertEqual(self.tool.get_filenames_in_revision('1'),
+                         ['/README', '/src/main.c'])
+
+    def test_latency(self):
+        """Testing FixtureTool with latency"""
+        self.repository.extra_data = {
+            'fixture_latency': 50,
+        }
+        tool = FixtureTool(self.repository)
+
+        start_time = time.time()
+        tool.get_files([('README', '1'), ('README', '2')])
+        self.assertTrue(time.time() - start_time >= 0.05)
+
+    def test_failures(self):
+        """Testing FixtureTool with failures"""
+        self.repository.extra_data = {
+            'fixture_failure_rate': 1,
+        }
+        tool = FixtureTool(self.repository)
+
+        self.assertRaises(SCMError, lambda: tool.get_file('README', '1'))
+        self.assertRaises(SCMError, lambda: tool.file_exists('README', '1'))
+
+    def test_failures_with_seed(self):
+        """Testing FixtureTool with seeded failures"""
+        def get_results():
+            # A new directory name gives the repository new random state.
+            self.repository.path = tempfile.mkdtemp(prefix='rb-tests-')
+            os.rmdir(self.repository.path)
+            results = []
+
+            for i in range(20):
+                try:
+                    FixtureTool(self.repository).file_exists('README', '1')
+                    results.append(True)
+                except SCMError:
+                    results.append(False)
+
+            return results
+
+        self.repository.extra_data = {
+            'fixture_failure_rate': 0.5,
+            'fixture_seed': 42,
+        }
+
+        results = get_results()
+        self.assertTrue(True in results)
+        self.assertTrue(False in results)
+        self.assertEqual(get_results(), results)
+
+    def test_check_repository(self):
+        """Testing FixtureTool.check_repository"""
+        FixtureTool.check_repository(self.repo_dir)
+        self.assertRaises(
+            RepositoryNotFoundError,
+            lambda: FixtureTool.check_repository(
+                os.path.join(self.repo_dir, 'revisions', '1')))
+
+
 class PolicyTests(DjangoTestCase):
     fixtures = ['test_scmtools']
 
@@ -0,0 +1,15 @@
+from reviewboard.signals import initializing
+
+
+def _connect_signals(**kwargs):
+    """
+    Listens to the ``initializing`` signal and connects the signals used
+    to keep the search and autocomplete indexes up to date.
+    """
+    from reviewboard.search import documents, typeahead
+
+    documents.connect_signals()
+    typeahead.connect_signals()
+
+
+initializing.connect(_connect_signals)
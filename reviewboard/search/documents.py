@@ -0,0 +1,194 @@
+"""Indexing of review requests for search."""
+import logging
+
+from djblets.siteconfig.models import SiteConfiguration
+
+from reviewboard.diffviewer.models import FileDiff
+from reviewboard.reviews.models import Comment, FileAttachmentComment, \
+                                       ReviewRequest, Review, \
+                                       ScreenshotComment
+from reviewboard.reviews.signals import review_published, \
+                                        review_request_closed, \
+                                        review_request_published, \
+                                        review_request_reopened
+from reviewboard.search.index import Field, SearchIndex
+from reviewboard.search.query import analyze_keyword, \
+                                     analyze_keyword_list, \
+                                     analyze_path, \
+                                     analyze_query_path, \
+                                     analyze_text
+
+
+SCHEMA = {
+    'summary': Field(analyze_text, boost=4.0, default=True),
+    'description': Field(analyze_text, default=True),
+    'testing_done': Field(analyze_text, boost=0.5, default=True),
+    'bug': Field(analyze_keyword_list, boost=2.0, default=True),
+    'changenum': Field(analyze_keyword, boost=2.0, default=True),
+    'author': Field(analyze_text, boost=1.5, default=True),
+    'username': Field(analyze_keyword),
+    'file': Field(analyze_path, boost=1.5,
+                  query_analyzer=analyze_query_path),
+    'review': Field(analyze_text, boost=0.5, default=True),
+
+    # The words in the file paths, so that plain queries can match them.
+    'file_words': Field(analyze_text, boost=0.5, default=True),
+}
+
+INDEXED_STATUSES = (ReviewRequest.PENDING_REVIEW, ReviewRequest.SUBMITTED)
+
+
+def get_search_index():
+    """Returns the SearchIndex for the site's configured index directory."""
+    siteconfig = SiteConfiguration.objects.get_current()
+
+    return SearchIndex(siteconfig.get('search_index_file'), SCHEMA)
+
+
+def get_indexed_review_requests():
+    """Returns a queryset of all review requests that should be indexed."""
+    return ReviewRequest.objects.filter(
+        public=True,
+        status__in=INDEXED_STATUSES).select_related('submitter')
+
+
+def is_indexed(review_request):
+    """Returns whether a review request belongs in the search index."""
+    return (review_request.public and
+            review_request.status in INDEXED_STATUSES)
+
+
+def build_documents(review_requests):
+    """Returns the values to index for a list of review requests.
+
+    The file paths and review text for all the review requests are fetched
+    at once. This returns a list of (review request ID, values) tuples.
+    """
+    if not review_requests:
+        return []
+
+    ids = [review_request.pk for review_request in review_requests]
+    history_ids = [review_request.diffset_history_id
+                   for review_request in review_requests
+                   if review_request.diffset_history_id]
+
+    file_paths = {}
+
+    if history_ids:
+        for history_id, source_file, dest_file in FileDiff.objects.filter(
+                diffset__history__in=history_ids
+            ).values_list('diffset__history', 'source_file', 'dest_file'):
+            paths = file_paths.setdefault(history_id, set())
+
+            if source_file:
+                paths.add(source_file)
+
+            if dest_file:
+                paths.add(dest_file)
+
+    review_text = {}
+
+    for review_request_id, body_top, body_bottom in Review.objects.filter(
+            review_request__in=ids,
+            public=True).values_list('review_request', 'body_top',
+                                     'body_bottom'):
+        review_text.setdefault(review_request_id, []).extend(
+            [body_top, body_bottom])
+
+    for model in (Comment, ScreenshotComment, FileAttachmentComment):
+        for review_request_id, text in model.objects.filter(
+                review__review_request__in=ids,
+                review__public=True).values_list('review__review_request',
+                                                 'text'):
+            review_text.setdefault(review_request_id, []).append(text)
+
+    return [
+        (review_request.pk,
+         build_document(review_request,
+                        file_paths.get(review_request.diffset_history_id, ()),
+                        review_text.get(review_request.pk, ())))
+        for review_request in review_requests
+    ]
+
+
+def build_document(review_request, file_paths, review_text=()):
+    """Returns the values to index for a review request."""
+    submitter = review_request.submitter
+    files = '\n'.join(sorted(file_paths))
+
+    if review_request.changenum:
+        changenum = unicode(review_request.changenum)
+    else:
+        changenum = u''
+
+    return {
+        'summary': review_request.summary,
+        'description': review_request.description,
+        'testing_done': review_request.testing_done,
+        'bug': review_request.bugs_closed,
+        'changenum': changenum,
+        'author': u' '.join([submitter.username, submitter.get_full_name()]),
+        'username': submitter.username,
+        'file': files,
+        'file_words': files,
+        'review': u'\n'.join(text for text in review_text if text),
+    }
+
+
+def analyze_documents(documents):
+    """Analyzes a list of (ID, values) tuples for the index.
+
+    This returns a list of (ID, fields) tuples that can be passed to
+    :py:meth:`IndexWriter.add_analyzed_document`. This is the expensive
+    part of indexing, and is safe to run in another process.
+    """
+    return [
+        (doc_id, SearchIndex.analyze(SCHEMA, values))
+        for doc_id, values in documents
+    ]
+
+
+def update_review_request(review_request):
+    """Updates a single review request in the search index.
+
+    The review request is added, replaced or removed as needed.
+    """
+    index = get_search_index()
+    writer = index.writer()
+
+    try:
+        if is_indexed(review_request):
+            for doc_id, values in build_documents([review_request]):
+                writer.add_document(doc_id, values)
+        else:
+            writer.delete_document(review_request.pk)
+    except:
+        writer.cancel()
+        raise
+
+    writer.commit()
+
+
+def _on_review_request_changed(sender, review_request, **kwargs):
+    siteconfig = SiteConfiguration.objects.get_current()
+
+    if not siteconfig.get('search_enable'):
+        return
+
+    try:
+        update_review_request(review_request)
+    except Exception, e:
+        logging.error('Unable to update review request #%s in the search '
+                      'index: %s' % (review_request.pk, e),
+                      exc_info=1)
+
+
+def _on_review_published(sender, review, **kwargs):
+    _on_review_request_changed(sender, review.review_request)
+
+
+def connect_signals():
+    review_request_published.connect(_on_review_request_changed)
+    review_request_closed.connect(_on_review_request_changed)
+    review_request_reopened.connect(_on_review_request_changed)
+    review_published.connect(_on_review_published)
@@ -0,0 +1,1092 @@
+"""An embedded full-text search index.
+
+The index lives in a directory, and is made up of immutable segment files
+and a manifest listing the live segments. Each change to the index bumps
+its generation. Deleted (or replaced) documents are recorded in the
+manifest along with the generation they were deleted in, which hides them
+in any segment written before then.
+
+Each segment stores a term dictionary and a postings list for every term.
+Terms are sorted and front-coded, which allows for fast prefix lookups.
+Postings are lists of (document number, term frequency) pairs, stored as
+delta-encoded varints.
+
+Writes add new segments and update the manifest atomically. Once there are
+too many segments, the smaller ones are merged together. Readers only ever
+see complete segments, so searches can run while the index is updated.
+
+Results are ranked using BM25, with per-field boosts.
+"""
+import bisect
+import math
+import mmap
+import os
+import struct
+import tempfile
+import threading
+import uuid
+from array import array
+
+from django.utils import simplejson
+
+try:
+    import fcntl
+except ImportError:
+    # Locking isn't available on this platform.
+    fcntl = None
+
+from reviewboard.search.query import MUST, MUST_NOT, SHOULD, parse_query
+
+
+FORMAT_VERSION = 1
+
+SEGMENT_MAGIC = 'RBSI'
+SEGMENT_EXT = '.seg'
+MANIFEST_NAME = 'manifest.json'
+MANIFEST_EXT = '.json'
+
+_footer = struct.Struct('>QQ4s')
+_header = struct.Struct('>4sB')
+
+
+class SearchIndexError(Exception):
+    """An error reading or writing the search index."""
+    pass
+
+
+class Field(object):
+    """A field in the search index schema.
+
+    ``analyzer`` splits values into terms. ``boost`` scales the score of
+    matches in this field. Fields with ``default`` set are searched when a
+    query doesn't name a field.
+    """
+    def __init__(self, analyzer, boost=1.0, default=False,
+                 query_analyzer=None):
+        self.analyzer = analyzer
+        self.boost = boost
+        self.default = default
+        self.query_analyzer = query_analyzer
+
+
+def encode_varint(value, out):
+    """Appends a non-negative integer to a bytearray as a varint."""
+    while value > 0x7F:
+        out.append((value & 0x7F) | 0x80)
+        value >>= 7
+
+    out.append(value)
+
+
+def decode_varint(data, pos):
+    """Decodes a varint from a bytearray.
+
+    Returns a tuple of the value and the position following it.
+    """
+    value = 0
+    shift = 0
+
+    while True:
+        b = data[pos]
+        pos += 1
+        value |= (b & 0x7F) << shift
+
+        if b < 0x80:
+            return value, pos
+
+        shift += 7
+
+
+def encode_postings(postings):
+    """Encodes a sorted list of (docnum, frequency) pairs."""
+    out = bytearray()
+    prev = 0
+
+    for docnum, freq in postings:
+        encode_varint(docnum - prev, out)
+        encode_varint(freq, out)
+        prev = docnum
+
+    return out
+
+
+def decode_postings(data, count):
+    """Decodes ``count`` (docnum, frequency) pairs."""
+    postings = []
+    pos = 0
+    docnum = 0
+
+    for i in xrange(count):
+        delta, pos = decode_varint(data, pos)
+        freq, pos = decode_varint(data, pos)
+        docnum += delta
+        postings.append((docnum, freq))
+
+    return postings
+
+
+def write_segment(path, fields, doc_ids, field_lengths, postings):
+    """Writes a segment file.
+
+    ``fields`` is the list of field names in the segment. ``doc_ids`` is the
+    list of document IDs, in document number order. ``field_lengths`` maps
+    field names to lists of the number of terms in each document's field.
+
+    ``postings`` is an iterable of ``(field, term, postings)`` tuples, sorted
+    by field and then term, where each postings list is a sorted list of
+    ``(docnum, frequency)`` pairs.
+    """
+    f = open(path, 'wb')
+
+    try:
+        f.write(_header.pack(SEGMENT_MAGIC, FORMAT_VERSION))
+        offset = _header.size
+
+        # The term dictionary is built up while writing the postings.
+        terms_by_field = dict((field, []) for field in fields)
+
+        for field, term, field_postings in postings:
+            data = encode_postings(field_postings)
+            f.write(data)
+            terms_by_field[field].append((term, len(field_postings),
+                                          offset, len(data)))
+            offset += len(data)
+
+        # Write the document table.
+        doc_table_offset = offset
+        out = bytearray()
+        encode_varint(len(doc_ids), out)
+
+        for doc_id in doc_ids:
+            encode_varint(doc_id, out)
+
+        encode_varint(len(fields), out)
+
+        for field in fields:
+            name = field.encode('utf-8')
+            encode_varint(len(name), out)
+            out.extend(name)
+
+            for length in field_lengths[field]:
+                encode_varint(length, out)
+
+        f.write(out)
+        offset += len(out)
+
+        # Write the term dictionary, front-coding the terms in each field.
+        dict_offset = offset
+        out = bytearray()
+
+        for field in fields:
+            terms = terms_by_field[field]
+            encode_varint(len(terms), out)
+            prev_term = ''
+            prev_offset = 0
+
+            for term, doc_freq, term_offset, length in terms:
+                term = term.encode('utf-8')
+                shared = 0
+                max_shared = min(len(term), len(prev_term))
+
+                while (shared < max_shared and
+                       term[shared] == prev_term[shared]):
+                    shared += 1
+
+                encode_varint(shared, out)
+                encode_varint(len(term) - shared, out)
+                out.extend(term[shared:])
+                encode_varint(doc_freq, out)
+                encode_varint(term_offset - prev_offset, out)
+                encode_varint(length, out)
+                prev_term = term
+                prev_offset = term_offset
+
+        f.write(out)
+        f.write(_footer.pack(doc_table_offset, dict_offset, SEGMENT_MAGIC))
+    finally:
+        f.close()
+
+
+class SegmentReader(object):
+    """Reads a segment file.
+
+    The term dictionary and document table are loaded into memory. Postings
+    are read from the memory-mapped file as needed.
+    """
+    def __init__(self, path):
+        self.path = path
+
+        f = open(path, 'rb')
+
+        try:
+            self._data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        finally:
+            f.close()
+
+        size = len(self._data)
+
+        if size < _header.size + _footer.size:
+            raise SearchIndexError('Segment %s is truncated' % path)
+
+        magic, version = _header.unpack(self._data[:_header.size])
+        doc_table_offset, dict_offset, footer_magic = \
+            _footer.unpack(self._data[size - _footer.size:])
+
+        if magic != SEGMENT_MAGIC or footer_magic != SEGMENT_MAGIC:
+            raise SearchIndexError('%s is not a search index segment' % path)
+
+        if version != FORMAT_VERSION:
+            raise SearchIndexError('Segment %s has unsupported version %s'
+                                   % (path, version))
+
+        self._dict_range = (dict_offset, size - _footer.size)
+        self._terms = None
+        self._term_info = None
+
+        self._load_doc_table(bytearray(
+            self._data[doc_table_offset:dict_offset]))
+
+    def close(self):
+        self._data.close()
+
+    @property
+    def num_docs(self):
+        return len(self.doc_ids)
+
+    def _load_doc_table(self, data):
+        num_docs, pos = decode_varint(data, 0)
+        self.doc_ids = array('L')
+
+        for i in xrange(num_docs):
+            doc_id, pos = decode_varint(data, pos)
+            self.doc_ids.append(doc_id)
+
+        num_fields, pos = decode_varint(data, pos)
+        self.fields = []
+        self.field_lengths = {}
+        self.total_field_lengths = {}
+
+        for i in xrange(num_fields):
+            length, pos = decode_varint(data, pos)
+            field = str(data[pos:pos + length]).decode('utf-8')
+            pos += length
+
+            lengths = array('L')
+
+            for j in xrange(num_docs):
+                value, pos = decode_varint(data, pos)
+                lengths.append(value)
+
+            self.fields.append(field)
+            self.field_lengths[field] = lengths
+            self.total_field_lengths[field] = sum(lengths)
+
+    @property
+    def terms(self):
+        """A dictionary mapping field names to sorted lists of terms."""
+        if self._terms is None:
+            self._load_dictionary()
+
+        return self._terms
+
+    @property
+    def term_info(self):
+        """A dictionary mapping field names to lists of term information.
+
+        Each entry is a tuple of the document frequency, postings offset
+        and postings length of the term at the same position in
+        :py:attr:`terms`.
+        """
+        if self._term_info is None:
+            self._load_dictionary()
+
+        return self._term_info
+
+    def _load_dictionary(self):
+        start, end = self._dict_range
+        data = bytearray(self._data[start:end])
+        pos = 0
+        terms_by_field = {}
+        info_by_field = {}
+
+        for field in self.fields:
+            num_terms, pos = decode_varint(data, pos)
+            terms = []
+            info = []
+            prev_term = ''
+            prev_offset = 0
+
+            for i in xrange(num_terms):
+                shared, pos = decode_varint(data, pos)
+                suffix_len, pos = decode_varint(data, pos)
+                term = prev_term[:shared] + str(data[pos:pos + suffix_len])
+                pos += suffix_len
+                doc_freq, pos = decode_varint(data, pos)
+                offset_delta, pos = decode_varint(data, pos)
+                length, pos = decode_varint(data, pos)
+
+                prev_term = term
+                prev_offset += offset_delta
+                terms.append(term.decode('utf-8'))
+                info.append((doc_freq, prev_offset, length))
+
+            terms_by_field[field] = terms
+            info_by_field[field] = info
+
+        self._terms = terms_by_field
+        self._term_info = info_by_field
+
+    def doc_freq(self, field, term):
+        """Returns the number of documents containing a term."""
+        i = self._find_term(field, term)
+
+        if i is None:
+            return 0
+
+        return self.term_info[field][i][0]
+
+    def postings(self, field, term):
+        """Returns the list of (docnum, frequency) pairs for a term."""
+        i = self._find_term(field, term)
+
+        if i is None:
+            return []
+
+        return self._read_postings(field, i)
+
+    def expand_prefix(self, field, prefix):
+        """Returns all terms in a field starting with a prefix."""
+        terms = self.terms.get(field)
+
+        if not terms:
+            return []
+
+        i = bisect.bisect_left(terms, prefix)
+        result = []
+
+        while i < len(terms) and terms[i].startswith(prefix):
+            result.append(terms[i])
+            i += 1
+
+        return result
+
+    def iter_postings(self, field):
+        """Yields every (term, postings) pair in a field, in term order."""
+        for i, term in enumerate(self.terms.get(field, [])):
+            yield term, self._read_postings(field, i)
+
+    def _find_term(self, field, term):
+        terms = self.terms.get(field)
+
+        if not terms:
+            return None
+
+        i = bisect.bisect_left(terms, term)
+
+        if i < len(terms) and terms[i] == term:
+            return i
+
+        return None
+
+    def _read_postings(self, field, i):
+        doc_freq, offset, length = self.term_info[field][i]
+
+        return decode_postings(bytearray(self._data[offset:offset + length]),
+                               doc_freq)
+
+
+class IndexReader(object):
+    """Searches a snapshot of the index.
+
+    This is a set of segment readers, along with the documents deleted from
+    each.
+    """
+    #: BM25 term frequency saturation.
+    K1 = 1.2
+
+    #: BM25 field length normalization.
+    B = 0.75
+
+    #: The most terms a prefix query will expand to.
+    MAX_PREFIX_TERMS = 1000
+
+    def __init__(self, schema, segments):
+        self.schema = schema
+        self.segments = segments
+
+        self.num_docs = sum(
+            reader.num_docs - len(deleted)
+            for reader, deleted in segments)
+
+        self._avg_lengths = {}
+
+        for field in schema:
+            total = sum(reader.total_field_lengths.get(field, 0)
+                        for reader, deleted in segments)
+            num_docs = sum(reader.num_docs for reader, deleted in segments)
+            self._avg_lengths[field] = float(total) / max(num_docs, 1)
+
+    def close(self):
+        for reader, deleted in self.segments:
+            reader.close()
+
+    def doc_ids(self):
+        """Returns the set of IDs of all documents in the index."""
+        result = set()
+
+        for reader, deleted in self.segments:
+            result.update(reader.doc_ids)
+            result.difference_update(deleted)
+
+        return result
+
+    def search(self, query, limit=None):
+        """Searches the index.
+
+        ``query`` may be a query string, or a list of parsed clauses.
+
+        Returns a list of (document ID, score) pairs, from best match to
+        worst.
+        """
+        if isinstance(query, basestring):
+            query = parse_query(
+                query,
+                dict((name, field.analyzer)
+                     for name, field in self.schema.iteritems()),
+                dict((name, field.query_analyzer)
+                     for name, field in self.schema.iteritems()
+                     if field.query_analyzer))
+
+        required = [clause for clause in query if clause.occur == MUST]
+        optional = [clause for clause in query if clause.occur == SHOULD]
+        excluded = [clause for clause in query if clause.occur == MUST_NOT]
+
+        if not required and not optional:
+            return []
+
+        scores = {}
+
+        for reader, deleted in self.segments:
+            segment_scores = self._search_segment(reader, required, optional,
+                                                  excluded)
+
+            for docnum, score in segment_scores.iteritems():
+                doc_id = reader.doc_ids[docnum]
+
+                if doc_id not in deleted:
+                    scores[doc_id] = score
+
+        results = sorted(scores.iteritems(),
+                         key=lambda (doc_id, score): (-score, -doc_id))
+
+        if limit is not None:
+            results = results[:limit]
+
+        return results
+
+    def _search_segment(self, reader, required, optional, excluded):
+        result = None
+
+        for clause in required:
+            scores = self._score_clause(reader, clause)
+
+            if result is None:
+                result = scores
+            else:
+                result = dict((docnum, score + scores[docnum])
+                              for docnum, score in result.iteritems()
+                              if docnum in scores)
+
+            if not result:
+                return {}
+
+        for clause in optional:
+            scores = self._score_clause(reader, clause)
+
+            if result is None:
+                result = scores
+            elif required:
+                for docnum, score in scores.iteritems():
+                    if docnum in result:
+                        result[docnum] += score
+            else:
+                for docnum, score in scores.iteritems():
+                    result[docnum] = result.get(docnum, 0) + score
+
+        if result:
+            for clause in excluded:
+                for docnum in self._score_clause(reader, clause):
+                    result.pop(docnum, None)
+
+        return result or {}
+
+    def _score_clause(self, reader, clause):
+        """Scores the documents in a segment matching a clause.
+
+        Every term in the clause must be found in the document, though they
+        can be in different fields if the clause doesn't name a field.
+        """
+        if clause.field:
+            fields = [clause.field]
+        else:
+            fields = [name for name, field in self.schema.iteritems()
+                      if field.default]
+
+        result = None
+
+        for i, term in enumerate(clause.terms):
+            if clause.prefix and i == len(clause.terms) - 1:
+                term_scores = self._score_prefix(reader, fields, term)
+            else:
+                term_scores = {}
+
+                for field in fields:
+                    self._add_term_scores(reader, field, term, term_scores)
+
+            if result is None:
+                result = term_scores
+            else:
+                result = dict((docnum, score + term_scores[docnum])
+                              for docnum, score in result.iteritems()
+                              if docnum in term_scores)
+
+            if not result:
+                return {}
+
+        return result
+
+    def _score_prefix(self, reader, fields, prefix):
+        scores = {}
+
+        for field in fields:
+            for term in reader.expand_prefix(
+                    field, prefix)[:self.MAX_PREFIX_TERMS]:
+                self._add_term_scores(reader, field, term, scores)
+
+        return scores
+
+    def _add_term_scores(self, reader, field, term, scores):
+        postings = reader.postings(field, term)
+
+        if not postings:
+            return
+
+        doc_freq = sum(segment_reader.doc_freq(field, term)
+                       for segment_reader, deleted in self.segments)
+        idf = math.log(1.0 + (self.num_docs - doc_freq + 0.5) /
+                       (doc_freq + 0.5))
+        weight = self.schema[field].boost * idf
+        avg_length = self._avg_lengths.get(field) or 1.0
+        lengths = reader.field_lengths[field]
+        k1 = self.K1
+        b = self.B
+
+        for docnum, freq in postings:
+            norm = k1 * (1.0 - b + b * lengths[docnum] / avg_length)
+            score = weight * freq * (k1 + 1.0) / (freq + norm)
+            scores[docnum] = scores.get(docnum, 0) + score
+
+
+class IndexWriter(object):
+    """Adds and removes documents from the index.
+
+    Changes are written out when :py:meth:`commit` is called. Only one
+    writer can be open on an index at a time.
+
+    Added documents are held in memory until there are ``FLUSH_DOCS`` of
+    them, at which point they're written to a new segment. The segments
+    only become part of the index on commit.
+    """
+    #: The number of added documents to hold in memory before writing them.
+    FLUSH_DOCS = 5000
+
+    def __init__(self, index, clear=False):
+        self.index = index
+        self._added = {}
+        self._deleted = set()
+        self._new_segments = []
+        self._lock_file = None
+
+        self._lock()
+
+        try:
+            if clear:
+                self._manifest = index._new_manifest()
+            else:
+                self._manifest = index._read_manifest()
+        except:
+            self._unlock()
+            raise
+
+        self._manifest['generation'] += 1
+        self.generation = self._manifest['generation']
+
+        #: Information stored along with the index, such as how far
+        #: indexing has gotten. This must be serializable to JSON.
+        self.state = self._manifest.setdefault('state', {})
+
+    def add_document(self, doc_id, values):
+        """Adds a document, replacing any existing one with the same ID.
+
+        ``values`` maps field names to the values to index.
+        """
+        self.add_analyzed_document(
+            doc_id, SearchIndex.analyze(self.index.schema, values))
+
+    def add_analyzed_document(self, doc_id, fields):
+        """Adds a document that has already been analyzed.
+
+        ``fields`` maps field names to lists of terms, as returned by
+        :py:meth:`SearchIndex.analyze`.
+        """
+        self._added[doc_id] = fields
+        self._deleted.add(doc_id)
+
+        if len(self._added) >= self.FLUSH_DOCS:
+            self._flush()
+
+    def delete_document(self, doc_id):
+        """Removes a document from the index."""
+        self._added.pop(doc_id, None)
+        self._deleted.add(doc_id)
+
+    def commit(self, optimize=False):
+        """Writes the changes and releases the lock.
+
+        If ``optimize`` is True, all segments are merged into one.
+        """
+        try:
+            index = self.index
+            manifest = self._manifest
+            generation = self.generation
+            segments = manifest['segments']
+            deletions = manifest['deletions']
+
+            if segments:
+                for doc_id in self._deleted:
+                    deletions[str(doc_id)] = generation
+
+            self._flush()
+            segments.extend(self._new_segments)
+
+            if optimize:
+                to_merge = segments
+            else:
+                to_merge = self._get_segments_to_merge(segments)
+
+            if len(to_merge) > 1:
+                merged = index._merge_segments(manifest, to_merge,
+                                               self._make_segment_name())
+
+                segments = [
+                    segment
+                    for segment in segments
+                    if segment not in to_merge
+                ] + [merged]
+                manifest['segments'] = segments
+
+            # Deletions only need to be kept as long as there's a segment
+            # older than them.
+            if segments:
+                oldest = min(segment['generation'] for segment in segments)
+                manifest['deletions'] = dict(
+                    (doc_id, deleted_generation)
+                    for doc_id, deleted_generation in deletions.iteritems()
+                    if deleted_generation > oldest)
+            else:
+                manifest['deletions'] = {}
+
+            index._write_manifest(
+                manifest,
+                [segment['name'] for segment in self._new_segments])
+        finally:
+            self._unlock()
+
+    def cancel(self):
+        """Discards the changes and releases the lock."""
+        try:
+            for segment in self._new_segments:
+                try:
+                    os.unlink(self.index._get_path(segment['name']))
+                except OSError:
+                    pass
+        finally:
+            self._unlock()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        if exc_type is None:
+            self.commit()
+        else:
+            self.cancel()
+
+    def _flush(self):
+        if self._added:
+            self._new_segments.append(self.index._write_new_segment(
+                self.generation, self._added, self._make_segment_name()))
+            self._added = {}
+
+    def _make_segment_name(self):
+        return 'seg_%s%s' % (uuid.uuid4().hex, SEGMENT_EXT)
+
+    def _get_segments_to_merge(self, segments):
+        """Returns the segments that should be merged.
+
+        Once there are more than ``MERGE_FACTOR`` segments, every segment
+        smaller than ``1/MERGE_FACTOR`` the size of the largest is merged.
+        """
+        merge_factor = self.index.MERGE_FACTOR
+
+        if len(segments) <= merge_factor:
+            return []
+
+        largest = max(segment['num_docs'] for segment in segments)
+
+        return [
+            segment
+            for segment in segments
+            if segment['num_docs'] * merge_factor < largest
+        ] or segments
+
+    def _lock(self):
+        if fcntl:
+            self._lock_file = open(
+                self.index._get_path(self.index.manifest_name + '.lock'), 'w')
+            fcntl.flock(self._lock_file, fcntl.LOCK_EX)
+
+    def _unlock(self):
+        if self._lock_file:
+            fcntl.flock(self._lock_file, fcntl.LOCK_UN)
+            self._lock_file.close()
+            self._lock_file = None
+
+
+class SearchIndex(object):
+    """A search index stored in a directory.
+
+    ``schema`` maps field names to :py:class:`Field` objects.
+
+    Several indexes can share a directory, as long as they have different
+    ``manifest_name`` values. This is used to build a new index alongside
+    the current one, and then swap it in with :py:meth:`replace_with`.
+    """
+    #: The number of segments allowed before they're merged.
+    MERGE_FACTOR = 10
+
+    _readers = {}
+    _readers_lock = threading.Lock()
+
+    def __init__(self, path, schema, manifest_name=MANIFEST_NAME):
+        assert manifest_name.endswith(MANIFEST_EXT)
+
+        self.path = path
+        self.schema = schema
+        self.manifest_name = manifest_name
+
+    @staticmethod
+    def analyze(schema, values):
+        """Analyzes a document's values into lists of terms for each field."""
+        fields = {}
+
+        for name, value in values.iteritems():
+            if value:
+                fields[name] = schema[name].analyzer(value)
+
+        return fields
+
+    def exists(self):
+        """Returns whether the index has been created."""
+        return os.path.exists(self._get_path(self.manifest_name))
+
+    def writer(self, clear=False):
+        """Returns an IndexWriter for the index.
+
+        If ``clear`` is True, the index will only contain the documents
+        added through the writer once it's committed.
+        """
+        if not os.path.exists(self.path):
+            os.makedirs(self.path)
+
+        return IndexWriter(self, clear=clear)
+
+    def reader(self):
+        """Returns an IndexReader for the latest version of the index.
+
+        Readers are cached and shared until the index changes.
+        """
+        try:
+            st = os.stat(self._get_path(self.manifest_name))
+            key = (self.path, st.st_mtime, st.st_size, st.st_ino)
+        except OSError:
+            key = (self.path, None, None, None)
+
+        self._readers_lock.acquire()
+
+        try:
+            reader = self._readers.get(key)
+
+            if reader is None:
+                reader = self._open_reader(self._read_manifest())
+
+                for old_key in self._readers.keys():
+                    if old_key[0] == self.path:
+                        del self._readers[old_key]
+
+                self._readers[key] = reader
+        finally:
+            self._readers_lock.release()
+
+        return reader
+
+    def search(self, query, limit=None):
+        """Searches the index.
+
+        See :py:meth:`IndexReader.search` for details.
+        """
+        return self.reader().search(query, limit)
+
+    def get_state(self):
+        """Returns the state stored by the last IndexWriter.
+
+        See :py:attr:`IndexWriter.state`.
+        """
+        return self._read_manifest().get('state', {})
+
+    def replace_with(self, other):
+        """Replaces the contents of this index with another index.
+
+        The other index must be in the same directory. It will no longer
+        exist afterward.
+        """
+        assert other.path == self.path
+        assert other.manifest_name != self.manifest_name
+
+        old_names = self._get_segment_names()
+        os.rename(other._get_path(other.manifest_name),
+                  self._get_path(self.manifest_name))
+        self._remove_unused_segments(old_names)
+
+    def delete(self):
+        """Deletes the index."""
+        old_names = self._get_segment_names()
+
+        try:
+            os.unlink(self._get_path(self.manifest_name))
+        except OSError:
+            pass
+
+        self._remove_unused_segments(old_names)
+
+    def _open_reader(self, manifest):
+        deletions = [
+            (int(doc_id), deleted_generation)
+            for doc_id, deleted_generation in
+            manifest['deletions'].iteritems()
+        ]
+
+        return IndexReader(self.schema, [
+            (SegmentReader(self._get_path(segment['name'])),
+             frozenset(doc_id
+                       for doc_id, deleted_generation in deletions
+                       if deleted_generation > segment['generation']))
+            for segment in manifest['segments']
+        ])
+
+    def _get_path(self, name):
+        return os.path.join(self.path, name)
+
+    def _new_manifest(self):
+        if self.exists():
+            generation = self._read_manifest()['generation']
+        else:
+            generation = 0
+
+        return {
+            'version': FORMAT_VERSION,
+            'generation': generation,
+            'segments': [],
+            'deletions': {},
+        }
+
+    def _read_manifest(self):
+        try:
+            f = open(self._get_path(self.manifest_name), 'r')
+        except IOError:
+            return {
+                'version': FORMAT_VERSION,
+                'generation': 0,
+                'segments': [],
+                'deletions': {},
+            }
+
+        try:
+            manifest = simplejson.load(f)
+        finally:
+            f.close()
+
+        if manifest.get('version') != FORMAT_VERSION:
+            raise SearchIndexError('The search index at %s has an '
+                                   'unsupported version. It must be '
+                                   'rebuilt.' % self.path)
+
+        return manifest
+
+    def _write_manifest(self, manifest, new_names=[]):
+        """Writes a new manifest for the index.
+
+        Segments used by the old manifest, or listed in ``new_names``, are
+        removed if nothing uses them any more.
+        """
+        old_names = self._get_segment_names()
+        old_names.update(new_names)
+
+        fd, tmp_path = tempfile.mkstemp(dir=self.path, prefix='manifest')
+        f = os.fdopen(fd, 'w')
+
+        try:
+            simplejson.dump(manifest, f)
+        finally:
+            f.close()
+
+        os.rename(tmp_path, self._get_path(self.manifest_name))
+        self._remove_unused_segments(old_names)
+
+    def _get_segment_names(self):
+        return set(segment['name']
+                   for segment in self._read_manifest()['segments'])
+
+    def _remove_unused_segments(self, names):
+        """Removes any of the given segments that no index is using.
+
+        Only segments known to have belonged to this index are passed in,
+        since another writer in the same directory may have written segments
+        that it hasn't committed yet. Readers that already have the segments
+        open can still use them.
+        """
+        live_names = set()
+
+        for name in os.listdir(self.path):
+            if name.endswith(MANIFEST_EXT):
+                index = SearchIndex(self.path, self.schema, name)
+                live_names.update(index._get_segment_names())
+
+        for name in names:
+            if name not in live_names:
+                try:
+                    os.unlink(self._get_path(name))
+                except OSError:
+                    pass
+
+    def _get_deleted(self, manifest, segment):
+        generation = segment['generation']
+
+        return set(int(doc_id)
+                   for doc_id, deleted_generation in
+                   manifest['deletions'].iteritems()
+                   if deleted_generation > generation)
+
+    def _write_new_segment(self, generation, docs, name):
+        """Writes a segment containing a new set of documents."""
+        doc_ids = sorted(docs.iterkeys())
+        fields = sorted(self.schema.iterkeys())
+        field_lengths = dict((field, []) for field in fields)
+        postings = {}
+
+        for docnum, doc_id in enumerate(doc_ids):
+            doc = docs[doc_id]
+
+            for field in fields:
+                terms = doc.get(field, [])
+                field_lengths[field].append(len(terms))
+                freqs = {}
+
+                for term in terms:
+                    freqs[term] = freqs.get(term, 0) + 1
+
+                for term, freq in freqs.iteritems():
+                    postings.setdefault((field, term), []).append(
+                        (docnum, freq))
+
+        write_segment(self._get_path(name), fields, doc_ids, field_lengths,
+                      ((field, term, postings[(field, term)])
+                       for field, term in sorted(postings.iterkeys())))
+
+        return {
+            'name': name,
+            'num_docs': len(doc_ids),
+            'generation': generation,
+        }
+
+    def _merge_segments(self, manifest, segments, name):
+        """Merges several segments into one, dropping deleted documents."""
+        readers = [SegmentReader(self._get_path(segment['name']))
+                   for segment in segments]
+
+        try:
+            fields = sorted(set(self.schema.iterkeys()).union(
+                *[reader.fields for reader in readers]))
+            doc_ids = []
+            field_lengths = dict((field, []) for field in fields)
+            docnum_maps = []
+
+            for reader, segment in zip(readers, segments):
+                deleted = self._get_deleted(manifest, segment)
+                docnum_map = []
+
+                for docnum, doc_id in enumerate(reader.doc_ids):
+                    if doc_id in deleted:
+                        docnum_map.append(None)
+                    else:
+                        docnum_map.append(len(doc_ids))
+                        doc_ids.append(doc_id)
+
+                        for field in fields:
+                            lengths = reader.field_lengths.get(field)
+
+                            if lengths:
+                                length = lengths[docnum]
+                            else:
+                                length = 0
+
+                            field_lengths[field].append(length)
+
+                docnum_maps.append(docnum_map)
+
+            write_segment(self._get_path(name), fields, doc_ids,
+                          field_lengths,
+                          self._iter_merged_postings(fields, readers,
+                                                     docnum_maps))
+        finally:
+            for reader in readers:
+                reader.close()
+
+        return {
+            'name': name,
+            'num_docs': len(doc_ids),
+            'generation': manifest['generation'],
+        }
+
+    def _iter_merged_postings(self, fields, readers, docnum_maps):
+        for field in fields:
+            terms = set()
+
+            for reader in readers:
+                terms.update(reader.terms.get(field, []))
+
+            for term in sorted(terms):
+                merged = []
+
+                # Each segment's documents were given a contiguous range
+                # of new document numbers, so the merged postings stay
+                # sorted.
+                for reader, docnum_map in zip(readers, docnum_maps):
+                    for docnum, freq in reader.postings(field, term):
+                        new_docnum = docnum_map[docnum]
+
+                        if new_docnum is not None:
+                            merged.append((new_docnum, freq))
+
+                if merged:
+                    yield field, term, merged
@@ -0,0 +1,19 @@
+from django.db.models import signals
+
+from reviewboard.search import models as search_models
+
+
+def init_typeahead(app, created_models, verbosity, **kwargs):
+    """
+    Builds the autocomplete index when its table is first created.
+
+    This fills the index for sites upgrading from a version without it, so
+    that autocomplete keeps working without having to run indextypeahead.
+    """
+    from reviewboard.search import typeahead
+
+    if search_models.TypeaheadEntry in created_models:
+        typeahead.rebuild()
+
+
+signals.post_syncdb.connect(init_typeahead, sender=search_models)
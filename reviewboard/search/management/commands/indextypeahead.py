@@ -0,0 +1,69 @@
+import optparse
+import time
+
+from django.core.management.base import NoArgsCommand
+
+from reviewboard.reviews.models import ReviewRequest
+from reviewboard.search import typeahead
+
+
+# Prefixes looked up by --benchmark. These match the text generated by the
+# fill-database command.
+BENCHMARK_PREFIXES = [
+    u'a',
+    u'lo',
+    u'lorem ip',
+    u'vestib',
+    u'1',
+    u'123',
+    u'nonexistent',
+]
+
+
+class Command(NoArgsCommand):
+    option_list = NoArgsCommand.option_list + (
+        optparse.make_option('--benchmark', action='store_true',
+                             dest='benchmark', default=False,
+                             help='Report the time taken to look up some '
+                                  'sample prefixes, instead of rebuilding '
+                                  'the index'),
+        optparse.make_option('--iterations', type='int', dest='iterations',
+                             default=20,
+                             help='The number of times to look up each '
+                                  'prefix when benchmarking'),
+        )
+    help = ("Rebuilds the index used to autocomplete users, groups and "
+            "review requests in the search field.")
+
+    def handle_noargs(self, **options):
+        if options['benchmark']:
+            self.benchmark(options['iterations'])
+            return
+
+        start_time = time.time()
+        num_objects = typeahead.rebuild()
+
+        self.stdout.write('Indexed %d objects in %.2fs.\n'
+                          % (num_objects, time.time() - start_time))
+
+    def benchmark(self, iterations):
+        """Prints the time taken to look up each benchmark prefix."""
+        self.stdout.write('Looking up prefixes with %d review requests.\n'
+                          % ReviewRequest.objects.count())
+
+        for prefix in BENCHMARK_PREFIXES:
+            timings = []
+
+            for i in xrange(iterations):
+                start_time = time.time()
+                results = typeahead.search(prefix)
+                timings.append((time.time() - start_time) * 1000)
+
+            timings.sort()
+
+            self.stdout.write(
+                '%-12s %3d results  p50 %.1fms  p95 %.1fms\n'
+                % (prefix, sum(len(objs) for objs in results),
+                   timings[len(timings) / 2],
+                   timings[min(int(len(timings) * 0.95),
+                               len(timings) - 1)]))
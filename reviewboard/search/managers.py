@@ -0,0 +1,133 @@
+import re
+
+from django.db import models
+
+
+class TypeaheadEntryManager(models.Manager):
+    """A manager for TypeaheadEntry.
+
+    This maintains an index of the prefixes that the search autocomplete
+    widget looks up: usernames and full names, group names and display
+    names, and review request IDs and summaries.
+
+    Every value is stored lowercased, starting at each of its words, and
+    cut off after ``MAX_WORD_LENGTH`` characters. Each word is stored in a
+    key along with the kind of object and its local site, so that a lookup
+    is a range scan over one index, rather than a case-insensitive
+    comparison against every row of every table. Prefixes longer than
+    ``MAX_WORD_LENGTH`` only have their beginning compared.
+    """
+    USER = 'U'
+    GROUP = 'G'
+    REVIEW_REQUEST = 'R'
+
+    MAX_WORD_LENGTH = 32
+
+    #: The number of objects to read at a time when rebuilding.
+    BATCH_SIZE = 1000
+
+    _word_start_re = re.compile(r'(?<!\w)\w', re.UNICODE)
+
+    def get_keys(self, kind, obj):
+        """Returns the set of keys to index for an object."""
+        if kind == self.USER:
+            values = [obj.username, obj.first_name, obj.last_name,
+                      obj.get_full_name()]
+
+            # Users are shared between all local sites.
+            local_site_id = None
+        elif kind == self.GROUP:
+            values = [obj.name, obj.display_name]
+            local_site_id = obj.local_site_id
+        elif kind == self.REVIEW_REQUEST:
+            values = [unicode(obj.display_id), obj.summary]
+            local_site_id = obj.local_site_id
+        else:
+            raise ValueError('Unknown typeahead entry kind %r' % kind)
+
+        keys = set()
+
+        for value in values:
+            value = value.strip().lower()
+
+            for m in self._word_start_re.finditer(value):
+                keys.add(self._make_key(kind, local_site_id,
+                                        value[m.start():]))
+
+        return keys
+
+    def update_object(self, kind, obj):
+        """Updates the entries for an object.
+
+        Nothing is written if the object's entries haven't changed.
+        """
+        keys = self.get_keys(kind, obj)
+        existing = set(self.filter(kind=kind, object_id=obj.pk).values_list(
+            'key', flat=True))
+
+        if keys != existing:
+            self.remove_object(kind, obj)
+            self.bulk_create([
+                self.model(kind=kind, object_id=obj.pk, key=key)
+                for key in keys
+            ])
+
+    def remove_object(self, kind, obj):
+        """Removes the entries for an object."""
+        self.filter(kind=kind, object_id=obj.pk).delete()
+
+    def rebuild(self, kind, queryset):
+        """Replaces all entries of a kind with those for a queryset.
+
+        The objects are read in batches, ordered by ID. This returns the
+        number of objects indexed.
+        """
+        self.filter(kind=kind).delete()
+
+        last_id = 0
+        num_objects = 0
+
+        while True:
+            objs = list(queryset.filter(pk__gt=last_id)
+                                .order_by('pk')[:self.BATCH_SIZE])
+
+            if not objs:
+                break
+
+            self.bulk_create([
+                self.model(kind=kind, object_id=obj.pk, key=key)
+                for obj in objs
+                for key in self.get_keys(kind, obj)
+            ])
+
+            last_id = objs[-1].pk
+            num_objects += len(objs)
+
+        return num_objects
+
+    def get_object_ids(self, kind, prefix, local_site=None):
+        """Returns the IDs of objects with a word starting with a prefix.
+
+        The IDs are ordered by the matching word. An ID may appear more
+        than once, if several of the object's words match. For users,
+        ``local_site`` is ignored, since users are shared between all local
+        sites.
+        """
+        if kind == self.USER or not local_site:
+            local_site_id = None
+        else:
+            local_site_id = local_site.pk
+
+        prefix = self._make_key(kind, local_site_id, prefix.strip().lower())
+
+        # Not every database can use an index for LIKE, so the prefix is
+        # also looked up as a range, which always can.
+        return self.filter(
+            key__gte=prefix,
+            key__lt=prefix + u'\uffff',
+            key__startswith=prefix).order_by('key').values_list(
+                'object_id', flat=True)
+
+    def _make_key(self, kind, local_site_id, word):
+        return u'%s%s:%s' % (kind, local_site_id or '',
+                             word[:self.MAX_WORD_LENGTH])
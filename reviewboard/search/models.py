@@ -0,0 +1,30 @@
+from django.db import models
+from django.utils.translation import ugettext_lazy as _
+
+from reviewboard.search.managers import TypeaheadEntryManager
+
+
+class TypeaheadEntry(models.Model):
+    """
+    An entry in the index used for autocompleting searches.
+
+    ``key`` holds the kind of object, its local site and the indexed word.
+    See TypeaheadEntryManager for what's indexed.
+    """
+    KINDS = (
+        (TypeaheadEntryManager.USER, _('User')),
+        (TypeaheadEntryManager.GROUP, _('Group')),
+        (TypeaheadEntryManager.REVIEW_REQUEST, _('Review request')),
+    )
+
+    kind = models.CharField(_('kind'), max_length=1, choices=KINDS)
+    object_id = models.PositiveIntegerField(_('object ID'), db_index=True)
+    key = models.CharField(_('key'), max_length=48, db_index=True)
+
+    objects = TypeaheadEntryManager()
+
+    def __unicode__(self):
+        return u'%s (%s %s)' % (self.key, self.kind, self.object_id)
+
+    class Meta:
+        verbose_name_plural = _('typeahead entries')
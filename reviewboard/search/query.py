@@ -0,0 +1,181 @@
+"""Text analysis and query parsing for the search index.
+
+Analyzers turn a field's value into the list of terms stored in the index.
+Queries are parsed into a list of :py:class:`Clause` objects, using a small
+subset of the Lucene query syntax:
+
+* Bare words match any of the default fields. Results are an OR of all
+  the words, unless ``AND`` is used.
+* ``field:word`` matches a word in a specific field.
+* ``word*`` matches any term starting with ``word``.
+* ``"some words"`` requires all of the words to match.
+* ``+word`` or ``AND`` requires a word, and ``-word`` or ``NOT`` excludes it.
+"""
+import re
+
+
+SHOULD = 0
+MUST = 1
+MUST_NOT = 2
+
+STOP_WORDS = frozenset([
+    'a', 'an', 'and', 'are', 'as', 'at', 'be', 'but', 'by', 'for', 'if',
+    'in', 'into', 'is', 'it', 'no', 'not', 'of', 'on', 'or', 'such', 'that',
+    'the', 'their', 'then', 'there', 'these', 'they', 'this', 'to', 'was',
+    'will', 'with',
+])
+
+_word_re = re.compile(r'\w+', re.UNICODE)
+_query_token_re = re.compile(
+    r'(?P<prefix>[+-])?'
+    r'(?:(?P<field>\w+):\s*)?'
+    r'(?:"(?P<phrase>[^"]*)"?|(?P<word>[^\s"]+))',
+    re.UNICODE)
+
+
+def analyze_text(value):
+    """Splits free-form text into lowercase words, minus stop words."""
+    return [word for word in _word_re.findall(value.lower())
+            if word not in STOP_WORDS]
+
+
+def analyze_keyword(value):
+    """Treats an entire value as a single term."""
+    value = value.strip().lower()
+
+    if value:
+        return [value]
+    else:
+        return []
+
+
+def analyze_keyword_list(value):
+    """Splits a comma- or space-separated list of keywords."""
+    return [keyword for keyword in re.split(r'[\s,]+', value.lower())
+            if keyword]
+
+
+def analyze_path(value):
+    """Splits a newline-separated list of file paths.
+
+    Each path is indexed in full (without any leading slash), so that
+    prefix queries like ``file:src/ui/*`` work, along with each of its
+    components, so that ``file:main.cc`` finds ``src/ui/main.cc``.
+    """
+    terms = []
+
+    for path in value.lower().splitlines():
+        path = path.strip().strip('/')
+
+        if path:
+            terms.append(path)
+            terms.extend(component for component in path.split('/')[:-1]
+                         if component)
+
+            basename = path.rsplit('/', 1)[-1]
+
+            if basename != path:
+                terms.append(basename)
+
+    return terms
+
+
+def analyze_query_path(value):
+    """Analyzes a path in a query, which is matched as a single term."""
+    return analyze_keyword(value.strip('/'))
+
+
+class Clause(object):
+    """A single clause in a parsed query.
+
+    ``terms`` is a list of analyzed terms, all of which must be present in a
+    document for the clause to match it. If ``field`` is None, the terms
+    may be found in any of the default fields. If ``prefix`` is True, the
+    last term matches any term starting with it.
+    """
+    def __init__(self, occur, field, terms, prefix=False):
+        self.occur = occur
+        self.field = field
+        self.terms = terms
+        self.prefix = prefix
+
+    def __repr__(self):
+        return '<Clause(%r, %r, %r, prefix=%r)>' % (
+            self.occur, self.field, self.terms, self.prefix)
+
+
+def parse_query(query, analyzers, query_analyzers={},
+                default_analyzer=analyze_text):
+    """Parses a query string into a list of Clauses.
+
+    ``analyzers`` maps field names to the analyzers used when indexing
+    them. Field names that aren't in ``analyzers`` are treated as part of
+    the word. ``query_analyzers`` can override the analyzer used for a
+    field's query terms.
+    """
+    clauses = []
+    next_occur = None
+
+    for m in _query_token_re.finditer(query):
+        prefix = m.group('prefix')
+        field = m.group('field')
+        phrase = m.group('phrase')
+        word = m.group('word')
+
+        if word in ('AND', 'OR', 'NOT') and not prefix and not field:
+            if word == 'AND':
+                next_occur = MUST
+
+                # "a AND b" requires both terms.
+                if clauses and clauses[-1].occur == SHOULD:
+                    clauses[-1].occur = MUST
+            elif word == 'NOT':
+                next_occur = MUST_NOT
+            else:
+                next_occur = SHOULD
+
+            continue
+
+        if field:
+            field = field.lower()
+
+            if field not in analyzers:
+                # This isn't a field we know about, so treat it as text.
+                if word is not None:
+                    word = '%s:%s' % (field, word)
+
+                field = None
+
+        if prefix == '+':
+            occur = MUST
+        elif prefix == '-':
+            occur = MUST_NOT
+        elif next_occur is not None:
+            occur = next_occur
+        else:
+            occur = SHOULD
+
+        next_occur = None
+
+        if field:
+            analyzer = query_analyzers.get(field, analyzers[field])
+        else:
+            analyzer = default_analyzer
+
+        is_prefix = False
+
+        if phrase is not None:
+            text = phrase
+        else:
+            text = word
+
+            if len(word) > 1 and word.endswith('*'):
+                text = word[:-1]
+                is_prefix = True
+
+        terms = analyzer(text)
+
+        if terms:
+            clauses.append(Clause(occur, field, terms, prefix=is_prefix))
+
+    return clauses
@@ -0,0 +1,398 @@
+import os
+import shutil
+import tempfile
+from StringIO import StringIO
+
+from django.contrib.auth.models import User
+from django.core.management import call_command
+from django.test import TestCase
+from django.utils import simplejson
+from djblets.siteconfig.models import SiteConfiguration
+
+from reviewboard import initialize
+from reviewboard.reviews.management.commands.index import \
+    REBUILD_MANIFEST_NAME
+from reviewboard.reviews.models import Group, Review, ReviewRequest
+from reviewboard.search import typeahead
+from reviewboard.search.documents import SCHEMA, get_search_index
+from reviewboard.search.index import IndexWriter, SearchIndex, \
+                                     decode_postings, encode_postings
+from reviewboard.search.models import TypeaheadEntry
+from reviewboard.search.query import MUST, MUST_NOT, SHOULD, \
+                                     analyze_path, parse_query
+from reviewboard.site.models import LocalSite
+
+
+class SearchIndexTestCase(TestCase):
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp(prefix='rb-tests-search-')
+        self.index = SearchIndex(os.path.join(self.tempdir, 'index'), SCHEMA)
+
+    def tearDown(self):
+        shutil.rmtree(self.tempdir)
+
+    def _add(self, docs, **kwargs):
+        writer = self.index.writer(**kwargs)
+
+        for doc_id, values in docs:
+            writer.add_document(doc_id, values)
+
+        writer.commit()
+
+    def _search(self, query):
+        return [doc_id for doc_id, score in self.index.search(query)]
+
+
+class SearchIndexTests(SearchIndexTestCase):
+    """Unit tests for the search index."""
+    def test_postings_encoding(self):
+        """Testing encoding and decoding postings"""
+        postings = [(0, 1), (5, 300), (127, 2), (128, 1), (100000, 7)]
+        self.assertEqual(
+            decode_postings(bytearray(encode_postings(postings)),
+                            len(postings)),
+            postings)
+
+    def test_search(self):
+        """Testing searching the index"""
+        self._add([
+            (1, {'summary': u'Fix the crash in the diff viewer',
+                 'description': u'The viewer crashed on empty files.'}),
+            (2, {'summary': u'Add a new dashboard column',
+                 'description': u'This is unrelated to the diff viewer.'}),
+            (3, {'summary': u'Update translations'}),
+        ])
+
+        self.assertEqual(self._search(u'viewer'), [1, 2])
+        self.assertEqual(sorted(self._search(u'crash dashboard')), [1, 2])
+        self.assertEqual(self._search(u'viewer AND dashboard'), [2])
+        self.assertEqual(self._search(u'viewer NOT dashboard'), [1])
+        self.assertEqual(self._search(u'summary:viewer'), [1])
+        self.assertEqual(self._search(u'"diff viewer" -crash'), [2])
+        self.assertEqual(self._search(u'transl*'), [3])
+        self.assertEqual(self._search(u'nonexistent'), [])
+
+    def test_search_ranking(self):
+        """Testing search result ranking with field boosts"""
+        self._add([
+            (1, {'description': u'Mentions the scrollbar once.'}),
+            (2, {'summary': u'Fix the scrollbar'}),
+        ])
+
+        self.assertEqual(self._search(u'scrollbar'), [2, 1])
+
+    def test_search_file_paths(self):
+        """Testing searching file paths"""
+        self._add([
+            (1, {'file': u'/trunk/player/linux/main.cc\n/trunk/README'}),
+            (2, {'file': u'/trunk/vmuiLinux/main.cc'}),
+            (3, {'file': u'/trunk/player/windows/util.cc'}),
+        ])
+
+        self.assertEqual(sorted(self._search(u'file:main.cc')), [1, 2])
+        self.assertEqual(sorted(self._search(u'file:trunk/player/*')),
+                         [1, 3])
+        self.assertEqual(self._search(u'file:/trunk/vmuiLinux/main.cc'), [2])
+
+    def test_update_documents(self):
+        """Testing replacing and deleting documents in the index"""
+        self._add([
+            (1, {'summary': u'Old summary'}),
+            (2, {'summary': u'Another summary'}),
+        ])
+
+        writer = self.index.writer()
+        writer.add_document(1, {'summary': u'New summary'})
+        writer.delete_document(2)
+        writer.commit()
+
+        self.assertEqual(self._search(u'old'), [])
+        self.assertEqual(self._search(u'new'), [1])
+        self.assertEqual(self._search(u'summary'), [1])
+
+    def test_clear(self):
+        """Testing rebuilding the index from scratch"""
+        self._add([(1, {'summary': u'First'})])
+        self._add([(2, {'summary': u'Second'})], clear=True)
+
+        self.assertEqual(self._search(u'first'), [])
+        self.assertEqual(self._search(u'second'), [2])
+
+    def test_merge_segments(self):
+        """Testing merging segments"""
+        self.index.MERGE_FACTOR = 2
+        old_flush_docs = IndexWriter.FLUSH_DOCS
+        IndexWriter.FLUSH_DOCS = 2
+
+        try:
+            self._add([
+                (i, {'summary': u'document %d' % i})
+                for i in range(10)
+            ])
+
+            for i in range(3):
+                writer = self.index.writer()
+                writer.add_document(i, {'summary': u'replaced %d' % i})
+                writer.commit()
+        finally:
+            IndexWriter.FLUSH_DOCS = old_flush_docs
+
+        self.assertTrue(len(self.index._read_manifest()['segments']) <= 3)
+        self.assertEqual(sorted(self._search(u'document')), range(3, 10))
+        self.assertEqual(sorted(self._search(u'replaced')), range(3))
+
+        writer = self.index.writer()
+        writer.commit(optimize=True)
+
+        manifest = self.index._read_manifest()
+        self.assertEqual(len(manifest['segments']), 1)
+        self.assertEqual(manifest['deletions'], {})
+        self.assertEqual(sorted(self._search(u'document')), range(3, 10))
+        self.assertEqual(sorted(self._search(u'replaced')), range(3))
+
+
+class QueryTests(TestCase):
+    """Unit tests for query parsing and analysis."""
+    def test_parse_query(self):
+        """Testing parse_query"""
+        analyzers = dict((name, field.analyzer)
+                         for name, field in SCHEMA.iteritems())
+        clauses = parse_query(u'foo +bar -baz summary:qux* unknown:x',
+                              analyzers)
+
+        self.assertEqual(
+            [(c.occur, c.field, c.terms, c.prefix) for c in clauses],
+            [(SHOULD, None, [u'foo'], False),
+             (MUST, None, [u'bar'], False),
+             (MUST_NOT, None, [u'baz'], False),
+             (SHOULD, u'summary', [u'qux'], True),
+             (SHOULD, None, [u'unknown', u'x'], False)])
+
+    def test_analyze_path(self):
+        """Testing analyze_path"""
+        self.assertEqual(analyze_path(u'/src/ui/Main.cc'),
+                         [u'src/ui/main.cc', u'src', u'ui', u'main.cc'])
+
+
+class ReviewRequestIndexingTests(SearchIndexTestCase):
+    """Unit tests for indexing review requests."""
+    fixtures = ['test_users', 'test_reviewrequests', 'test_scmtools']
+
+    def setUp(self):
+        super(ReviewRequestIndexingTests, self).setUp()
+
+        initialize()
+
+        self.siteconfig = SiteConfiguration.objects.get_current()
+        self.siteconfig.set('search_enable', True)
+        self.siteconfig.set('search_index_file', self.index.path)
+        self.siteconfig.set('mail_send_review_mail', False)
+        self.siteconfig.save()
+
+    def tearDown(self):
+        self.siteconfig.set('search_enable', False)
+        self.siteconfig.save()
+
+        super(ReviewRequestIndexingTests, self).tearDown()
+
+    def test_index_on_publish(self):
+        """Testing updating the search index when publishing"""
+        user = User.objects.get(username='doc')
+        review_request = ReviewRequest.objects.create(user, None)
+        review_request.summary = u'Frobnicate the widgets'
+        review_request.publish(user)
+
+        index = get_search_index()
+        self.assertEqual(
+            [doc_id for doc_id, score in index.search(u'frobnicate')],
+            [review_request.pk])
+
+        review_request.close(ReviewRequest.DISCARDED, user)
+        self.assertEqual(index.search(u'frobnicate'), [])
+
+    def test_index_reviews(self):
+        """Testing updating the search index when publishing reviews"""
+        user = User.objects.get(username='doc')
+        review_request = ReviewRequest.objects.create(user, None)
+        review_request.summary = u'Frobnicate the widgets'
+        review_request.publish(user)
+
+        review = Review.objects.create(review_request=review_request,
+                                       user=user,
+                                       body_top=u'Needs more xyzzy.')
+        review.publish()
+
+        self.assertEqual(
+            [doc_id for doc_id, score in
+             get_search_index().search(u'review:xyzzy')],
+            [review_request.pk])
+
+    def test_index_command(self):
+        """Testing the index management command"""
+        call_command('index', incremental=False, processes=1, batch_size=2)
+
+        self.assertEqual(sorted(self.index.reader().doc_ids()),
+                         [2, 3, 4, 6, 7, 8, 9])
+        self.assertFalse(os.path.exists(
+            os.path.join(self.index.path, REBUILD_MANIFEST_NAME)))
+
+        review_request = ReviewRequest.objects.get(pk=3)
+        review_request.status = ReviewRequest.DISCARDED
+        review_request.save()
+
+        call_command('index', processes=1)
+
+        self.assertEqual(sorted(self.index.reader().doc_ids()),
+                         [2, 4, 6, 7, 8, 9])
+
+    def test_index_command_resume(self):
+        """Testing resuming a full rebuild with the index management command"""
+        os.makedirs(self.index.path)
+        rebuild_index = SearchIndex(self.index.path, SCHEMA,
+                                    REBUILD_MANIFEST_NAME)
+
+        # Simulate a rebuild that was interrupted after review request #4.
+        writer = rebuild_index.writer(clear=True)
+        writer.state.update({
+            'last_id': 4,
+            'last_updated': ReviewRequest.objects.latest(
+                'last_updated').last_updated.isoformat(),
+        })
+        writer.commit()
+
+        call_command('index', incremental=False, processes=1)
+
+        self.assertEqual(sorted(self.index.reader().doc_ids()),
+                         [6, 7, 8, 9])
+        self.assertFalse(rebuild_index.exists())
+
+    def test_search_view(self):
+        """Testing the search view"""
+        writer = self.index.writer()
+        writer.add_document(2, {'summary': u'cleaned_data changes'})
+        writer.add_document(4, {'summary': u'improvements',
+                                'description': u'cleaned_data'})
+        writer.commit()
+
+        response = self.client.get('/r/search/', {'q': 'cleaned_data'})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual([r.pk for r in response.context['object_list']],
+                         [2, 4])
+
+
+class TypeaheadTests(TestCase):
+    """Unit tests for the autocomplete index."""
+    fixtures = ['test_users', 'test_reviewrequests', 'test_scmtools',
+                'test_site']
+
+    def setUp(self):
+        initialize()
+
+        siteconfig = SiteConfiguration.objects.get_current()
+        siteconfig.set('mail_send_review_mail', False)
+        siteconfig.save()
+
+        call_command('indextypeahead', stdout=StringIO())
+
+    def _search(self, prefix, **kwargs):
+        users, groups, review_requests = typeahead.search(prefix, **kwargs)
+
+        return ([user.username for user in users],
+                [group.name for group in groups],
+                [review_request.pk for review_request in review_requests])
+
+    def test_search(self):
+        """Testing looking up prefixes in the autocomplete index"""
+        users, groups, review_requests = self._search(u'DO')
+        self.assertEqual(users, ['doc', 'dopey'])
+        self.assertEqual(groups, [])
+        self.assertEqual(
+            sorted(review_requests),
+            sorted(ReviewRequest.objects.filter(
+                local_site=None, summary__istartswith=u'do')
+                .values_list('pk', flat=True)))
+
+        self.assertEqual(self._search(u'devgroup')[1], ['devgroup'])
+        self.assertEqual(self._search(u'3')[2], [3])
+        self.assertEqual(self._search(u'nonexistent'), ([], [], []))
+
+    def test_search_words(self):
+        """Testing looking up prefixes of words in the autocomplete index"""
+        review_request = ReviewRequest.objects.get(pk=3)
+        review_request.summary = u'Fix the frobnicator'
+        review_request.save()
+
+        self.assertEqual(self._search(u'frob')[2], [3])
+        self.assertEqual(self._search(u'the frob')[2], [3])
+        self.assertEqual(self._search(u'nicator')[2], [])
+
+    def test_search_max_results(self):
+        """Testing limiting the results from the autocomplete index"""
+        self.assertEqual(len(self._search(u'', max_results=2)[0]), 2)
+        self.assertEqual(self._search(u'd', max_results=1)[0], ['doc'])
+
+    def test_search_max_batches(self):
+        """Testing limiting the batches read from the autocomplete index"""
+        for i in xrange(typeahead.MAX_BATCHES * 4):
+            User.objects.create(username='inactive%02d' % i,
+                                is_active=False)
+
+        # Each batch is one query for the IDs and one for the objects.
+        with self.assertNumQueries(2 * typeahead.MAX_BATCHES):
+            users = typeahead._get_matches(
+                User.objects.filter(is_active=True),
+                TypeaheadEntry.objects.USER, u'inactive', None, 2)
+
+        self.assertEqual(users, [])
+
+    def test_search_local_site(self):
+        """Testing the autocomplete index with local sites"""
+        local_site = LocalSite.objects.get(name='local-site-1')
+        group = Group.objects.create(name='localgroup', local_site=local_site)
+
+        self.assertEqual(self._search(u'localgroup')[1], [])
+        self.assertEqual(
+            self._search(u'localgroup', local_site=local_site)[1],
+            ['localgroup'])
+
+        group.delete()
+        self.assertFalse(TypeaheadEntry.objects.filter(
+            kind=TypeaheadEntry.objects.GROUP, object_id=group.pk).exists())
+
+    def test_sync(self):
+        """Testing keeping the autocomplete index up to date"""
+        user = User.objects.create(username='zed', first_name='Zachary')
+        self.assertEqual(self._search(u'zach')[0], ['zed'])
+
+        user.first_name = 'Zebulon'
+        user.save()
+        self.assertEqual(self._search(u'zach')[0], [])
+        self.assertEqual(self._search(u'zebulon')[0], ['zed'])
+
+        user.delete()
+        self.assertEqual(self._search(u'zed')[0], [])
+
+    def test_init_on_syncdb(self):
+        """Testing building the autocomplete index when it's created"""
+        from reviewboard.search.management import init_typeahead
+        from reviewboard.search import models as search_models
+
+        TypeaheadEntry.objects.all().delete()
+        self.assertEqual(self._search(u'do')[0], [])
+
+        init_typeahead(search_models, [TypeaheadEntry], 0)
+        self.assertEqual(self._search(u'do')[0], ['doc', 'dopey'])
+
+    def test_search_resource(self):
+        """Testing the GET search/ API"""
+        self.client.login(username='doc', password='doc')
+        response = self.client.get('/api/search/', {
+            'q': 'do',
+            'max-results': 1,
+        })
+        self.assertEqual(response.status_code, 200)
+
+        rsp = simplejson.loads(response.content)
+        self.assertEqual(rsp['stat'], 'ok')
+        self.assertEqual([user['username'] for user in rsp['search']['users']],
+                         ['doc'])
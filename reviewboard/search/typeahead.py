@@ -0,0 +1,114 @@
+"""Keeps the autocomplete index up to date."""
+from django.contrib.auth.models import User
+from django.db.models.signals import post_delete, post_save
+
+from reviewboard.reviews.models import Group, ReviewRequest
+from reviewboard.search.models import TypeaheadEntry
+
+
+KINDS = [
+    (User, TypeaheadEntry.objects.USER),
+    (Group, TypeaheadEntry.objects.GROUP),
+    (ReviewRequest, TypeaheadEntry.objects.REVIEW_REQUEST),
+]
+
+# The most batches of object IDs read from the index for one lookup.
+MAX_BATCHES = 5
+
+
+def search(prefix, local_site=None, max_results=25):
+    """Returns the users, groups and review requests matching a prefix.
+
+    This returns a tuple of lists of users, groups and review requests,
+    each containing at most ``max_results`` objects. Matches are ordered by
+    the word that matched. If ``prefix`` is empty, the first objects of
+    each type are returned.
+    """
+    if local_site:
+        users = local_site.users.filter(is_active=True)
+    else:
+        users = User.objects.filter(is_active=True)
+
+    querysets = [
+        (users.order_by('username'), TypeaheadEntry.objects.USER),
+        (Group.objects.filter(local_site=local_site).order_by('name'),
+         TypeaheadEntry.objects.GROUP),
+        (ReviewRequest.objects.filter(local_site=local_site).order_by('-pk'),
+         TypeaheadEntry.objects.REVIEW_REQUEST),
+    ]
+
+    if not prefix:
+        return tuple(list(queryset[:max_results])
+                     for queryset, kind in querysets)
+
+    return tuple(_get_matches(queryset, kind, prefix, local_site, max_results)
+                 for queryset, kind in querysets)
+
+
+def rebuild():
+    """Rebuilds the autocomplete index from scratch.
+
+    This returns the number of objects indexed.
+    """
+    return sum(TypeaheadEntry.objects.rebuild(kind, model.objects.all())
+               for model, kind in KINDS)
+
+
+def _get_matches(queryset, kind, prefix, local_site, max_results):
+    """Returns the objects in a queryset that match a prefix.
+
+    Object IDs are read from the index in order, a few more at a time than
+    are needed, since some may be filtered out by the queryset. This stops
+    as soon as there are enough results, so the cost doesn't depend on how
+    many objects match.
+
+    At most ``MAX_BATCHES`` batches are read. If most of the matches are
+    filtered out (for instance, inactive users or users on other local
+    sites), fewer than ``max_results`` objects may be returned, rather than
+    paging through every match.
+    """
+    object_ids = TypeaheadEntry.objects.get_object_ids(kind, prefix,
+                                                       local_site)
+    batch_size = max_results * 2
+    results = []
+    seen = set()
+    offset = 0
+
+    for i in xrange(MAX_BATCHES):
+        if len(results) >= max_results:
+            break
+
+        ids = list(object_ids[offset:offset + batch_size])
+
+        if not ids:
+            break
+
+        offset += len(ids)
+        objs = queryset.in_bulk(set(ids) - seen)
+
+        for object_id in ids:
+            if object_id in objs and object_id not in seen:
+                results.append(objs[object_id])
+
+            seen.add(object_id)
+
+    return results[:max_results]
+
+
+def _make_handlers(kind):
+    def on_saved(sender, instance, **kwargs):
+        TypeaheadEntry.objects.update_object(kind, instance)
+
+    def on_deleted(sender, instance, **kwargs):
+        TypeaheadEntry.objects.remove_object(kind, instance)
+
+    return on_saved, on_deleted
+
+
+def connect_signals():
+    for model, kind in KINDS:
+        on_saved, on_deleted = _make_handlers(kind)
+        post_save.connect(on_saved, sender=model, weak=False,
+                          dispatch_uid='typeahead-save-%s' % kind)
+        post_delete.connect(on_deleted, sender=model, weak=False,
+                            dispatch_uid='typeahead-delete-%s' % kind)
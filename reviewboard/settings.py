@@ -60,10 +60,11 @@ MIDDLEWARE_CLASSES = [
     # Keep these first, in order
     'django.middleware.gzip.GZipMiddleware',
     'reviewboard.admin.middleware.InitReviewBoardMiddleware',
+    'reviewboard.admin.middleware.InstrumentationMiddleware',
 
     'django.middleware.common.CommonMiddleware',
     'django.middleware.doc.XViewMiddleware',
-    'django.middleware.http.ConditionalGetMiddleware',
+    'reviewboard.admin.middleware.ConditionalGetMiddleware',
     'django.middleware.locale.LocaleMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.contrib.auth.middleware.AuthenticationMiddleware',
@@ -79,6 +80,7 @@ MIDDLEWARE_CLASSES = [
     'reviewboard.admin.middleware.CheckUpdatesRequiredMiddleware',
     'reviewboard.admin.middleware.X509AuthMiddleware',
     'reviewboard.site.middleware.LocalSiteMiddleware',
+    'reviewboard.hostingsvcs.middleware.HostingServiceMiddleware',
 ]
 RB_EXTRA_MIDDLEWARE_CLASSES = []
 
@@ -154,6 +156,7 @@ RB_BUILTIN_APPS = [
     'reviewboard.reviews',
     'reviewboard.reviews.ui',
     'reviewboard.scmtools',
+    'reviewboard.search',
     'reviewboard.site',
     'reviewboard.ssh',
     'reviewboard.webapi',
@@ -183,6 +186,30 @@ AUTH_PROFILE_MODULE = "accounts.Profile"
 # CACHE_BACKEND is specified in settings_local.py
 CACHE_EXPIRATION_TIME = 60 * 60 * 24 * 30 # 1 month
 
+# Whether changes to the incoming review request counters should be queued
+# in the database instead of applied right away. Publishing review requests
+# targeting very large groups is much faster with this on, but the counters
+# will only be updated when the processcounterupdates management command runs.
+DEFER_COUNTER_UPDATES = False
+
+# Whether e-mail notifications should be queued in the database instead of
+# sent while publishing. Publishing no longer waits on the mail server with
+# this on, but e-mails will only be sent when the sendqueuedmail management
+# command runs.
+DEFER_EMAIL_SENDING = False
+
+# The number of seconds that e-mail about a review request is held for users
+# who've chosen to receive digests, before being sent as a single e-mail.
+# Digests are sent by the senddigests management command. If this is None,
+# digests are turned off, and everyone receives e-mail right away.
+EMAIL_DIGEST_WINDOW = None
+
+# Whether the SQL of each query run while handling a request should be kept
+# in the per-view stats, rather than just counting the queries. This makes
+# every query slower, so it should only be turned on while investigating a
+# problem.
+INSTRUMENTATION_CAPTURE_QUERIES = False
+
 # Custom test runner, which uses nose to find tests and execute them.  This
 # gives us a somewhat more comprehensive test execution than django's built-in
 # runner, as well as some special features like a code coverage report.
@@ -0,0 +1,494 @@
+"""Sharing SSH connections between rbssh processes.
+
+Every rbssh process normally makes its own SSH connection, which means a
+new TCP connection, key exchange and authentication for every fetch. A
+control master is a long-running process that keeps authenticated
+connections open, one for each local site, host, port and user, and closes
+them once they've been idle for a while.
+
+rbssh talks to the control master over a Unix socket. It sends a request
+for a command or subsystem, and the control master opens a new channel on
+the shared connection and relays the channel's input and output over the
+socket.
+
+Everything sent over the socket is a frame, made up of a one-character
+type, a 4-byte length and then the data.
+"""
+import logging
+import os
+import select
+import socket
+import struct
+import threading
+import time
+
+from django.utils import simplejson
+import paramiko
+
+from reviewboard.ssh.client import SSHClient
+from reviewboard.ssh.errors import SSHError
+from reviewboard.ssh.storage import FileSSHStorage
+
+
+FRAME_HEADER = struct.Struct('>cI')
+EXIT_STATUS = struct.Struct('>i')
+
+FRAME_REQUEST = 'q'
+FRAME_RESPONSE = 'r'
+FRAME_STDIN = 'i'
+FRAME_STDIN_EOF = 'I'
+FRAME_STDOUT = 'o'
+FRAME_STDERR = 'e'
+FRAME_EXIT_STATUS = 'x'
+
+CONTROL_FILENAME = 'rbssh-control'
+
+BUFFER_SIZE = 32768
+
+
+class ControlMasterError(SSHError):
+    """An error communicating with a control master."""
+    pass
+
+
+def is_supported():
+    """Returns whether control masters can be used on this platform."""
+    return hasattr(socket, 'AF_UNIX')
+
+
+def get_control_path():
+    """Returns the path to the control master's socket.
+
+    This can be set with the ``RBSSH_CONTROL_PATH`` environment variable.
+    Otherwise, it's in the SSH directory of the site.
+    """
+    return (os.getenv('RBSSH_CONTROL_PATH') or
+            os.path.join(FileSSHStorage().get_ssh_dir(), CONTROL_FILENAME))
+
+
+def send_frame(sock, frame_type, data=''):
+    """Sends a frame over a socket."""
+    sock.sendall(FRAME_HEADER.pack(frame_type, len(data)) + data)
+
+
+def recv_frame(sock):
+    """Receives a frame from a socket.
+
+    This returns a tuple of the frame type and data. If the socket was
+    closed, the frame type will be None.
+    """
+    header = _recv_exactly(sock, FRAME_HEADER.size)
+
+    if header is None:
+        return None, None
+
+    frame_type, length = FRAME_HEADER.unpack(header)
+    data = _recv_exactly(sock, length)
+
+    if data is None:
+        return None, None
+
+    return frame_type, data
+
+
+def _recv_exactly(sock, length):
+    chunks = []
+
+    while length > 0:
+        chunk = sock.recv(length)
+
+        if not chunk:
+            return None
+
+        chunks.append(chunk)
+        length -= len(chunk)
+
+    return ''.join(chunks)
+
+
+class SharedConnection(object):
+    """An SSH connection shared by any number of channels."""
+    def __init__(self, namespace, hostname, port, username):
+        self.namespace = namespace
+        self.hostname = hostname
+        self.port = port
+        self.username = username
+        self.client = None
+        self.num_channels = 0
+        self.last_used = time.time()
+        self.lock = threading.Lock()
+
+    def is_active(self):
+        """Returns whether the connection is open."""
+        if self.client is None:
+            return False
+
+        transport = self.client.get_transport()
+
+        return transport is not None and transport.is_active()
+
+    def connect(self, allow_agent=True):
+        """Connects and authenticates to the server.
+
+        This uses the SSH keys stored for the local site. Password
+        authentication isn't possible, since there's nobody to ask.
+        """
+        self.close()
+
+        client = SSHClient(namespace=self.namespace)
+        client.set_missing_host_key_policy(paramiko.WarningPolicy())
+        client.connect(self.hostname, port=self.port,
+                       username=self.username, pkey=client.get_user_key(),
+                       allow_agent=allow_agent)
+        self.client = client
+
+    def open_channel(self):
+        """Opens a new channel on the connection."""
+        return self.client.get_transport().open_session()
+
+    def close(self):
+        """Closes the connection."""
+        if self.client is not None:
+            self.client.close()
+            self.client = None
+
+
+class ControlMaster(object):
+    """Shares SSH connections between rbssh processes.
+
+    Connections are made when they're first needed, and are closed once
+    they have had no open channels for ``idle_timeout`` seconds.
+    """
+    DEFAULT_IDLE_TIMEOUT = 300
+
+    #: How often to check for idle connections, in seconds.
+    EXPIRE_INTERVAL = 5
+
+    def __init__(self, path, idle_timeout=DEFAULT_IDLE_TIMEOUT,
+                 allow_agent=True):
+        self.path = path
+        self.idle_timeout = idle_timeout
+        self.allow_agent = allow_agent
+        self.connections = {}
+        self._lock = threading.Lock()
+        self._sock = None
+        self._stopped = threading.Event()
+
+    def listen(self):
+        """Starts listening on the control socket.
+
+        This will raise ControlMasterError if another control master is
+        already listening.
+        """
+        if os.path.exists(self.path):
+            sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+
+            try:
+                sock.connect(self.path)
+            except socket.error:
+                # This was left behind by a control master that's gone.
+                os.unlink(self.path)
+            else:
+                raise ControlMasterError(
+                    'A control master is already listening on %s'
+                    % self.path)
+            finally:
+                sock.close()
+
+        self._sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+
+        # Only this user can connect to the socket.
+        old_umask = os.umask(0077)
+
+        try:
+            self._sock.bind(self.path)
+        finally:
+            os.umask(old_umask)
+
+        self._sock.listen(16)
+
+    def serve_forever(self):
+        """Handles requests until stop() is called."""
+        if self._sock is None:
+            self.listen()
+
+        try:
+            while not self._stopped.isSet():
+                rl, wl, el = select.select([self._sock], [], [],
+                                           self.EXPIRE_INTERVAL)
+
+                if rl:
+                    conn, addr = self._sock.accept()
+                    thread = threading.Thread(target=self.handle_session,
+                                              args=(conn,))
+                    thread.setDaemon(True)
+                    thread.start()
+
+                self.expire_connections()
+        finally:
+            self.close()
+
+    def stop(self):
+        """Stops serving requests."""
+        self._stopped.set()
+
+    def close(self):
+        """Stops listening and closes all connections."""
+        if self._sock is not None:
+            self._sock.close()
+            self._sock = None
+
+            try:
+                os.unlink(self.path)
+            except OSError:
+                pass
+
+        self._lock.acquire()
+
+        try:
+            for connection in self.connections.itervalues():
+                connection.close()
+
+            self.connections = {}
+        finally:
+            self._lock.release()
+
+    def expire_connections(self):
+        """Closes any connections that have been idle for too long."""
+        expire_time = time.time() - self.idle_timeout
+
+        self._lock.acquire()
+
+        try:
+            for key, connection in self.connections.items():
+                if (connection.num_channels == 0 and
+                    (connection.last_used < expire_time or
+                     not connection.is_active())):
+                    logging.debug('Closing idle connection to %s@%s'
+                                  % (connection.username,
+                                     connection.hostname))
+                    connection.close()
+                    del self.connections[key]
+        finally:
+            self._lock.release()
+
+    def open_channel(self, request):
+        """Opens a channel for a request, connecting if needed.
+
+        This returns a tuple of the SharedConnection and the new channel.
+        The caller must call release_channel() once it's done with the
+        channel.
+        """
+        key = (request.get('local_site_name'), request['hostname'],
+               request.get('port') or 22, request['username'])
+
+        self._lock.acquire()
+
+        try:
+            connection = self.connections.get(key)
+
+            if connection is None:
+                connection = SharedConnection(*key)
+                self.connections[key] = connection
+
+            # Keep the connection from being expired while connecting.
+            connection.num_channels += 1
+        finally:
+            self._lock.release()
+
+        try:
+            connection.lock.acquire()
+
+            try:
+                if not connection.is_active():
+                    connection.connect(
+                        allow_agent=(self.allow_agent and
+                                     request.get('allow_agent', True)))
+
+                channel = connection.open_channel()
+            finally:
+                connection.lock.release()
+        except:
+            self.release_channel(connection)
+            raise
+
+        return connection, channel
+
+    def release_channel(self, connection):
+        """Marks a channel on a connection as closed."""
+        self._lock.acquire()
+
+        try:
+            connection.num_channels -= 1
+            connection.last_used = time.time()
+        finally:
+            self._lock.release()
+
+    def handle_session(self, sock):
+        """Handles a request from rbssh."""
+        try:
+            frame_type, data = recv_frame(sock)
+
+            if frame_type != FRAME_REQUEST:
+                return
+
+            request = simplejson.loads(data)
+
+            try:
+                connection, channel = self.open_channel(request)
+            except paramiko.AuthenticationException, e:
+                self._send_response(sock, 'fail', unicode(e),
+                                    auth_failed=True)
+                return
+            except Exception, e:
+                self._send_response(sock, 'fail', unicode(e))
+                return
+
+            try:
+                if request.get('subsystem'):
+                    channel.invoke_subsystem(request['subsystem'])
+                else:
+                    channel.exec_command(request['command'])
+
+                self._send_response(sock, 'ok')
+                exit_status = self.relay(sock, channel)
+            finally:
+                channel.close()
+                self.release_channel(connection)
+
+            send_frame(sock, FRAME_EXIT_STATUS, EXIT_STATUS.pack(exit_status))
+        except (socket.error, paramiko.SSHException), e:
+            logging.debug('Error handling rbssh session: %s' % e)
+        finally:
+            sock.close()
+
+    def relay(self, sock, channel):
+        """Relays a channel's input and output over the socket.
+
+        This returns the exit status of the channel's command.
+        """
+        stdin_thread = threading.Thread(target=self._relay_stdin,
+                                        args=(sock, channel))
+        stdin_thread.setDaemon(True)
+        stdin_thread.start()
+
+        while True:
+            if channel.recv_stderr_ready():
+                send_frame(sock, FRAME_STDERR,
+                           channel.recv_stderr(BUFFER_SIZE))
+            elif channel.recv_ready():
+                send_frame(sock, FRAME_STDOUT, channel.recv(BUFFER_SIZE))
+            elif (channel.eof_received or channel.closed or
+                  channel.exit_status_ready()):
+                break
+            else:
+                # Not every kind of event wakes up the channel's file
+                # descriptor, so don't wait too long.
+                select.select([channel], [], [], 0.1)
+
+        # The last of the output may have arrived along with the EOF, after
+        # it was checked for above, so read anything that's left.
+        for recv, frame_type in ((channel.recv, FRAME_STDOUT),
+                                 (channel.recv_stderr, FRAME_STDERR)):
+            while True:
+                data = recv(BUFFER_SIZE)
+
+                if not data:
+                    break
+
+                send_frame(sock, frame_type, data)
+
+        return channel.recv_exit_status()
+
+    def _relay_stdin(self, sock, channel):
+        try:
+            while True:
+                frame_type, data = recv_frame(sock)
+
+                if frame_type != FRAME_STDIN:
+                    break
+
+                channel.sendall(data)
+
+            channel.shutdown_write()
+        except (socket.error, EnvironmentError, paramiko.SSHException):
+            pass
+
+    def _send_response(self, sock, stat, error=None, **kwargs):
+        response = {'stat': stat}
+        response.update(kwargs)
+
+        if error is not None:
+            response['error'] = error
+
+        send_frame(sock, FRAME_RESPONSE, simplejson.dumps(response))
+
+
+def run_command(path, request, stdin, stdout, stderr):
+    """Runs a command or subsystem through a control master.
+
+    ``request`` contains the ``hostname``, ``port``, ``username``,
+    ``local_site_name`` and ``allow_agent`` to connect with, along with
+    either a ``command`` or a ``subsystem``.
+
+    Input is read from the ``stdin`` file, and output is written to the
+    ``stdout`` and ``stderr`` files. This returns the exit status of the
+    command, or None if the control master couldn't run it, in which case
+    the caller should connect on its own.
+    """
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+
+    try:
+        sock.connect(path)
+    except socket.error:
+        sock.close()
+        return None
+
+    try:
+        send_frame(sock, FRAME_REQUEST, simplejson.dumps(request))
+        frame_type, data = recv_frame(sock)
+
+        if frame_type != FRAME_RESPONSE:
+            return None
+
+        response = simplejson.loads(data)
+
+        if response['stat'] != 'ok':
+            logging.debug('Control master could not run the command: %s'
+                          % response.get('error'))
+            return None
+
+        # From here on, the command is running, so it can't be retried
+        # without the control master.
+        stdin_fd = stdin.fileno()
+        inputs = [sock, stdin_fd]
+
+        while True:
+            rl, wl, el = select.select(inputs, [], [])
+
+            if stdin_fd in rl:
+                data = os.read(stdin_fd, BUFFER_SIZE)
+
+                if data:
+                    send_frame(sock, FRAME_STDIN, data)
+                else:
+                    send_frame(sock, FRAME_STDIN_EOF)
+                    inputs.remove(stdin_fd)
+
+            if sock in rl:
+                frame_type, data = recv_frame(sock)
+
+                if frame_type == FRAME_STDOUT:
+                    stdout.write(data)
+                    stdout.flush()
+                elif frame_type == FRAME_STDERR:
+                    stderr.write(data)
+                    stderr.flush()
+                elif frame_type == FRAME_EXIT_STATUS:
+                    return EXIT_STATUS.unpack(data)[0]
+                else:
+                    logging.error('Lost the connection to the SSH control '
+                                  'master')
+                    return 255
+    finally:
+        sock.close()
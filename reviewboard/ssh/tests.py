@@ -1,10 +1,14 @@
 import os
 import shutil
+import socket
 import tempfile
+import threading
+from StringIO import StringIO
 
 from django.test import TestCase as DjangoTestCase
 import paramiko
 
+from reviewboard.ssh import controlmaster
 from reviewboard.ssh.client import SSHClient
 from reviewboard.ssh.errors import UnsupportedSSHKeyError
 from reviewboard.ssh.storage import FileSSHStorage
@@ -239,3 +243,244 @@ class SSHClientTests(SSHTestCase):
     def test_import_user_key_with_localsite(self):
         """Testing SSHClient.import_user_key with localsite"""
         self.test_import_user_key('site-1')
+
+
+class StubSSHServer(paramiko.ServerInterface):
+    """A local SSH server that stands in for a real one in tests.
+
+    It accepts connections authenticated with a single key. Commands read
+    all their input first. Running ``cat`` then writes the input back,
+    ``fail`` writes to stderr and exits with a status of 3, and anything
+    else writes the command back.
+    """
+    def __init__(self, host_key, authorized_key):
+        self.host_key = host_key
+        self.authorized_key = authorized_key
+        self.num_connections = 0
+        self.num_auths = 0
+        self.transports = []
+
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.sock.bind(('127.0.0.1', 0))
+        self.sock.listen(5)
+        self.port = self.sock.getsockname()[1]
+
+        thread = threading.Thread(target=self._accept)
+        thread.setDaemon(True)
+        thread.start()
+
+    def close(self):
+        self.sock.close()
+
+        for transport in self.transports:
+            transport.close()
+
+    def get_allowed_auths(self, username):
+        return 'publickey'
+
+    def check_auth_publickey(self, username, key):
+        if key == self.authorized_key:
+            self.num_auths += 1
+            return paramiko.AUTH_SUCCESSFUL
+
+        return paramiko.AUTH_FAILED
+
+    def check_channel_request(self, kind, chanid):
+        if kind == 'session':
+            return paramiko.OPEN_SUCCEEDED
+
+        return paramiko.OPEN_FAILED_ADMINISTRATIVELY_PROHIBITED
+
+    def check_channel_exec_request(self, channel, command):
+        thread = threading.Thread(target=self._run_command,
+                                  args=(channel, command))
+        thread.setDaemon(True)
+        thread.start()
+
+        return True
+
+    def _accept(self):
+        while True:
+            try:
+                sock, addr = self.sock.accept()
+            except socket.error:
+                break
+
+            self.num_connections += 1
+
+            transport = paramiko.Transport(sock)
+            transport.add_server_key(self.host_key)
+            transport.start_server(server=self)
+            self.transports.append(transport)
+
+    def _run_command(self, channel, command):
+        # Every command reads all its input before writing anything, so
+        # that nothing is written before the client knows the command
+        # started.
+        input = []
+
+        while True:
+            data = channel.recv(1024)
+
+            if not data:
+                break
+
+            input.append(data)
+
+        if command == 'cat':
+            channel.sendall(''.join(input))
+            status = 0
+        elif command == 'fail':
+            channel.sendall_stderr('failed\n')
+            status = 3
+        else:
+            channel.sendall('ran %s\n' % command)
+            status = 0
+
+        channel.send_exit_status(status)
+        channel.close()
+
+
+class ControlMasterTests(SSHTestCase):
+    """Unit tests for ControlMaster."""
+    def setUp(self):
+        super(ControlMasterTests, self).setUp()
+
+        self.tempdir = tempfile.mkdtemp(prefix='rb-tests-home-')
+        self._set_home(self.tempdir)
+
+        client = SSHClient()
+        client.import_user_key(self.key1)
+
+        self.server = StubSSHServer(host_key=self.key2,
+                                    authorized_key=self.key1)
+        client.add_host_key('[127.0.0.1]:%d' % self.server.port, self.key2)
+
+        self.path = controlmaster.get_control_path()
+        self.master = controlmaster.ControlMaster(self.path,
+                                                  allow_agent=False)
+        self.master.EXPIRE_INTERVAL = 0.1
+        self.master.listen()
+
+        self.master_thread = threading.Thread(
+            target=self.master.serve_forever)
+        self.master_thread.start()
+
+    def tearDown(self):
+        self.master.stop()
+        self.master_thread.join()
+        self.server.close()
+
+        super(ControlMasterTests, self).tearDown()
+
+    def test_run_command(self):
+        """Testing ControlMaster running commands on a shared connection"""
+        self.assertEqual(self._run_command('echo 1'), (0, 'ran echo 1\n', ''))
+        self.assertEqual(self._run_command('echo 2'), (0, 'ran echo 2\n', ''))
+        self.assertEqual(self._run_command('fail'), (3, '', 'failed\n'))
+
+        self.assertEqual(self.server.num_connections, 1)
+        self.assertEqual(self.server.num_auths, 1)
+        self.assertEqual(len(self.master.connections), 1)
+
+    def test_run_command_with_stdin(self):
+        """Testing ControlMaster relaying input to commands"""
+        self.assertEqual(self._run_command('cat', 'line 1\nline 2\n'),
+                         (0, 'line 1\nline 2\n', ''))
+
+    def test_relay_output_after_eof(self):
+        """Testing ControlMaster.relay with output arriving with the EOF"""
+        class Channel(object):
+            eof_received = True
+            closed = False
+
+            def __init__(self):
+                self.stdout = ['out 1', 'out 2', '']
+                self.stderr = ['err', '']
+
+            def recv_ready(self):
+                return False
+
+            def recv_stderr_ready(self):
+                return False
+
+            def exit_status_ready(self):
+                return True
+
+            def recv(self, size):
+                return self.stdout.pop(0)
+
+            def recv_stderr(self, size):
+                return self.stderr.pop(0)
+
+            def recv_exit_status(self):
+                return 2
+
+            def shutdown_write(self):
+                pass
+
+        sock, peer = socket.socketpair()
+
+        try:
+            self.assertEqual(self.master.relay(sock, Channel()), 2)
+            self.assertEqual(controlmaster.recv_frame(peer),
+                             (controlmaster.FRAME_STDOUT, 'out 1'))
+            self.assertEqual(controlmaster.recv_frame(peer),
+                             (controlmaster.FRAME_STDOUT, 'out 2'))
+            self.assertEqual(controlmaster.recv_frame(peer),
+                             (controlmaster.FRAME_STDERR, 'err'))
+        finally:
+            sock.close()
+            peer.close()
+
+    def test_expire_connections(self):
+        """Testing ControlMaster.expire_connections"""
+        self._run_command('echo 1')
+        self.master.expire_connections()
+        self.assertEqual(len(self.master.connections), 1)
+
+        self.master.idle_timeout = -1
+        self.master.expire_connections()
+        self.assertEqual(self.master.connections, {})
+
+        # A new connection is made for the next command.
+        self.assertEqual(self._run_command('echo 2'), (0, 'ran echo 2\n', ''))
+        self.assertEqual(self.server.num_connections, 2)
+
+    def test_run_command_auth_failure(self):
+        """Testing controlmaster.run_command with authentication failures"""
+        SSHClient().import_user_key(paramiko.RSAKey.generate(1024))
+
+        self.assertEqual(self._run_command('echo 1'), None)
+        self.assertEqual(self.server.num_auths, 0)
+
+    def test_run_command_without_control_master(self):
+        """Testing controlmaster.run_command without a control master"""
+        self.master.stop()
+        self.master_thread.join()
+
+        self.assertFalse(os.path.exists(self.path))
+        self.assertEqual(self._run_command('echo 1'), None)
+
+    def _run_command(self, command, input=''):
+        stdin = tempfile.TemporaryFile()
+        stdin.write(input)
+        stdin.seek(0)
+        stdout = StringIO()
+        stderr = StringIO()
+
+        status = controlmaster.run_command(
+            self.path,
+            {
+                'hostname': '127.0.0.1',
+                'port': self.server.port,
+                'username': 'user',
+                'command': command,
+            },
+            stdin, stdout, stderr)
+        stdin.close()
+
+        if status is None:
+            return None
+
+        return status, stdout.getvalue(), stderr.getvalue()
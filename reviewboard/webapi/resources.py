@@ -15,6 +15,7 @@ from django.http import HttpResponseRedirect, HttpResponse, \
 from django.template.defaultfilters import timesince
 from django.utils.encoding import force_unicode
 from django.utils.formats import localize
+from django.utils import timezone
 from django.utils.translation import ugettext as _
 from djblets.extensions.base import RegisteredExtension
 from djblets.extensions.resources import ExtensionResource
@@ -42,17 +43,21 @@ from reviewboard.accounts.models import Profile
 from reviewboard.attachments.forms import UploadFileForm
 from reviewboard.attachments.models import FileAttachment
 from reviewboard.changedescs.models import ChangeDescription
-from reviewboard.diffviewer.diffutils import get_diff_files, \
+from reviewboard.diffviewer.diffutils import get_chunk_index, \
+                                             get_chunks_in_row_range, \
+                                             get_diff_files, \
                                              get_original_file, \
                                              get_patched_file, \
                                              populate_diff_chunks
 from reviewboard.diffviewer.forms import EmptyDiffError, DiffTooBigError
+from reviewboard.diffviewer.models import FilePathToken
 from reviewboard.extensions.base import get_extension_manager
 from reviewboard.hostingsvcs.errors import AuthorizationError
 from reviewboard.hostingsvcs.models import HostingServiceAccount
 from reviewboard.hostingsvcs.service import get_hosting_service
 from reviewboard.reviews.errors import PermissionError
 from reviewboard.reviews.forms import UploadDiffForm, UploadScreenshotForm
+from reviewboard.reviews.updates import get_update_serial, wait_for_update
 from reviewboard.reviews.models import BaseComment, Comment, DiffSet, \
                                        FileDiff, Group, Repository, \
                                        ReviewRequest, ReviewRequestDraft, \
@@ -67,6 +72,7 @@ from reviewboard.scmtools.errors import AuthenticationError, \
                                         RepositoryNotFoundError, \
                                         UnverifiedCertificateError
 from reviewboard.scmtools.models import Tool
+from reviewboard.search import typeahead
 from reviewboard.site.models import LocalSite
 from reviewboard.site.urlresolvers import local_site_reverse
 from reviewboard.ssh.client import SSHClient
@@ -1115,6 +1121,15 @@ class FileDiffResource(WebAPIResource):
         for each line will contain HTML markup showing syntax highlighting.
         Otherwise, the content will be in plain text.
 
+        Large diffs can be fetched in windows. ``?start-chunk=`` and
+        ``?max-chunks=`` limit the result to a range of chunks (0-based),
+        and ``?first-line=`` and ``?num-lines=`` limit the result to a range
+        of rows in the side-by-side diff (1-based). Chunks that only partly
+        fall within the requested rows are trimmed to those rows. Only the
+        requested window is generated, but ``num_chunks`` and
+        ``changed_chunk_indexes`` always describe the entire file, in order
+        to allow for navigation.
+
         The format of the diff data is a bit complex. The data is stored
         under a top-level ``diff_data`` element and contains the following
         information:
@@ -1146,6 +1161,10 @@ class FileDiffResource(WebAPIResource):
              - Whether or not this is a newly added file, rather than an
                existing file in the repository.
 
+           * - **num_chunks**
+             - Integer
+             - The total number of chunks in the diff.
+
            * - **num_changes**
              - Integer
              - The number of changes made in this file (chunks of adds,
@@ -1277,8 +1296,28 @@ class FileDiffResource(WebAPIResource):
 
         highlighting = request.GET.get('syntax-highlighting', False)
 
+        window_args = {}
+        invalid_fields = {}
+
+        for field in ('start-chunk', 'max-chunks', 'first-line', 'num-lines'):
+            if field in request.GET:
+                try:
+                    value = int(request.GET[field])
+
+                    if value < 0:
+                        raise ValueError
+                except ValueError:
+                    invalid_fields[field] = \
+                        ['This must be a non-negative integer']
+                else:
+                    window_args[field] = value
+
+        if invalid_fields:
+            return INVALID_FORM_DATA, {
+                'fields': invalid_fields,
+            }
+
         files = get_diff_files(filediff.diffset, filediff)
-        populate_diff_chunks(files, highlighting)
 
         if not files:
             # This may not be the right error here.
@@ -1287,14 +1326,41 @@ class FileDiffResource(WebAPIResource):
         assert len(files) == 1
         f = files[0]
 
-        payload = {
-            'diff_data': {
-                'binary': f['binary'],
+        if window_args:
+            chunk_index = get_chunk_index(f)
+            first_row, last_row = \
+                self._get_diff_data_row_range(chunk_index, window_args)
+            chunks = get_chunks_in_row_range(f, chunk_index, first_row,
+                                             last_row, highlighting)
+            changed_chunk_indexes = [
+                entry['index']
+                for entry in chunk_index
+                if entry['change'] != 'equal'
+            ]
+
+            diff_data = {
+                'chunks': chunks,
+                'num_chunks': len(chunk_index),
+                'changed_chunk_indexes': changed_chunk_indexes,
+                'num_changes': len(changed_chunk_indexes),
+            }
+        else:
+            populate_diff_chunks(files, highlighting)
+
+            diff_data = {
                 'chunks': f['chunks'],
-                'num_changes': f['num_changes'],
+                'num_chunks': f['num_chunks'],
                 'changed_chunk_indexes': f['changed_chunk_indexes'],
-                'new_file': f['newfile'],
+                'num_changes': f['num_changes'],
             }
+
+        diff_data.update({
+            'binary': f['binary'],
+            'new_file': f['newfile'],
+        })
+
+        payload = {
+            'diff_data': diff_data,
         }
 
         # XXX: Kind of a hack.
@@ -1305,6 +1371,48 @@ class FileDiffResource(WebAPIResource):
 
         return resp
 
+    def _get_diff_data_row_range(self, chunk_index, window_args):
+        """Returns the range of rows requested for the diff data.
+
+        The range is returned as a (first, last) tuple of virtual row
+        numbers, inclusive. Chunk-based windows (``start-chunk`` and
+        ``max-chunks``) are converted to rows using the chunk index, and
+        then narrowed by any line-based window (``first-line`` and
+        ``num-lines``).
+        """
+        if chunk_index:
+            last_entry = chunk_index[-1]
+            num_rows = last_entry['first_row'] + last_entry['numlines'] - 1
+        else:
+            num_rows = 0
+
+        first_row = 1
+        last_row = num_rows
+
+        if 'start-chunk' in window_args or 'max-chunks' in window_args:
+            start_chunk = window_args.get('start-chunk', 0)
+            end_chunk = len(chunk_index)
+
+            if 'max-chunks' in window_args:
+                end_chunk = min(end_chunk,
+                                start_chunk + window_args['max-chunks'])
+
+            window = chunk_index[start_chunk:end_chunk]
+
+            if window:
+                first_row = window[0]['first_row']
+                last_row = window[-1]['first_row'] + window[-1]['numlines'] - 1
+            else:
+                return 0, -1
+
+        if 'first-line' in window_args:
+            first_row = max(first_row, window_args['first-line'])
+
+        if 'num-lines' in window_args:
+            last_row = min(last_row, first_row + window_args['num-lines'] - 1)
+
+        return first_row, last_row
+
 filediff_resource = FileDiffResource()
 
 
@@ -1580,7 +1688,7 @@ class DiffResource(WebAPIResource):
             return DOES_NOT_EXIST
 
         tool = review_request.repository.get_scmtool()
-        data = tool.get_parser('').raw_diff(diffset)
+        data = tool.get_parser('').iter_raw_diff(diffset)
 
         resp = HttpResponse(data, mimetype='text/x-patch')
 
@@ -6045,6 +6153,180 @@ class ReviewRequestLastUpdateResource(WebAPIResource):
 review_request_last_update_resource = ReviewRequestLastUpdateResource()
 
 
+class ReviewRequestUpdatesResource(WebAPIResource):
+    """Provides the public updates made to a review request since a time.
+
+    Clients that are displaying a review request can use this to fetch only
+    what's new, instead of reloading everything. The returned ``timestamp``
+    should be passed as ``since`` on the next request.
+
+    By passing ``wait``, clients can long-poll for updates. The request will
+    not return until there's something new or the wait times out.
+    """
+    name = 'updates'
+    singleton = True
+    mimetype_item_resource_name = 'review-request-updates'
+    allowed_methods = ('GET',)
+
+    #: The maximum number of seconds a client can wait for updates.
+    MAX_WAIT = 60
+
+    fields = {
+        'timestamp': {
+            'type': str,
+            'description': 'The timestamp of the most recent update returned, '
+                           'or the ``since`` timestamp if there were no '
+                           'updates. This should be passed as ``since`` when '
+                           'next checking for updates.',
+        },
+        'reviews': {
+            'type': [ReviewResource],
+            'description': 'The reviews published since the timestamp.',
+        },
+        'replies': {
+            'type': [ReviewReplyResource],
+            'description': 'The replies published since the timestamp.',
+        },
+        'changes': {
+            'type': [ChangeResource],
+            'description': 'The changes made to the review request since '
+                           'the timestamp.',
+        },
+        'issue_updates': {
+            'type': [BaseCommentResource],
+            'description': 'The comments on previously published reviews '
+                           'whose issue status has changed since the '
+                           'timestamp.',
+        },
+    }
+
+    @webapi_check_local_site
+    @webapi_check_login_required
+    @webapi_response_errors(DOES_NOT_EXIST, INVALID_FORM_DATA,
+                            NOT_LOGGED_IN, PERMISSION_DENIED)
+    @webapi_request_fields(
+        required={
+            'since': {
+                'type': str,
+                'description': 'Only updates made after this date/time will '
+                               'be returned. This should be the '
+                               '``timestamp`` from a previous response, '
+                               'or an ISO 8601 date/time.',
+            },
+        },
+        optional={
+            'wait': {
+                'type': int,
+                'description': 'The number of seconds to wait for an '
+                               'update, if there are none yet. This is '
+                               'capped at 60 seconds. The default is to '
+                               'return immediately.',
+            },
+        },
+    )
+    def get(self, request, since=None, wait=0, *args, **kwargs):
+        """Returns the public updates made since a date/time.
+
+        This returns the reviews, replies and change descriptions that were
+        published after ``since``, along with any comments whose issue
+        status changed after ``since``.
+
+        If ``wait`` is set and there are no updates yet, the request will be
+        held open until an update is published or the wait times out, in
+        which case an empty set of updates is returned.
+        """
+        try:
+            review_request = \
+                review_request_resource.get_object(request, *args, **kwargs)
+        except ObjectDoesNotExist:
+            return DOES_NOT_EXIST
+
+        if not review_request_resource.has_access_permissions(request,
+                                                              review_request):
+            return _no_access_error(request.user)
+
+        since = review_request_resource._parse_date(since)
+
+        if since is None:
+            return INVALID_FORM_DATA, {
+                'fields': {
+                    'since': ['This is not a valid date/time'],
+                },
+            }
+
+        if timezone.is_naive(since):
+            since = timezone.make_aware(since, timezone.get_current_timezone())
+
+        if wait < 0:
+            return INVALID_FORM_DATA, {
+                'fields': {
+                    'wait': ['This must be a positive number'],
+                },
+            }
+
+        wait = min(wait, self.MAX_WAIT)
+
+        # Grab the serial before querying, so that an update made while
+        # querying won't be missed.
+        serial = get_update_serial(review_request.pk)
+        updates = self._get_updates(review_request, since)
+
+        if (wait and not any(updates.itervalues()) and
+            wait_for_update(review_request.pk, serial, wait)):
+            updates = self._get_updates(review_request, since)
+
+        timestamp = since
+
+        for objs in updates.itervalues():
+            for obj in objs:
+                timestamp = max(timestamp, obj.timestamp)
+
+        updates['timestamp'] = timestamp.isoformat()
+
+        return 200, {
+            self.item_result_key: updates,
+        }
+
+    def _get_updates(self, review_request, since):
+        """Returns the public updates made to a review request."""
+        reviews = []
+        replies = []
+
+        q = review_request.reviews.filter(public=True, timestamp__gt=since)
+
+        for review in q.order_by('timestamp'):
+            if review.is_reply():
+                replies.append(review)
+            else:
+                reviews.append(review)
+
+        # Comments are updated when their issue status changes. Comments
+        # belonging to the reviews and replies above are new, rather than
+        # updated, and are left out.
+        new_review_ids = [review.pk for review in reviews + replies]
+        issue_updates = []
+
+        for model in (Comment, ScreenshotComment, FileAttachmentComment):
+            issue_updates += list(
+                model.objects.filter(review__review_request=review_request,
+                                     review__public=True,
+                                     issue_opened=True,
+                                     timestamp__gt=since)
+                             .exclude(review__in=new_review_ids))
+
+        issue_updates.sort(key=lambda comment: comment.timestamp)
+
+        return {
+            'reviews': reviews,
+            'replies': replies,
+            'changes': list(review_request.changedescs.filter(
+                public=True, timestamp__gt=since).order_by('timestamp')),
+            'issue_updates': issue_updates,
+        }
+
+review_request_updates_resource = ReviewRequestUpdatesResource()
+
+
 class ReviewRequestResource(WebAPIResource):
     """Provides information on review requests."""
     model = ReviewRequest
@@ -6134,6 +6416,7 @@ class ReviewRequestResource(WebAPIResource):
         diffset_resource,
         review_request_draft_resource,
         review_request_last_update_resource,
+        review_request_updates_resource,
         review_resource,
         screenshot_resource,
         file_attachment_resource
@@ -6204,6 +6487,14 @@ class ReviewRequestResource(WebAPIResource):
               - A comma-separated list of review group names that the review
                 requests must have in the reviewer list.
 
+          * ``touches-path``
+              - A file or directory that the review requests' diffs must
+                touch. This can be the end of a file's path, such as
+                ``main.cc`` or ``linux/main.cc``, or a directory anywhere in
+                the path, such as ``player/linux``. A trailing ``/`` only
+                matches directories. A leading ``/`` requires the path to
+                match from the top of the repository.
+
           * ``to-user-groups``
               - A comma-separated list of usernames who are in groups that the
                 review requests must have in the reviewer list.
@@ -6265,6 +6556,11 @@ class ReviewRequestResource(WebAPIResource):
             if 'changenum' in request.GET:
                 q = q & Q(changenum=int(request.GET.get('changenum')))
 
+            if 'touches-path' in request.GET:
+                q = q & Q(diffset_history__in=
+                          FilePathToken.objects.get_histories_touching(
+                              request.GET.get('touches-path')))
+
             if 'ship-it' in request.GET:
                 ship_it = request.GET.get('ship-it')
 
@@ -6734,6 +7030,9 @@ class SearchResource(WebAPIResource, DjbletsUserResource):
     name = 'search'
     singleton = True
 
+    DEFAULT_MAX_RESULTS = 25
+    MAX_RESULTS_LIMIT = 100
+
     @webapi_check_local_site
     @webapi_check_login_required
     def get(self, request, local_site_name=None, fullname=None, q=None,
@@ -6745,55 +7044,30 @@ class SearchResource(WebAPIResource, DjbletsUserResource):
         function returns users' first name, last name and username,
         groups' name and display name, and review requests' ID and
         summary.
-        """
-        search_q = request.GET.get('q', None)
-        local_site = _get_local_site(local_site_name)
-        if local_site:
-            query = local_site.users.filter(is_active=True)
-        else:
-            query = self.model.objects.filter(is_active=True)
-
-        if search_q:
-            q = (Q(username__istartswith=search_q) |
-                 Q(first_name__istartswith=search_q) |
-                 Q(last_name__istartswith=search_q))
-
-            if request.GET.get('fullname', None):
-                q = q | (Q(first_name__istartswith=search_q) |
-                         Q(last_name__istartswith=search_q))
 
-            query = query.filter(q)
-
-        search_q = request.GET.get('q', None)
-        local_site = _get_local_site(local_site_name)
-        query_groups = Group.objects.filter(local_site=local_site)
-
-        if search_q:
-            q = (Q(name__istartswith=search_q) |
-                  Q(display_name__istartswith=search_q))
-
-            if request.GET.get('displayname', None):
-                q = q | Q(display_name__istartswith=search_q)
-
-            query_groups = query_groups.filter(q)
-
-        search_q = request.GET.get('q', None)
-        query_review_requests = ReviewRequest.objects.filter(local_site=local_site)
-
-        if search_q:
-            q = (Q(id__istartswith=search_q) |
-                  Q(summary__icontains=search_q))
-
-            if request.GET.get('id', None):
-                q = q | Q(id__istartswith=search_q)
+        Users are matched by the start of their username, first name,
+        last name or full name, groups by the start of their name or
+        display name, and review requests by the start of their ID or of
+        any word in their summary. At most ``max-results`` of each are
+        returned.
+        """
+        try:
+            max_results = min(int(request.GET.get('max-results',
+                                                  self.DEFAULT_MAX_RESULTS)),
+                              self.MAX_RESULTS_LIMIT)
+        except ValueError:
+            max_results = self.DEFAULT_MAX_RESULTS
 
-            query_review_requests = query_review_requests.filter(q)
+        users, groups, review_requests = typeahead.search(
+            request.GET.get('q', None),
+            _get_local_site(local_site_name),
+            max(max_results, 0))
 
         return 200, {
             self.name: {
-                'users': query,
-                'groups': query_groups,
-                'review_requests': query_review_requests,
+                'users': users,
+                'groups': groups,
+                'review_requests': review_requests,
             },
         }
 
@@ -17,9 +17,10 @@ import paramiko
 from reviewboard import initialize
 from reviewboard.attachments.models import FileAttachment
 from reviewboard.changedescs.models import ChangeDescription
-from reviewboard.diffviewer.models import DiffSet
+from reviewboard.diffviewer.models import DiffSet, FilePathToken
 from reviewboard.notifications.tests import EmailTestHelper
-from reviewboard.reviews.models import FileAttachmentComment, Group, \
+from reviewboard.reviews.models import BaseComment, \
+                                       FileAttachmentComment, Group, \
                                        ReviewRequest, ReviewRequestDraft, \
                                        Review, Comment, Screenshot, \
                                        ScreenshotComment
@@ -2112,6 +2113,40 @@ class ReviewRequestResourceTests(BaseWebAPITestCase):
                          ReviewRequest.objects.to_group("devgroup",
                                                         None).count())
 
+    def test_get_reviewrequests_with_touches_path(self):
+        """Testing the GET review-requests/?touches-path= API"""
+        for diffset in DiffSet.objects.all():
+            FilePathToken.objects.index_diffset(diffset)
+
+        rsp = self.apiGet(self.get_list_url(), {
+            'touches-path': 'reviews/forms.py',
+            'status': 'all',
+        }, expected_mimetype=self.list_mimetype)
+        self.assertEqual(rsp['stat'], 'ok')
+
+        review_requests = ReviewRequest.objects.public(status=None).filter(
+            diffset_history__diffsets__files__source_file=
+                '/trunk/reviewboard/reviews/forms.py').distinct()
+        self.assertTrue(review_requests.count() > 0)
+        self.assertEqual(
+            sorted(r['id'] for r in rsp['review_requests']),
+            sorted(r.display_id for r in review_requests))
+
+        rsp = self.apiGet(self.get_list_url(), {
+            'touches-path': 'reviews/',
+            'status': 'all',
+        }, expected_mimetype=self.list_mimetype)
+        self.assertEqual(rsp['stat'], 'ok')
+        self.assertTrue(len(rsp['review_requests']) >=
+                        review_requests.count())
+
+        rsp = self.apiGet(self.get_list_url(), {
+            'touches-path': 'models.py/',
+            'status': 'all',
+        }, expected_mimetype=self.list_mimetype)
+        self.assertEqual(rsp['stat'], 'ok')
+        self.assertEqual(len(rsp['review_requests']), 0)
+
     def test_get_reviewrequests_with_to_users(self):
         """Testing the GET review-requests/?to-users= API"""
         rsp = self.apiGet(self.get_list_url(), {
@@ -4807,6 +4842,71 @@ class ChangeResourceTests(BaseWebAPITestCase):
             })
 
 
+class ReviewRequestUpdatesResourceTests(BaseWebAPITestCase):
+    """Testing the ReviewRequestUpdatesResource APIs."""
+    fixtures = ['test_users', 'test_scmtools', 'test_reviewrequests']
+
+    item_mimetype = _build_mimetype('review-request-updates')
+
+    def test_get_updates(self):
+        """Testing the GET review-requests/<id>/updates/ API"""
+        rsp = self.apiGet('/api/review-requests/3/updates/', {
+            'since': '2007-06-24T00:23:00+00:00',
+        }, expected_mimetype=self.item_mimetype)
+
+        self.assertEqual(rsp['stat'], 'ok')
+        updates = rsp['updates']
+        self.assertEqual([review['id'] for review in updates['reviews']],
+                         [4, 5])
+        self.assertEqual([reply['id'] for reply in updates['replies']],
+                         [6, 7])
+        self.assertEqual(updates['changes'], [])
+        self.assertEqual(updates['issue_updates'], [])
+        self.assertEqual(updates['timestamp'], '2007-06-24T00:26:03+00:00')
+
+    def test_get_updates_with_issue_status(self):
+        """Testing the GET review-requests/<id>/updates/ API with issues"""
+        comment = Comment.objects.get(pk=1)
+        comment.issue_opened = True
+        comment.issue_status = BaseComment.RESOLVED
+        comment.save()
+
+        rsp = self.apiGet('/api/review-requests/3/updates/', {
+            'since': '2007-06-24T00:26:03+00:00',
+        }, expected_mimetype=self.item_mimetype)
+
+        self.assertEqual(rsp['stat'], 'ok')
+        updates = rsp['updates']
+        self.assertEqual(updates['reviews'], [])
+        self.assertEqual(updates['replies'], [])
+        self.assertEqual(len(updates['issue_updates']), 1)
+        self.assertEqual(updates['issue_updates'][0]['id'], comment.pk)
+        self.assertEqual(updates['issue_updates'][0]['issue_status'],
+                         'resolved')
+
+    def test_get_updates_with_wait_timeout(self):
+        """Testing the GET review-requests/<id>/updates/ API with wait"""
+        rsp = self.apiGet('/api/review-requests/3/updates/', {
+            'since': '2007-06-24T00:26:03+00:00',
+            'wait': 1,
+        }, expected_mimetype=self.item_mimetype)
+
+        self.assertEqual(rsp['stat'], 'ok')
+        self.assertEqual(rsp['updates']['reviews'], [])
+        self.assertEqual(rsp['updates']['timestamp'],
+                         '2007-06-24T00:26:03+00:00')
+
+    def test_get_updates_with_invalid_since(self):
+        """Testing the GET review-requests/<id>/updates/ API with bad since"""
+        rsp = self.apiGet('/api/review-requests/3/updates/', {
+            'since': 'foo',
+        }, expected_status=400)
+
+        self.assertEqual(rsp['stat'], 'fail')
+        self.assertEqual(rsp['err']['code'], INVALID_FORM_DATA.code)
+        self.assertTrue('since' in rsp['fields'])
+
+
 class DiffResourceTests(BaseWebAPITestCase):
     """Testing the DiffResource APIs."""
     fixtures = ['test_users', 'test_scmtools']